@@ -0,0 +1,116 @@
+"""
+Бенчмарк выборки аудитории рассылки
+
+  orm list   - прежняя выборка get_all_users: список объектов User
+               целиком, из которого берется telegram_id
+  keyset     - страницы _iter_audience_pages, по которым create_broadcast_job
+               заполняет доставки: только telegram_id, по AUDIENCE_PAGE_SIZE
+               через idx_user_audience_active
+
+Для каждого размера базы меряются время прохода и пик памяти Python
+(tracemalloc); идентификаторы только считаются, не накапливаются.
+Отдельно - create_broadcast_job со списком получателей и с выборкой
+аудитории внутри транзакции.
+
+Запуск: python benchmarks/bench_audience.py
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot"))
+os.chdir(tempfile.mkdtemp(prefix="cardio_bench_"))
+
+from database import (  # noqa: E402
+    AUDIENCE_PAGE_SIZE, User, _iter_audience_pages, create_broadcast_job, engine, get_db_sync, init_db
+)
+
+SIZES = (50_000, 200_000)
+
+
+def add_users(start: int, count: int):
+    db = get_db_sync()
+    try:
+        db.bulk_insert_mappings(User, [
+            {'telegram_id': 1_000_000 + i, 'name': f"User{i}", 'email': f"u{i}@bench", 'phone': f"+{i}",
+             'registration_completed': i % 10 != 0, 'completed_diagnostic': i % 3 == 0}
+            for i in range(start, start + count)
+        ])
+        db.commit()
+    finally:
+        db.close()
+
+
+async def measure(coro_factory):
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = await coro_factory()
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak / 1024 / 1024
+
+
+def load_users() -> list:
+    """Выборка, которой раньше пользовалась рассылка"""
+    db = get_db_sync()
+    try:
+        return db.query(User).filter(User.registration_completed == True).all()  # noqa: E712
+    finally:
+        db.close()
+
+
+async def orm_list():
+    return sum(1 for user in load_users() if user.telegram_id)
+
+
+async def keyset():
+    db = get_db_sync()
+    try:
+        return sum(len(page) for page in _iter_audience_pages(db, "all", AUDIENCE_PAGE_SIZE))
+    finally:
+        db.close()
+
+
+async def main():
+    init_db()
+    with engine.connect() as connection:
+        plan = connection.exec_driver_sql(
+            "EXPLAIN QUERY PLAN SELECT telegram_id FROM users WHERE registration_completed = 1 "
+            "AND delivery_status = 'active' AND completed_diagnostic = 0 AND telegram_id > 5 "
+            "ORDER BY telegram_id LIMIT 1000"
+        ).all()
+    print("keyset page plan:", "; ".join(row[-1] for row in plan))
+    print()
+    print(f"{'users':>8} | {'mode':>9} | {'audience':>8} | {'time, s':>7} | {'peak MB':>7}")
+    print("-" * 52)
+
+    total = 0
+    for size in SIZES:
+        add_users(total, size - total)
+        total = size
+        for mode, factory in (("orm list", orm_list), ("keyset", keyset)):
+            count, elapsed, peak = await measure(factory)
+            print(f"{size:>8} | {mode:>9} | {count:>8} | {elapsed:>7.2f} | {peak:>7.1f}")
+
+    print()
+    print(f"{'create_broadcast_job':>22} | {'time, s':>7} | {'peak MB':>7}")
+    print("-" * 42)
+
+    async def from_list():
+        return await create_broadcast_job("bench", "-", [user.telegram_id for user in load_users()])
+
+    async def from_audience():
+        return await create_broadcast_job("bench", "-", target_audience="all")
+
+    for mode, factory in (("list of users", from_list), ("audience stream", from_audience)):
+        job, elapsed, peak = await measure(factory)
+        print(f"{mode:>22} | {elapsed:>7.2f} | {peak:>7.1f}   ({job['total_users']} recipients)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,93 @@
+"""
+Бенчмарк исключения недоступных получателей из рассылок
+
+Доля BLOCKED_SHARE пользователей заблокировала бота (имитация Bot API
+отвечает им 403). Подряд отправляется REMINDERS рассылок всем, как
+напоминания расписания; темп задает OutboundLimiter с лимитом RATE.
+
+  keep     - прежнее поведение: недоступные остаются в аудитории
+             (delivery_status сбрасывается перед каждой рассылкой)
+  skip     - после первой рассылки они помечаются и больше не выбираются
+
+Запуск: python benchmarks/bench_blocked.py
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(tempfile.mkdtemp(prefix="cardio_bench_"))
+
+from aiogram import Bot  # noqa: E402
+from aiogram.client.session.aiohttp import AiohttpSession  # noqa: E402
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+
+from broadcast import BroadcastEngine  # noqa: E402
+from database import User, create_broadcast_job, get_db_sync, get_delivery_stats, init_db  # noqa: E402
+from fake_telegram import FakeTelegram  # noqa: E402
+from outbound import OutboundLimiter  # noqa: E402
+
+USERS = 1000
+BLOCKED_SHARE = 0.2
+REMINDERS = 3
+RATE = 100
+NETWORK_DELAY = 0.02
+
+
+def reset_statuses():
+    db = get_db_sync()
+    try:
+        db.query(User).update({'delivery_status': 'active', 'blocked_at': None})
+        db.commit()
+    finally:
+        db.close()
+
+
+async def run(mode: str, blocked: set):
+    reset_statuses()
+    fake = FakeTelegram(network_delay=NETWORK_DELAY, blocked=blocked)
+    base = await fake.start()
+    bot = Bot("42:TEST", session=AiohttpSession(api=TelegramAPIServer.from_base(base)))
+    bot.session.middleware(OutboundLimiter(global_rate=RATE))
+    engine = BroadcastEngine(bot)
+
+    started = time.perf_counter()
+    for reminder in range(REMINDERS):
+        if mode == "keep":
+            reset_statuses()
+        job = await create_broadcast_job(f"{mode}_{reminder}", "reminder", target_audience="all")
+        await engine.run_job(job['id'])
+    elapsed = time.perf_counter() - started
+
+    await bot.session.close()
+    await fake.stop()
+    stats = await get_delivery_stats()
+    print(f"{mode:>6} | {fake.calls.get('sendmessage', 0):>5} | {fake.blocked_errors:>11} | {elapsed:>7.1f} | "
+          f"{stats['unreachable']:>11}")
+
+
+async def main():
+    init_db()
+    chat_ids = [100_000 + i for i in range(USERS)]
+    db = get_db_sync()
+    try:
+        db.bulk_insert_mappings(User, [{'telegram_id': chat_id, 'registration_completed': True}
+                                       for chat_id in chat_ids])
+        db.commit()
+    finally:
+        db.close()
+    blocked = set(chat_ids[::int(1 / BLOCKED_SHARE)])
+
+    print(f"users: {USERS}, blocked {len(blocked)}, {REMINDERS} broadcasts, limit {RATE} msg/s")
+    print(f"{'mode':>6} | {'sends':>5} | {'403 replies':>11} | {'time, s':>7} | {'unreachable':>11}")
+    print("-" * 52)
+    for mode in ("keep", "skip"):
+        await run(mode, blocked)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
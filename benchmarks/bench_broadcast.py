@@ -0,0 +1,78 @@
+"""
+Бенчмарк рассылки: последовательная отправка и BroadcastEngine
+
+Имитация Bot API отвечает с сетевой задержкой NETWORK_DELAY, выдает 429
+при превышении FLOOD_LIMIT отправок в секунду и 502 на долю ERROR_RATE
+отправок. В обоих режимах темп задает OutboundLimiter (полоса рассылок).
+
+  sequential  - прежний цикл: следующее сообщение после ответа на предыдущее,
+                ошибки не повторяются
+  engine      - BroadcastEngine: BROADCAST_CONCURRENCY отправителей, повтор
+                временных ошибок с разбросом
+
+Запуск: python benchmarks/bench_broadcast.py
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(tempfile.mkdtemp(prefix="cardio_bench_"))
+
+from aiogram import Bot  # noqa: E402
+from aiogram.client.session.aiohttp import AiohttpSession  # noqa: E402
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+
+from broadcast import BroadcastEngine  # noqa: E402
+from fake_telegram import FakeTelegram  # noqa: E402
+from outbound import OutboundLimiter, low_priority  # noqa: E402
+
+USERS = 400
+NETWORK_DELAY = 0.08
+FLOOD_LIMIT = 30
+ERROR_RATE = 0.02
+
+
+async def run(mode: str):
+    fake = FakeTelegram(network_delay=NETWORK_DELAY, flood_limit=FLOOD_LIMIT, error_rate=ERROR_RATE)
+    base = await fake.start()
+    bot = Bot("42:TEST", session=AiohttpSession(api=TelegramAPIServer.from_base(base)))
+    bot.session.middleware(OutboundLimiter())
+    chat_ids = [100_000 + i for i in range(USERS)]
+
+    started = time.perf_counter()
+    if mode == "sequential":
+        sent = errors = 0
+        with low_priority():
+            for chat_id in chat_ids:
+                try:
+                    await bot.send_message(chat_id, "broadcast")
+                    sent += 1
+                except Exception:
+                    errors += 1
+    else:
+        result = await BroadcastEngine(bot, retry_delay=0.2).send(chat_ids, "broadcast")
+        sent, errors = result['sent'], result['errors']
+    elapsed = time.perf_counter() - started
+
+    await bot.session.close()
+    await fake.stop()
+    print(f"{mode:>10} | {sent:>5} | {errors:>6} | {elapsed:>7.1f} | {sent / elapsed:>7.1f} | "
+          f"{fake.flood_errors:>5} | {fake.server_errors:>5}")
+
+
+async def main():
+    print(f"users: {USERS}, network delay {NETWORK_DELAY * 1000:.0f} ms, flood limit {FLOOD_LIMIT}/s, "
+          f"502 on {ERROR_RATE:.0%} of sends")
+    print(f"{'mode':>10} | {'sent':>5} | {'failed':>6} | {'time, s':>7} | {'msg/s':>7} | {'429':>5} | {'502':>5}")
+    print("-" * 62)
+    for mode in ("sequential", "engine"):
+        await run(mode)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
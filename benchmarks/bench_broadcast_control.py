@@ -0,0 +1,162 @@
+"""
+Бенчмарк хода, паузы и отмены рассылки
+
+Задание на USERS получателей отправляется через имитацию Bot API с
+лимитом RATE сообщений в секунду (OutboundLimiter). Ход показывается
+в сообщении админа (report_broadcast_progress) с интервалом
+BROADCAST_PROGRESS_INTERVAL; раз в секунду печатается снимок хода.
+
+  pause       - control_broadcast в этом процессе: пул останавливается
+                после сообщений, уже ушедших в сеть
+  pause (db)  - только статус в базе, как при нажатии кнопки в другом
+                процессе: отправитель останавливается после текущей пачки
+  resume      - продолжение с сохраненной позиции до отмены
+  cancel      - отмена; задание закрывается, оставшиеся не отправляются
+
+Для каждой остановки - задержка от нажатия до остановки пула и сколько
+сообщений ушло после нажатия. В конце - проверка, что никто не получил
+сообщение дважды и что отправленные и оставшиеся в очереди дают в сумме
+всех получателей.
+
+Запуск: python benchmarks/bench_broadcast_control.py
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(tempfile.mkdtemp(prefix="cardio_bench_"))
+os.environ.setdefault("BROADCAST_PROGRESS_INTERVAL", "2")
+
+from aiogram import Bot  # noqa: E402
+from aiogram.client.session.aiohttp import AiohttpSession  # noqa: E402
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+
+import admin  # noqa: E402
+from broadcast import (  # noqa: E402
+    BroadcastEngine, BroadcastProgress, active_broadcasts, control_broadcast, format_progress, resume_broadcast
+)
+from database import (  # noqa: E402
+    BroadcastDelivery, BroadcastLog, control_broadcast_job, create_broadcast_job, get_broadcast_job,
+    get_db_sync, init_db
+)
+from fake_telegram import FakeTelegram  # noqa: E402
+from outbound import OutboundLimiter  # noqa: E402
+
+USERS = 3000
+RATE = 200
+NETWORK_DELAY = 0.05
+ADMIN_CHAT = 1
+STOP_AT = {"pause": 0.2, "pause (db)": 0.45, "cancel": 0.75}  # Доля отправленного на момент нажатия
+
+
+class CountingTelegram(FakeTelegram):
+    """Имитация, запоминающая, сколько сообщений получил каждый чат"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.received = {}
+
+    def _send_message(self, params: dict) -> dict:
+        chat_id = int(params["chat_id"])
+        if chat_id != ADMIN_CHAT:
+            self.received[chat_id] = self.received.get(chat_id, 0) + 1
+        return super()._send_message(params)
+
+
+def delivery_counts(job_id: int) -> dict:
+    db = get_db_sync()
+    try:
+        rows = db.query(BroadcastDelivery.status).filter(BroadcastDelivery.job_id == job_id).all()
+    finally:
+        db.close()
+    counts = {}
+    for (status,) in rows:
+        counts[status] = counts.get(status, 0) + 1
+    return counts
+
+
+async def watch(progress: BroadcastProgress, fake: CountingTelegram, mode: str):
+    """Печатать ход раз в секунду и нажать кнопку mode, когда отправлена нужная доля"""
+    pressed = None
+    last_print = 0.0
+    while not progress.finished.is_set():
+        now = time.monotonic()
+        if now - last_print >= 1:
+            last_print = now
+            rate = progress.rate()
+            eta = f"{progress.remaining / rate:.1f} s" if rate else "-"
+            print(f"  sent {progress.sent:>5} | failed {progress.failed:>3} | remaining {progress.remaining:>5} | "
+                  f"{rate:>6.1f} msg/s | eta {eta}")
+        if pressed is None and len(fake.received) >= USERS * STOP_AT[mode]:
+            pressed = (time.monotonic(), len(fake.received))
+            if mode == "pause (db)":
+                await control_broadcast_job(progress.job_id, 'pause')
+            else:
+                await control_broadcast(progress.job_id, mode)
+        await asyncio.sleep(0.01)
+    stopped = time.monotonic()
+    return stopped - pressed[0], len(fake.received) - pressed[1]
+
+
+async def main():
+    init_db()
+    fake = CountingTelegram(network_delay=NETWORK_DELAY)
+    base = await fake.start()
+    bot = Bot("42:TEST", session=AiohttpSession(api=TelegramAPIServer.from_base(base)))
+    bot.session.middleware(OutboundLimiter(global_rate=RATE))
+
+    job = await create_broadcast_job("bench", "broadcast", [100_000 + i for i in range(USERS)])
+    report = await bot.send_message(ADMIN_CHAT, "📤 Рассылка запущена")
+    print(f"recipients: {USERS}, rate limit {RATE} msg/s, progress edits every "
+          f"{admin.BROADCAST_PROGRESS_INTERVAL:.0f} s")
+
+    stops = []
+    started = time.perf_counter()
+    for mode in ("pause", "pause (db)", "cancel"):
+        progress = BroadcastProgress(await get_broadcast_job(job['id']))
+        print(f"{mode}:")
+        if mode == "pause":
+            run = BroadcastEngine(bot).run_job(job['id'], progress)
+        else:
+            run = resume_broadcast(bot, job['id'], progress)
+        reporter = asyncio.create_task(admin.report_broadcast_progress(report, progress))
+        run = asyncio.create_task(run)
+        latency, after = await watch(progress, fake, mode)
+        result = await run
+        await reporter
+        counts = delivery_counts(job['id'])
+        stops.append((mode, latency, after, result['job']['status'], counts))
+
+    elapsed = time.perf_counter() - started
+    print()
+    print(f"{'stop':>12} | {'latency, s':>10} | {'sent after':>10} | {'status':>9} | deliveries")
+    print("-" * 78)
+    for mode, latency, after, status, counts in stops:
+        print(f"{mode:>12} | {latency:>10.3f} | {after:>10} | {status:>9} | "
+              f"{', '.join(f'{k} {v}' for k, v in sorted(counts.items()))}")
+
+    counts = stops[-1][4]
+    duplicates = sum(1 for count in fake.received.values() if count > 1)
+    db = get_db_sync()
+    try:
+        logged = db.query(BroadcastLog).filter(BroadcastLog.broadcast_type == "bench").count()
+    finally:
+        db.close()
+    print()
+    print(f"delivered {len(fake.received)}/{USERS} in {elapsed:.1f} s, sent twice {duplicates}, "
+          f"sent + pending + unknown = {sum(counts.get(k, 0) for k in ('sent', 'pending', 'unknown'))}, "
+          f"broadcast_logs rows {logged}, still active {len(active_broadcasts)}")
+    print(f"admin message edits: {fake.calls.get('editmessagetext', 0)}, last view:")
+    print(format_progress(progress))
+
+    await bot.session.close()
+    await fake.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
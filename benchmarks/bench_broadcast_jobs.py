@@ -0,0 +1,126 @@
+"""
+Бенчмарк сохраняемых заданий рассылки
+
+1. Цена учета доставок (имитация Bot API без задержки и без ограничителя,
+   чтобы мерить только базу):
+     per message  - статус каждой доставки фиксируется отдельным commit
+                    до и после отправки
+     batched      - BroadcastEngine.run_job: пачка выдается и закрывается
+                    одной транзакцией
+2. Падение посреди рассылки: run_job прерывается через CRASH_AFTER секунд
+   и запускается снова. Считается, сколько получателей получили сообщение
+   дважды (должно быть 0) и сколько остались в статусе unknown.
+
+Запуск: python benchmarks/bench_broadcast_jobs.py
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(tempfile.mkdtemp(prefix="cardio_bench_"))
+
+from aiogram import Bot  # noqa: E402
+from aiogram.client.session.aiohttp import AiohttpSession  # noqa: E402
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+
+from broadcast import BroadcastEngine  # noqa: E402
+from database import BroadcastDelivery, create_broadcast_job, get_db_sync, init_db  # noqa: E402
+from fake_telegram import FakeTelegram  # noqa: E402
+
+USERS = 5000
+CRASH_AFTER = 0.5
+
+
+class CountingTelegram(FakeTelegram):
+    """Имитация, запоминающая, сколько сообщений получил каждый чат"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.received = {}
+
+    def _send_message(self, params: dict) -> dict:
+        chat_id = int(params["chat_id"])
+        self.received[chat_id] = self.received.get(chat_id, 0) + 1
+        return super()._send_message(params)
+
+
+async def per_message(bot: Bot, job_id: int):
+    loop = asyncio.get_running_loop()
+
+    def mark(delivery_id: int, status: str):
+        db = get_db_sync()
+        try:
+            db.query(BroadcastDelivery).filter(BroadcastDelivery.id == delivery_id).update({'status': status})
+            db.commit()
+        finally:
+            db.close()
+
+    db = get_db_sync()
+    try:
+        deliveries = db.query(BroadcastDelivery.id, BroadcastDelivery.telegram_id).filter(
+            BroadcastDelivery.job_id == job_id).all()
+    finally:
+        db.close()
+
+    pending = iter(deliveries)
+
+    async def sender():
+        for delivery_id, telegram_id in pending:
+            await loop.run_in_executor(None, mark, delivery_id, 'sending')
+            await bot.send_message(telegram_id, "broadcast")
+            await loop.run_in_executor(None, mark, delivery_id, 'sent')
+
+    await asyncio.gather(*(sender() for _ in range(25)))
+
+
+async def main():
+    init_db()
+    fake = CountingTelegram()
+    base = await fake.start()
+    bot = Bot("42:TEST", session=AiohttpSession(api=TelegramAPIServer.from_base(base)))
+    engine = BroadcastEngine(bot)
+    chat_ids = [100_000 + i for i in range(USERS)]
+
+    print(f"recipients: {USERS}")
+    print(f"{'bookkeeping':>14} | {'time, s':>7} | {'msg/s':>7}")
+    print("-" * 34)
+    for mode in ("per message", "batched"):
+        job = await create_broadcast_job(mode, "broadcast", chat_ids)
+        started = time.perf_counter()
+        if mode == "per message":
+            await per_message(bot, job['id'])
+        else:
+            await engine.run_job(job['id'])
+        elapsed = time.perf_counter() - started
+        print(f"{mode:>14} | {elapsed:>7.2f} | {USERS / elapsed:>7.0f}")
+
+    fake.received.clear()
+    job = await create_broadcast_job("crash", "broadcast", chat_ids)
+    task = asyncio.create_task(engine.run_job(job['id']))
+    await asyncio.sleep(CRASH_AFTER)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    result = await engine.run_job(job['id'])
+
+    duplicates = sum(1 for count in fake.received.values() if count > 1)
+    db = get_db_sync()
+    try:
+        unknown = db.query(BroadcastDelivery).filter(BroadcastDelivery.job_id == job['id'],
+                                                     BroadcastDelivery.status == 'unknown').count()
+    finally:
+        db.close()
+    print()
+    print(f"crash after {CRASH_AFTER} s: delivered {len(fake.received)}/{USERS}, sent twice {duplicates}, "
+          f"unknown {unknown}, job sent_count {result['job']['sent_count']}")
+
+    await bot.session.close()
+    await fake.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,76 @@
+"""
+Микробенчмарк выбора обработчика callback_query
+
+Берет обработчики callback_query из handlers.router (с их реальными фильтрами,
+но пустыми телами) и сравнивает перебор фильтров штатным наблюдателем aiogram
+с выбором кандидатов по префиксному дереву (CallbackTrieObserver).
+
+Запуск: python benchmarks/bench_callback_router.py
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot"))
+os.chdir(tempfile.mkdtemp(prefix="cardio_bench_"))
+
+from aiogram import Router  # noqa: E402
+from aiogram.dispatcher.event.bases import UNHANDLED  # noqa: E402
+from aiogram.dispatcher.event.telegram import TelegramEventObserver  # noqa: E402
+from aiogram.types import CallbackQuery, User  # noqa: E402
+
+from handlers import UserStates, cardio_survey, router as handlers_router  # noqa: E402
+from routing import CallbackTrieObserver  # noqa: E402
+
+ITERATIONS = 2_000
+
+# callback_data и состояние FSM, в котором пользователь обычно нажимает кнопку
+CASES = [
+    ("continue_current", None),
+    ("location_big_city", cardio_survey.questions[2].state.state),
+    ("health_advice_doctor", cardio_survey.questions[-1].state.state),
+    ("ta:h:5:1:beef", UserStates.hads_test.state),
+    ("answer_2", UserStates.hads_test.state),
+    ("back_to_tests", UserStates.test_selection.state),
+]
+
+
+def build_observer(observer_cls):
+    """Наблюдатель с теми же фильтрами, что и в handlers.router, и пустыми обработчиками"""
+    observer = observer_cls(Router(), "callback_query")
+    for handler in handlers_router.callback_query.handlers:
+        async def noop(*args, **kwargs):
+            return None
+        observer.register(noop, *(f.magic or f.callback for f in handler.filters or []), flags=handler.flags)
+    return observer
+
+
+async def measure(observer, data: str, raw_state) -> float:
+    user = User(id=1, is_bot=False, first_name="Bench")
+    event = CallbackQuery(id="1", from_user=user, chat_instance="1", data=data)
+    # Промах по всем обработчикам мерил бы не тот путь: callback_data устарела
+    if await observer.trigger(event, raw_state=raw_state) is UNHANDLED:
+        raise RuntimeError(f"Ни один обработчик не принимает {data!r}")
+    started = time.perf_counter()
+    for _ in range(ITERATIONS):
+        await observer.trigger(event, raw_state=raw_state)
+    return (time.perf_counter() - started) / ITERATIONS * 1e6
+
+
+async def main():
+    linear = build_observer(TelegramEventObserver)
+    trie = build_observer(CallbackTrieObserver)
+    print(f"handlers: {len(linear.handlers)}")
+    print(f"{'callback_data':>20} | {'linear, us':>10} | {'trie, us':>9} | {'speedup':>7}")
+    print("-" * 56)
+    for data, raw_state in CASES:
+        linear_us = await measure(linear, data, raw_state)
+        trie_us = await measure(trie, data, raw_state)
+        print(f"{data:>20} | {linear_us:>10.2f} | {trie_us:>9.2f} | {linear_us / trie_us:>6.1f}x")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
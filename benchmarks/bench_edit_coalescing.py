@@ -0,0 +1,137 @@
+"""
+Бенчмарк правок клавиатуры мультивыбора при частых нажатиях
+
+Пользователи быстро отмечают варианты в вопросе heart_danger. Обновления
+одного пользователя обрабатываются по очереди (как в UserSerializer), каждое
+нажатие перерисовывает клавиатуру.
+
+  legacy     - прежний safe_edit_message: каждая правка ждет ответа API
+  coalescer  - EditCoalescer: обработчик не ждет правку, устаревшие
+               правки отбрасываются, неизменившиеся не отправляются
+
+Измеряется число вызовов editMessageText, задержка обработки нажатия
+(от нажатия до конца обработчика) и совпадение итоговой клавиатуры.
+
+Запуск: python benchmarks/bench_edit_coalescing.py
+"""
+
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(tempfile.mkdtemp(prefix="cardio_bench_"))
+
+from aiogram import Bot  # noqa: E402
+from aiogram.client.session.aiohttp import AiohttpSession  # noqa: E402
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+from aiogram.types import Chat, Message  # noqa: E402
+
+from fake_telegram import FakeTelegram  # noqa: E402
+from outbound import EditCoalescer  # noqa: E402
+from survey_engine import load_survey  # noqa: E402
+
+NETWORK_DELAY = 0.15        # Ответ Bot API на editMessageText (сек)
+USERS = 50
+CLICKS = 8                  # Нажатий на пользователя
+CLICK_INTERVAL = 0.05       # Пауза между нажатиями одного пользователя
+
+
+async def legacy_edit(message, text, parse_mode="HTML", reply_markup=None, max_retries=3):
+    for attempt in range(max_retries):
+        try:
+            await message.edit_text(text, parse_mode=parse_mode, reply_markup=reply_markup)
+            return True
+        except Exception as e:
+            if "message is not modified" in str(e):
+                return True
+            if attempt == max_retries - 1:
+                try:
+                    await message.answer(text, parse_mode=parse_mode, reply_markup=reply_markup)
+                    return True
+                except Exception:
+                    return False
+            await asyncio.sleep(0.5)
+    return False
+
+
+async def run(mode: str, question, clicks_by_user) -> None:
+    fake = FakeTelegram(network_delay=NETWORK_DELAY)
+    base = await fake.start()
+    bot = Bot("42:TEST", session=AiohttpSession(api=TelegramAPIServer.from_base(base)))
+    coalescer = EditCoalescer()
+
+    async def edit(message, text, reply_markup):
+        if mode == "legacy":
+            await legacy_edit(message, text, reply_markup=reply_markup)
+        else:
+            coalescer.edit(message, text, reply_markup=reply_markup)
+
+    latencies = []
+    expected = {}
+
+    async def user(user_id: int, clicks):
+        message = Message(message_id=1, date=datetime.now(), chat=Chat(id=user_id, type="private")).as_(bot)
+        lock = asyncio.Lock()
+        selected = []
+
+        async def click(option):
+            nonlocal selected
+            clicked = time.perf_counter()
+            async with lock:
+                updated, alert = question.toggle(selected, option)
+                if alert:
+                    latencies.append(time.perf_counter() - clicked)
+                    return
+                selected = updated
+                await edit(message, question.text, question.keyboard(selected))
+            latencies.append(time.perf_counter() - clicked)
+
+        tasks = []
+        for option in clicks:
+            tasks.append(asyncio.create_task(click(option)))
+            await asyncio.sleep(CLICK_INTERVAL)
+        await asyncio.gather(*tasks)
+        expected[(user_id, 1)] = json.loads(question.keyboard(selected).model_dump_json(exclude_none=True))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user(1000 + i, clicks) for i, clicks in enumerate(clicks_by_user)))
+    while coalescer.stats()['in_flight']:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+
+    await bot.session.close()
+    await fake.stop()
+
+    correct = sum(1 for key, markup in expected.items()
+                  if key in fake.edited and json.loads(fake.edited[key][1]) == markup)
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000
+    p95 = latencies[int(len(latencies) * 0.95)] * 1000
+    print(f"{mode:>10} | {fake.calls.get('editmessagetext', 0):>5} | {p50:>8.1f} | {p95:>8.1f} | "
+          f"{elapsed:>6.2f} | {correct:>3}/{len(expected)}")
+
+
+async def main():
+    survey = load_survey("survey_cardio.json")
+    question = next(q for q in survey.questions if q.key == "heart_danger")
+    rnd = random.Random(42)
+    # Нажатия повторяются: вариант отмечается и тут же снимается
+    clicks_by_user = [[rnd.choice(question.options) for _ in range(CLICKS)] for _ in range(USERS)]
+
+    print(f"users: {USERS}, clicks: {CLICKS} every {CLICK_INTERVAL * 1000:.0f} ms, "
+          f"API delay {NETWORK_DELAY * 1000:.0f} ms")
+    print(f"{'mode':>10} | {'edits':>5} | {'p50, ms':>8} | {'p95, ms':>8} | {'total':>6} | final")
+    print("-" * 60)
+    for mode in ("legacy", "coalescer"):
+        await run(mode, question, clicks_by_user)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,94 @@
+"""
+Бенчмарк записи лога активности: на пути ответа и через шину событий
+
+  inline     - прежний log_user_interaction: обработчик ждет commit
+               отдельной транзакции на каждое действие
+  event bus  - обработчик публикует UserAction, подписчик пишет
+               накопившиеся события одной транзакцией
+
+Измеряется время, которое обработчик тратит на логирование, и время до
+записи всех строк в базу (для шины - включая разбор очередей в close).
+waits - сколько раз publish ждал места в переполненной очереди.
+
+Запуск: python benchmarks/bench_event_bus.py
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot"))
+os.chdir(tempfile.mkdtemp(prefix="cardio_bench_"))
+
+from database import ActivityLog, User, get_db_sync, init_db, log_user_activity  # noqa: E402
+from events import EventBus, UserAction, write_activity_log  # noqa: E402
+
+USERS = 200
+ACTIONS = 10            # Действий на пользователя
+THINK_TIME = 0.01       # Пауза между действиями одного пользователя
+
+
+def prepare_users():
+    db = get_db_sync()
+    try:
+        db.query(ActivityLog).delete()
+        if not db.query(User).count():
+            for i in range(USERS):
+                db.add(User(telegram_id=1000 + i, name=f"User{i}", email=f"u{i}@bench", phone=f"+{i}"))
+        db.commit()
+    finally:
+        db.close()
+
+
+def count_rows() -> int:
+    db = get_db_sync()
+    try:
+        return db.query(ActivityLog).count()
+    finally:
+        db.close()
+
+
+async def run(mode: str):
+    prepare_users()
+    bus = EventBus()
+    bus.subscribe("activity_log", write_activity_log, flush_interval=0.2)
+    latencies = []
+
+    async def log(user_id: int, action: str):
+        started = time.perf_counter()
+        if mode == "inline":
+            await log_user_activity(telegram_id=user_id, action=action, details={}, step=action)
+        else:
+            await bus.publish(UserAction(user_id, action))
+        latencies.append(time.perf_counter() - started)
+
+    async def user(user_id: int):
+        for i in range(ACTIONS):
+            await log(user_id, f"action_{i}")
+            await asyncio.sleep(THINK_TIME)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user(1000 + i) for i in range(USERS)))
+    await bus.close()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000
+    p95 = latencies[int(len(latencies) * 0.95)] * 1000
+    print(f"{mode:>10} | {p50:>8.2f} | {p95:>8.2f} | {elapsed:>7.2f} | {count_rows():>6} | "
+          f"{bus.backpressure_waits:>5}")
+
+
+async def main():
+    init_db()
+    print(f"users: {USERS}, actions: {ACTIONS} per user")
+    print(f"{'mode':>10} | {'p50, ms':>8} | {'p95, ms':>8} | {'total':>7} | {'rows':>6} | {'waits':>5}")
+    print("-" * 58)
+    for mode in ("inline", "event bus"):
+        await run(mode)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
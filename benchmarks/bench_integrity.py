@@ -0,0 +1,105 @@
+"""
+Бенчмарк проверок целостности при запуске
+
+  full         - первый запуск (контрольных точек нет): полный проход
+                 fix_incomplete_records и validate_data_integrity, как раньше
+  incremental  - следующий запуск после CHANGED измененных пользователей:
+                 перепроверяются только они (integrity_changes)
+
+Отдельно - цена триггеров при записи: SAVES сохранений опроса через
+save_survey_data с триггерами и без них.
+
+Запуск: python benchmarks/bench_integrity.py
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot"))
+os.chdir(tempfile.mkdtemp(prefix="cardio_bench_"))
+
+from sqlalchemy import text  # noqa: E402
+
+import database  # noqa: E402
+from database import (  # noqa: E402
+    Survey, TestResult, User, engine, fix_incomplete_records, get_db_sync, init_db, save_survey_data,
+    validate_data_integrity
+)
+
+USERS = 100_000
+CHANGED = 100
+SAVES = 500
+
+
+def prepare_database():
+    init_db()
+    db = get_db_sync()
+    try:
+        db.bulk_insert_mappings(User, [
+            {'telegram_id': 1_000_000 + i, 'name': f"User{i}", 'email': f"u{i}@bench", 'phone': f"+{i}",
+             'registration_completed': True}
+            for i in range(USERS)
+        ])
+        db.bulk_insert_mappings(Survey, [{'telegram_id': 1_000_000 + i, 'age': 40} for i in range(0, USERS, 2)])
+        db.bulk_insert_mappings(TestResult, [{'telegram_id': 1_000_000 + i} for i in range(0, USERS, 3)])
+        db.commit()
+    finally:
+        db.close()
+
+
+def run_checks() -> float:
+    started = time.perf_counter()
+    fix_incomplete_records()
+    validate_data_integrity()
+    return time.perf_counter() - started
+
+
+def time_saves(offset: int) -> float:
+    async def saves():
+        for i in range(SAVES):
+            await save_survey_data(1_000_000 + offset + i, {'age': 50})
+
+    started = time.perf_counter()
+    asyncio.run(saves())
+    return (time.perf_counter() - started) / SAVES * 1000
+
+
+def main():
+    prepare_database()
+    database.logger.disabled = True
+
+    full = run_checks()
+    with_triggers = time_saves(0)
+    db = get_db_sync()
+    try:
+        for i in range(CHANGED):
+            user = db.query(User).filter(User.telegram_id == 1_000_000 + SAVES + i).one()
+            user.name = f"Renamed{i}"
+        db.commit()
+    finally:
+        db.close()
+    incremental = run_checks()
+
+    with engine.begin() as connection:
+        names = connection.execute(text("SELECT name FROM sqlite_master WHERE type = 'trigger'")).scalars().all()
+        for name in names:
+            connection.execute(text(f"DROP TRIGGER {name}"))
+    without_triggers = time_saves(SAVES + CHANGED)
+
+    print(f"users: {USERS}, changed since last check: {SAVES + CHANGED}")
+    print(f"{'startup checks':>24} | {'seconds':>8}")
+    print("-" * 36)
+    print(f"{'full':>24} | {full:>8.3f}")
+    print(f"{'incremental':>24} | {incremental:>8.3f}")
+    print()
+    print(f"{'save_survey_data':>24} | {'ms/save':>8}")
+    print("-" * 36)
+    print(f"{'without triggers':>24} | {without_triggers:>8.2f}")
+    print(f"{'with triggers':>24} | {with_triggers:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
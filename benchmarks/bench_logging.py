@@ -0,0 +1,116 @@
+"""
+Бенчмарк стоимости вызова логгера в потоке цикла событий
+
+  file handler  - прежняя настройка: FileHandler + StreamHandler, запись
+                  и flush прямо в вызове logger.info
+  queue         - logs.setup_logging: вызов только кладет запись в очередь,
+                  JSON-формат и ротация - в потоке QueueListener
+
+Замеряется время каждого вызова logger.info (p50, p99, максимум, число
+вызовов дольше 1 мс) и общее
+время с учетом дописывания очереди. Консоль в обоих режимах пишет в пустой
+поток, чтобы мерить только файл. Строки "stalls" имитируют медленный диск:
+каждая STALL_EVERY-я запись в файл задерживается на STALL_TIME.
+
+Запуск: python benchmarks/bench_logging.py
+"""
+
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot"))
+os.chdir(tempfile.mkdtemp(prefix="cardio_bench_"))
+
+import logs  # noqa: E402
+
+RECORDS = 10_000
+INTERVAL = 0.0005           # Пауза между записями: 2000 записей/с, как при пиковой нагрузке
+STALL_EVERY = 1000
+STALL_TIME = 0.02
+
+
+class NullStream:
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+
+def add_stalls(handler: logging.Handler):
+    emit = handler.emit
+    counter = [0]
+
+    def slow_emit(record):
+        counter[0] += 1
+        if counter[0] % STALL_EVERY == 0:
+            time.sleep(STALL_TIME)
+        emit(record)
+
+    handler.emit = slow_emit
+
+
+def reset_root():
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+
+
+def run(name: str, finish=None) -> str:
+    logger = logging.getLogger("database")
+    durations = []
+    started = time.perf_counter()
+    for i in range(RECORDS):
+        call_started = time.perf_counter()
+        logger.info(f"Пользователь {1_000_000 + i} сохранен (ID в БД: {i})")
+        durations.append(time.perf_counter() - call_started)
+        time.sleep(INTERVAL)
+    if finish:
+        finish()
+    elapsed = time.perf_counter() - started
+
+    durations.sort()
+    slow = sum(1 for duration in durations if duration > 0.001)
+    return (f"{name:>22} | {durations[len(durations) // 2] * 1e6:>8.1f} | "
+            f"{durations[int(len(durations) * 0.99)] * 1e6:>8.1f} | {durations[-1] * 1e3:>7.2f} | "
+            f"{slow:>6} | {elapsed:>6.2f}")
+
+
+def main():
+    rows = []
+    for stalls in (False, True):
+        suffix = " + stalls" if stalls else ""
+
+        reset_root()
+        file_handler = logging.FileHandler('legacy.log', encoding='utf-8')
+        file_handler.setFormatter(logging.Formatter(logs.TEXT_FORMAT))
+        console_handler = logging.StreamHandler(NullStream())
+        console_handler.setFormatter(logging.Formatter(logs.TEXT_FORMAT))
+        if stalls:
+            add_stalls(file_handler)
+        logging.basicConfig(level=logging.INFO, handlers=[file_handler, console_handler])
+        rows.append(run("file handler" + suffix))
+
+        reset_root()
+        stdout, sys.stdout = sys.stdout, NullStream()
+        try:
+            listener = logs.setup_logging(log_file='queue.log')
+        finally:
+            sys.stdout = stdout
+        if stalls:
+            add_stalls(listener.handlers[0])
+        rows.append(run("queue" + suffix, finish=logs.stop_logging))
+
+    print(f"records: {RECORDS}, {1 / INTERVAL:.0f}/s")
+    print(f"{'mode':>22} | {'p50, us':>8} | {'p99, us':>8} | {'max, ms':>7} | {'> 1 ms':>6} | {'total':>6}")
+    print("-" * 74)
+    for row in rows:
+        print(row)
+
+
+if __name__ == "__main__":
+    main()
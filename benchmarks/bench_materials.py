@@ -0,0 +1,105 @@
+"""
+Бенчмарк отправки материалов завершившим диагностику
+
+Сравнивает прежнюю отправку (каждый файл заново через FSInputFile с паузой
+в 1 секунду) и MaterialsCache (одна медиагруппа, file_id из кэша) на
+имитации Bot API с ограниченной скоростью загрузки. Третий прогон создает
+новый MaterialsCache, имитируя перезапуск бота: file_id берутся из базы.
+
+Запуск: python benchmarks/bench_materials.py
+"""
+
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+MATERIALS_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "materials")
+os.chdir(tempfile.mkdtemp(prefix="cardio_bench_"))
+
+from aiogram import Bot  # noqa: E402
+from aiogram.client.session.aiohttp import AiohttpSession  # noqa: E402
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+from aiogram.types import Chat, FSInputFile, Message  # noqa: E402
+
+from database import init_db  # noqa: E402
+from fake_telegram import FakeTelegram  # noqa: E402
+from media import MaterialsCache, material_caption  # noqa: E402
+
+NETWORK_DELAY = 0.02        # Задержка ответа Bot API (сек)
+UPLOAD_SPEED = 2_000_000    # Скорость загрузки файлов (байт/сек)
+LEGACY_PAUSE = 1.0          # Пауза между файлами в прежней реализации
+USERS = 100
+
+
+def prepare_materials() -> str:
+    directory = os.path.abspath("materials")
+    os.makedirs(directory, exist_ok=True)
+    for filename in os.listdir(MATERIALS_SOURCE):
+        shutil.copy(os.path.join(MATERIALS_SOURCE, filename), directory)
+    for filename in ("analyses.pdf", "checklist.pdf"):
+        with open(os.path.join(directory, filename), "wb") as f:
+            f.write(os.urandom(300_000))
+    return directory
+
+
+def make_message(bot: Bot, user_id: int) -> Message:
+    chat = Chat(id=user_id, type="private")
+    return Message(message_id=1, date=datetime.now(), chat=chat).as_(bot)
+
+
+async def legacy_send(message: Message, directory: str):
+    for filename in os.listdir(directory):
+        path = os.path.join(directory, filename)
+        await message.answer_document(FSInputFile(path), caption=material_caption(filename))
+        await asyncio.sleep(LEGACY_PAUSE)
+
+
+async def run(name: str, send) -> None:
+    fake = FakeTelegram(network_delay=NETWORK_DELAY, upload_speed=UPLOAD_SPEED)
+    base = await fake.start()
+    bot = Bot("42:TEST", session=AiohttpSession(api=TelegramAPIServer.from_base(base)))
+
+    durations = []
+
+    async def deliver(user_id: int):
+        started = time.perf_counter()
+        await send(make_message(bot, user_id))
+        durations.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(deliver(1000 + i) for i in range(USERS)))
+    elapsed = time.perf_counter() - started
+
+    await bot.session.close()
+    await fake.stop()
+
+    durations.sort()
+    calls = sum(count for method, count in fake.calls.items() if method.startswith("send"))
+    print(f"{name:>16} | {calls:>9} | {fake.uploaded_files:>8} | {fake.uploaded_bytes / 1e6:>8.1f} | "
+          f"{durations[len(durations) // 2]:>7.2f} | {elapsed:>6.2f}")
+
+
+async def main():
+    init_db()
+    directory = prepare_materials()
+    print(f"users: {USERS}, files: {len(os.listdir(directory))}, upload {UPLOAD_SPEED / 1e6:.0f} MB/s")
+    print(f"{'mode':>16} | {'api calls':>9} | {'uploads':>8} | {'MB sent':>8} | {'p50, s':>7} | {'total':>6}")
+    print("-" * 70)
+
+    await run("legacy", lambda message: legacy_send(message, directory))
+
+    cache = MaterialsCache(directory)
+    await run("file_id cache", cache.send)
+
+    # Новый процесс: file_id загружаются из таблицы media_cache
+    await run("after restart", MaterialsCache(directory).send)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
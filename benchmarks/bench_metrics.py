@@ -0,0 +1,71 @@
+"""
+Бенчмарк накладных расходов HandlerMetrics
+
+Один и тот же пустой обработчик вызывается напрямую и через middleware
+метрик (с замером вызова Bot API и задачи в пуле потоков в отдельных
+строках). Разница - стоимость метрик на один апдейт.
+
+Запуск: python benchmarks/bench_metrics.py
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot"))
+os.chdir(tempfile.mkdtemp(prefix="cardio_bench_"))
+
+from metrics import ApiTimingMiddleware, HandlerMetrics  # noqa: E402
+
+ITERATIONS = 200_000
+
+
+class FakeHandlerObject:
+    def __init__(self, callback):
+        self.callback = callback
+
+
+async def handle_update(event, data):
+    return None
+
+
+async def make_request(bot, method):
+    return None
+
+
+async def measure(call) -> float:
+    for _ in range(1000):
+        await call()
+    started = time.perf_counter()
+    for _ in range(ITERATIONS):
+        await call()
+    return (time.perf_counter() - started) / ITERATIONS * 1e6
+
+
+async def main():
+    metrics = HandlerMetrics()
+    api_timing = ApiTimingMiddleware()
+    data = {'handler': FakeHandlerObject(handle_update)}
+
+    async def handler_with_api(event, data):
+        await api_timing(make_request, None, None)
+
+    baseline = await measure(lambda: handle_update(None, data))
+    with_metrics = await measure(lambda: metrics(handle_update, None, data))
+    api_baseline = await measure(lambda: handler_with_api(None, data))
+    api_metrics = await measure(lambda: metrics(handler_with_api, None, data))
+
+    print(f"iterations: {ITERATIONS}")
+    print(f"{'case':>26} | {'us/update':>9} | {'overhead, us':>12}")
+    print("-" * 54)
+    print(f"{'handler':>26} | {baseline:>9.2f} |")
+    print(f"{'handler + metrics':>26} | {with_metrics:>9.2f} | {with_metrics - baseline:>12.2f}")
+    print(f"{'handler + API call':>26} | {api_baseline:>9.2f} |")
+    print(f"{'handler + API + metrics':>26} | {api_metrics:>9.2f} | {api_metrics - api_baseline:>12.2f}")
+    print(f"recorded: {metrics.handlers()[0].wall.count} calls")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,107 @@
+"""
+Бенчмарк исходящих сообщений: рассылка одновременно с ответами пользователям
+
+Имитация Bot API отвечает 429 при превышении 30 отправок в секунду.
+Во время рассылки пользователи получают интерактивные ответы, измеряется
+задержка ответа (без сетевой задержки), длительность рассылки и число 429.
+
+  legacy    - без ограничителя, рассылка с паузой 50 мс, как раньше
+  one lane  - OutboundLimiter, но ответы стоят в одной очереди с рассылкой
+  priority  - OutboundLimiter, ответы в приоритетной полосе
+
+Запуск: python benchmarks/bench_outbound.py
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from contextlib import nullcontext
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(tempfile.mkdtemp(prefix="cardio_bench_"))
+
+from aiogram import Bot  # noqa: E402
+from aiogram.client.session.aiohttp import AiohttpSession  # noqa: E402
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+
+from fake_telegram import FakeTelegram  # noqa: E402
+from outbound import OutboundLimiter, low_priority  # noqa: E402
+
+NETWORK_DELAY = 0.02
+FLOOD_LIMIT = 30            # Отправок в секунду до ответа 429
+BROADCAST_USERS = 300
+REPLY_INTERVAL = 0.08       # Интерактивный ответ каждые 80 мс (12.5/с)
+LEGACY_PAUSE = 0.05
+
+
+async def run(mode: str):
+    fake = FakeTelegram(network_delay=NETWORK_DELAY, flood_limit=FLOOD_LIMIT)
+    base = await fake.start()
+    bot = Bot("42:TEST", session=AiohttpSession(api=TelegramAPIServer.from_base(base)))
+    if mode != "legacy":
+        bot.session.middleware(OutboundLimiter())
+
+    errors = 0
+    latencies = []
+    done = asyncio.Event()
+
+    async def broadcast():
+        nonlocal errors
+        lane = nullcontext() if mode == "legacy" else low_priority()
+        with lane:
+            for i in range(BROADCAST_USERS):
+                try:
+                    await bot.send_message(100_000 + i, "broadcast")
+                except Exception:
+                    errors += 1
+                if mode == "legacy":
+                    await asyncio.sleep(LEGACY_PAUSE)
+        done.set()
+
+    async def reply(chat_id: int):
+        nonlocal errors
+        lane = low_priority() if mode == "one lane" else nullcontext()
+        started = time.perf_counter()
+        try:
+            with lane:
+                await bot.send_message(chat_id, "reply")
+            latencies.append(time.perf_counter() - started - NETWORK_DELAY)
+        except Exception:
+            errors += 1
+
+    started = time.perf_counter()
+    broadcast_task = asyncio.create_task(broadcast())
+    replies = []
+    i = 0
+    while not done.is_set():
+        replies.append(asyncio.create_task(reply(1000 + i % 50)))
+        i += 1
+        await asyncio.sleep(REPLY_INTERVAL)
+    await broadcast_task
+    broadcast_time = time.perf_counter() - started
+    await asyncio.gather(*replies)
+
+    await bot.session.close()
+    await fake.stop()
+
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000 if latencies else float("nan")
+    p95 = latencies[int(len(latencies) * 0.95)] * 1000 if latencies else float("nan")
+    print(f"{mode:>9} | {len(replies):>7} | {p50:>8.1f} | {p95:>8.1f} | {broadcast_time:>9.1f} | "
+          f"{fake.flood_errors:>5} | {errors:>6}")
+
+
+async def main():
+    print(f"broadcast: {BROADCAST_USERS} messages, replies every {REPLY_INTERVAL * 1000:.0f} ms, "
+          f"flood limit {FLOOD_LIMIT}/s")
+    print(f"{'mode':>9} | {'replies':>7} | {'p50, ms':>8} | {'p95, ms':>8} | {'bcast, s':>9} | {'429':>5} | {'failed':>6}")
+    print("-" * 68)
+    for mode in ("legacy", "one lane", "priority"):
+        await run(mode)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,60 @@
+"""
+Бенчмарк RateLimitMiddleware: время на обновление и память на ведра
+
+Заполняет ограничитель 100k активных пользователей и измеряет
+накладные расходы на одно обновление и объем памяти, занятой ведрами.
+
+Запуск: python benchmarks/bench_rate_limit.py
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot"))
+os.chdir(tempfile.mkdtemp(prefix="cardio_bench_"))
+
+from middlewares import RateLimitMiddleware  # noqa: E402
+
+USERS = 100_000
+UPDATES = 200_000
+
+
+async def noop_handler(event, data):
+    return None
+
+
+def make_event(user_id: int):
+    return SimpleNamespace(from_user=SimpleNamespace(id=user_id), text="ответ")
+
+
+async def main():
+    # Глобальный лимит снят, чтобы измерять только ведра пользователей
+    limiter = RateLimitMiddleware(global_rate=1e9, global_burst=1e9)
+    events = [make_event(user_id) for user_id in range(1, USERS + 1)]
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for event in events:
+        await limiter(noop_handler, event, {})
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    started = time.perf_counter()
+    for i in range(UPDATES):
+        await limiter(noop_handler, events[i % USERS], {})
+    elapsed = time.perf_counter() - started
+
+    stats = limiter.stats()
+    print(f"users tracked:      {stats['tracked_users']}")
+    print(f"bytes per user:     {(after - before) / USERS:.0f}")
+    print(f"us per update:      {elapsed / UPDATES * 1e6:.2f}")
+    print(f"passed / throttled: {stats['passed_total']} / {stats['throttled_user']}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
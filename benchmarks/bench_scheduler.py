@@ -0,0 +1,129 @@
+"""
+Бенчмарк планировщика напоминаний: точность времени отправки
+
+Время масштабировано: 1 минута расписания = 1 секунда. Напоминания идут
+каждые SPACING минут до вебинара; отправка сама по себе ничего не делает,
+записывается только момент.
+
+  polling  - прежний цикл: проверка раз в 5 минут, отправка, если до
+             назначенного времени меньше 5 минут в любую сторону
+  heap     - BroadcastScheduler: сон ровно до ближайшего напоминания
+
+Отдельно - запуск после простоя: планировщик стартует, когда часть
+напоминаний уже прошла (окно догоняния CATCH_UP минут).
+
+Запуск: python benchmarks/bench_scheduler.py
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot"))
+os.chdir(tempfile.mkdtemp(prefix="cardio_bench_"))
+
+import broadcast  # noqa: E402
+from broadcast import BroadcastScheduler  # noqa: E402
+from database import init_db, seed_broadcast_schedules  # noqa: E402
+
+SLOTS = 8
+SPACING = 4        # Минут между напоминаниями
+POLL = 5           # Прежний интервал проверки и окно, минут
+CATCH_UP = 3       # Окно догоняния после простоя, минут
+
+broadcast.BROADCAST_SCHEDULE_RELOAD = 3600
+
+
+class ScaledScheduler(BroadcastScheduler):
+    """Планировщик, у которого минута смещения длится секунду, а вебинар - в заданный момент"""
+
+    def __init__(self, webinar_date: datetime):
+        super().__init__(bot=None)
+        self.fixed_webinar_date = webinar_date
+        self.sent_at = {}
+
+    def parse_webinar_date(self, value: str) -> datetime:
+        return getattr(self, 'fixed_webinar_date', None) or super().parse_webinar_date(value)
+
+    def send_time(self, schedule: dict) -> datetime:
+        return self.webinar_date - timedelta(seconds=schedule['offset_minutes'])
+
+    async def send_broadcast_by_type(self, broadcast_type: str):
+        self.sent_at[broadcast_type] = self.get_moscow_time()
+        self.sent_keys.add(self.job_key(broadcast_type))
+
+
+async def run_polling(scheduler: ScaledScheduler, duration: float):
+    """Прежний check_and_send_broadcasts в масштабе времени"""
+    started = time.monotonic()
+    sent = set()
+    while time.monotonic() - started < duration:
+        now = scheduler.get_moscow_time()
+        for broadcast_type, schedule in scheduler.schedules.items():
+            if abs((now - scheduler.send_time(schedule)).total_seconds()) < POLL and broadcast_type not in sent:
+                await scheduler.send_broadcast_by_type(broadcast_type)
+                sent.add(broadcast_type)
+        await asyncio.sleep(POLL)
+
+
+async def run_heap(scheduler: ScaledScheduler, duration: float):
+    task = asyncio.create_task(scheduler.start_scheduler())
+    await asyncio.sleep(duration)
+    scheduler.stop_scheduler()
+    await task
+
+
+def report(mode: str, scheduler: ScaledScheduler):
+    errors = [(scheduler.sent_at[broadcast_type] - scheduler.send_time(schedule)).total_seconds() * 60
+              for broadcast_type, schedule in scheduler.schedules.items() if broadcast_type in scheduler.sent_at]
+    missed = len(scheduler.schedules) - len(errors)
+    worst = max(errors, key=abs) if errors else 0.0
+    mean = sum(abs(error) for error in errors) / len(errors) if errors else 0.0
+    print(f"{mode:>22} | {len(errors):>4} | {missed:>6} | {mean:>12.2f} | {worst:>+13.2f}")
+
+
+async def main():
+    init_db()
+    await seed_broadcast_schedules([
+        {'broadcast_type': f"slot_{i}", 'offset_minutes': (SLOTS - 1 - i) * SPACING, 'message_text': "-",
+         'catch_up_minutes': CATCH_UP}
+        for i in range(SLOTS)
+    ])
+    # Без напоминаний по умолчанию: только тестовые
+    broadcast.default_schedules = lambda: []
+    span = (SLOTS - 1) * SPACING
+
+    print(f"{SLOTS} reminders every {SPACING} min, 1 min scaled to 1 s; error in schedule seconds")
+    print(f"{'mode':>22} | {'sent':>4} | {'missed':>6} | {'mean |error|':>12} | {'worst error':>13}")
+    print("-" * 70)
+    for mode in ("polling", "heap"):
+        scheduler = ScaledScheduler(datetime.now(broadcast.pytz.timezone('Europe/Moscow'))
+                                    + timedelta(seconds=span + 1.3))
+        await scheduler.load_schedule()
+        if mode == "polling":
+            await run_polling(scheduler, span + 2 + POLL)
+        else:
+            await run_heap(scheduler, span + 2)
+        report(mode, scheduler)
+
+    # Простой: к запуску прошли четыре напоминания, последнее - SPACING / 2 минут назад
+    for mode in ("polling", "heap"):
+        scheduler = ScaledScheduler(datetime.now(broadcast.pytz.timezone('Europe/Moscow'))
+                                    + timedelta(seconds=span / 2))
+        await scheduler.load_schedule()
+        if mode == "polling":
+            await run_polling(scheduler, span / 2 + POLL)
+        else:
+            await run_heap(scheduler, span / 2 + 1)
+        report(f"{mode} after downtime", scheduler)
+        late = [broadcast_type for broadcast_type, schedule in scheduler.schedules.items()
+                if broadcast_type in scheduler.sent_at and scheduler.sent_at[broadcast_type] >
+                scheduler.send_time(schedule) + timedelta(seconds=1)]
+        print(f"{'':>22}   caught up: {', '.join(late) or '-'}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,132 @@
+"""
+Бенчмарк сегментов аудитории
+
+Для каждого выражения:
+  count        - count_audience: один COUNT по скомпилированному условию
+                 (предпросмотр в /segment)
+  python       - то же условие, посчитанное в Python по всем пользователям,
+                 опросам, тестам и действиям (проверка правильности и
+                 ориентир по времени)
+
+Отдельно - COUNT для "did ... within" без индекса
+idx_activity_telegram_id_action_timestamp.
+
+Запуск: python benchmarks/bench_segments.py
+"""
+
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot"))
+os.chdir(tempfile.mkdtemp(prefix="cardio_bench_"))
+
+from sqlalchemy import text  # noqa: E402
+
+from database import (  # noqa: E402
+    ActivityLog, Survey, TestResult, User, count_audience, engine, get_db_sync, init_db
+)
+
+USERS = 50_000
+RISKS = ("НИЗКИЙ", "УМЕРЕННЫЙ", "ВЫСОКИЙ", "ОЧЕНЬ ВЫСОКИЙ")
+NOW = datetime.now()
+
+SEGMENTS = {
+    "survey and not tests and survey_age >= 48h":
+        lambda u, s, t, a: u['survey'] and not u['tests'] and s and s['completed_at'] <= NOW - timedelta(hours=48),
+    "risk in (ВЫСОКИЙ, ОЧЕНЬ_ВЫСОКИЙ)":
+        lambda u, s, t, a: t is not None and t['risk'] in ("ВЫСОКИЙ", "ОЧЕНЬ ВЫСОКИЙ"),
+    "stop_bang >= 5":
+        lambda u, s, t, a: t is not None and t['stop_bang'] >= 5,
+    "inactive >= 7d":
+        lambda u, s, t, a: u['last_activity'] <= NOW - timedelta(days=7),
+    "did survey_started and not did survey_started within 48h and not tests":
+        lambda u, s, t, a: a and not u['tests'] and max(a) < NOW - timedelta(hours=48),
+}
+
+
+def prepare_database(rng: random.Random):
+    """Пользователи, их опросы, тесты (иногда по два - учитывается последний) и действия"""
+    init_db()
+    users, surveys, tests, actions, model = [], [], [], [], {}
+    for i in range(USERS):
+        telegram_id = 1_000_000 + i
+        user = {'telegram_id': telegram_id, 'registration_completed': True, 'survey': rng.random() < 0.7,
+                'last_activity': NOW - timedelta(hours=rng.uniform(0, 24 * 30))}
+        user['tests'] = user['survey'] and rng.random() < 0.6
+        survey = test = None
+        if user['survey']:
+            survey = {'telegram_id': telegram_id, 'age': rng.randint(25, 75),
+                      'completed_at': NOW - timedelta(hours=rng.uniform(0, 24 * 10))}
+            surveys.append(survey)
+        if user['tests']:
+            for _ in range(rng.choice((1, 1, 2))):
+                test = {'telegram_id': telegram_id, 'overall_cv_risk_level': rng.choice(RISKS),
+                        'stop_bang_score': rng.randint(0, 8), 'completed_at': NOW}
+                tests.append(test)
+        started = [NOW - timedelta(hours=rng.uniform(0, 24 * 10)) for _ in range(rng.choice((0, 0, 1, 2)))]
+        actions.extend({'telegram_id': telegram_id, 'action': "survey_started", 'timestamp': ts} for ts in started)
+        actions.extend({'telegram_id': telegram_id, 'action': "help_requested", 'timestamp': NOW}
+                       for _ in range(rng.randint(0, 6)))
+        users.append({'telegram_id': telegram_id, 'name': f"User{i}", 'registration_completed': True,
+                      'survey_completed': user['survey'], 'tests_completed': user['tests'],
+                      'last_activity': user['last_activity']})
+        model[telegram_id] = (
+            user, survey,
+            {'risk': test['overall_cv_risk_level'], 'stop_bang': test['stop_bang_score']} if test else None,
+            started
+        )
+
+    db = get_db_sync()
+    try:
+        for mapper, rows in ((User, users), (Survey, surveys), (TestResult, tests), (ActivityLog, actions)):
+            db.bulk_insert_mappings(mapper, rows)
+        db.commit()
+    finally:
+        db.close()
+    return model, len(actions)
+
+
+async def main():
+    model, activity_rows = prepare_database(random.Random(7))
+    print(f"users: {USERS}, activity rows: {activity_rows}")
+    print(f"{'segment':>72} | {'count':>6} | {'count, ms':>9} | {'python':>6} | {'python, ms':>10}")
+    print("-" * 116)
+    for expression, predicate in SEGMENTS.items():
+        started = time.perf_counter()
+        count = await count_audience(expression)
+        count_ms = (time.perf_counter() - started) * 1000
+
+        # Python-ориентир начинается с выборки всего нужного из базы, как без сегментов
+        started = time.perf_counter()
+        db = get_db_sync()
+        try:
+            for mapper in (User, Survey, TestResult, ActivityLog):
+                db.query(mapper).all()
+        finally:
+            db.close()
+        expected = sum(1 for user, survey, test, started_at in model.values()
+                       if predicate(user, survey, test, started_at))
+        python_ms = (time.perf_counter() - started) * 1000
+        print(f"{expression:>72} | {count:>6} | {count_ms:>9.1f} | {expected:>6} | {python_ms:>10.0f}")
+
+    expression = "did survey_started within 48h"
+    started = time.perf_counter()
+    with_index = await count_audience(expression)
+    with_ms = (time.perf_counter() - started) * 1000
+    with engine.begin() as connection:
+        connection.execute(text("DROP INDEX idx_activity_telegram_id_action_timestamp"))
+    started = time.perf_counter()
+    without_index = await count_audience(expression)
+    without_ms = (time.perf_counter() - started) * 1000
+    print()
+    print(f"'{expression}': {with_index} users, {with_ms:.1f} ms with action index, "
+          f"{without_index} users, {without_ms:.1f} ms without")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,103 @@
+"""
+Бенчмарк шардирования: пропускная способность обработчиков от числа воркеров
+
+Основной процесс раздает сырые обновления через ShardRouter воркерам,
+каждый воркер прогоняет их через собственный диспетчер aiogram
+с обработчиком, нагружающим процессор (имитация рендеринга и расчетов).
+
+Запуск: python benchmarks/bench_sharding.py
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(tempfile.mkdtemp(prefix="cardio_bench_"))
+
+from fake_telegram import make_message_update  # noqa: E402
+from sharding import ShardRouter, start_workers, stop_workers  # noqa: E402
+
+UPDATES = 4000
+USERS = 1000
+HANDLER_CPU_TIME = 0.002  # Процессорное время обработчика (сек)
+
+
+def burn(seconds: float):
+    deadline = time.process_time() + seconds
+    while time.process_time() < deadline:
+        pass
+
+
+def bench_worker(index: int, updates_queue, workers: int, done_queue):
+    from aiogram import Bot, Dispatcher, Router
+    from aiogram.types import Message
+
+    router = Router()
+
+    @router.message()
+    async def handle(message: Message):
+        burn(HANDLER_CPU_TIME)
+
+    dp = Dispatcher()
+    dp.include_router(router)
+    bot = Bot("42:TEST")
+
+    async def run():
+        processed = 0
+        loop = asyncio.get_event_loop()
+        while True:
+            update = await loop.run_in_executor(None, updates_queue.get)
+            if update is None:
+                break
+            await dp.feed_raw_update(bot, update)
+            processed += 1
+            if update["update_id"] < 0:
+                done_queue.put(processed)
+        await bot.session.close()
+
+    asyncio.run(run())
+
+
+async def measure(workers: int) -> float:
+    import multiprocessing
+    done_queue = multiprocessing.get_context("spawn").Queue()
+    processes, queues = start_workers(workers, bench_worker, done_queue)
+    router = ShardRouter(queues)
+
+    # Прогрев: дожидаемся запуска всех воркеров
+    for index in range(workers):
+        await router.route(make_message_update(-1, index, "warmup"))
+    for _ in range(workers):
+        done_queue.get()
+
+    started = time.perf_counter()
+    for i in range(1, UPDATES + 1):
+        await router.route(make_message_update(i, 1000 + i % USERS, "ping"))
+    # Маркер конца в каждый воркер
+    for index in range(workers):
+        await router.route(make_message_update(-2, index, "done"))
+    for _ in range(workers):
+        done_queue.get()
+    elapsed = time.perf_counter() - started
+
+    stop_workers(processes, queues)
+    return UPDATES / elapsed
+
+
+async def main():
+    print(f"cpu cores: {os.cpu_count()}, handler cpu time {HANDLER_CPU_TIME * 1000:.0f} ms")
+    print(f"{'workers':>8} | {'upd/s':>8} | {'speedup':>8}")
+    print("-" * 32)
+    baseline = None
+    for workers in (1, 2, 4):
+        throughput = await measure(workers)
+        baseline = baseline or throughput
+        print(f"{workers:>8} | {throughput:>8.0f} | {throughput / baseline:>7.2f}x")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,93 @@
+"""
+Бенчмарк остановки: сколько начатой работы сохраняется
+
+Диспетчер обрабатывает UPDATES апдейтов; обработчик сохраняет данные в пуле
+потоков (SAVE_TIME, как save_test_results) и публикует событие в шину.
+Через STOP_AFTER после начала приходит сигнал остановки.
+
+  legacy       - прежний finally: шина закрывается сразу, незавершенные
+                 задачи обработчиков отменяются при выходе из asyncio.run
+  coordinator  - shutdown_coordinator: ждет обработчиков, затем закрывает шину
+
+Запуск: python benchmarks/bench_shutdown.py
+"""
+
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot"))
+os.chdir(tempfile.mkdtemp(prefix="cardio_bench_"))
+
+from aiogram import Bot, Dispatcher, Router  # noqa: E402
+from aiogram.types import Message  # noqa: E402
+
+from events import EventBus, UserAction  # noqa: E402
+from fake_telegram import make_message_update  # noqa: E402
+from shutdown import ShutdownCoordinator  # noqa: E402
+
+UPDATES = 200
+SAVE_TIME = (0.05, 0.5)     # Время сохранения в пуле потоков, равномерно
+STOP_AFTER = 0.1
+
+
+async def run(mode: str):
+    random.seed(1)
+    coordinator = ShutdownCoordinator()
+    bus = EventBus()
+    saved = []
+    written = []
+    handled = []
+
+    async def write_events(events):
+        written.extend(events)
+
+    bus.subscribe("activity_log", write_events, flush_interval=0.05)
+
+    router = Router()
+
+    @router.message()
+    async def handler(message: Message):
+        delay = random.uniform(*SAVE_TIME)
+        await asyncio.get_running_loop().run_in_executor(None, time.sleep, delay)
+        saved.append(message.from_user.id)
+        await bus.publish(UserAction(message.from_user.id, "test_completed"))
+        handled.append(message.from_user.id)
+
+    dp = Dispatcher()
+    dp.update.outer_middleware(coordinator)
+    dp.include_router(router)
+    bot = Bot("42:BENCH")
+
+    tasks = [asyncio.create_task(dp.feed_raw_update(bot, make_message_update(i, 1000 + i, "/done")))
+             for i in range(UPDATES)]
+    await asyncio.sleep(STOP_AFTER)
+
+    started = time.monotonic()
+    if mode == "legacy":
+        await bus.close()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    else:
+        coordinator.add_step("event_bus", bus.close)
+        await coordinator.shutdown()
+    elapsed = time.monotonic() - started
+    await bot.session.close()
+
+    print(f"{mode:>12} | {len(saved):>6} | {len(handled):>8} | {len(written):>7} | {elapsed:>9.2f}")
+
+
+async def main():
+    print(f"updates: {UPDATES}, save time {SAVE_TIME[0]}-{SAVE_TIME[1]} s, stop after {STOP_AFTER} s")
+    print(f"{'mode':>12} | {'saved':>6} | {'finished':>8} | {'events':>7} | {'shutdown':>9}")
+    print("-" * 54)
+    for mode in ("legacy", "coordinator"):
+        await run(mode)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,101 @@
+"""
+Бенчмарк запуска: время до готовности принимать обновления
+
+  eager  - прежний порядок: pandas при импорте database, статистика дня
+           при импорте, исправление записей и проверка целостности до
+           начала приема обновлений (FAST_START=false)
+  fast   - pandas только при выгрузке в Excel, до приема обновлений только
+           init_db; проверки и статистика дня - в фоне (FAST_START=true)
+
+Каждый режим запускается в отдельном процессе на одной и той же заполненной
+базе. "ready" - от старта процесса до конца startup_checks, "background" -
+сколько фоновые проверки занимают уже после этого.
+
+Запуск: python benchmarks/bench_startup.py
+"""
+
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot")
+
+USERS = 50_000
+ACTIONS = 4             # Записей лога активности на пользователя
+RUNS = 3
+
+
+def child(mode: str):
+    started = time.monotonic()
+    sys.path.insert(0, BOT_DIR)
+    if mode == "eager":
+        import pandas  # noqa: F401
+    import main
+    import database
+    if mode == "eager":
+        database.setup_daily_stats_job()
+    assert asyncio.run(main.startup_checks())
+    ready = time.monotonic() - started
+
+    background = 0.0
+    if mode == "fast":
+        background_started = time.perf_counter()
+        main.run_integrity_checks()
+        background = time.perf_counter() - background_started
+    # Консоль логов пишет в stdout из своего потока, результат - в stderr
+    print(f"RESULT {ready:.3f} {background:.3f}", file=sys.stderr, flush=True)
+
+
+def prepare_database():
+    sys.path.insert(0, BOT_DIR)
+    from database import ActivityLog, Survey, User, get_db_sync, init_db
+
+    init_db()
+    db = get_db_sync()
+    try:
+        db.bulk_insert_mappings(User, [
+            {'telegram_id': 1_000_000 + i, 'name': f"User{i}", 'email': f"u{i}@bench", 'phone': f"+{i}",
+             'registration_completed': True, 'survey_completed': i % 2 == 0}
+            for i in range(USERS)
+        ])
+        db.bulk_insert_mappings(Survey, [{'telegram_id': 1_000_000 + i, 'age': 40} for i in range(0, USERS, 2)])
+        db.bulk_insert_mappings(ActivityLog, [
+            {'telegram_id': 1_000_000 + i, 'action': f"action_{j}"}
+            for i in range(USERS) for j in range(ACTIONS)
+        ])
+        db.commit()
+    finally:
+        db.close()
+
+
+def main():
+    workdir = tempfile.mkdtemp(prefix="cardio_bench_")
+    os.chdir(workdir)
+    started = time.perf_counter()
+    prepare_database()
+    print(f"users: {USERS}, activity rows: {USERS * ACTIONS}, "
+          f"database prepared in {time.perf_counter() - started:.1f} s")
+
+    env = dict(os.environ, BOT_TOKEN="123:bench", ADMIN_PASSWORD="bench", ADMIN_IDS="1")
+    print(f"{'mode':>6} | {'ready, s':>8} | {'background, s':>13}")
+    print("-" * 34)
+    for mode in ("eager", "fast"):
+        env['FAST_START'] = "true" if mode == "fast" else "false"
+        results = []
+        for _ in range(RUNS):
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), mode], env=env, cwd=workdir,
+                                    capture_output=True, text=True, check=True).stderr
+            line = next(line for line in output.splitlines() if line.startswith("RESULT"))
+            results.append(tuple(map(float, line.split()[1:])))
+        ready, background = sorted(results)[RUNS // 2]
+        print(f"{mode:>6} | {ready:>8.2f} | {background:>13.2f}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        child(sys.argv[1])
+    else:
+        main()
@@ -0,0 +1,114 @@
+"""
+Бенчмарк накладных расходов StateProtectionMiddleware на одно обновление
+
+Сравнивает текущую реализацию (ExpiringMap) с прежней очисткой кэшей
+словарными включениями при 1k/10k/100k отслеживаемых пользователей.
+
+Запуск: python benchmarks/bench_state_protection.py
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot"))
+os.chdir(tempfile.mkdtemp(prefix="cardio_bench_"))
+
+from handlers import StateProtectionMiddleware  # noqa: E402
+
+UPDATES = 2000
+# Прежняя реализация пересобирает словари на каждом обновлении, выборки поменьше
+LEGACY_UPDATES = 50
+
+
+class LegacyCleanupMiddleware(StateProtectionMiddleware):
+    """Прежняя схема: полный пересбор словарей после каждого обновления"""
+
+    def __init__(self):
+        super().__init__()
+        self.user_last_action = {}
+        self.action_timeouts = {}
+        self.processing_users = set()
+
+    async def __call__(self, handler, event, data):
+        user_id = event.from_user.id
+        current_time = asyncio.get_event_loop().time()
+        action_id = self._get_action_id(event)
+        if self._is_admin_action(event):
+            return await handler(event, data)
+        if user_id in self.user_last_action:
+            last_action, last_time = self.user_last_action[user_id]
+            if last_action == action_id and (current_time - last_time) < 2.0:
+                return
+        if user_id in self.processing_users:
+            return
+        if user_id in self.action_timeouts and current_time < self.action_timeouts[user_id]:
+            return
+        self.processing_users.add(user_id)
+        self.user_last_action[user_id] = (action_id, current_time)
+        self.action_timeouts[user_id] = current_time + 0.5
+        try:
+            return await handler(event, data)
+        finally:
+            self.processing_users.discard(user_id)
+            cutoff_time = current_time - 600
+            self.user_last_action = {
+                uid: (action, t) for uid, (action, t) in self.user_last_action.items()
+                if t > cutoff_time
+            }
+            self.action_timeouts = {
+                uid: timeout for uid, timeout in self.action_timeouts.items()
+                if timeout > current_time
+            }
+
+
+async def noop_handler(event, data):
+    return None
+
+
+def make_event(user_id: int, payload: str):
+    async def answer(*args, **kwargs):
+        return None
+    return SimpleNamespace(from_user=SimpleNamespace(id=user_id), data=payload, answer=answer)
+
+
+def prefill(middleware, tracked_users: int):
+    """Заполнить кэши middleware заданным количеством пользователей"""
+    now = asyncio.get_event_loop().time()
+    last_action = middleware.user_last_action
+    for user_id in range(1, tracked_users + 1):
+        if isinstance(last_action, dict):
+            last_action[user_id] = ("prefill", now)
+            middleware.action_timeouts[user_id] = now + 0.5
+        else:
+            last_action.set(user_id, ("prefill", now), now)
+
+
+async def measure(middleware_cls, tracked_users: int, updates: int) -> float:
+    middleware = middleware_cls()
+    prefill(middleware, tracked_users)
+
+    base_id = tracked_users + 1
+    events = [make_event(base_id + i, f"answer_{i % 4}") for i in range(updates)]
+
+    started = time.perf_counter()
+    for event in events:
+        await middleware(noop_handler, event, {})
+    elapsed = time.perf_counter() - started
+    return elapsed / updates * 1e6
+
+
+async def main():
+    print(f"{'users':>8} | {'expiring map, us':>17} | {'legacy dicts, us':>17}")
+    print("-" * 50)
+    for tracked_users in (1_000, 10_000, 100_000):
+        current = await measure(StateProtectionMiddleware, tracked_users, UPDATES)
+        legacy = await measure(LegacyCleanupMiddleware, tracked_users, LEGACY_UPDATES)
+        print(f"{tracked_users:>8} | {current:>17.2f} | {legacy:>17.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
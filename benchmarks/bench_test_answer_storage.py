@@ -0,0 +1,105 @@
+"""
+Бенчмарк обращений к FSM-хранилищу на один ответ в тесте
+
+Прогоняет handle_test_answer по вопросам теста HADS с хранилищем,
+которое считает чтения и записи, и выводит количество операций на ответ.
+База данных создается во временном каталоге.
+
+Запуск: python benchmarks/bench_test_answer_storage.py
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot"))
+os.chdir(tempfile.mkdtemp(prefix="cardio_bench_"))
+
+from aiogram.fsm.context import FSMContext  # noqa: E402
+from aiogram.fsm.storage.base import StorageKey  # noqa: E402
+from aiogram.fsm.storage.memory import MemoryStorage  # noqa: E402
+
+from database import init_db  # noqa: E402
+from handlers import UserStates, handle_test_answer  # noqa: E402
+from keyboards import TestAnswer  # noqa: E402
+from surveys import get_hads_questions  # noqa: E402
+
+USER_ID = 777
+NONCE = "beef"
+MESSAGE_ID = 1
+
+
+class CountingStorage(MemoryStorage):
+    """MemoryStorage со счетчиками обращений"""
+
+    def __init__(self):
+        super().__init__()
+        self.reads = 0
+        self.writes = 0
+
+    async def get_state(self, key):
+        self.reads += 1
+        return await super().get_state(key)
+
+    async def get_data(self, key):
+        self.reads += 1
+        return await super().get_data(key)
+
+    async def set_state(self, key, state=None):
+        self.writes += 1
+        return await super().set_state(key, state)
+
+    async def set_data(self, key, data):
+        self.writes += 1
+        return await super().set_data(key, data)
+
+
+async def noop(*args, **kwargs):
+    return None
+
+
+def make_callback(question_index: int, option: int):
+    callback_data = TestAnswer(t="h", q=question_index, o=option, n=NONCE)
+    # Сообщение с вопросом: правки идут через edit_coalescer, которому нужны id и текущий вид
+    message = SimpleNamespace(edit_text=noop, answer=noop, chat=SimpleNamespace(id=USER_ID),
+                              from_user=SimpleNamespace(id=USER_ID), message_id=MESSAGE_ID,
+                              text="", html_text="", reply_markup=None)
+    callback = SimpleNamespace(from_user=SimpleNamespace(id=USER_ID), data=callback_data.pack(),
+                               message=message, answer=noop)
+    return callback, callback_data
+
+
+async def main():
+    init_db()
+    storage = CountingStorage()
+    state = FSMContext(storage, StorageKey(bot_id=1, chat_id=USER_ID, user_id=USER_ID))
+
+    questions = get_hads_questions()
+    await state.set_state(UserStates.hads_test)
+    await state.set_data({
+        "current_test": "hads",
+        "test_questions": questions,
+        "current_question_index": 0,
+        "test_answers": [],
+        "test_nonce": NONCE,
+    })
+
+    # Последний ответ завершает тест и не входит в измерение
+    taps = len(questions) - 1
+    storage.reads = storage.writes = 0
+    for i in range(taps):
+        callback, callback_data = make_callback(i, i % 4)
+        await handle_test_answer(callback, callback_data, state)
+    reads, writes = storage.reads, storage.writes
+
+    data = await state.get_data()
+    assert len(data["test_answers"]) == taps
+    print(f"answers:           {taps}")
+    print(f"reads per answer:  {reads / taps:.1f}")
+    print(f"writes per answer: {writes / taps:.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
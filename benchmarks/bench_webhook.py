@@ -0,0 +1,115 @@
+"""
+Бенчмарк получения обновлений: long polling против webhook
+
+Поднимает локальную имитацию Bot API (fake_telegram.py), бот отвечает
+на каждое сообщение. Измеряется задержка от отправки обновления до ответа
+бота при равномерной нагрузке и пропускная способность при всплеске.
+
+Запуск: python benchmarks/bench_webhook.py
+"""
+
+import asyncio
+import os
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(tempfile.mkdtemp(prefix="cardio_bench_"))
+
+from aiogram import Bot, Dispatcher, Router  # noqa: E402
+from aiogram.client.session.aiohttp import AiohttpSession  # noqa: E402
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+from aiogram.types import Message  # noqa: E402
+
+from fake_telegram import FakeTelegram, make_message_update  # noqa: E402
+from webhook import start_webhook_server  # noqa: E402
+
+NETWORK_DELAY = 0.02     # Имитация сетевой задержки до Telegram (сек)
+HANDLER_TIME = 0.005     # Время работы обработчика (сек)
+PACED_UPDATES = 500
+PACED_RATE = 200         # Обновлений в секунду
+BURST_UPDATES = 3000
+USERS = 1000
+
+
+def build_dispatcher() -> Dispatcher:
+    router = Router()
+
+    @router.message()
+    async def echo(message: Message):
+        await asyncio.sleep(HANDLER_TIME)
+        await message.answer(f"echo:{message.message_id}")
+
+    dp = Dispatcher()
+    dp.include_router(router)
+    return dp
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def run_scenario(mode: str, updates: int, rate: float) -> dict:
+    fake = FakeTelegram(network_delay=NETWORK_DELAY)
+    base = await fake.start()
+    bot = Bot("42:TEST", session=AiohttpSession(api=TelegramAPIServer.from_base(base)))
+    dp = build_dispatcher()
+
+    polling_task = None
+    server = None
+    if mode == "polling":
+        polling_task = asyncio.create_task(dp.start_polling(bot, handle_signals=False, polling_timeout=10))
+        while "getupdates" not in fake.calls:
+            await asyncio.sleep(0.01)
+    else:
+        port = free_port()
+        server = await start_webhook_server(bot, dp, f"http://127.0.0.1:{port}",
+                                            host="127.0.0.1", port=port, path="/webhook")
+
+    fake.expected = updates
+    started = time.perf_counter()
+    for i in range(1, updates + 1):
+        fake.inject(make_message_update(i, 1000 + i % USERS, "ping"))
+        if rate:
+            await asyncio.sleep(1 / rate)
+    await asyncio.wait_for(fake.all_replied.wait(), timeout=120)
+    elapsed = time.perf_counter() - started
+    # Даем последним ответам API дойти до бота перед остановкой
+    await asyncio.sleep(NETWORK_DELAY * 5)
+
+    if polling_task:
+        await dp.stop_polling()
+        await polling_task
+    if server:
+        await server.stop()
+    await bot.session.close()
+    await fake.stop()
+
+    latencies = fake.latencies()
+    return {
+        "throughput": updates / elapsed,
+        "p50": latencies[len(latencies) // 2] * 1000,
+        "p95": latencies[int(len(latencies) * 0.95)] * 1000,
+        "p99": latencies[int(len(latencies) * 0.99)] * 1000,
+    }
+
+
+async def main():
+    print(f"network delay {NETWORK_DELAY * 1000:.0f} ms, handler {HANDLER_TIME * 1000:.0f} ms")
+    print(f"{'mode':>8} | {'scenario':>14} | {'upd/s':>8} | {'p50 ms':>7} | {'p95 ms':>7} | {'p99 ms':>7}")
+    print("-" * 66)
+    for mode in ("polling", "webhook"):
+        for scenario, updates, rate in (("paced 200/s", PACED_UPDATES, PACED_RATE),
+                                        ("burst", BURST_UPDATES, 0)):
+            result = await run_scenario(mode, updates, rate)
+            print(f"{mode:>8} | {scenario:>14} | {result['throughput']:>8.0f} | "
+                  f"{result['p50']:>7.1f} | {result['p95']:>7.1f} | {result['p99']:>7.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
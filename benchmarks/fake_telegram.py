@@ -0,0 +1,252 @@
+"""
+Локальная имитация Telegram Bot API для бенчмарков
+
+Поддерживает getMe, getUpdates (long polling), setWebhook/deleteWebhook
+с доставкой обновлений POST-запросами, sendMessage/answerCallbackQuery,
+editMessageText (последний вид сообщения сохраняется в edited)
+и sendDocument/sendMediaGroup (с подсчетом загруженных байт).
+Каждому ответу API добавляется задержка network_delay, имитирующая сеть,
+загрузка файлов дополнительно ограничена скоростью upload_speed (байт/сек).
+При заданном flood_limit отправки сверх этого числа за секунду получают
+ошибку 429 с retry_after, как у настоящего Bot API. error_rate - доля
+отправок, на которые сервер отвечает 502 (временный сбой). Отправки в
+чаты из blocked получают 403 "bot was blocked by the user".
+"""
+
+import asyncio
+import json
+import random
+import time
+from collections import deque
+
+import aiohttp
+from aiohttp import web
+
+BOT_ID = 42
+BOT_INFO = {"id": BOT_ID, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+
+def make_message_update(update_id: int, user_id: int, text: str) -> dict:
+    user = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": user,
+            "text": text,
+        },
+    }
+
+
+class FakeTelegram:
+    """Сервер, отвечающий как Bot API, и источник обновлений"""
+
+    def __init__(self, network_delay: float = 0.0, upload_speed: float = 0.0, flood_limit: int = 0,
+                 error_rate: float = 0.0, blocked=()):
+        self.network_delay = network_delay
+        self.upload_speed = upload_speed
+        self.flood_limit = flood_limit
+        self.flood_errors = 0
+        self.error_rate = error_rate
+        self.server_errors = 0
+        self.blocked = set(blocked)
+        self.blocked_errors = 0
+        self._random = random.Random(42)
+        self._recent_sends = deque()
+        self.pending = []                  # Обновления для getUpdates
+        self.pending_event = asyncio.Event()
+        self.webhook = None                # (url, secret, max_connections)
+        self.webhook_queue = asyncio.Queue()
+        self.webhook_workers = []
+
+        self.injected_at = {}              # update_id -> время отправки боту
+        self.replied_at = {}               # update_id -> время ответа бота
+        self.calls = {}                    # method -> количество вызовов
+        self.all_replied = asyncio.Event()
+        self.expected = 0
+        self.uploaded_bytes = 0
+        self.uploaded_files = 0
+        self.edited = {}                   # (chat_id, message_id) -> (text, reply_markup)
+
+        self._runner = None
+        self._client = None
+        self._next_message_id = 1
+        self._next_file_id = 1
+
+    # ------------------------------------------------------------------ сервер
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application()
+        app.router.add_route("POST", "/bot{token}/{method}", self._handle_api)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self._client = aiohttp.ClientSession()
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        for worker in self.webhook_workers:
+            worker.cancel()
+        await asyncio.gather(*self.webhook_workers, return_exceptions=True)
+        if self._client:
+            await self._client.close()
+        if self._runner:
+            await self._runner.cleanup()
+
+    async def _handle_api(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        params = dict(await request.post())
+        self.calls[method] = self.calls.get(method, 0) + 1
+        uploaded = self._count_uploads(params)
+
+        if self.flood_limit and method.startswith(("send", "edit")) and self._flooded():
+            self.flood_errors += 1
+            if self.network_delay:
+                await asyncio.sleep(self.network_delay)
+            return web.json_response({"ok": False, "error_code": 429,
+                                      "description": "Too Many Requests: retry after 1",
+                                      "parameters": {"retry_after": 1}}, status=429)
+
+        if self.error_rate and method.startswith("send") and self._random.random() < self.error_rate:
+            self.server_errors += 1
+            if self.network_delay:
+                await asyncio.sleep(self.network_delay)
+            return web.json_response({"ok": False, "error_code": 502, "description": "Bad Gateway"}, status=502)
+
+        if self.blocked and method.startswith("send") and int(params.get("chat_id", 0)) in self.blocked:
+            self.blocked_errors += 1
+            if self.network_delay:
+                await asyncio.sleep(self.network_delay)
+            return web.json_response({"ok": False, "error_code": 403,
+                                      "description": "Forbidden: bot was blocked by the user"}, status=403)
+
+        if method == "getupdates":
+            result = await self._get_updates(params)
+        elif method == "sendmessage":
+            result = self._send_message(params)
+        elif method == "senddocument":
+            result = self._send_document(params, params.get("document"), params.get("caption"))
+        elif method == "sendmediagroup":
+            result = [self._send_document(params, item["media"], item.get("caption"))
+                      for item in json.loads(params["media"])]
+        elif method == "editmessagetext":
+            key = (int(params.get("chat_id", 0)), int(params.get("message_id", 0)))
+            self.edited[key] = (params.get("text", ""), params.get("reply_markup"))
+            result = True
+        elif method == "getme":
+            result = BOT_INFO
+        elif method == "setwebhook":
+            self._set_webhook(params)
+            result = True
+        else:
+            result = True
+
+        delay = self.network_delay
+        if uploaded and self.upload_speed:
+            delay += uploaded / self.upload_speed
+        if delay:
+            await asyncio.sleep(delay)
+        return web.json_response({"ok": True, "result": result})
+
+    def _flooded(self) -> bool:
+        now = time.monotonic()
+        recent = self._recent_sends
+        while recent and recent[0] <= now - 1.0:
+            recent.popleft()
+        if len(recent) >= self.flood_limit:
+            return True
+        recent.append(now)
+        return False
+
+    def _count_uploads(self, params: dict) -> int:
+        uploaded = 0
+        for value in params.values():
+            if isinstance(value, web.FileField):
+                size = len(value.file.read())
+                uploaded += size
+                self.uploaded_files += 1
+        self.uploaded_bytes += uploaded
+        return uploaded
+
+    async def _get_updates(self, params: dict) -> list:
+        offset = int(params.get("offset", 0) or 0)
+        timeout = float(params.get("timeout", 0) or 0)
+        if offset:
+            self.pending = [u for u in self.pending if u["update_id"] >= offset]
+        if not self.pending and timeout:
+            self.pending_event.clear()
+            try:
+                await asyncio.wait_for(self.pending_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.pending[:100]
+
+    def _send_message(self, params: dict) -> dict:
+        text = params.get("text", "")
+        chat_id = int(params.get("chat_id", 0))
+        if text.startswith("echo:"):
+            update_id = int(text[5:])
+            self.replied_at.setdefault(update_id, time.perf_counter())
+            if self.expected and len(self.replied_at) >= self.expected:
+                self.all_replied.set()
+        message_id = self._next_message_id
+        self._next_message_id += 1
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_INFO,
+            "text": text,
+        }
+
+    def _send_document(self, params: dict, media, caption) -> dict:
+        # Загруженный файл получает новый file_id, переданный file_id возвращается как есть
+        if isinstance(media, str) and not media.startswith("attach://"):
+            file_id = media
+        else:
+            file_id = f"doc{self._next_file_id}"
+            self._next_file_id += 1
+        message = self._send_message({"chat_id": params.get("chat_id", 0), "text": ""})
+        message.pop("text")
+        message["caption"] = caption or ""
+        message["document"] = {"file_id": file_id, "file_unique_id": file_id}
+        return message
+
+    def _set_webhook(self, params: dict):
+        max_connections = int(params.get("max_connections", 40) or 40)
+        self.webhook = (params["url"], params.get("secret_token", ""), max_connections)
+        for _ in range(max_connections):
+            self.webhook_workers.append(asyncio.create_task(self._webhook_worker()))
+
+    # ---------------------------------------------------------- доставка
+
+    def inject(self, update: dict):
+        """Передать обновление боту: через webhook, если он установлен"""
+        self.injected_at[update["update_id"]] = time.perf_counter()
+        if self.webhook:
+            self.webhook_queue.put_nowait(update)
+        else:
+            self.pending.append(update)
+            self.pending_event.set()
+
+    async def _webhook_worker(self):
+        url, secret, _ = self.webhook
+        headers = {"X-Telegram-Bot-Api-Secret-Token": secret, "Content-Type": "application/json"}
+        while True:
+            update = await self.webhook_queue.get()
+            if self.network_delay:
+                await asyncio.sleep(self.network_delay)
+            while True:
+                async with self._client.post(url, data=json.dumps(update), headers=headers) as response:
+                    await response.read()
+                    if response.status == 200:
+                        break
+                # Telegram повторяет доставку при ошибке
+                await asyncio.sleep(0.1)
+
+    def latencies(self) -> list:
+        return sorted(self.replied_at[u] - self.injected_at[u] for u in self.replied_at)
@@ -1,5 +1,7 @@
+import asyncio
+import html
 import os
-from aiogram import Router, F
+from aiogram import Router
 from aiogram.types import Message, CallbackQuery, FSInputFile
 from aiogram.filters import Command
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
@@ -9,15 +11,20 @@ from datetime import datetime, timedelta
 import pytz
 
 from database import admin_export_data, admin_get_stats, clean_old_data
+from metrics import handler_metrics
+from outbound import edit_coalescer
+from routing import CallbackRoute, install_callback_trie
 from dotenv import load_dotenv
 load_dotenv()
 admin_router = Router()
+install_callback_trie(admin_router)
 
 class AdminStates(StatesGroup):
     waiting_password = State()
 
 # Получаем пароль из переменных окружения
 ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD", "")
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "5"))  # Обновлять ход рассылки (сек)
 
 def get_admin_keyboard():
     """Клавиатура административной панели"""
@@ -53,6 +60,22 @@ async def request_admin_password(message: Message, state: FSMContext):
     await message.answer(text, parse_mode="HTML")
     await state.set_state(AdminStates.waiting_password)
 
+@admin_router.message(Command("metrics"))
+async def admin_metrics(message: Message, state: FSMContext, is_admin: bool = False):
+    """Время обработчиков этого процесса"""
+    if not is_admin:
+        await message.answer("❌ У вас нет прав администратора.")
+        return
+    
+    admin_session = await state.get_data()
+    if not admin_session.get('admin_authenticated'):
+        await request_admin_password(message, state)
+        return
+    
+    summary = handler_metrics.summary()
+    text = f"⏱ <b>Обработчики (по p95)</b>\n\n{summary}" if summary else "⏱ Обработчики еще не вызывались"
+    await message.answer(text, parse_mode="HTML")
+
 async def request_admin_password(message: Message, state: FSMContext):
     """Запрос пароля для доступа к админке"""
     text = """🔐 <b>Доступ к административной панели</b>
@@ -122,12 +145,10 @@ async def show_admin_panel(message: Message):
 🚪 <b>Выйти</b> - выход из админ-панели"""
     
     keyboard = get_admin_keyboard()
-    try:
-        await message.edit_text(text, parse_mode="HTML", reply_markup=keyboard)
-    except:
-        await message.answer(text, parse_mode="HTML", reply_markup=keyboard)
+    # Сообщение пользователя (после ввода пароля) не отредактировать - тогда придет новое
+    await edit_coalescer.edit(message, text, reply_markup=keyboard)
 
-@admin_router.callback_query(F.data == "admin_stats")
+@admin_router.callback_query(CallbackRoute("admin_stats"))
 async def show_stats(callback: CallbackQuery, state: FSMContext, is_admin: bool = False):
     """Показать статистику"""
     if not await check_admin_auth(callback, state, is_admin):
@@ -151,7 +172,9 @@ async def show_stats(callback: CallbackQuery, state: FSMContext, is_admin: bool
 • Регистрация: {stats['completed_registration']/max(stats['total_users'], 1)*100:.1f}%
 • Опрос: {stats['completed_surveys']/max(stats['total_users'], 1)*100:.1f}%
 • Тесты: {stats['completed_tests']/max(stats['total_users'], 1)*100:.1f}%
-• Полная диагностика: {stats['completed_diagnostic']/max(stats['total_users'], 1)*100:.1f}%"""
+• Полная диагностика: {stats['completed_diagnostic']/max(stats['total_users'], 1)*100:.1f}%
+
+{await format_delivery_stats()}"""
         
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_stats")],
@@ -159,12 +182,29 @@ async def show_stats(callback: CallbackQuery, state: FSMContext, is_admin: bool
             [InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_back")]
         ])
         
-        await callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard)
+        await edit_coalescer.edit(callback.message, text, reply_markup=keyboard)
         
     except Exception as e:
-        await callback.message.edit_text(f"❌ Ошибка получения статистики: {e}")
-
-@admin_router.callback_query(F.data == "admin_detailed_stats")
+        await edit_coalescer.edit(callback.message, f"❌ Ошибка получения статистики: {e}", parse_mode=None)
+
+async def format_delivery_stats() -> str:
+    """Недоступные получатели и время рассылок, которое экономит их исключение"""
+    from database import get_broadcast_schedules, get_delivery_stats
+    from outbound import OUTBOUND_GLOBAL_RATE
+    
+    stats = await get_delivery_stats()
+    reminders = sum(1 for schedule in await get_broadcast_schedules() if schedule['enabled'])
+    # Без завершенных рассылок - оценка по лимиту исходящих сообщений
+    per_message = stats['seconds_per_message'] or 1 / OUTBOUND_GLOBAL_RATE
+    saved = stats['unreachable'] * per_message
+    labels = {'blocked': "заблокировали бота", 'deactivated': "удалили аккаунт", 'not_found': "чат не найден"}
+    details = ", ".join(f"{labels.get(status, status)}: {count}" for status, count in stats['by_status'].items())
+    
+    return f"""📵 <b>Недоступны для рассылок:</b> {stats['unreachable']}{f' ({details})' if details else ''}
+• Экономия на одной рассылке: {saved:.0f} сек ({per_message * 1000:.0f} мс на сообщение)
+• На {reminders} напоминаниях расписания: {saved * reminders / 60:.1f} мин"""
+
+@admin_router.callback_query(CallbackRoute("admin_detailed_stats"))
 async def show_detailed_stats(callback: CallbackQuery, state: FSMContext, is_admin: bool = False):
     """Показать детальную статистику"""
     if not await check_admin_auth(callback, state, is_admin):
@@ -211,19 +251,19 @@ async def show_detailed_stats(callback: CallbackQuery, state: FSMContext, is_adm
             [InlineKeyboardButton(text="⬅️ К основной статистике", callback_data="admin_stats")]
         ])
         
-        await callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard)
+        await edit_coalescer.edit(callback.message, text, reply_markup=keyboard)
         
     except Exception as e:
-        await callback.message.edit_text(f"❌ Ошибка получения детальной статистики: {e}")
+        await edit_coalescer.edit(callback.message, f"❌ Ошибка получения детальной статистики: {e}", parse_mode=None)
 
-@admin_router.callback_query(F.data == "admin_refresh_stats")
+@admin_router.callback_query(CallbackRoute("admin_refresh_stats"))
 async def refresh_stats(callback: CallbackQuery, state: FSMContext, is_admin: bool = False):
     """Обновить статистику вручную"""
     if not await check_admin_auth(callback, state, is_admin):
         return
     
     await callback.answer()
-    await callback.message.edit_text("⏳ Обновляю статистику...")
+    await edit_coalescer.edit(callback.message, "⏳ Обновляю статистику...", parse_mode=None)
     
     try:
         from database import update_daily_stats
@@ -255,19 +295,19 @@ async def refresh_stats(callback: CallbackQuery, state: FSMContext, is_admin: bo
             [InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_back")]
         ])
         
-        await callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard)
+        await edit_coalescer.edit(callback.message, text, reply_markup=keyboard)
         
     except Exception as e:
-        await callback.message.edit_text(f"❌ Ошибка обновления статистики: {e}")
+        await edit_coalescer.edit(callback.message, f"❌ Ошибка обновления статистики: {e}", parse_mode=None)
 
-@admin_router.callback_query(F.data == "admin_export")
+@admin_router.callback_query(CallbackRoute("admin_export"))
 async def export_data(callback: CallbackQuery, state: FSMContext, is_admin: bool = False):
     """Экспорт данных в Excel"""
     if not await check_admin_auth(callback, state, is_admin):
         return
     
     await callback.answer()
-    await callback.message.edit_text("⏳ Подготавливаю данные для экспорта...")
+    await edit_coalescer.edit(callback.message, "⏳ Подготавливаю данные для экспорта...", parse_mode=None)
     
     try:
         filename = await admin_export_data()
@@ -286,12 +326,12 @@ async def export_data(callback: CallbackQuery, state: FSMContext, is_admin: bool
             # Возвращаемся к админ панели
             await show_admin_panel(callback.message)
         else:
-            await callback.message.edit_text("❌ Ошибка: файл не создан")
+            await edit_coalescer.edit(callback.message, "❌ Ошибка: файл не создан", parse_mode=None)
             
     except Exception as e:
-        await callback.message.edit_text(f"❌ Ошибка экспорта: {e}")
+        await edit_coalescer.edit(callback.message, f"❌ Ошибка экспорта: {e}", parse_mode=None)
 
-@admin_router.callback_query(F.data == "admin_clean")
+@admin_router.callback_query(CallbackRoute("admin_clean"))
 async def clean_data_menu(callback: CallbackQuery, state: FSMContext, is_admin: bool = False):
     """Меню очистки данных"""
     if not await check_admin_auth(callback, state, is_admin):
@@ -319,9 +359,9 @@ async def clean_data_menu(callback: CallbackQuery, state: FSMContext, is_admin:
         [InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_back")]
     ])
     
-    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard)
+    await edit_coalescer.edit(callback.message, text, reply_markup=keyboard)
 
-@admin_router.callback_query(F.data.startswith("clean_"))
+@admin_router.callback_query(CallbackRoute(prefix="clean_"))
 async def clean_old_data_action(callback: CallbackQuery, state: FSMContext, is_admin: bool = False):
     """Очистка старых данных"""
     if not await check_admin_auth(callback, state, is_admin):
@@ -332,7 +372,7 @@ async def clean_old_data_action(callback: CallbackQuery, state: FSMContext, is_a
     # Получаем количество дней
     days = int(callback.data.split("_")[1])
     
-    await callback.message.edit_text(f"⏳ Удаляю данные старше {days} дней...")
+    await edit_coalescer.edit(callback.message, f"⏳ Удаляю данные старше {days} дней...", parse_mode=None)
     
     try:
         def _clean():
@@ -355,12 +395,12 @@ async def clean_old_data_action(callback: CallbackQuery, state: FSMContext, is_a
             [InlineKeyboardButton(text="⬅️ Назад к админ панели", callback_data="admin_back")]
         ])
         
-        await callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard)
+        await edit_coalescer.edit(callback.message, text, reply_markup=keyboard)
         
     except Exception as e:
-        await callback.message.edit_text(f"❌ Ошибка очистки: {e}")
+        await edit_coalescer.edit(callback.message, f"❌ Ошибка очистки: {e}", parse_mode=None)
 
-@admin_router.callback_query(F.data == "admin_back")
+@admin_router.callback_query(CallbackRoute("admin_back"))
 async def back_to_admin(callback: CallbackQuery, state: FSMContext, is_admin: bool = False):
     """Вернуться к админ панели"""
     if not await check_admin_auth(callback, state, is_admin):
@@ -369,7 +409,7 @@ async def back_to_admin(callback: CallbackQuery, state: FSMContext, is_admin: bo
     await callback.answer()
     await show_admin_panel(callback.message)
 
-@admin_router.callback_query(F.data == "admin_logout")
+@admin_router.callback_query(CallbackRoute("admin_logout"))
 async def admin_logout(callback: CallbackQuery, state: FSMContext, is_admin: bool = False):
     """Выход из админ панели"""
     if not is_admin:
@@ -387,7 +427,7 @@ async def admin_logout(callback: CallbackQuery, state: FSMContext, is_admin: boo
 Вы успешно вышли из административной панели.
 Для повторного входа используйте команду /admin"""
     
-    await callback.message.edit_text(text, parse_mode="HTML")
+    await edit_coalescer.edit(callback.message, text)
 
 async def check_admin_auth(callback: CallbackQuery, state: FSMContext, is_admin: bool) -> bool:
     """Проверка авторизации администратора БЕЗ очистки состояния"""
@@ -468,6 +508,12 @@ async def admin_help(message: Message, state: FSMContext, is_admin: bool = False
 /admin - Открыть административную панель (требует пароль)
 /stats - Быстрый просмотр статистики (требует авторизации)
 /export - Быстрый экспорт данных в Excel (требует авторизации)
+/metrics - Время работы обработчиков (требует авторизации)
+/schedule - Расписание напоминаний и его изменение (требует авторизации)
+/webinar - Изменить дату вебинара (требует авторизации)
+/segment - Сегмент аудитории и число получателей (требует авторизации)
+/send_segment - Рассылка по выбранному сегменту (требует авторизации)
+/broadcasts - Ход рассылок, пауза и отмена (требует авторизации)
 /adminhelp - Эта справка
 
 <b>🔐 Безопасность:</b>
@@ -498,24 +544,25 @@ async def admin_help(message: Message, state: FSMContext, is_admin: bool = False
     
     await message.answer(text, parse_mode="HTML")
     
-@admin_router.callback_query(F.data == "admin_test_broadcast")
+@admin_router.callback_query(CallbackRoute("admin_test_broadcast"))
 async def test_broadcast_system(callback: CallbackQuery, state: FSMContext, is_admin: bool = False):
     """Тестирование системы рассылок"""
     if not await check_admin_auth(callback, state, is_admin):
         return
     
     await callback.answer()
-    await callback.message.edit_text("🧪 Тестирую систему рассылок...")
+    await edit_coalescer.edit(callback.message, "🧪 Тестирую систему рассылок...", parse_mode=None)
     
     try:
         from broadcast import BroadcastScheduler
         
-        # Создаем тестовый планировщик
+        # Создаем тестовый планировщик с расписанием из базы
         scheduler = BroadcastScheduler(callback.bot)
+        await scheduler.load_schedule()
+        await scheduler.load_sent_jobs()
         
         # Проверяем настройки времени
-        moscow_tz = pytz.timezone('Europe/Moscow')
-        current_time = datetime.now(moscow_tz)
+        current_time = scheduler.get_moscow_time()
         webinar_time = scheduler.webinar_date
         
         # Рассчитываем время до вебинара
@@ -524,9 +571,9 @@ async def test_broadcast_system(callback: CallbackQuery, state: FSMContext, is_a
         hours_until = time_until_webinar.seconds // 3600
         
         # Проверяем пользователей
-        from database import get_all_users, get_completed_users
-        all_users = await get_all_users()
-        completed_users = await get_completed_users()
+        from database import count_audience
+        all_users = await count_audience('all')
+        completed_users = await count_audience('completed')
         
         # Формируем отчет
         text = f"""🧪 <b>ТЕСТ СИСТЕМЫ РАССЫЛОК</b>
@@ -537,44 +584,18 @@ async def test_broadcast_system(callback: CallbackQuery, state: FSMContext, is_a
 • До вебинара: {days_until} дней, {hours_until} часов
 
 👥 <b>Пользователи для рассылки:</b>
-• Всего пользователей: {len(all_users)}
-• Завершили диагностику: {len(completed_users)}
-• Получат рассылки: {len(all_users)}
-
-🕐 <b>Расписание рассылок:</b>"""
-        
-        # Добавляем расписание рассылок
-        schedule = {
-            'За неделю': webinar_time - timedelta(days=7),
-            'За 3 дня': webinar_time - timedelta(days=3), 
-            'За 1 день': webinar_time - timedelta(days=1),
-            'За 3 часа': webinar_time - timedelta(hours=3),
-            'За 2 часа': webinar_time - timedelta(hours=2),
-            'За 1 час': webinar_time - timedelta(hours=1),
-            'За 15 минут': webinar_time - timedelta(minutes=15),
-            'Начало вебинара': webinar_time
-        }
-        
-        for name, send_time in schedule.items():
-            time_diff = send_time - current_time
-            if time_diff.total_seconds() > 0:
-                status = "⏳ Ожидает"
-                days = time_diff.days
-                hours = time_diff.seconds // 3600
-                time_left = f"через {days}д {hours}ч"
-            else:
-                status = "✅ Прошло"
-                time_left = "уже отправлено"
-            
-            text += f"\n• {name}: {send_time.strftime('%d.%m %H:%M')} - {status} ({time_left})"
+• Всего пользователей: {all_users}
+• Завершили диагностику: {completed_users}
+• Получат рассылки: {all_users}
+
+🕐 <b>Расписание рассылок:</b>
+{format_schedule(scheduler)}"""
         
         text += f"""
 
 🔧 <b>Техническая информация:</b>
-• Планировщик: {'Активен' if scheduler.running else 'Не запущен'}
-• Проверка каждые: 5 минут
 • Отправленные рассылки: {len(scheduler.sent_broadcasts)}
-• Задержка между сообщениями: 50ms
+• Изменить расписание: /schedule, /webinar
 • Часовой пояс: Europe/Moscow
 
 ✅ Система рассылок готова к работе!"""
@@ -585,19 +606,345 @@ async def test_broadcast_system(callback: CallbackQuery, state: FSMContext, is_a
             [InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_back")]
         ])
         
-        await callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard)
+        await edit_coalescer.edit(callback.message, text, reply_markup=keyboard)
         
     except Exception as e:
-        await callback.message.edit_text(f"❌ Ошибка тестирования: {e}")
+        await edit_coalescer.edit(callback.message, f"❌ Ошибка тестирования: {e}", parse_mode=None)
+
+def format_schedule(scheduler) -> str:
+    """Строки расписания напоминаний для админки"""
+    now = scheduler.get_moscow_time()
+    lines = []
+    for broadcast_type, schedule in scheduler.schedules.items():
+        send_time = scheduler.send_time(schedule)
+        if not schedule['enabled']:
+            status = "⏸ Выключено"
+        elif broadcast_type in scheduler.sent_broadcasts:
+            status = "✅ Отправлено"
+        elif send_time > now:
+            time_diff = send_time - now
+            status = f"⏳ через {time_diff.days}д {time_diff.seconds // 3600}ч"
+        else:
+            status = "⏭ Пропущено"
+        lines.append(f"• <code>{broadcast_type}</code>: {send_time.strftime('%d.%m %H:%M')} "
+                     f"({schedule['target_audience']}, догонять {schedule['catch_up_minutes']} мин) - {status}")
+    return "\n".join(lines)
+
+async def check_admin_command(message: Message, state: FSMContext, is_admin: bool) -> bool:
+    """Проверка прав и авторизации для команд, меняющих настройки"""
+    if not is_admin:
+        await message.answer("❌ У вас нет прав администратора.")
+        return False
+    
+    admin_session = await state.get_data()
+    if not admin_session.get('admin_authenticated'):
+        await request_admin_password(message, state)
+        return False
+    return True
+
+@admin_router.message(Command("schedule"))
+async def admin_schedule(message: Message, state: FSMContext, is_admin: bool = False):
+    """Просмотр и изменение расписания напоминаний о вебинаре
+
+    /schedule - текущее расписание
+    /schedule <тип> offset|audience|catchup|enabled|text <значение>
+    """
+    if not await check_admin_command(message, state, is_admin):
+        return
+    
+    from broadcast import AUDIENCES, BroadcastScheduler, reload_schedule
+    from database import update_broadcast_schedule
+    
+    parts = (message.text or "").split(maxsplit=3)
+    if len(parts) >= 4:
+        broadcast_type, field, value = parts[1], parts[2].lower(), parts[3].strip()
+        try:
+            if field == "offset":
+                fields = {'offset_minutes': int(value)}
+            elif field == "catchup":
+                fields = {'catch_up_minutes': int(value)}
+            elif field == "audience" and value in AUDIENCES:
+                fields = {'target_audience': value}
+            elif field == "enabled" and value in ("on", "off"):
+                fields = {'enabled': value == "on"}
+            elif field == "text":
+                fields = {'message_text': value}
+            else:
+                raise ValueError(field)
+        except ValueError:
+            await message.answer(f"❌ Неверное значение. Аудитории: {', '.join(AUDIENCES)}; enabled: on/off; "
+                                 f"offset и catchup - в минутах")
+            return
+        
+        if not await update_broadcast_schedule(broadcast_type, **fields):
+            await message.answer(f"❌ Нет напоминания <code>{broadcast_type}</code>", parse_mode="HTML")
+            return
+        reload_schedule()
+        await message.answer(f"✅ Напоминание <code>{broadcast_type}</code> изменено", parse_mode="HTML")
+    elif len(parts) > 1:
+        await message.answer("Использование: /schedule &lt;тип&gt; offset|audience|catchup|enabled|text &lt;значение&gt;",
+                             parse_mode="HTML")
+        return
+    
+    scheduler = BroadcastScheduler(message.bot)
+    await scheduler.load_schedule()
+    await scheduler.load_sent_jobs()
+    text = f"""🕐 <b>Расписание рассылок</b>
+Вебинар: {scheduler.webinar_date.strftime('%d.%m.%Y %H:%M')} МСК
+
+{format_schedule(scheduler)}
+
+Изменить: /schedule &lt;тип&gt; offset|audience|catchup|enabled|text &lt;значение&gt;
+Дата вебинара: /webinar ГГГГ-ММ-ДД ЧЧ:ММ"""
+    await message.answer(text, parse_mode="HTML")
+
+@admin_router.message(Command("webinar"))
+async def admin_set_webinar(message: Message, state: FSMContext, is_admin: bool = False):
+    """Изменить дату вебинара: /webinar ГГГГ-ММ-ДД ЧЧ:ММ (МСК)"""
+    if not await check_admin_command(message, state, is_admin):
+        return
+    
+    from broadcast import WEBINAR_DATE_FORMAT, reload_schedule
+    from database import set_bot_setting
+    
+    value = (message.text or "").partition(" ")[2].strip()
+    try:
+        webinar_date = datetime.strptime(value, WEBINAR_DATE_FORMAT)
+    except ValueError:
+        await message.answer("Использование: /webinar ГГГГ-ММ-ДД ЧЧ:ММ (по Москве)")
+        return
+    
+    await set_bot_setting('webinar_date', webinar_date.strftime(WEBINAR_DATE_FORMAT))
+    reload_schedule()
+    await message.answer(f"✅ Вебинар перенесен на {webinar_date.strftime('%d.%m.%Y %H:%M')} МСК. "
+                         f"Напоминания будут отправлены заново для новой даты.")
+
+# Рассылки из админки и показ их хода идут в фоне: обработчик не ждет их окончания
+_admin_broadcasts = set()
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    _admin_broadcasts.add(task)
+    task.add_done_callback(_admin_broadcasts.discard)
+    return task
+
+def get_broadcast_control_keyboard(job_id: int, status: str):
+    """Кнопки паузы, продолжения и отмены для задания рассылки"""
+    if status in ('pending', 'running'):
+        first = InlineKeyboardButton(text="⏸ Пауза", callback_data=f"bjob_pause:{job_id}")
+    elif status == 'paused':
+        first = InlineKeyboardButton(text="▶️ Продолжить", callback_data=f"bjob_resume:{job_id}")
+    else:
+        return None
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [first, InlineKeyboardButton(text="⏹ Отменить", callback_data=f"bjob_cancel:{job_id}")]
+    ])
+
+async def report_broadcast_progress(message: Message, progress):
+    """Обновлять сообщение с ходом рассылки раз в BROADCAST_PROGRESS_INTERVAL, пока она не остановится
+
+    Правки идут через edit_coalescer: при частых нажатиях кнопок и
+    обновлениях в Telegram уходит только последнее состояние.
+    """
+    from broadcast import format_progress
+    
+    while not progress.finished.is_set():
+        edit_coalescer.edit(message, format_progress(progress),
+                            reply_markup=get_broadcast_control_keyboard(progress.job_id, progress.status))
+        try:
+            await asyncio.wait_for(progress.finished.wait(), BROADCAST_PROGRESS_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+    await edit_coalescer.edit(message, format_progress(progress),
+                              reply_markup=get_broadcast_control_keyboard(progress.job_id, progress.status))
+
+def start_broadcast(bot, job: dict, message: Message, resume: bool = False):
+    """Отправлять задание в фоне, показывая ход в message"""
+    from broadcast import BroadcastEngine, BroadcastProgress, resume_broadcast
+    
+    progress = BroadcastProgress(job)
+    
+    async def send():
+        try:
+            if resume:
+                await resume_broadcast(bot, job['id'], progress)
+            else:
+                await BroadcastEngine(bot).run_job(job['id'], progress)
+        finally:
+            # Задание могли продолжить из другого места - показ хода тоже заканчивается
+            progress.finished.set()
+    
+    run_in_background(send())
+    run_in_background(report_broadcast_progress(message, progress))
+
+@admin_router.message(Command("broadcasts"))
+async def admin_broadcasts(message: Message, state: FSMContext, is_admin: bool = False):
+    """Идущие и приостановленные рассылки с ходом отправки и кнопками управления"""
+    if not await check_admin_command(message, state, is_admin):
+        return
+    
+    from broadcast import BroadcastProgress, active_broadcasts, format_progress
+    from database import get_broadcast_jobs
+    
+    jobs = await get_broadcast_jobs(('pending', 'running', 'paused'))
+    if not jobs:
+        await message.answer("📭 Нет идущих или приостановленных рассылок")
+        return
+    
+    for job in jobs:
+        # Задание этого процесса показывается вживую, остальные - по состоянию в базе
+        progress = active_broadcasts.get(job['id']) or BroadcastProgress(job)
+        sent = await message.answer(format_progress(progress), parse_mode="HTML",
+                                    reply_markup=get_broadcast_control_keyboard(job['id'], progress.status))
+        if job['id'] in active_broadcasts:
+            run_in_background(report_broadcast_progress(sent, progress))
+
+@admin_router.callback_query(CallbackRoute(prefix="bjob_"))
+async def admin_control_broadcast(callback: CallbackQuery, state: FSMContext, is_admin: bool = False):
+    """Пауза, продолжение и отмена рассылки: bjob_pause|bjob_resume|bjob_cancel:<id>"""
+    if not await check_admin_auth(callback, state, is_admin):
+        return
+    
+    from broadcast import (
+        JOB_STATUS_NAMES, BroadcastProgress, active_broadcasts, control_broadcast, format_progress
+    )
+    from database import JOB_CONTROL_TRANSITIONS, get_broadcast_job
+    
+    action, _, job_id = callback.data[len("bjob_"):].partition(":")
+    if action not in JOB_CONTROL_TRANSITIONS or not job_id.isdigit():
+        await callback.answer("❌ Неизвестная команда", show_alert=True)
+        return
+    job_id = int(job_id)
+    
+    if action == 'resume':
+        job = await get_broadcast_job(job_id)
+        if not job or job['status'] != 'paused':
+            await callback.answer("Рассылка не на паузе", show_alert=True)
+            return
+        await callback.answer("▶️ Продолжаю рассылку")
+        start_broadcast(callback.bot, job, callback.message, resume=True)
+        return
+    
+    job = await control_broadcast(job_id, action)
+    if job is None:
+        await callback.answer("❌ Рассылка не найдена", show_alert=True)
+        return
+    if job['status'] != JOB_CONTROL_TRANSITIONS[action][1]:
+        await callback.answer(f"Рассылка уже {JOB_STATUS_NAMES.get(job['status'], job['status'])}", show_alert=True)
+    elif action == 'pause':
+        await callback.answer("⏸ Рассылка остановится после сообщений, которые уже отправляются")
+    else:
+        await callback.answer("⏹ Рассылка отменена")
+    
+    if job_id not in active_broadcasts:
+        # Задание отправляет другой процесс или никто: показываем состояние из базы
+        progress = BroadcastProgress(job)
+        edit_coalescer.edit(callback.message, format_progress(progress),
+                            reply_markup=get_broadcast_control_keyboard(job_id, job['status']))
+
+@admin_router.message(Command("segment"))
+async def admin_segment(message: Message, state: FSMContext, is_admin: bool = False):
+    """Предпросмотр сегмента: /segment <выражение> - сколько пользователей получат рассылку"""
+    if not await check_admin_command(message, state, is_admin):
+        return
+    
+    from database import count_audience
+    from segments import SegmentError
+    
+    expression = (message.text or "").partition(" ")[2].strip()
+    if not expression:
+        await message.answer("""🎯 <b>Сегменты рассылок</b>
+
+Использование: /segment &lt;выражение&gt;, затем /send_segment &lt;текст&gt;
+
+<b>Флаги:</b> registered, completed, survey, tests
+<b>Последний опрос:</b> age, gender, health_rating
+<b>Последние тесты:</b> risk, risk_score, risk_factors, hads_anxiety, hads_depression, burns, isi, stop_bang, ess, fagerstrom, audit
+<b>Давность:</b> inactive, registered_age, survey_age, tests_age (30m, 48h, 7d)
+<b>Действия:</b> did &lt;действие&gt; [within 48h]
+
+<b>Примеры:</b>
+<code>survey and not tests and survey_age &gt;= 48h</code>
+<code>risk in (ВЫСОКИЙ, ОЧЕНЬ_ВЫСОКИЙ)</code>
+<code>stop_bang &gt;= 5</code>
+<code>inactive &gt;= 7d</code>""", parse_mode="HTML")
+        return
+    
+    try:
+        count = await count_audience(expression)
+    except SegmentError as e:
+        # В тексте ошибки имена полей с "_" и операторы "<": разметка не применяется
+        await message.answer(f"❌ Ошибка в выражении: {e}", parse_mode=None)
+        return
+    
+    await state.update_data(segment=expression)
+    await message.answer(f"🎯 Сегмент <code>{html.escape(expression)}</code>: <b>{count}</b> пользователей\n\n"
+                         f"Отправить им сообщение: /send_segment &lt;текст&gt;", parse_mode="HTML")
+
+@admin_router.message(Command("send_segment"))
+async def admin_send_segment(message: Message, state: FSMContext, is_admin: bool = False):
+    """Подготовить рассылку по сегменту из /segment; отправка - после подтверждения"""
+    if not await check_admin_command(message, state, is_admin):
+        return
+    
+    from database import count_audience
+    
+    data = await state.get_data()
+    segment = data.get('segment')
+    text = (message.text or "").partition(" ")[2].strip()
+    if not segment or not text:
+        await message.answer("Сначала выберите сегмент: /segment &lt;выражение&gt;, затем /send_segment &lt;текст&gt;",
+                             parse_mode="HTML")
+        return
+    
+    await state.update_data(segment_text=text)
+    count = await count_audience(segment)
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"✅ Отправить {count} пользователям", callback_data="segment_send_confirm")],
+        [InlineKeyboardButton(text="❌ Отмена", callback_data="segment_send_cancel")]
+    ])
+    await message.answer(f"📤 <b>Рассылка по сегменту</b> <code>{html.escape(segment)}</code>\n"
+                         f"Получателей: <b>{count}</b>\n\nТекст (Markdown) ниже:", parse_mode="HTML")
+    await message.answer(text, reply_markup=keyboard)
+
+@admin_router.callback_query(CallbackRoute("segment_send_confirm", "segment_send_cancel"))
+async def admin_confirm_segment(callback: CallbackQuery, state: FSMContext, is_admin: bool = False):
+    """Подтверждение или отмена рассылки по сегменту"""
+    if not await check_admin_auth(callback, state, is_admin):
+        return
+    
+    data = await state.get_data()
+    await state.update_data(segment_text=None)
+    await callback.answer()
+    if callback.data == "segment_send_cancel" or not data.get('segment_text'):
+        await callback.message.edit_reply_markup(reply_markup=None)
+        await callback.message.answer("❌ Рассылка отменена")
+        return
+    
+    from database import create_broadcast_job
+    
+    segment, text = data['segment'], data['segment_text']
+    await callback.message.edit_reply_markup(reply_markup=None)
+    # Сначала сообщение для хода рассылки, потом задание: если ответ не ушел,
+    # задания нет, и его не дошлет resume_jobs после перезапуска без ведома админа
+    message = await callback.message.answer(f"📤 Рассылка по сегменту <code>{html.escape(segment)}</code> "
+                                            f"запускается...", parse_mode="HTML")
+    try:
+        job = await create_broadcast_job("custom_admin", text, target_audience=segment, parse_mode="Markdown")
+    except Exception as e:
+        await edit_coalescer.edit(message, f"❌ Рассылка не запущена: {e}", parse_mode=None)
+        return
+    # Ход рассылки обновляется в этом сообщении, в нем же кнопки паузы и отмены
+    start_broadcast(callback.bot, job, message)
 
-@admin_router.callback_query(F.data == "admin_send_test")
+@admin_router.callback_query(CallbackRoute("admin_send_test"))
 async def send_test_broadcast(callback: CallbackQuery, state: FSMContext, is_admin: bool = False):
     """Отправка тестовой рассылки"""
     if not await check_admin_auth(callback, state, is_admin):
         return
     
     await callback.answer()
-    await callback.message.edit_text("📤 Отправляю тестовую рассылку...")
+    await edit_coalescer.edit(callback.message, "📤 Отправляю тестовую рассылку...", parse_mode=None)
     
     try:
         from broadcast import send_custom_broadcast
@@ -626,10 +973,10 @@ async def send_test_broadcast(callback: CallbackQuery, state: FSMContext, is_adm
             [InlineKeyboardButton(text="⬅️ Назад к тесту", callback_data="admin_test_broadcast")]
         ])
         
-        await callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard)
+        await edit_coalescer.edit(callback.message, text, reply_markup=keyboard)
         
     except Exception as e:
-        await callback.message.edit_text(f"❌ Ошибка отправки: {e}")
+        await edit_coalescer.edit(callback.message, f"❌ Ошибка отправки: {e}", parse_mode=None)
 
 async def send_test_to_admins(bot, message_text: str):
     """Отправка тестового сообщения админам"""
@@ -4,113 +4,375 @@
 """
 
 import asyncio
+import heapq
 import logging
+import os
+import random
+import time
+from collections import deque
 from datetime import datetime, timedelta
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Iterable, List
 import pytz
 from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+)
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from database import get_all_users, get_completed_users, get_uncompleted_users, log_broadcast
+from database import (
+    count_audience, create_broadcast_job, start_broadcast_job,
+    claim_broadcast_deliveries, finish_broadcast_deliveries, complete_broadcast_job, get_broadcast_jobs,
+    control_broadcast_job,
+    get_broadcast_schedules, seed_broadcast_schedules, get_bot_setting, set_bot_setting
+)
+from outbound import low_priority
 
 logger = logging.getLogger(__name__)
 
-class BroadcastScheduler:
-    def __init__(self, bot: Bot):
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "25"))    # Параллельных отправителей
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))     # Повторов при временных ошибках
+BROADCAST_RETRY_DELAY = float(os.getenv("BROADCAST_RETRY_DELAY", "1"))   # Пауза перед повтором, удваивается
+BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", "200"))     # Получателей на одну запись в базу
+BROADCAST_RATE_WINDOW = float(os.getenv("BROADCAST_RATE_WINDOW", "30"))  # Окно расчета текущей скорости (сек)
+
+# Ошибки, после которых имеет смысл повторить отправку
+TRANSIENT_ERRORS = (TelegramNetworkError, TelegramServerError)
+
+
+def classify_send_error(error: Exception) -> Optional[str]:
+    """delivery_status получателя, которому писать бесполезно, или None
+
+    Forbidden: bot was blocked by the user / bot can't initiate conversation -> blocked,
+    Forbidden: user is deactivated -> deactivated, Bad Request: chat not found -> not_found.
+    """
+    if isinstance(error, TelegramForbiddenError):
+        return 'deactivated' if 'deactivated' in error.message.lower() else 'blocked'
+    if isinstance(error, TelegramBadRequest) and 'chat not found' in error.message.lower():
+        return 'not_found'
+    return None
+
+# ============================================================================
+# ХОД РАССЫЛКИ
+# ============================================================================
+
+class BroadcastProgress:
+    """Ход выполнения задания рассылки в этом процессе
+
+    Счетчики обновляются отправителями после каждого сообщения, скорость
+    считается по отправкам за последние BROADCAST_RATE_WINDOW секунд.
+    request_stop просит пул остановиться: отправители не берут новых
+    получателей, не начатые возвращаются в очередь задания.
+    """
+
+    def __init__(self, job: Dict[str, Any]):
+        self.job_id = job['id']
+        self.broadcast_type = job['broadcast_type']
+        self.status = job['status']
+        self.total = job['total_users']
+        self.sent = job['sent_count']
+        self.failed = job['error_count']
+        self.stop_requested = False
+        self.finished = asyncio.Event()
+        self._sends = deque()
+
+    def load(self, job: Dict[str, Any]):
+        """Взять счетчики из задания в базе (с учетом отправленного до перезапуска)"""
+        self.status = job['status']
+        self.total = job['total_users']
+        self.sent = job['sent_count']
+        self.failed = job['error_count']
+
+    def record(self, delivered: bool):
+        if delivered:
+            self.sent += 1
+        else:
+            self.failed += 1
+        self._sends.append(time.monotonic())
+
+    @property
+    def remaining(self) -> int:
+        return max(self.total - self.sent - self.failed, 0)
+
+    def rate(self) -> float:
+        """Сообщений в секунду за последние BROADCAST_RATE_WINDOW секунд"""
+        now = time.monotonic()
+        while self._sends and now - self._sends[0] > BROADCAST_RATE_WINDOW:
+            self._sends.popleft()
+        if len(self._sends) < 2:
+            return 0.0
+        return len(self._sends) / max(now - self._sends[0], 1.0)
+
+    def eta(self) -> Optional[float]:
+        """Секунд до конца при текущей скорости или None"""
+        rate = self.rate()
+        return self.remaining / rate if rate > 0 else None
+
+    def request_stop(self, status: str):
+        self.status = status
+        self.stop_requested = True
+
+
+# Задания, которые сейчас отправляет этот процесс: job_id -> BroadcastProgress
+active_broadcasts: Dict[int, BroadcastProgress] = {}
+
+JOB_STATUS_NAMES = {
+    'pending': "⏳ ожидает",
+    'running': "📤 идет",
+    'paused': "⏸ на паузе",
+    'cancelled': "⏹ отменена",
+    'completed': "✅ завершена",
+}
+
+
+def format_progress(progress: BroadcastProgress) -> str:
+    done = progress.sent + progress.failed
+    percent = done * 100 / progress.total if progress.total else 100.0
+    status = JOB_STATUS_NAMES.get(progress.status, progress.status)
+    if progress.stop_requested and not progress.finished.is_set():
+        status += " (останавливается)"
+    text = (f"📤 <b>Рассылка {progress.job_id}</b> ({progress.broadcast_type}): {status}\n\n"
+            f"Отправлено: {progress.sent}\n"
+            f"Ошибок: {progress.failed}\n"
+            f"Осталось: {progress.remaining} из {progress.total} ({percent:.0f}% готово)")
+    rate = progress.rate()
+    if progress.status == 'running' and not progress.finished.is_set() and rate > 0:
+        text += (f"\nСкорость: {rate:.1f} сообщ./сек\n"
+                 f"Осталось времени: ~{timedelta(seconds=round(progress.remaining / rate))}")
+    return text
+
+
+async def control_broadcast(job_id: int, action: str) -> Optional[Dict[str, Any]]:
+    """Приостановить (pause) или отменить (cancel) задание; None, если задания нет
+
+    Статус меняется в базе, поэтому задание, которое отправляет другой
+    процесс, остановится после текущей пачки. Если задание отправляется
+    здесь, пул останавливается сразу после сообщений, уже ушедших в сеть.
+    """
+    job = await control_broadcast_job(job_id, action)
+    progress = active_broadcasts.get(job_id)
+    if job and progress and job['status'] in ('paused', 'cancelled'):
+        progress.request_stop(job['status'])
+    return job
+
+
+async def resume_broadcast(bot: Bot, job_id: int, progress: BroadcastProgress = None) -> Optional[Dict[str, Any]]:
+    """Продолжить приостановленное задание с сохраненного места
+
+    Возвращает итог run_job или None, если задание не было на паузе.
+    """
+    stopping = active_broadcasts.get(job_id)
+    if stopping is not None:
+        if not stopping.stop_requested:
+            return None
+        # Пауза нажата только что: ждем, пока прежний пул вернет получателей в очередь
+        await stopping.finished.wait()
+    job = await control_broadcast_job(job_id, 'resume')
+    if not job or job['status'] != 'running' or job_id in active_broadcasts:
+        return None
+    return await BroadcastEngine(bot).run_job(job_id, progress)
+
+
+async def stop_active_broadcasts():
+    """Остановить рассылки этого процесса при выключении и дождаться их отправителей
+
+    Пул останавливается после сообщений, уже ушедших в сеть, и записывает
+    позицию: не начатые получатели возвращаются в очередь. Статус в базе
+    не меняется, поэтому после перезапуска resume_jobs досылает задание
+    (пауза в базе означала бы остановку админом).
+    """
+    stopping = list(active_broadcasts.values())
+    if not stopping:
+        return
+    logger.info(f"Останавливаю рассылки: {', '.join(str(progress.job_id) for progress in stopping)}")
+    for progress in stopping:
+        progress.request_stop('paused')
+    await asyncio.gather(*(progress.finished.wait() for progress in stopping))
+
+# ============================================================================
+# ОТПРАВКА РАССЫЛКИ
+# ============================================================================
+
+class BroadcastEngine:
+    """Рассылка пулом параллельных отправителей
+
+    Темп задает общий OutboundLimiter сессии (полоса рассылок), поэтому
+    параллельность нужна только чтобы сетевая задержка одного запроса не
+    ограничивала скорость: concurrency должно хватать на лимит * задержку.
+    RetryAfter сначала обрабатывает ограничитель; если он исчерпал попытки,
+    отправитель ждет retry_after сам. Сетевые ошибки и 5xx повторяются с
+    экспоненциальной паузой и случайным разбросом, остальные ошибки - нет.
+    Получатели, заблокировавшие бота или удалившие аккаунт, попадают в
+    result['unreachable'] и при run_job исключаются из следующих рассылок.
+
+    run_job отправляет сохраненное в базе задание пачками по batch_size:
+    пачка выдается отправителям и ее итоги записываются одной транзакцией.
+    Ход задания публикуется в active_broadcasts; пауза и отмена
+    (control_broadcast) останавливают пул, позиция остается в базе.
+    """
+
+    def __init__(self, bot: Bot, concurrency: int = BROADCAST_CONCURRENCY,
+                 max_retries: int = BROADCAST_MAX_RETRIES, retry_delay: float = BROADCAST_RETRY_DELAY,
+                 batch_size: int = BROADCAST_BATCH_SIZE):
         self.bot = bot
-        # Указываем время в московском часовом поясе
-        self.timezone = pytz.timezone('Europe/Moscow')
-        # Дата вебинара: 3 августа 2025, 12:00 МСК
-        self.webinar_date = self.timezone.localize(datetime(2025, 8, 3, 12, 0))
-        self.running = False
-        
-        # Флаги отправленных рассылок (для предотвращения дублирования)
-        self.sent_broadcasts = set()
-        
-        logger.info(f"📅 Вебинар запланирован на: {self.webinar_date}")
-    
-    async def start_scheduler(self):
-        """Запуск планировщика рассылок"""
-        self.running = True
-        logger.info("📡 Планировщик рассылок запущен")
-        
-        while self.running:
+        self.concurrency = max(concurrency, 1)
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.batch_size = max(batch_size, 1)
+
+    async def send(self, chat_ids: Iterable[int], text: str, **kwargs) -> Dict[str, Any]:
+        """Отправить text всем chat_ids, kwargs передаются в send_message
+
+        result['outcomes'] - chat_id -> None (доставлено) или текст ошибки,
+        result['in_flight'] - получатели, отправка которым еще идет.
+        """
+        return await self._send(chat_ids, text, kwargs, self._new_result())
+
+    @staticmethod
+    def _new_result() -> Dict[str, Any]:
+        return {'total': 0, 'sent': 0, 'errors': 0, 'retries': 0, 'retry_after': 0,
+                'outcomes': {}, 'in_flight': set(), 'unreachable': {}}
+
+    async def _send(self, chat_ids: Iterable[int], text: str, kwargs: dict, result: dict,
+                    progress: BroadcastProgress = None) -> Dict[str, Any]:
+        chat_ids = list(chat_ids)
+        result['total'] += len(chat_ids)
+        pending = iter(chat_ids)
+        started = time.monotonic()
+
+        async def sender():
+            with low_priority():
+                # Общий итератор: следующий получатель достается первому освободившемуся
+                for chat_id in pending:
+                    if progress is not None and progress.stop_requested:
+                        # Взятый получатель не начат и вернется в очередь
+                        break
+                    result['in_flight'].add(chat_id)
+                    error = await self._deliver(chat_id, text, kwargs, result)
+                    result['in_flight'].discard(chat_id)
+                    result['outcomes'][chat_id] = error
+                    if error is None:
+                        result['sent'] += 1
+                    else:
+                        result['errors'] += 1
+                    if progress is not None:
+                        progress.record(error is None)
+
+        await asyncio.gather(*(sender() for _ in range(min(self.concurrency, len(chat_ids)))))
+
+        result['elapsed'] = time.monotonic() - started
+        result['rate'] = result['sent'] / result['elapsed'] if result['elapsed'] > 0 else 0.0
+        return result
+
+    async def _deliver(self, chat_id: int, text: str, kwargs: dict, result: dict) -> Optional[str]:
+        """Отправить одно сообщение с повторами; None - доставлено, иначе текст ошибки"""
+        for attempt in range(self.max_retries + 1):
             try:
-                await self.check_and_send_broadcasts()
-                # Проверяем каждые 5 минут
-                await asyncio.sleep(300)
+                await self.bot.send_message(chat_id, text, **kwargs)
+                return None
+            except TelegramRetryAfter as e:
+                result['retry_after'] += 1
+                if attempt >= self.max_retries:
+                    logger.error(f"❌ Ошибка отправки пользователю {chat_id}: {e}")
+                    return str(e)
+                await asyncio.sleep(e.retry_after)
+            except TRANSIENT_ERRORS as e:
+                if attempt >= self.max_retries:
+                    logger.error(f"❌ Ошибка отправки пользователю {chat_id}: {e}")
+                    return str(e)
+                result['retries'] += 1
+                await asyncio.sleep(self.retry_delay * 2 ** attempt * random.uniform(0.5, 1.5))
             except Exception as e:
-                logger.error(f"❌ Ошибка в планировщике: {e}")
-                # При ошибке ждем 10 минут
-                await asyncio.sleep(600)
-    
-    def stop_scheduler(self):
-        """Остановка планировщика"""
-        self.running = False
-        logger.info("⏹ Планировщик рассылок остановлен")
-    
-    def get_moscow_time(self) -> datetime:
-        """Получить текущее время в Москве"""
-        return datetime.now(self.timezone)
-    
-    async def check_and_send_broadcasts(self):
-        """Проверка времени и отправка рассылок"""
-        now = self.get_moscow_time()
-        
-        # Временные точки для рассылок
-        broadcast_schedule = {
-            # За неделю до вебинара
-            'week_before': self.webinar_date - timedelta(days=7),
-            # За 3 дня
-            'three_days': self.webinar_date - timedelta(days=3),
-            # За день
-            'one_day': self.webinar_date - timedelta(days=1),
-            # В день вебинара
-            'three_hours': self.webinar_date - timedelta(hours=3),
-            'two_hours': self.webinar_date - timedelta(hours=2),
-            'one_hour': self.webinar_date - timedelta(hours=1),
-            'fifteen_minutes': self.webinar_date - timedelta(minutes=15),
-            'webinar_start': self.webinar_date,
-        }
-        
-        # Проверяем каждое время рассылки
-        for broadcast_id, broadcast_time in broadcast_schedule.items():
-            # Проверяем, нужно ли отправить рассылку (в пределах 5 минут)
-            time_diff = abs((now - broadcast_time).total_seconds())
-            
-            if time_diff < 300 and broadcast_id not in self.sent_broadcasts:  # 5 минут
-                logger.info(f"⏰ Время для рассылки: {broadcast_id}")
-                await self.send_broadcast_by_type(broadcast_id)
-                self.sent_broadcasts.add(broadcast_id)
-    
-    async def send_broadcast_by_type(self, broadcast_type: str):
-        """Отправка рассылки по типу"""
-        broadcast_functions = {
-            'week_before': self.send_week_reminder,
-            'three_days': self.send_three_days_reminder,
-            'one_day': self.send_day_reminder,
-            'three_hours': self.send_three_hours_reminder,
-            'two_hours': self.send_two_hours_reminder,
-            'one_hour': self.send_hour_reminder,
-            'fifteen_minutes': self.send_fifteen_minutes_reminder,
-            'webinar_start': self.send_start_reminder,
-        }
-        
-        function = broadcast_functions.get(broadcast_type)
-        if function:
-            await function()
+                status = classify_send_error(e)
+                if status:
+                    # Ожидаемо для части аудитории, не ошибка бота
+                    logger.info(f"Пользователь {chat_id} недоступен ({status}): {e}")
+                    result['unreachable'][chat_id] = status
+                else:
+                    logger.error(f"❌ Ошибка отправки пользователю {chat_id}: {e}")
+                return str(e)
+        return "retries exhausted"
+
+    async def run_job(self, job_id: int, progress: BroadcastProgress = None) -> Dict[str, Any]:
+        """Отправить задание рассылки из базы, продолжая с курсора после перезапуска
+
+        progress - объект для показа хода (например, в админке); если не
+        передан, создается. До окончания доступен в active_broadcasts.
+        """
+        job = await start_broadcast_job(job_id)
+        if progress is None:
+            progress = BroadcastProgress(job)
         else:
-            logger.warning(f"⚠️ Неизвестный тип рассылки: {broadcast_type}")
-    
-    def get_diagnostic_keyboard(self):
-        """Клавиатура для прохождения диагностики"""
-        return InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="✍️ Пройти диагностику", callback_data="start_diagnostic")],
-            [InlineKeyboardButton(text="✅ Уже пройдено", callback_data="already_completed")]
-        ])
-    
-    async def send_week_reminder(self):
-        """Рассылка за неделю до вебинара"""
-        text = """📌 Осталась ровно неделя до вебинара «Умный кардиочекап» с Дианой Новиковой и Еленой Удачкиной.
+            progress.load(job)
+        active_broadcasts[job_id] = progress
+        try:
+            return await self._run_job(job, progress)
+        finally:
+            if active_broadcasts.get(job_id) is progress:
+                del active_broadcasts[job_id]
+            progress.finished.set()
+
+    async def _run_job(self, job: Dict[str, Any], progress: BroadcastProgress) -> Dict[str, Any]:
+        job_id = job['id']
+        kwargs = {'parse_mode': job['parse_mode']}
+        if job['reply_markup']:
+            kwargs['reply_markup'] = InlineKeyboardMarkup.model_validate_json(job['reply_markup'])
+
+        result = {'total': 0, 'sent': 0, 'errors': 0, 'retries': 0, 'retry_after': 0, 'unreachable': {}}
+        started = time.monotonic()
+        while not progress.stop_requested:
+            # Пустая пачка - все отправлено или задание остановлено из другого процесса
+            batch = await claim_broadcast_deliveries(job_id, self.batch_size)
+            if not batch:
+                break
+            batch_result = self._new_result()
+            try:
+                await self._send([telegram_id for _, telegram_id in batch], job['message_text'], kwargs,
+                                 batch_result, progress)
+            finally:
+                # При остановке посреди пачки записываем, что успели; не начатые
+                # возвращаются в очередь, а отправляемые в этот момент станут unknown
+                outcomes = batch_result['outcomes']
+                await asyncio.shield(finish_broadcast_deliveries(
+                    job_id,
+                    [(delivery_id, outcomes[telegram_id]) for delivery_id, telegram_id in batch
+                     if telegram_id in outcomes],
+                    released=[delivery_id for delivery_id, telegram_id in batch
+                              if telegram_id not in outcomes and telegram_id not in batch_result['in_flight']],
+                    unreachable=batch_result['unreachable']
+                ))
+            result['unreachable'].update(batch_result['unreachable'])
+            for key in ('total', 'sent', 'errors', 'retries', 'retry_after'):
+                result[key] += batch_result[key]
+
+        result['elapsed'] = time.monotonic() - started
+        result['rate'] = result['sent'] / result['elapsed'] if result['elapsed'] > 0 else 0.0
+        # Приостановленное задание остается в базе с позицией, отмененное закрывается
+        job = await complete_broadcast_job(job_id)
+        progress.load(job)
+        # Итог по всему заданию, включая отправленное до перезапуска
+        result['job'] = job
+        return result
+
+
+def format_broadcast_result(result: Dict[str, Any]) -> str:
+    return (f"отправлено {result['sent']}/{result['total']} за {result['elapsed']:.1f} сек "
+            f"({result['rate']:.1f} сообщ./сек), ошибок {result['errors']} "
+            f"(из них недоступных получателей {len(result.get('unreachable', ()))}), "
+            f"повторов {result['retries']}, RetryAfter {result['retry_after']}")
+
+# ============================================================================
+# РАСПИСАНИЕ НАПОМИНАНИЙ О ВЕБИНАРЕ
+# ============================================================================
+
+# Начальные значения: при первом запуске записываются в broadcast_schedules и
+# bot_settings, дальше расписание и дата меняются из админки (/schedule, /webinar)
+DEFAULT_WEBINAR_DATE = os.getenv("WEBINAR_DATE", "2025-08-03 12:00")               # МСК, ГГГГ-ММ-ДД ЧЧ:ММ
+BROADCAST_SCHEDULE_RELOAD = float(os.getenv("BROADCAST_SCHEDULE_RELOAD", "60"))    # Перечитывать расписание (сек)
+BROADCAST_SCHEDULER_ERROR_DELAY = float(os.getenv("BROADCAST_SCHEDULER_ERROR_DELAY", "60"))  # Пауза после ошибки (сек)
+
+WEBINAR_DATE_FORMAT = "%Y-%m-%d %H:%M"
+AUDIENCES = ("all", "completed", "uncompleted")
+
+WEEK_BEFORE_TEXT = """📌 Осталась ровно неделя до вебинара «Умный кардиочекап» с Дианой Новиковой и Еленой Удачкиной.
 
 📅 Вебинар «Умный Кардиочекап» пройдёт **3 августа в 12:00 МСК**.
 
@@ -125,12 +387,8 @@ class BroadcastScheduler:
 📍 Всё будет здесь, в боте — записи, ссылки, необходимые материалы и бонусы.
 
 Подготовка уже началась! Не забудьте пройти диагностику и опрос, если ещё этого не сделали. Это важно ― так вы сможете извлечь максимум пользы из вебинара и получить бонусы 🎁"""
-        
-        await self.broadcast_to_users(text, self.get_diagnostic_keyboard(), "week_before")
-    
-    async def send_three_days_reminder(self):
-        """Рассылка за 3 дня до вебинара"""
-        text = """🔹 🗓️ До вебинара «Умный Кардиочекап» осталось 3 дня.
+
+THREE_DAYS_TEXT = """🔹 🗓️ До вебинара «Умный Кардиочекап» осталось 3 дня.
 
 Это не просто лекция. Это чёткий пошаговый алгоритм диагностики, выявления рисков и предупреждения инфаркта, инсульта и других ССЗ ― своевременно и с минимальными затратами.
 
@@ -139,12 +397,8 @@ class BroadcastScheduler:
 📩 Если ещё не прошли диагностику — сейчас самое время.
 
 Ссылка на эфир будет здесь, в боте."""
-        
-        await self.broadcast_to_users(text, self.get_diagnostic_keyboard(), "three_days")
-    
-    async def send_day_reminder(self):
-        """Рассылка за день до вебинара"""
-        text = """🔹 🫀 Уже завтра — вебинар, после которого у вас будет на руках маршрутная карта, чтобы помочь вам сохранить сердце здоровым, а жизнь долгой и полноценной — для себя и своих близких.
+
+ONE_DAY_TEXT = """🔹 🫀 Уже завтра — вебинар, после которого у вас будет на руках маршрутная карта, чтобы помочь вам сохранить сердце здоровым, а жизнь долгой и полноценной — для себя и своих близких.
 
 📅 **3 августа, 12:00 МСК**
 
@@ -163,17 +417,8 @@ class BroadcastScheduler:
 ✔️стакан с любимым напитком 😉
 
 ⏰ Завтра утром пришлю ссылку. Ничего не пропустите."""
-        
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="✍️ Пройти диагностику", callback_data="start_diagnostic")],
-            [InlineKeyboardButton(text="✅ Диагностика пройдена", callback_data="already_completed")]
-        ])
-        
-        await self.broadcast_to_users(text, keyboard, "one_day")
-    
-    async def send_three_hours_reminder(self):
-        """Рассылка за 3 часа до вебинара"""
-        text = """🔸 📲 Вебинар через 3 часа
+
+THREE_HOURS_TEXT = """🔸 📲 Вебинар через 3 часа
 
 Сегодня — день, когда вы получите общую картину состояния сердца и сосудов и системное представление о том, насколько вы защищены от инфаркта и инсульта, чтобы выстроить эффективную стратегию действий для сохранения молодости сердца и сосудов.
 
@@ -188,12 +433,8 @@ class BroadcastScheduler:
 ✔️результаты базовых анализов (если сдавали)
 ✔️ответы тестов из бота
 ✔️стакан с любимым напитком 😉"""
-        
-        await self.broadcast_to_users(text, target_audience="all", broadcast_type="three_hours")
-    
-    async def send_two_hours_reminder(self):
-        """Рассылка за 2 часа до вебинара"""
-        text = """🔸 📲 2 часа до вебинара «Умный кардиочекап»
+
+TWO_HOURS_TEXT = """🔸 📲 2 часа до вебинара «Умный кардиочекап»
 
 ✅ **Готовый маршрут диагностики:** получите чёткий список критически важных обследований и анализов, нужных именно вам
 
@@ -202,32 +443,20 @@ class BroadcastScheduler:
 ✅ **Как не потратить лишнего:** узнаете, как стабилизировать состояние и вовремя остановить прогрессирование заболеваний без ненужных обследований, бесполезных препаратов и бесконечных походов по врачам
 
 **Не пропустите ‼️**"""
-        
-        await self.broadcast_to_users(text, target_audience="all", broadcast_type="two_hours")
-    
-    async def send_hour_reminder(self):
-        """Рассылка за час до вебинара"""
-        text = """🔸 **Ссылка на вебинар «Умный кардиочекап»**
+
+ONE_HOUR_TEXT = """🔸 **Ссылка на вебинар «Умный кардиочекап»**
 
 🕛 **Начало — через час, в 12:00 МСК**
 
 🔗 **Ссылка на эфир:** https://your-webinar-link.com"""
-        
-        await self.broadcast_to_users(text, target_audience="all", broadcast_type="one_hour")
-    
-    async def send_fifteen_minutes_reminder(self):
-        """Рассылка за 15 минут до вебинара"""
-        text = """🔸 **Через 15 минут — старт 🚀**
+
+FIFTEEN_MINUTES_TEXT = """🔸 **Через 15 минут — старт 🚀**
 
 Вебинар «Умный Кардиочекап» начинается в ровно в **12:00 МСК**
 
 🔗 **Присоединиться:** https://your-webinar-link.com"""
-        
-        await self.broadcast_to_users(text, target_audience="all", broadcast_type="fifteen_minutes")
-    
-    async def send_start_reminder(self):
-        """Рассылка в момент начала вебинара"""
-        text = """🔸 **Мы начали!**
+
+WEBINAR_START_TEXT = """🔸 **Мы начали!**
 
 Вебинар в прямом эфире. Подключайтесь сейчас — идёт обсуждение ключевых тем:
 
@@ -237,109 +466,286 @@ class BroadcastScheduler:
 ✔️ Рассчитаете риски сердечно-сосудистых заболеваний и вероятность преждевременных инфарктов и инсультов
 ✔️ Поймёте, какие анализы и когда сдавать
 ✔️ Получите важную информацию для выстраивания пошаговой стратегии сохранения здоровья сердца"""
+
+
+def get_diagnostic_keyboard(done_text: str = "✅ Уже пройдено") -> InlineKeyboardMarkup:
+    """Клавиатура для прохождения диагностики"""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="✍️ Пройти диагностику", callback_data="start_diagnostic")],
+        [InlineKeyboardButton(text=done_text, callback_data="already_completed")]
+    ])
+
+
+def default_schedules() -> List[Dict[str, Any]]:
+    """Напоминания по умолчанию: смещение до вебинара и окно догоняния в минутах"""
+    diagnostic = get_diagnostic_keyboard().model_dump_json(exclude_none=True)
+    day_before = get_diagnostic_keyboard("✅ Диагностика пройдена").model_dump_json(exclude_none=True)
+    rows = [
+        # тип, за сколько минут, текст, клавиатура, догонять в течение
+        ('week_before', 7 * 24 * 60, WEEK_BEFORE_TEXT, diagnostic, 24 * 60),
+        ('three_days', 3 * 24 * 60, THREE_DAYS_TEXT, diagnostic, 12 * 60),
+        ('one_day', 24 * 60, ONE_DAY_TEXT, day_before, 6 * 60),
+        ('three_hours', 3 * 60, THREE_HOURS_TEXT, None, 30),
+        ('two_hours', 2 * 60, TWO_HOURS_TEXT, None, 30),
+        ('one_hour', 60, ONE_HOUR_TEXT, None, 30),
+        ('fifteen_minutes', 15, FIFTEEN_MINUTES_TEXT, None, 10),
+        ('webinar_start', 0, WEBINAR_START_TEXT, None, 30),
+    ]
+    return [
+        {'broadcast_type': broadcast_type, 'offset_minutes': offset, 'message_text': text,
+         'parse_mode': "Markdown", 'reply_markup': keyboard, 'target_audience': "all",
+         'catch_up_minutes': catch_up, 'enabled': True}
+        for broadcast_type, offset, text, keyboard, catch_up in rows
+    ]
+
+
+_running_scheduler = None
+
+
+def reload_schedule():
+    """Сообщить работающему в этом процессе планировщику, что расписание изменилось
+
+    Планировщик в другом процессе (при шардировании админка работает в
+    воркерах) заметит изменения не позже чем через BROADCAST_SCHEDULE_RELOAD.
+    """
+    if _running_scheduler is not None:
+        _running_scheduler._changed.set()
+
+
+class BroadcastScheduler:
+    """Планировщик напоминаний о вебинаре
+
+    Время каждого напоминания - дата вебинара минус offset_minutes. Ближайшие
+    лежат в куче, и планировщик спит ровно до первого из них (или до
+    изменения расписания). Наступившее напоминание отправляется заданием
+    рассылки с ключом тип:дата, поэтому не дублируется после перезапуска.
+
+    Правила догоняния после простоя: из нескольких наступивших напоминаний
+    отправляется только последнее (остальные устарели), и только если с его
+    времени прошло не больше catch_up_minutes.
+    """
+
+    def __init__(self, bot: Bot):
+        self.bot = bot
+        # Указываем время в московском часовом поясе
+        self.timezone = pytz.timezone('Europe/Moscow')
+        self.webinar_date = self.parse_webinar_date(DEFAULT_WEBINAR_DATE)
+        self.running = False
+        self.engine = BroadcastEngine(bot)
+        
+        self.schedules = {}           # тип -> параметры из broadcast_schedules
+        self._queue = []              # куча (время отправки, тип)
+        self._loaded_at = None
+        self._changed = asyncio.Event()
+        
+        # Ключи заданий, отправленных или пропущенных по правилам догоняния;
+        # отправленные при запуске восстанавливаются из базы (load_sent_jobs)
+        self.sent_keys = set()
+        self.skipped_keys = set()
+    
+    def parse_webinar_date(self, value: str) -> datetime:
+        return self.timezone.localize(datetime.strptime(value.strip(), WEBINAR_DATE_FORMAT))
+    
+    @property
+    def sent_broadcasts(self) -> set:
+        """Типы напоминаний, уже отправленных для текущей даты вебинара"""
+        return {broadcast_type for broadcast_type in self.schedules
+                if self.job_key(broadcast_type) in self.sent_keys}
+    
+    def job_key(self, broadcast_type: str) -> str:
+        """Ключ задания напоминания: одно задание на тип и дату вебинара"""
+        return f"{broadcast_type}:{self.webinar_date:%Y-%m-%d}"
+    
+    def send_time(self, schedule: Dict[str, Any]) -> datetime:
+        return self.webinar_date - timedelta(minutes=schedule['offset_minutes'])
+    
+    async def load_schedule(self):
+        """Прочитать дату вебинара и расписание из базы и пересобрать кучу"""
+        await seed_broadcast_schedules(default_schedules())
+        value = await get_bot_setting('webinar_date')
+        if value is None:
+            value = DEFAULT_WEBINAR_DATE
+            await set_bot_setting('webinar_date', value)
+        
+        webinar_date = self.parse_webinar_date(value)
+        if webinar_date != self.webinar_date or self._loaded_at is None:
+            logger.info(f"📅 Вебинар запланирован на: {webinar_date}")
+        self.webinar_date = webinar_date
+        
+        self.schedules = {schedule['broadcast_type']: schedule for schedule in await get_broadcast_schedules()}
+        # В куче и прошедшие напоминания: по ним решается, какие из наступивших устарели
+        self._queue = [(self.send_time(schedule), broadcast_type)
+                       for broadcast_type, schedule in self.schedules.items() if schedule['enabled']]
+        heapq.heapify(self._queue)
+        self._loaded_at = time.monotonic()
+    
+    async def start_scheduler(self):
+        """Запуск планировщика рассылок"""
+        global _running_scheduler
+        self.running = True
+        _running_scheduler = self
+        logger.info("📡 Планировщик рассылок запущен")
+        
+        try:
+            await self.load_schedule()
+            await self.resume_jobs()
+        except Exception as e:
+            logger.error(f"❌ Не удалось восстановить задания рассылок: {e}")
         
-        await self.broadcast_to_users(text, target_audience="all", broadcast_type="webinar_start")
+        while self.running:
+            try:
+                if self._changed.is_set() or self._loaded_at is None or \
+                        time.monotonic() - self._loaded_at >= BROADCAST_SCHEDULE_RELOAD:
+                    self._changed.clear()
+                    await self.load_schedule()
+                await self.send_due_broadcasts()
+                await self.wait_next()
+            except Exception as e:
+                logger.error(f"❌ Ошибка в планировщике: {e}")
+                # Пропущенное за время паузы отправится по правилам догоняния
+                await asyncio.sleep(BROADCAST_SCHEDULER_ERROR_DELAY)
     
-    async def broadcast_to_users(self, text: str, keyboard: Optional[InlineKeyboardMarkup] = None, 
-                                target_audience: str = "all", broadcast_type: str = ""):
-        """Отправка сообщения пользователям"""
+    async def wait_next(self):
+        """Спать до ближайшего напоминания, изменения расписания или плановой перезагрузки"""
+        timeout = BROADCAST_SCHEDULE_RELOAD - (time.monotonic() - self._loaded_at)
+        if self._queue:
+            timeout = min(timeout, (self._queue[0][0] - self.get_moscow_time()).total_seconds())
+        if timeout <= 0:
+            return
         try:
-            # Получаем список пользователей
-            if target_audience == "completed":
-                users = await get_completed_users()
-            elif target_audience == "uncompleted":
-                users = await get_uncompleted_users()
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+    
+    async def load_sent_jobs(self) -> List[Dict[str, Any]]:
+        """Запомнить завершенные напоминания; возвращает незавершенные задания"""
+        unfinished = []
+        for job in await get_broadcast_jobs():
+            if job['status'] in ('completed', 'cancelled', 'paused'):
+                # Остановленные админом напоминания не повторяются и сами не продолжаются
+                if job['job_key']:
+                    self.sent_keys.add(job['job_key'])
+                if job['status'] == 'cancelled' and not job['finished']:
+                    # Отмена пришла, когда задание отправлялось, и процесс упал
+                    unfinished.append(job)
             else:
-                users = await get_all_users()
-            
-            total_users = len(users)
-            sent_count = 0
-            error_count = 0
-            
-            logger.info(f"📤 Начинаю рассылку для {total_users} пользователей (тип: {broadcast_type})")
+                unfinished.append(job)
+        return unfinished
+    
+    async def resume_jobs(self):
+        """Отметить завершенные напоминания и дослать прерванные перезапуском рассылки"""
+        for job in await self.load_sent_jobs():
+            logger.info(f"🔁 Продолжаю рассылку {job['broadcast_type']} (задание {job['id']}): "
+                       f"отправлено {job['sent_count']}/{job['total_users']}")
+            result = await self.engine.run_job(job['id'])
+            if job['job_key']:
+                self.sent_keys.add(job['job_key'])
+            logger.info(f"✅ Рассылка {job['broadcast_type']} ({JOB_STATUS_NAMES[result['job']['status']]}): "
+                       f"{format_broadcast_result(result)}")
+    
+    def stop_scheduler(self):
+        """Остановка планировщика"""
+        global _running_scheduler
+        self.running = False
+        if _running_scheduler is self:
+            _running_scheduler = None
+        self._changed.set()
+        logger.info("⏹ Планировщик рассылок остановлен")
+    
+    def get_moscow_time(self) -> datetime:
+        """Получить текущее время в Москве"""
+        return datetime.now(self.timezone)
+    
+    async def send_due_broadcasts(self):
+        """Отправить наступившие напоминания по правилам догоняния"""
+        now = self.get_moscow_time()
+        due = []
+        while self._queue and self._queue[0][0] <= now:
+            due.append(heapq.heappop(self._queue))
+        if not due:
+            return
+        
+        *outdated, (send_time, broadcast_type) = due
+        for outdated_time, outdated_type in outdated:
+            key = self.job_key(outdated_type)
+            if key not in self.sent_keys and key not in self.skipped_keys:
+                self.skipped_keys.add(key)
+                logger.warning(f"⏭ Рассылка {outdated_type} ({outdated_time:%d.%m %H:%M}) пропущена: "
+                               f"уже наступило время {broadcast_type}")
+        
+        key = self.job_key(broadcast_type)
+        if key in self.sent_keys or key in self.skipped_keys:
+            return
+        
+        delay = now - send_time
+        if delay > timedelta(minutes=self.schedules[broadcast_type]['catch_up_minutes']):
+            self.skipped_keys.add(key)
+            logger.warning(f"⏭ Рассылка {broadcast_type} ({send_time:%d.%m %H:%M}) пропущена: "
+                           f"опоздание {delay} больше окна догоняния")
+            return
+        
+        logger.info(f"⏰ Время для рассылки: {broadcast_type} (опоздание {delay.total_seconds():.1f} сек)")
+        await self.send_broadcast_by_type(broadcast_type)
+    
+    async def send_broadcast_by_type(self, broadcast_type: str):
+        """Отправка напоминания по типу с текстом и аудиторией из расписания"""
+        schedule = self.schedules.get(broadcast_type)
+        if not schedule:
+            logger.warning(f"⚠️ Неизвестный тип рассылки: {broadcast_type}")
+            return
+        
+        if await self.broadcast_to_users(schedule['message_text'], schedule['reply_markup'],
+                                         schedule['target_audience'], broadcast_type, schedule['parse_mode']):
+            self.sent_keys.add(self.job_key(broadcast_type))
+    
+    async def broadcast_to_users(self, text: str, reply_markup: Optional[str] = None,
+                                target_audience: str = "all", broadcast_type: str = "",
+                                parse_mode: Optional[str] = "Markdown") -> bool:
+        """Отправка сообщения пользователям; True, если рассылка завершена"""
+        try:
+            # Задание с получателями аудитории сохраняется до отправки: после
+            # перезапуска рассылка продолжится с места остановки (resume_jobs)
+            job = await create_broadcast_job(
+                broadcast_type, text, target_audience=target_audience, job_key=self.job_key(broadcast_type), parse_mode=parse_mode,
+                reply_markup=reply_markup
+            )
+            if job['status'] in ('completed', 'cancelled', 'paused'):
+                logger.info(f"Рассылка {broadcast_type} уже отправлена или остановлена админом "
+                           f"(задание {job['id']}, {job['status']})")
+                return True
             
-            for user in users:
-                try:
-                    if keyboard:
-                        await self.bot.send_message(
-                            user.telegram_id, 
-                            text, 
-                            parse_mode="Markdown",
-                            reply_markup=keyboard
-                        )
-                    else:
-                        await self.bot.send_message(
-                            user.telegram_id, 
-                            text, 
-                            parse_mode="Markdown"
-                        )
-                    sent_count += 1
-                    
-                    # Задержка между отправками для избежания лимитов
-                    await asyncio.sleep(0.05)  # 50ms между сообщениями
-                    
-                except Exception as e:
-                    error_count += 1
-                    logger.error(f"❌ Ошибка отправки пользователю {user.telegram_id}: {e}")
+            logger.info(f"📤 Начинаю рассылку для {job['total_users']} пользователей (тип: {broadcast_type})")
             
-            # Логируем результат рассылки
-            await log_broadcast(
-                broadcast_type=broadcast_type,
-                message_text=text,
-                target_audience=target_audience,
-                total_users=total_users,
-                sent_count=sent_count,
-                error_count=error_count
-            )
+            # Итог пишется в broadcast_logs при завершении задания
+            result = await self.engine.run_job(job['id'])
             
-            logger.info(f"✅ Рассылка завершена. Отправлено: {sent_count}/{total_users}, ошибок: {error_count}")
+            logger.info(f"✅ Рассылка {broadcast_type} ({JOB_STATUS_NAMES[result['job']['status']]}): "
+                       f"{format_broadcast_result(result)}")
+            return True
             
         except Exception as e:
             logger.error(f"❌ Критическая ошибка при рассылке: {e}")
+            return False
 
 # Дополнительные функции для административной рассылки
 
 async def send_custom_broadcast(bot: Bot, message_text: str, user_filter: str = "all"):
-    """Отправка произвольной рассылки через админку"""
+    """Отправка произвольной рассылки через админку
+
+    user_filter - all, completed, uncompleted или выражение сегмента
+    (segments.py), например "survey and not tests and survey_age >= 48h".
+    """
     try:
-        if user_filter == "completed":
-            users = await get_completed_users()
-        elif user_filter == "uncompleted":
-            users = await get_uncompleted_users()
-        else:
-            users = await get_all_users()
-        
-        total_users = len(users)
-        sent_count = 0
-        error_count = 0
-        
-        logger.info(f"📤 Отправка кастомной рассылки для {total_users} пользователей")
-        
-        for user in users:
-            try:
-                await bot.send_message(
-                    user.telegram_id,
-                    message_text,
-                    parse_mode="Markdown"
-                )
-                sent_count += 1
-                await asyncio.sleep(0.05)
-                
-            except Exception as e:
-                error_count += 1
-                logger.error(f"❌ Ошибка отправки пользователю {user.telegram_id}: {e}")
-        
-        # Логируем результат
-        await log_broadcast(
-            broadcast_type="custom_admin",
-            message_text=message_text,
-            target_audience=user_filter,
-            total_users=total_users,
-            sent_count=sent_count,
-            error_count=error_count
+        job = await create_broadcast_job(
+            "custom_admin", message_text, target_audience=user_filter, parse_mode="Markdown"
         )
+        logger.info(f"📤 Отправка кастомной рассылки для {job['total_users']} пользователей")
         
-        return {"sent": sent_count, "errors": error_count, "total": total_users}
+        result = await BroadcastEngine(bot).run_job(job['id'])
+        
+        logger.info(f"✅ Кастомная рассылка завершена: {format_broadcast_result(result)}")
+        return {"sent": result['sent'], "errors": result['errors'], "total": result['total'],
+                "elapsed": result['elapsed'], "rate": result['rate']}
         
     except Exception as e:
         logger.error(f"❌ Ошибка при произвольной рассылке: {e}")
@@ -351,14 +757,10 @@ async def test_broadcast_system():
     
     # Проверяем наличие пользователей
     try:
-        all_users = await get_all_users()
-        completed_users = await get_completed_users()
-        uncompleted_users = await get_uncompleted_users()
-        
         logger.info(f"📊 Статистика пользователей:")
-        logger.info(f"   Всего: {len(all_users)}")
-        logger.info(f"   Завершили диагностику: {len(completed_users)}")
-        logger.info(f"   Не завершили: {len(uncompleted_users)}")
+        logger.info(f"   Всего: {await count_audience('all')}")
+        logger.info(f"   Завершили диагностику: {await count_audience('completed')}")
+        logger.info(f"   Не завершили: {await count_audience('uncompleted')}")
         
         return True
         
@@ -2,16 +2,20 @@ import asyncio
 import json
 import logging
 import os
-import pandas as pd
+import time
 from datetime import datetime, timedelta
-from typing import Dict, List, Any
+from typing import Dict, Iterable, List, Any
 from sqlalchemy import (
-    create_engine, Column, Integer, String, DateTime, Text, Boolean, ForeignKey, Index, func, or_, and_
+    create_engine, event, Column, Integer, String, DateTime, Text, Boolean, ForeignKey, Index, func, or_, and_,
+    select, text
 )
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.schema import CreateColumn
 from sqlalchemy import BigInteger
 
+from middlewares import ExpiringMap
+
 # Настройка логирования
 logger = logging.getLogger(__name__)
 
@@ -38,6 +42,11 @@ class User(Base):
     survey_completed = Column(Boolean, default=False, nullable=False)
     tests_completed = Column(Boolean, default=False, nullable=False)
     
+    # Доступность для рассылок: active, blocked (бот заблокирован), deactivated (аккаунт удален),
+    # not_found (чат не найден). Сбрасывается в active при любом действии пользователя
+    delivery_status = Column(String(20), default='active', server_default='active', nullable=False)
+    blocked_at = Column(DateTime, nullable=True)
+    
     # Временные метки
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
@@ -195,6 +204,89 @@ class BroadcastLog(Base):
     def __repr__(self):
         return f"<BroadcastLog(type='{self.broadcast_type}', sent={self.sent_count})>"
 
+class BroadcastJob(Base):
+    """Задание рассылки: текст, аудитория и курсор отправки для продолжения после перезапуска"""
+    __tablename__ = 'broadcast_jobs'
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    job_key = Column(String(100), nullable=True, unique=True)  # Напоминания: "one_day:2025-08-03"; у ручных пусто
+    
+    # Параметры рассылки
+    broadcast_type = Column(String(100), nullable=False)
+    message_text = Column(Text, nullable=False)
+    parse_mode = Column(String(20), nullable=True)
+    reply_markup = Column(Text, nullable=True)  # JSON клавиатуры
+    target_audience = Column(String(100), nullable=True)
+    
+    # Ход отправки
+    # pending, running, paused (админом), cancelled (админом), completed
+    status = Column(String(20), default='pending', nullable=False, index=True)
+    cursor = Column(Integer, default=0, nullable=False)  # id последней доставки, выданной отправителям
+    total_users = Column(Integer, default=0, nullable=False)
+    sent_count = Column(Integer, default=0, nullable=False)
+    error_count = Column(Integer, default=0, nullable=False)
+    
+    # Временные метки
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    started_at = Column(DateTime, nullable=True)
+    completed_at = Column(DateTime, nullable=True)
+    
+    def __repr__(self):
+        return f"<BroadcastJob(id={self.id}, type='{self.broadcast_type}', status='{self.status}')>"
+
+class BroadcastDelivery(Base):
+    """Доставка рассылки одному получателю
+
+    pending -> sending (выдана отправителю, зафиксировано до отправки) -> sent / failed.
+    sending, оставшийся после падения процесса, становится unknown и повторно
+    не отправляется: каждому получателю - не более одного сообщения.
+    """
+    __tablename__ = 'broadcast_deliveries'
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    job_id = Column(Integer, ForeignKey('broadcast_jobs.id'), nullable=False)
+    telegram_id = Column(BigInteger, nullable=False)
+    status = Column(String(20), default='pending', nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    sent_at = Column(DateTime, nullable=True)
+    error = Column(String(255), nullable=True)
+    
+    def __repr__(self):
+        return f"<BroadcastDelivery(job_id={self.job_id}, telegram_id={self.telegram_id}, status='{self.status}')>"
+
+class BroadcastSchedule(Base):
+    """Напоминание о вебинаре: время отправки задается смещением от даты вебинара"""
+    __tablename__ = 'broadcast_schedules'
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    broadcast_type = Column(String(100), nullable=False, unique=True)  # week_before, one_hour, ...
+    offset_minutes = Column(Integer, nullable=False)  # За сколько минут до начала вебинара (0 - в момент начала)
+    
+    message_text = Column(Text, nullable=False)
+    parse_mode = Column(String(20), nullable=True)
+    reply_markup = Column(Text, nullable=True)  # JSON клавиатуры
+    target_audience = Column(String(100), default='all', nullable=False)  # all, completed, uncompleted
+    
+    # Сколько минут после назначенного времени напоминание еще отправляется (после простоя)
+    catch_up_minutes = Column(Integer, default=30, nullable=False)
+    enabled = Column(Boolean, default=True, nullable=False)
+    
+    updated_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    
+    def __repr__(self):
+        return f"<BroadcastSchedule(type='{self.broadcast_type}', offset={self.offset_minutes})>"
+
+class BotSetting(Base):
+    """Настройки, изменяемые из админки (дата вебинара и т.п.)"""
+    __tablename__ = 'bot_settings'
+    
+    key = Column(String(100), primary_key=True)
+    value = Column(Text, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    
+    def __repr__(self):
+        return f"<BotSetting(key='{self.key}', value='{self.value}')>"
+
 class SystemStats(Base):
     """Системная статистика по дням"""
     __tablename__ = 'system_stats'
@@ -232,6 +324,44 @@ class SystemStats(Base):
     def __repr__(self):
         return f"<SystemStats(date={self.date.date()}, total_users={self.total_users})>"
 
+class MediaCache(Base):
+    """Кэш file_id файлов, уже загруженных в Telegram"""
+    __tablename__ = 'media_cache'
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    path = Column(String(500), nullable=False, unique=True, index=True)
+    file_id = Column(String(255), nullable=False)
+    
+    # Версия файла, для которой получен file_id
+    sha256 = Column(String(64), nullable=False)
+    size = Column(BigInteger, nullable=False)
+    mtime_ns = Column(BigInteger, nullable=False)
+    
+    updated_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    
+    def __repr__(self):
+        return f"<MediaCache(path='{self.path}', file_id='{self.file_id[:16]}...')>"
+
+class IntegrityChange(Base):
+    """Пользователи, чьи статусы, опросы или тесты менялись (пишут триггеры INTEGRITY_TRIGGERS)"""
+    __tablename__ = 'integrity_changes'
+    # id не переиспользуются после очистки: контрольные точки сравнивают id
+    __table_args__ = {'sqlite_autoincrement': True}
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    telegram_id = Column(BigInteger, nullable=False)
+
+class IntegrityCheckpoint(Base):
+    """Последнее изменение из integrity_changes, проверенное функцией обслуживания"""
+    __tablename__ = 'integrity_checkpoints'
+    
+    name = Column(String(100), primary_key=True)  # fix_incomplete_records, validate_data_integrity, ...
+    last_change_id = Column(Integer, default=0, nullable=False)
+    verified_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    
+    def __repr__(self):
+        return f"<IntegrityCheckpoint(name='{self.name}', last_change_id={self.last_change_id})>"
+
 # ============================================================================
 # ИНДЕКСЫ ДЛЯ ОПТИМИЗАЦИИ
 # ============================================================================
@@ -242,8 +372,22 @@ Index('idx_survey_telegram_id_completed', Survey.telegram_id, Survey.completed_a
 Index('idx_tests_telegram_id_completed', TestResult.telegram_id, TestResult.completed_at)
 Index('idx_activity_telegram_id_timestamp', ActivityLog.telegram_id, ActivityLog.timestamp)
 Index('idx_broadcast_type_created', BroadcastLog.broadcast_type, BroadcastLog.created_at)
+Index('idx_delivery_job_telegram_id', BroadcastDelivery.job_id, BroadcastDelivery.telegram_id, unique=True)
 Index('idx_stats_date', SystemStats.date)
 
+# Аудитории рассылок: постраничный проход по telegram_id среди доступных пользователей
+# внутри каждого статуса (заменил idx_user_audience без delivery_status)
+AUDIENCE_INDEX = Index('idx_user_audience_active', User.registration_completed, User.delivery_status,
+                       User.completed_diagnostic, User.telegram_id)
+# Сегменты: "did <действие> within <срок>" (segments.py)
+ACTIVITY_ACTION_INDEX = Index('idx_activity_telegram_id_action_timestamp',
+                              ActivityLog.telegram_id, ActivityLog.action, ActivityLog.timestamp)
+
+# Колонки и индексы, добавленные к уже существующим таблицам: create_all их не создает
+ADDED_COLUMNS = [User.__table__.c.delivery_status, User.__table__.c.blocked_at]
+ADDED_INDEXES = [AUDIENCE_INDEX, ACTIVITY_ACTION_INDEX]
+DROPPED_INDEXES = ['idx_user_audience']
+
 # ============================================================================
 # НАСТРОЙКА БАЗЫ ДАННЫХ
 # ============================================================================
@@ -251,18 +395,108 @@ Index('idx_stats_date', SystemStats.date)
 # Путь к базе данных
 DATABASE_URL = "sqlite:///cardio_bot.db"
 engine = create_engine(DATABASE_URL, echo=False, pool_pre_ping=True)
+
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """WAL и ожидание блокировки: базу одновременно используют несколько процессов"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Инварианты, которые раньше искали полным сканированием при каждом запуске,
+# поддерживаются при записи. Триггеры, а не CHECK: SQLite не добавляет
+# ограничения в существующие таблицы.
+#  - completed_at опроса и тестов не бывает NULL;
+#  - survey_completed / tests_completed выставляются при появлении записи
+#    опроса / тестов и снимаются, когда у пользователя их не осталось;
+#  - каждое изменение статусов и записей попадает в integrity_changes, и
+#    функции обслуживания перепроверяют только этих пользователей.
+INTEGRITY_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS users_integrity_insert AFTER INSERT ON users
+    BEGIN
+        INSERT INTO integrity_changes (telegram_id) VALUES (NEW.telegram_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS users_integrity_update
+    AFTER UPDATE OF telegram_id, name, email, phone, registration_completed, survey_completed,
+                    tests_completed, completed_diagnostic ON users
+    BEGIN
+        INSERT INTO integrity_changes (telegram_id) VALUES (NEW.telegram_id);
+    END""",
+]
+
+for _table, _flag in (('surveys', 'survey_completed'), ('test_results', 'tests_completed')):
+    INTEGRITY_TRIGGERS += [
+        f"""CREATE TRIGGER IF NOT EXISTS {_table}_integrity_insert AFTER INSERT ON {_table}
+        BEGIN
+            UPDATE {_table} SET completed_at = NEW.created_at WHERE id = NEW.id AND NEW.completed_at IS NULL;
+            UPDATE users SET {_flag} = 1 WHERE telegram_id = NEW.telegram_id AND {_flag} = 0;
+            INSERT INTO integrity_changes (telegram_id) VALUES (NEW.telegram_id);
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {_table}_integrity_completed_at
+        AFTER UPDATE OF completed_at ON {_table} WHEN NEW.completed_at IS NULL
+        BEGIN
+            UPDATE {_table} SET completed_at = NEW.created_at WHERE id = NEW.id;
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {_table}_integrity_move AFTER UPDATE OF telegram_id ON {_table}
+        BEGIN
+            UPDATE users SET {_flag} = 1 WHERE telegram_id = NEW.telegram_id AND {_flag} = 0;
+            UPDATE users SET {_flag} = 0 WHERE telegram_id = OLD.telegram_id AND {_flag} = 1
+                AND NOT EXISTS (SELECT 1 FROM {_table} WHERE telegram_id = OLD.telegram_id);
+            INSERT INTO integrity_changes (telegram_id) VALUES (OLD.telegram_id), (NEW.telegram_id);
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {_table}_integrity_delete AFTER DELETE ON {_table}
+        BEGIN
+            UPDATE users SET {_flag} = 0 WHERE telegram_id = OLD.telegram_id AND {_flag} = 1
+                AND NOT EXISTS (SELECT 1 FROM {_table} WHERE telegram_id = OLD.telegram_id);
+            INSERT INTO integrity_changes (telegram_id) VALUES (OLD.telegram_id);
+        END""",
+    ]
+
+def _add_missing_columns():
+    with engine.begin() as connection:
+        for column in ADDED_COLUMNS:
+            table = column.table.name
+            existing = {row[1] for row in connection.exec_driver_sql(f"PRAGMA table_info({table})")}
+            if column.name not in existing:
+                ddl = CreateColumn(column).compile(dialect=engine.dialect)
+                connection.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {ddl}")
+                logger.info(f"Добавлена колонка {table}.{column.name}")
+
 def init_db():
     """Инициализация базы данных"""
     try:
         Base.metadata.create_all(bind=engine)
+        _add_missing_columns()
+        with engine.begin() as connection:
+            for name in DROPPED_INDEXES:
+                connection.exec_driver_sql(f"DROP INDEX IF EXISTS {name}")
+        for index in ADDED_INDEXES:
+            index.create(bind=engine, checkfirst=True)
+        with engine.begin() as connection:
+            for ddl in INTEGRITY_TRIGGERS:
+                connection.execute(text(ddl))
         logger.info("✅ База данных успешно инициализирована")
         return True
     except Exception as e:
         logger.error(f"❌ Ошибка инициализации базы данных: {e}")
         return False
 
+async def checkpoint_wal():
+    """Перенести WAL в основной файл базы и обрезать его (при остановке бота)"""
+    def _checkpoint():
+        with engine.connect() as connection:
+            busy, log_frames, checkpointed = connection.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)").one()
+        if busy:
+            # База открыта другим процессом (воркеры): WAL дочистит последний
+            logger.info(f"Контрольная точка WAL неполная: перенесено {checkpointed} из {log_frames} страниц")
+        return {'busy': bool(busy), 'log_frames': log_frames, 'checkpointed': checkpointed}
+    
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, _checkpoint)
+
 def get_db():
     """Получить сессию базы данных"""
     db = SessionLocal()
@@ -423,12 +657,12 @@ def find_existing_user_safe(telegram_id: int, email: str = None, phone: str = No
     """ИСПРАВЛЕННАЯ функция поиска пользователя - НЕ МЕНЯЕТ telegram_id если он правильный"""
     db = get_db_sync()
     try:
-        logger.info(f"🔍 ПОИСК пользователя: telegram_id={telegram_id}, email={email}, phone={phone}")
+        logger.debug("Поиск пользователя", extra={'telegram_id': telegram_id})
         
         # 1. СНАЧАЛА точный поиск по telegram_id - ПРИОРИТЕТ!
         user = db.query(User).filter(User.telegram_id == telegram_id).first()
         if user:
-            logger.info(f"✅ НАЙДЕН точно по telegram_id: {user.id}")
+            logger.debug("Пользователь найден по telegram_id", extra={'telegram_id': telegram_id, 'user_id': user.id})
             return user
         
         # 2. Поиск по email (ТОЛЬКО если это НЕ автогенерированный email)
@@ -454,9 +688,8 @@ def find_existing_user_safe(telegram_id: int, email: str = None, phone: str = No
                     # Message ID обычно небольшие числа
                     return 1 <= msg_id <= 999999
                 
-                logger.info(f"Анализ ID:")
-                logger.info(f"  old_telegram_id: {old_telegram_id} (real_user: {is_real_user_id(old_telegram_id)}, msg_like: {is_likely_message_id(old_telegram_id)})")
-                logger.info(f"  current_telegram_id: {current_telegram_id} (real_user: {is_real_user_id(current_telegram_id)}, msg_like: {is_likely_message_id(current_telegram_id)})")
+                logger.debug("Выбор telegram_id", extra={'old_telegram_id': old_telegram_id,
+                                                          'current_telegram_id': current_telegram_id})
                 
                 # ЛОГИКА ВЫБОРА ПРАВИЛЬНОГО ID:
                 correct_telegram_id = None
@@ -492,7 +725,8 @@ def find_existing_user_safe(telegram_id: int, email: str = None, phone: str = No
                     tests_updated = db.query(TestResult).filter(TestResult.telegram_id == old_id_for_update).update({TestResult.telegram_id: correct_telegram_id})
                     activities_updated = db.query(ActivityLog).filter(ActivityLog.telegram_id == old_id_for_update).update({ActivityLog.telegram_id: correct_telegram_id})
                     
-                    logger.info(f"   Обновлено связанных записей: опросы={surveys_updated}, тесты={tests_updated}, активность={activities_updated}")
+                    logger.debug("Обновлены связанные записи", extra={'surveys': surveys_updated, 'tests': tests_updated,
+                                                                        'activities': activities_updated})
                     
                     # ТЕПЕРЬ обновляем основной telegram_id
                     user.telegram_id = correct_telegram_id
@@ -500,7 +734,7 @@ def find_existing_user_safe(telegram_id: int, email: str = None, phone: str = No
                     db.commit()
                     logger.info(f"✅ telegram_id обновлен на {correct_telegram_id}")
                 else:
-                    logger.info(f"✅ telegram_id уже правильный: {correct_telegram_id}")
+                    logger.debug(f"telegram_id уже правильный: {correct_telegram_id}")
                 
                 return user
         
@@ -543,7 +777,7 @@ def find_existing_user_safe(telegram_id: int, email: str = None, phone: str = No
                         
                         return user
         
-        logger.info(f"❌ Пользователь НЕ НАЙДЕН")
+        logger.debug("Пользователь не найден", extra={'telegram_id': telegram_id})
         return None
         
     except Exception as e:
@@ -575,29 +809,21 @@ async def safe_save_user_data(telegram_id: int, name: str = None, email: str = N
         # В этом случае нужно получить правильный user_id из контекста
         raise ValueError(f"Подозрительный telegram_id: {telegram_id}. Проверьте, что передается from_user.id, а не message_id")
     
-    print("=" * 80)
-    print("💾 ИСПРАВЛЕННОЕ СОХРАНЕНИЕ В БД")
-    print(f"💾 ВХОДЯЩИЙ telegram_id: {telegram_id}")
-    print(f"💾 Проверка user_id: {is_likely_user_id(telegram_id)}")
-    print(f"💾 name: {name}")
-    print(f"💾 email: {email}")
-    print(f"💾 phone: {phone}")
-    print("=" * 80)
+    logger.debug("Сохранение пользователя", extra={'telegram_id': telegram_id, 'has_name': bool(name),
+                                                    'has_email': bool(email), 'has_phone': bool(phone)})
     
     def _save():
         db = get_db_sync()
         try:
             current_time = datetime.now()
             
-            logger.info(f"🔍 ИСПРАВЛЕННОЕ сохранение для telegram_id = {telegram_id}")
             
             # ПОИСК с исправленной логикой
             existing_user = find_existing_user_safe(telegram_id, email, phone)
             
             if existing_user:
-                logger.info(f"✅ Найден существующий пользователь:")
-                logger.info(f"   ID в БД: {existing_user.id}")
-                logger.info(f"   ФИНАЛЬНЫЙ telegram_id: {existing_user.telegram_id}")
+                logger.debug("Обновляю существующего пользователя",
+                             extra={'telegram_id': existing_user.telegram_id, 'user_id': existing_user.id})
                 
                 # Обновляем данные (НЕ меняем telegram_id - он уже правильный)
                 if name and name != f"User_{telegram_id}":
@@ -630,12 +856,6 @@ async def safe_save_user_data(telegram_id: int, name: str = None, email: str = N
                 )
                 db.add(user)
             
-            # ФИНАЛЬНАЯ ПРОВЕРКА
-            logger.info(f"🔍 ПЕРЕД COMMIT:")
-            logger.info(f"   user.telegram_id: {user.telegram_id}")
-            logger.info(f"   ожидаемый: {telegram_id}")
-            logger.info(f"   корректность: {is_likely_user_id(user.telegram_id)}")
-            
             # Логируем операцию
             log_entry = ActivityLog(
                 telegram_id=user.telegram_id,  # Используем финальный правильный ID
@@ -650,16 +870,12 @@ async def safe_save_user_data(telegram_id: int, name: str = None, email: str = N
             )
             db.add(log_entry)
             
-            logger.info("🔍 ВЫПОЛНЯЮ COMMIT...")
             db.commit()
-            logger.info("✅ COMMIT ВЫПОЛНЕН")
             
             # ФИНАЛЬНАЯ ВЕРИФИКАЦИЯ
             verification = db.query(User).filter(User.telegram_id == user.telegram_id).first()
             if verification:
-                logger.info(f"✅ ВЕРИФИКАЦИЯ УСПЕШНА:")
-                logger.info(f"   ID в БД: {verification.id}")
-                logger.info(f"   telegram_id: {verification.telegram_id}")
+                logger.info(f"Пользователь {verification.telegram_id} сохранен (ID в БД: {verification.id})")
                 
                 return {
                     'user_id': verification.id,
@@ -752,30 +968,6 @@ async def save_survey_data(telegram_id: int, state_data: Dict[str, Any]):
             
             db.add(survey)
             
-            # Логируем завершение опроса с детальной информацией
-            log_entry = ActivityLog(
-                telegram_id=telegram_id,
-                action="survey_completed",
-                details=json.dumps({
-                    "questions_count": 18,
-                    "completion_time": current_time.isoformat(),
-                    "demographics": {
-                        "age": state_data.get('age'),
-                        "gender": state_data.get('gender'),
-                        "location": state_data.get('location'),
-                        "education": state_data.get('education')
-                    },
-                    "health_data": {
-                        "health_rating": state_data.get('health_rating'),
-                        "heart_disease": state_data.get('heart_disease'),
-                        "cv_risk": state_data.get('cv_risk'),
-                        "cv_knowledge": state_data.get('cv_knowledge')
-                    }
-                }, ensure_ascii=False),
-                step="survey_completion"
-            )
-            db.add(log_entry)
-            
             db.commit()
             
             # Возвращаем данные опроса
@@ -806,8 +998,7 @@ async def save_test_results(telegram_id: int, test_data: Dict[str, Any]):
         try:
             current_time = datetime.now()
             
-            logger.info(f"=== ПУЛЕНЕПРОБИВАЕМОЕ СОХРАНЕНИЕ ТЕСТОВ {telegram_id} ===")
-            logger.info(f"Данные: {test_data}")
+            logger.debug("Сохранение тестов", extra={'telegram_id': telegram_id, 'tests': sorted(test_data)})
             
             # КРИТИЧЕСКИ ВАЖНО: сначала убеждаемся что пользователь существует
             user = db.query(User).filter(User.telegram_id == telegram_id).first()
@@ -968,26 +1159,10 @@ async def save_test_results(telegram_id: int, test_data: Dict[str, Any]):
             
             db.add(test_result)
             
-            # Лог активности
-            log_entry = ActivityLog(
-                telegram_id=telegram_id,
-                action="tests_completed_bulletproof",
-                details=json.dumps({
-                    "method": "bulletproof_save",
-                    "risk_level": risk_level,
-                    "risk_score": risk_score,
-                    "tests_count": len([k for k, v in test_data.items() if v is not None and not k.endswith('_skipped')])
-                }, ensure_ascii=False),
-                step="bulletproof_tests"
-            )
-            db.add(log_entry)
-            
             # COMMIT с повторными попытками
             for attempt in range(3):
                 try:
-                    logger.info(f"Commit попытка #{attempt + 1}")
                     db.commit()
-                    logger.info(f"✅ COMMIT УСПЕШЕН")
                     break
                 except Exception as commit_error:
                     logger.error(f"Ошибка commit: {commit_error}")
@@ -1050,23 +1225,6 @@ async def mark_user_completed(telegram_id: int):
                     'diagnostic_completed': True
                 }
                 
-                # Логируем завершение диагностики с подробной информацией
-                log_entry = ActivityLog(
-                    telegram_id=telegram_id,
-                    action="diagnostic_completed",
-                    details=json.dumps({
-                        "completed_at": current_time.isoformat(),
-                        "completion_stats": completion_stats,
-                        "user_journey": {
-                            "registration_date": user.created_at.isoformat() if user.created_at else None,
-                            "last_activity": current_time.isoformat(),
-                            "time_to_completion": str(current_time - user.created_at) if user.created_at else None
-                        }
-                    }, ensure_ascii=False),
-                    step="diagnostic_completion"
-                )
-                db.add(log_entry)
-                
                 db.commit()
                 
                 return {
@@ -1092,47 +1250,487 @@ async def mark_user_completed(telegram_id: int):
 # ФУНКЦИИ ДЛЯ РАССЫЛОК
 # ============================================================================
 
-async def get_all_users():
-    """Получить всех пользователей для рассылки"""
-    def _get_users():
+def _job_info(job: BroadcastJob) -> Dict[str, Any]:
+    return {
+        'id': job.id,
+        'job_key': job.job_key,
+        'broadcast_type': job.broadcast_type,
+        'message_text': job.message_text,
+        'parse_mode': job.parse_mode,
+        'reply_markup': job.reply_markup,
+        'target_audience': job.target_audience,
+        'status': job.status,
+        'total_users': job.total_users,
+        'sent_count': job.sent_count,
+        'error_count': job.error_count,
+        'finished': job.completed_at is not None
+    }
+
+async def create_broadcast_job(broadcast_type: str, message_text: str, telegram_ids: List[int] = None,
+                               target_audience: str = "all", job_key: str = None,
+                               parse_mode: str = None, reply_markup: str = None) -> Dict[str, Any]:
+    """Создать задание рассылки со списком получателей
+
+    Без telegram_ids получатели выбираются из аудитории target_audience
+    постранично, прямо в транзакции создания задания.
+
+    Если задание с таким job_key уже есть, возвращается оно (в том числе
+    завершенное) - повторный вызов после перезапуска не создает дубль.
+    """
+    def _create():
         db = get_db_sync()
         try:
-            return db.query(User).filter(User.registration_completed == True).all()
+            if job_key:
+                existing = db.query(BroadcastJob).filter(BroadcastJob.job_key == job_key).first()
+                if existing:
+                    return _job_info(existing)
+            
+            job = BroadcastJob(
+                job_key=job_key,
+                broadcast_type=broadcast_type,
+                message_text=message_text,
+                parse_mode=parse_mode,
+                reply_markup=reply_markup,
+                target_audience=target_audience
+            )
+            db.add(job)
+            db.flush()
+            
+            # Порядок и уникальность получателей фиксируются при создании
+            if telegram_ids is None:
+                pages = _iter_audience_pages(db, target_audience, AUDIENCE_PAGE_SIZE)
+            else:
+                pages = [list(dict.fromkeys(telegram_ids))]
+            total = 0
+            for page in pages:
+                db.bulk_insert_mappings(BroadcastDelivery, [
+                    {'job_id': job.id, 'telegram_id': telegram_id} for telegram_id in page
+                ])
+                total += len(page)
+            job.total_users = total
+            db.commit()
+            return _job_info(job)
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Ошибка создания задания рассылки {broadcast_type}: {e}")
+            raise e
         finally:
             db.close()
     
     loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(None, _get_users)
+    return await loop.run_in_executor(None, _create)
 
-async def get_completed_users():
-    """Получить пользователей, завершивших диагностику"""
-    def _get_completed():
+async def start_broadcast_job(job_id: int) -> Dict[str, Any]:
+    """Перевести задание в работу; доставки, выданные до падения процесса, помечаются unknown"""
+    def _start():
         db = get_db_sync()
         try:
-            return db.query(User).filter(
-                User.registration_completed == True,
-                User.completed_diagnostic == True
-            ).all()
+            job = db.get(BroadcastJob, job_id)
+            lost = db.query(BroadcastDelivery).filter(
+                BroadcastDelivery.job_id == job_id,
+                BroadcastDelivery.id <= job.cursor,
+                BroadcastDelivery.status == 'sending'
+            ).update({'status': 'unknown'}, synchronize_session=False)
+            if lost:
+                logger.warning(f"Рассылка {job_id}: {lost} сообщений могли не дойти при прошлом запуске, "
+                               f"повторно не отправляются")
+            
+            # Возвращенные при остановке получатели снова попадают под курсор
+            first_released = db.query(func.min(BroadcastDelivery.id)).filter(
+                BroadcastDelivery.job_id == job_id,
+                BroadcastDelivery.id <= job.cursor,
+                BroadcastDelivery.status == 'pending'
+            ).scalar()
+            if first_released is not None:
+                job.cursor = first_released - 1
+            if job.status == 'pending':
+                job.started_at = datetime.now()
+            # Приостановленное или отмененное админом задание не запускается
+            if job.status in ('pending', 'running'):
+                job.status = 'running'
+            db.commit()
+            return _job_info(job)
         finally:
             db.close()
     
     loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(None, _get_completed)
+    return await loop.run_in_executor(None, _start)
+
+async def claim_broadcast_deliveries(job_id: int, limit: int) -> List[tuple]:
+    """Выдать отправителям следующие limit получателей: [(id доставки, telegram_id)]
 
-async def get_uncompleted_users():
-    """Получить пользователей, не завершивших диагностику"""
-    def _get_uncompleted():
+    Доставки помечаются sending и курсор задания сдвигается одной транзакцией
+    до отправки, поэтому после падения они не будут отправлены повторно.
+    Если задание приостановлено или отменено (в том числе из другого
+    процесса), возвращается пустой список.
+    """
+    def _claim():
         db = get_db_sync()
         try:
-            return db.query(User).filter(
-                User.registration_completed == True,
-                User.completed_diagnostic == False
-            ).all()
+            job = db.get(BroadcastJob, job_id)
+            if job.status != 'running':
+                return []
+            batch = db.query(BroadcastDelivery.id, BroadcastDelivery.telegram_id).filter(
+                BroadcastDelivery.job_id == job_id,
+                BroadcastDelivery.id > job.cursor,
+                BroadcastDelivery.status == 'pending'
+            ).order_by(BroadcastDelivery.id).limit(limit).all()
+            if not batch:
+                return []
+            
+            db.query(BroadcastDelivery).filter(
+                BroadcastDelivery.id.in_([row.id for row in batch])
+            ).update({'status': 'sending', 'attempts': BroadcastDelivery.attempts + 1},
+                     synchronize_session=False)
+            job.cursor = batch[-1].id
+            db.commit()
+            return [(row.id, row.telegram_id) for row in batch]
+        finally:
+            db.close()
+    
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, _claim)
+
+async def finish_broadcast_deliveries(job_id: int, results: List[tuple], released: List[int] = (),
+                                      unreachable: Dict[int, str] = None):
+    """Записать итоги пачки одной транзакцией: [(id доставки, текст ошибки или None)]
+
+    released - доставки, которые так и не начали отправлять (остановка
+    посреди пачки): они возвращаются в pending.
+    unreachable - telegram_id -> delivery_status пользователей, которым
+    писать бесполезно (заблокировали бота, удалили аккаунт); они
+    исключаются из следующих рассылок.
+    """
+    def _finish():
+        db = get_db_sync()
+        try:
+            now = datetime.now()
+            if released:
+                db.query(BroadcastDelivery).filter(
+                    BroadcastDelivery.id.in_(list(released))
+                ).update({'status': 'pending'}, synchronize_session=False)
+            db.bulk_update_mappings(BroadcastDelivery, [
+                {'id': delivery_id, 'status': 'failed' if error else 'sent',
+                 'sent_at': None if error else now, 'error': error[:255] if error else None}
+                for delivery_id, error in results
+            ])
+            for status in set((unreachable or {}).values()):
+                db.query(User).filter(
+                    User.telegram_id.in_([telegram_id for telegram_id, value in unreachable.items() if value == status])
+                ).update({'delivery_status': status, 'blocked_at': now}, synchronize_session=False)
+            errors = sum(1 for _, error in results if error)
+            db.query(BroadcastJob).filter(BroadcastJob.id == job_id).update({
+                'sent_count': BroadcastJob.sent_count + len(results) - errors,
+                'error_count': BroadcastJob.error_count + errors
+            }, synchronize_session=False)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Ошибка записи итогов рассылки {job_id}: {e}")
+            raise e
+        finally:
+            db.close()
+    
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, _finish)
+
+def _close_job(db, job: BroadcastJob):
+    """Отметить окончание задания (завершено или отменено) и записать итог в broadcast_logs"""
+    job.completed_at = datetime.now()
+    db.add(BroadcastLog(
+        broadcast_type=job.broadcast_type,
+        message_text=job.message_text,
+        target_audience=job.target_audience,
+        total_users=job.total_users,
+        sent_count=job.sent_count,
+        error_count=job.error_count,
+        started_at=job.started_at,
+        completed_at=job.completed_at
+    ))
+
+async def complete_broadcast_job(job_id: int) -> Dict[str, Any]:
+    """Завершить задание после отправки; приостановленное остается как есть
+
+    Задание, которое успели продолжить после паузы, пока отправитель
+    останавливался, остается running: его досылает новый отправитель.
+    """
+    def _complete():
+        db = get_db_sync()
+        try:
+            job = db.get(BroadcastJob, job_id)
+            pending = db.query(BroadcastDelivery.id).filter(
+                BroadcastDelivery.job_id == job_id, BroadcastDelivery.status == 'pending'
+            ).first()
+            if job.status == 'running' and pending is None:
+                job.status = 'completed'
+            if job.status in ('completed', 'cancelled') and job.completed_at is None:
+                _close_job(db, job)
+            db.commit()
+            return _job_info(job)
+        finally:
+            db.close()
+    
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, _complete)
+
+# Действие админа -> (из каких статусов, в какой)
+JOB_CONTROL_TRANSITIONS = {
+    'pause': (('pending', 'running'), 'paused'),
+    'resume': (('paused',), 'running'),
+    'cancel': (('pending', 'running', 'paused'), 'cancelled'),
+}
+
+async def control_broadcast_job(job_id: int, action: str) -> Dict[str, Any]:
+    """Приостановить (pause), продолжить (resume) или отменить (cancel) задание
+
+    Отправители видят новый статус при выдаче следующей пачки. Задание,
+    которое никто не отправляет, при отмене закрывается сразу, работающее -
+    отправителем после остановки. Возвращает задание (None, если его нет).
+    """
+    allowed, new_status = JOB_CONTROL_TRANSITIONS[action]
+    
+    def _control():
+        db = get_db_sync()
+        try:
+            job = db.get(BroadcastJob, job_id)
+            if job is None or job.status not in allowed:
+                return _job_info(job) if job else None
+            previous = job.status
+            job.status = new_status
+            if new_status == 'cancelled' and previous != 'running':
+                _close_job(db, job)
+            db.commit()
+            logger.info(f"Рассылка {job_id} ({job.broadcast_type}): {previous} -> {new_status}")
+            return _job_info(job)
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Ошибка изменения статуса рассылки {job_id}: {e}")
+            raise e
+        finally:
+            db.close()
+    
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, _control)
+
+async def get_broadcast_jobs(status: str = None) -> List[Dict[str, Any]]:
+    """Задания рассылок (все, с указанным статусом или списком статусов) в порядке создания"""
+    def _get_jobs():
+        db = get_db_sync()
+        try:
+            query = db.query(BroadcastJob)
+            if isinstance(status, (list, tuple, set)):
+                query = query.filter(BroadcastJob.status.in_(list(status)))
+            elif status:
+                query = query.filter(BroadcastJob.status == status)
+            return [_job_info(job) for job in query.order_by(BroadcastJob.id).all()]
+        finally:
+            db.close()
+    
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, _get_jobs)
+
+async def get_broadcast_job(job_id: int) -> Dict[str, Any]:
+    """Задание рассылки по id или None"""
+    def _get_job():
+        db = get_db_sync()
+        try:
+            job = db.get(BroadcastJob, job_id)
+            return _job_info(job) if job else None
+        finally:
+            db.close()
+    
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, _get_job)
+
+SCHEDULE_FIELDS = ('offset_minutes', 'message_text', 'parse_mode', 'reply_markup', 'target_audience',
+                   'catch_up_minutes', 'enabled')
+
+def _schedule_info(schedule: BroadcastSchedule) -> Dict[str, Any]:
+    info = {field: getattr(schedule, field) for field in SCHEDULE_FIELDS}
+    info['broadcast_type'] = schedule.broadcast_type
+    return info
+
+async def get_broadcast_schedules() -> List[Dict[str, Any]]:
+    """Расписание напоминаний о вебинаре, от самого раннего"""
+    def _get_schedules():
+        db = get_db_sync()
+        try:
+            schedules = db.query(BroadcastSchedule).order_by(BroadcastSchedule.offset_minutes.desc()).all()
+            return [_schedule_info(schedule) for schedule in schedules]
+        finally:
+            db.close()
+    
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, _get_schedules)
+
+async def seed_broadcast_schedules(schedules: List[Dict[str, Any]]) -> int:
+    """Добавить напоминания, которых еще нет в базе; измененные админом не трогаются"""
+    def _seed():
+        db = get_db_sync()
+        try:
+            existing = {row[0] for row in db.query(BroadcastSchedule.broadcast_type).all()}
+            added = [schedule for schedule in schedules if schedule['broadcast_type'] not in existing]
+            if added:
+                db.bulk_insert_mappings(BroadcastSchedule, added)
+                db.commit()
+            return len(added)
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Ошибка заполнения расписания рассылок: {e}")
+            raise e
+        finally:
+            db.close()
+    
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, _seed)
+
+async def update_broadcast_schedule(broadcast_type: str, **fields) -> Dict[str, Any]:
+    """Изменить напоминание; возвращает его новые параметры или None, если типа нет"""
+    unknown = set(fields) - set(SCHEDULE_FIELDS)
+    if unknown:
+        raise ValueError(f"Неизвестные поля расписания: {', '.join(sorted(unknown))}")
+    
+    def _update():
+        db = get_db_sync()
+        try:
+            schedule = db.query(BroadcastSchedule).filter(BroadcastSchedule.broadcast_type == broadcast_type).first()
+            if not schedule:
+                return None
+            for field, value in fields.items():
+                setattr(schedule, field, value)
+            schedule.updated_at = datetime.utcnow()
+            db.commit()
+            return _schedule_info(schedule)
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Ошибка изменения расписания {broadcast_type}: {e}")
+            raise e
+        finally:
+            db.close()
+    
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, _update)
+
+async def get_bot_setting(key: str, default: str = None) -> str:
+    """Значение настройки из bot_settings"""
+    def _get_setting():
+        db = get_db_sync()
+        try:
+            setting = db.get(BotSetting, key)
+            return setting.value if setting else default
+        finally:
+            db.close()
+    
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, _get_setting)
+
+async def set_bot_setting(key: str, value: str):
+    """Сохранить настройку в bot_settings"""
+    def _set_setting():
+        db = get_db_sync()
+        try:
+            db.merge(BotSetting(key=key, value=value, updated_at=datetime.utcnow()))
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Ошибка сохранения настройки {key}: {e}")
+            raise e
+        finally:
+            db.close()
+    
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, _set_setting)
+
+AUDIENCE_PAGE_SIZE = int(os.getenv("AUDIENCE_PAGE_SIZE", "1000"))  # telegram_id за один запрос
+
+# Аудитория -> значения completed_diagnostic; каждое проходится отдельно по AUDIENCE_INDEX
+AUDIENCE_GROUPS = {
+    'all': (False, True),
+    'completed': (True,),
+    'uncompleted': (False,),
+}
+
+def _audience_passes(audience: str) -> List[tuple]:
+    """Условия проходов по аудитории; внутри каждого - keyset по telegram_id
+
+    Кроме all / completed / uncompleted аудиторией может быть выражение
+    сегмента (segments.py), например "stop_bang >= 5 and not completed".
+    """
+    # Заблокировавшие бота и удаленные аккаунты не попадают ни в одну аудиторию
+    reachable = (User.registration_completed == True, User.delivery_status == 'active')
+    if not audience or audience in AUDIENCE_GROUPS:
+        return [(*reachable, User.completed_diagnostic == completed_diagnostic)
+                for completed_diagnostic in AUDIENCE_GROUPS[audience or 'all']]
+    
+    from segments import compile_segment
+    return [(*reachable, compile_segment(audience))]
+
+def _audience_page(db, filters: tuple, after: int, limit: int) -> List[int]:
+    """Следующие limit telegram_id пользователей аудитории после after (keyset)"""
+    query = db.query(User.telegram_id).filter(*filters)
+    if after is not None:
+        query = query.filter(User.telegram_id > after)
+    return [row[0] for row in query.order_by(User.telegram_id).limit(limit)]
+
+def _iter_audience_pages(db, audience: str, page_size: int):
+    """Страницы telegram_id аудитории (keyset): память не зависит от размера аудитории"""
+    for filters in _audience_passes(audience):
+        after = None
+        while True:
+            page = _audience_page(db, filters, after, page_size)
+            if page:
+                yield page
+            if len(page) < page_size:
+                break
+            after = page[-1]
+
+async def count_audience(audience: str = "all") -> int:
+    """Размер аудитории рассылки одним запросом COUNT, без выборки пользователей
+
+    Для сегмента это предпросмотр перед отправкой; ошибка в выражении -
+    segments.SegmentError.
+    """
+    passes = _audience_passes(audience)
+    
+    def _count():
+        db = get_db_sync()
+        try:
+            return sum(db.query(func.count(User.id)).filter(*filters).scalar() for filters in passes)
         finally:
             db.close()
     
     loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(None, _get_uncompleted)
+    return await loop.run_in_executor(None, _count)
+
+async def get_delivery_stats() -> Dict[str, Any]:
+    """Недоступные для рассылок пользователи и средняя длительность одного сообщения рассылки"""
+    def _get_stats():
+        db = get_db_sync()
+        try:
+            statuses = dict(db.query(User.delivery_status, func.count(User.id)).filter(
+                User.registration_completed == True
+            ).group_by(User.delivery_status).all())
+            
+            # Темп по последним завершенным рассылкам
+            jobs = db.query(BroadcastJob.started_at, BroadcastJob.completed_at, BroadcastJob.total_users).filter(
+                BroadcastJob.status == 'completed',
+                BroadcastJob.started_at.isnot(None),
+                BroadcastJob.total_users > 0
+            ).order_by(BroadcastJob.id.desc()).limit(20).all()
+            seconds = sum((job.completed_at - job.started_at).total_seconds() for job in jobs)
+            messages = sum(job.total_users for job in jobs)
+            
+            return {
+                'active': statuses.pop('active', 0),
+                'unreachable': sum(statuses.values()),
+                'by_status': statuses,
+                'seconds_per_message': seconds / messages if messages else None
+            }
+        finally:
+            db.close()
+    
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, _get_stats)
 
 async def log_broadcast(broadcast_type: str, message_text: str, target_audience: str, 
                        total_users: int, sent_count: int, error_count: int):
@@ -1164,18 +1762,101 @@ async def log_broadcast(broadcast_type: str, message_text: str, target_audience:
     loop = asyncio.get_event_loop()
     return await loop.run_in_executor(None, _log)
 
+# ============================================================================
+# КЭШ FILE_ID МАТЕРИАЛОВ
+# ============================================================================
+
+async def get_media_cache() -> Dict[str, Dict[str, Any]]:
+    """Все сохраненные file_id: путь -> {file_id, sha256, size, mtime_ns}"""
+    def _get():
+        db = get_db_sync()
+        try:
+            return {
+                row.path: {
+                    'file_id': row.file_id,
+                    'sha256': row.sha256,
+                    'size': row.size,
+                    'mtime_ns': row.mtime_ns
+                }
+                for row in db.query(MediaCache).all()
+            }
+        finally:
+            db.close()
+    
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, _get)
+
+async def save_media_file_id(path: str, file_id: str, sha256: str, size: int, mtime_ns: int):
+    """Сохранить file_id для версии файла"""
+    def _save():
+        db = get_db_sync()
+        try:
+            row = db.query(MediaCache).filter(MediaCache.path == path).first()
+            if row is None:
+                row = MediaCache(path=path)
+                db.add(row)
+            row.file_id = file_id
+            row.sha256 = sha256
+            row.size = size
+            row.mtime_ns = mtime_ns
+            row.updated_at = datetime.utcnow()
+            db.commit()
+            
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Ошибка сохранения file_id для {path}: {e}")
+            raise e
+        finally:
+            db.close()
+    
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, _save)
+
 # ============================================================================
 # ФУНКЦИИ ПОЛУЧЕНИЯ ДАННЫХ
 # ============================================================================
 
-def check_user_completed(telegram_id: int) -> bool:
+# Флаг меняется только при завершении диагностики; кэш обновляет
+# подписчик событий (events.update_completed_cache). Кэш читается и
+# пишется только в цикле событий, в пуле потоков выполняется лишь запрос
+USER_COMPLETED_CACHE_TTL = 300
+_user_completed_cache = ExpiringMap(USER_COMPLETED_CACHE_TTL)
+_user_completed_version = 0  # Растет при каждом обновлении кэша из событий
+
+async def check_user_completed(telegram_id: int) -> bool:
     """Проверить, завершил ли пользователь диагностику"""
-    db = get_db_sync()
-    try:
-        user = db.query(User).filter(User.telegram_id == telegram_id).first()
-        return user.completed_diagnostic if user else False
-    finally:
-        db.close()
+    now = time.monotonic()
+    completed = _user_completed_cache.get(telegram_id, now)
+    if completed is not None:
+        return completed
+    
+    def _query():
+        db = get_db_sync()
+        try:
+            user = db.query(User).filter(User.telegram_id == telegram_id).first()
+            return user.completed_diagnostic if user else False
+        finally:
+            db.close()
+    
+    version = _user_completed_version
+    loop = asyncio.get_event_loop()
+    completed = await loop.run_in_executor(None, _query)
+    
+    # Пока шел запрос, событие могло обновить кэш: прочитанное значение уже устарело
+    if version == _user_completed_version:
+        now = time.monotonic()
+        _user_completed_cache.purge(now)
+        _user_completed_cache.set(telegram_id, completed, now)
+    return completed
+
+def remember_user_completed(telegram_id: int, completed: bool = None):
+    """Записать флаг завершения в кэш; None - сбросить запись"""
+    global _user_completed_version
+    _user_completed_version += 1
+    if completed is None:
+        _user_completed_cache.pop(telegram_id)
+    else:
+        _user_completed_cache.set(telegram_id, completed, time.monotonic())
 
 def get_user_data(telegram_id: int) -> Dict[str, Any]:
     """Получить полные данные пользователя"""
@@ -1294,6 +1975,9 @@ def get_detailed_stats() -> Dict[str, Any]:
 
 def export_to_excel(filename: str = "cardio_bot_data.xlsx") -> str:
     """Экспорт данных в Excel"""
+    # pandas и openpyxl нужны только для выгрузки: не грузим их при старте бота
+    import pandas as pd
+
     db = get_db_sync()
     try:
         # Основной запрос с объединением таблиц
@@ -1737,36 +2421,43 @@ def get_database_info() -> Dict[str, Any]:
         db.close()
 
 def validate_database_integrity() -> Dict[str, Any]:
-    """Проверка целостности базы данных"""
+    """Проверка целостности базы данных (пользователи, измененные после прошлой проверки)"""
     db = get_db_sync()
     try:
         issues = []
+        changed, last_change_id = _changes_since_checkpoint(db, 'validate_database_integrity')
         
         # Проверяем пользователей без обязательных данных
-        users_without_data = db.query(User).filter(
+        users_without_data = _problem_ids(_only_changed(db.query(User), User.telegram_id, changed).filter(
             User.registration_completed == True,
-            db.or_(User.name == None, User.email == None, User.phone == None)
-        ).count()
+            or_(User.name == None, User.email == None, User.phone == None)
+        ), User.telegram_id)
         
-        if users_without_data > 0:
-            issues.append(f"Пользователей с незаполненными данными: {users_without_data}")
+        if users_without_data:
+            issues.append(f"Пользователей с незаполненными данными: {len(users_without_data)}")
         
         # Проверяем тесты без соответствующих опросов
-        tests_without_surveys = db.query(TestResult).outerjoin(Survey).filter(
-            Survey.id == None
-        ).count()
+        tests_without_surveys = _problem_ids(
+            _only_changed(db.query(TestResult), TestResult.telegram_id, changed).outerjoin(
+                Survey, Survey.telegram_id == TestResult.telegram_id
+            ).filter(
+                Survey.id == None
+            ), TestResult.telegram_id)
         
-        if tests_without_surveys > 0:
-            issues.append(f"Результатов тестов без опросов: {tests_without_surveys}")
+        if tests_without_surveys:
+            issues.append(f"Результатов тестов без опросов: {len(tests_without_surveys)}")
         
         # Проверяем консистентность статусов
-        inconsistent_statuses = db.query(User).filter(
+        inconsistent_statuses = _problem_ids(_only_changed(db.query(User), User.telegram_id, changed).filter(
             User.completed_diagnostic == True,
-            db.or_(User.survey_completed == False, User.tests_completed == False)
-        ).count()
+            or_(User.survey_completed == False, User.tests_completed == False)
+        ), User.telegram_id)
+        
+        if inconsistent_statuses:
+            issues.append(f"Пользователей с некорректными статусами: {len(inconsistent_statuses)}")
         
-        if inconsistent_statuses > 0:
-            issues.append(f"Пользователей с некорректными статусами: {inconsistent_statuses}")
+        _save_checkpoint(db, 'validate_database_integrity', last_change_id,
+                         recheck=users_without_data + tests_without_surveys + inconsistent_statuses)
         
         return {
             'healthy': len(issues) == 0,
@@ -1806,9 +2497,8 @@ def ensure_database_exists() -> bool:
         logger.error(f"❌ Проблема с базой данных: {e}")
         return False
 
-# Автоматическое обновление ежедневной статистики при импорте модуля
 def setup_daily_stats_job():
-    """Настройка автоматического обновления статистики"""
+    """Обновление ежедневной статистики (фоном после запуска бота, не при импорте)"""
     try:
         # Только пытаемся обновить статистику, если база уже инициализирована
         if os.path.exists("cardio_bot.db"):
@@ -1818,13 +2508,6 @@ def setup_daily_stats_job():
     except Exception as e:
         logger.warning(f"Ошибка при настройке ежедневной статистики: {e}")
 
-# Вызываем при импорте модуля только если это не главный модуль
-if __name__ != "__main__":
-    try:
-        setup_daily_stats_job()
-    except Exception as e:
-        logger.warning(f"Не удалось настроить ежедневную статистику: {e}")
-        
 async def log_user_activity(telegram_id: int, action: str, details: Dict[str, Any] = None, step: str = None):
     """Логирование активности пользователя с детальной информацией"""
     def _log():
@@ -1861,6 +2544,54 @@ async def log_user_activity(telegram_id: int, action: str, details: Dict[str, An
     loop = asyncio.get_event_loop()
     return await loop.run_in_executor(None, _log)
 
+async def log_user_activity_batch(entries: List[Dict[str, Any]]):
+    """Запись пачки действий пользователей одной транзакцией
+
+    entries - словари с ключами telegram_id, action, details, step, timestamp
+    """
+    def _log():
+        db = get_db_sync()
+        try:
+            last_activity = {}
+            for entry in entries:
+                db.add(ActivityLog(
+                    telegram_id=entry['telegram_id'],
+                    action=entry['action'],
+                    details=json.dumps(entry.get('details') or {}, ensure_ascii=False, default=str),
+                    step=entry.get('step'),
+                    timestamp=entry['timestamp']
+                ))
+                telegram_id = entry['telegram_id']
+                if telegram_id not in last_activity or last_activity[telegram_id] < entry['timestamp']:
+                    last_activity[telegram_id] = entry['timestamp']
+            
+            # Одно обновление на пользователя, а не на каждое действие; кто пишет боту,
+            # тот снова доступен для рассылок - но только если действие позже блокировки:
+            # пачка могла задержаться в шине событий дольше, чем шла рассылка
+            for telegram_id, timestamp in last_activity.items():
+                db.query(User).filter(User.telegram_id == telegram_id).update(
+                    {User.last_activity: timestamp, User.updated_at: timestamp},
+                    synchronize_session=False
+                )
+                db.query(User).filter(
+                    User.telegram_id == telegram_id,
+                    User.delivery_status != 'active',
+                    or_(User.blocked_at.is_(None), User.blocked_at < timestamp)
+                ).update({User.delivery_status: 'active', User.blocked_at: None}, synchronize_session=False)
+            
+            db.commit()
+            return len(entries)
+            
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Ошибка записи {len(entries)} действий в лог активности: {e}")
+            raise e
+        finally:
+            db.close()
+    
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, _log)
+
 # ============================================================================
 # УЛУЧШЕННЫЕ ФУНКЦИИ ПОЛУЧЕНИЯ СТАТИСТИКИ
 # ============================================================================
@@ -1967,15 +2698,67 @@ def get_comprehensive_user_stats() -> Dict[str, Any]:
 # УТИЛИТЫ ДЛЯ МИГРАЦИИ И ИСПРАВЛЕНИЯ ДАННЫХ
 # ============================================================================
 
+def _changes_since_checkpoint(db, name: str):
+    """Пользователи, измененные после контрольной точки name
+
+    Возвращает (подзапрос telegram_id или None, id последнего изменения).
+    None - контрольной точки еще нет, нужна полная проверка.
+    """
+    last_change_id = db.query(func.max(IntegrityChange.id)).scalar() or 0
+    checkpoint = db.get(IntegrityCheckpoint, name)
+    if checkpoint is None:
+        return None, last_change_id
+    changed = select(IntegrityChange.telegram_id).where(
+        IntegrityChange.id > checkpoint.last_change_id,
+        IntegrityChange.id <= last_change_id
+    )
+    return changed, last_change_id
+
+def _only_changed(query, column, changed):
+    return query if changed is None else query.filter(column.in_(changed))
+
+def _problem_ids(query, column) -> List[int]:
+    """telegram_id строк, нарушающих проверку (по одному на строку)"""
+    return [telegram_id for telegram_id, in query.with_entities(column)]
+
+def _save_checkpoint(db, name: str, last_change_id: int, recheck: Iterable[int] = ()):
+    """Запомнить проверенное изменение и удалить пройденные всеми проверками
+
+    recheck - пользователи с найденными проблемами: они снова ставятся в
+    integrity_changes и проверяются при следующем запуске, пока проблема
+    не будет исправлена.
+    """
+    checkpoint = db.get(IntegrityCheckpoint, name)
+    if checkpoint is None:
+        checkpoint = IntegrityCheckpoint(name=name)
+        db.add(checkpoint)
+    checkpoint.last_change_id = last_change_id
+    checkpoint.verified_at = datetime.utcnow()
+    db.flush()
+    
+    # Последняя запись не удаляется: в таблицах, созданных без AUTOINCREMENT,
+    # SQLite иначе начнет id заново и новые изменения окажутся "до" контрольных точек
+    passed = db.query(func.min(IntegrityCheckpoint.last_change_id)).scalar() or 0
+    db.query(IntegrityChange).filter(
+        IntegrityChange.id <= passed, IntegrityChange.id < last_change_id
+    ).delete(synchronize_session=False)
+    db.bulk_insert_mappings(IntegrityChange, [{'telegram_id': telegram_id} for telegram_id in sorted(set(recheck))])
+    db.commit()
+
 def fix_incomplete_records():
-    """Исправление неполных записей в базе данных"""
+    """Исправление неполных записей в базе данных
+
+    Полный проход только при первом запуске; дальше - пользователи,
+    измененные после прошлого исправления (integrity_changes).
+    """
     db = get_db_sync()
     try:
         fixed_count = 0
         current_time = datetime.utcnow()
+        changed, last_change_id = _changes_since_checkpoint(db, 'fix_incomplete_records')
         
         # Исправляем пользователей без временных меток
-        users_without_timestamps = db.query(User).filter(
+        users_without_timestamps = _only_changed(db.query(User), User.telegram_id, changed).filter(
             or_(
                 User.created_at.is_(None),
                 User.updated_at.is_(None),
@@ -1993,7 +2776,7 @@ def fix_incomplete_records():
             fixed_count += 1
         
         # Исправляем опросы без временных меток
-        surveys_without_timestamps = db.query(Survey).filter(
+        surveys_without_timestamps = _only_changed(db.query(Survey), Survey.telegram_id, changed).filter(
             or_(
                 Survey.created_at.is_(None),
                 Survey.completed_at.is_(None)
@@ -2008,7 +2791,7 @@ def fix_incomplete_records():
             fixed_count += 1
         
         # Исправляем результаты тестов без временных меток
-        tests_without_timestamps = db.query(TestResult).filter(
+        tests_without_timestamps = _only_changed(db.query(TestResult), TestResult.telegram_id, changed).filter(
             or_(
                 TestResult.created_at.is_(None),
                 TestResult.completed_at.is_(None)
@@ -2022,10 +2805,11 @@ def fix_incomplete_records():
                 test.completed_at = current_time
             fixed_count += 1
         
-        db.commit()
-        logger.info(f"Исправлено {fixed_count} записей в базе данных")
+        _save_checkpoint(db, 'fix_incomplete_records', last_change_id)
+        logger.info(f"Исправлено {fixed_count} записей в базе данных "
+                   f"({'полная проверка' if changed is None else 'изменения после прошлой проверки'})")
         
-        return {'fixed_records': fixed_count}
+        return {'fixed_records': fixed_count, 'full_scan': changed is None}
         
     except Exception as e:
         db.rollback()
@@ -2035,54 +2819,68 @@ def fix_incomplete_records():
         db.close()
 
 def validate_data_integrity():
-    """Проверка целостности данных"""
+    """Проверка целостности данных
+
+    Как и fix_incomplete_records, после первого запуска проверяет только
+    пользователей, измененных после прошлой проверки.
+    """
     db = get_db_sync()
     try:
         issues = []
+        changed, last_change_id = _changes_since_checkpoint(db, 'validate_data_integrity')
+        
+        def users():
+            return _only_changed(db.query(User), User.telegram_id, changed)
         
         # Пользователи с незавершенной регистрацией, но отмеченные как завершившие
-        inconsistent_registration = db.query(User).filter(
+        inconsistent_registration = _problem_ids(users().filter(
             User.registration_completed == True,
             or_(User.name.is_(None), User.email.is_(None), User.phone.is_(None))
-        ).count()
+        ), User.telegram_id)
         
-        if inconsistent_registration > 0:
-            issues.append(f"Пользователей с некорректным статусом регистрации: {inconsistent_registration}")
+        if inconsistent_registration:
+            issues.append(f"Пользователей с некорректным статусом регистрации: {len(inconsistent_registration)}")
         
         # Пользователи, отмеченные как завершившие опрос, но без записи в surveys
-        users_survey_mismatch = db.query(User).outerjoin(Survey).filter(
+        users_survey_mismatch = _problem_ids(users().outerjoin(Survey).filter(
             User.survey_completed == True,
             Survey.id.is_(None)
-        ).count()
+        ), User.telegram_id)
         
-        if users_survey_mismatch > 0:
-            issues.append(f"Пользователей без записи опроса: {users_survey_mismatch}")
+        if users_survey_mismatch:
+            issues.append(f"Пользователей без записи опроса: {len(users_survey_mismatch)}")
         
         # Пользователи, отмеченные как завершившие тесты, но без записи в test_results
-        users_tests_mismatch = db.query(User).outerjoin(TestResult).filter(
+        users_tests_mismatch = _problem_ids(users().outerjoin(TestResult).filter(
             User.tests_completed == True,
             TestResult.id.is_(None)
-        ).count()
+        ), User.telegram_id)
         
-        if users_tests_mismatch > 0:
-            issues.append(f"Пользователей без записи тестов: {users_tests_mismatch}")
+        if users_tests_mismatch:
+            issues.append(f"Пользователей без записи тестов: {len(users_tests_mismatch)}")
         
         # Пользователи, завершившие диагностику, но не прошедшие все этапы
-        diagnostic_incomplete = db.query(User).filter(
+        diagnostic_incomplete = _problem_ids(users().filter(
             User.completed_diagnostic == True,
             or_(
                 User.registration_completed == False,
                 User.survey_completed == False,
                 User.tests_completed == False
             )
-        ).count()
+        ), User.telegram_id)
+        
+        if diagnostic_incomplete:
+            issues.append(f"Пользователей с неполной диагностикой: {len(diagnostic_incomplete)}")
         
-        if diagnostic_incomplete > 0:
-            issues.append(f"Пользователей с неполной диагностикой: {diagnostic_incomplete}")
+        # Пользователи с проблемами перепроверяются при каждом запуске, пока их не исправят
+        _save_checkpoint(db, 'validate_data_integrity', last_change_id,
+                         recheck=inconsistent_registration + users_survey_mismatch + users_tests_mismatch
+                         + diagnostic_incomplete)
         
         return {
             'healthy': len(issues) == 0,
             'issues': issues,
+            'full_scan': changed is None,
             'checked_at': datetime.now().isoformat()
         }
         
@@ -0,0 +1,235 @@
+"""
+Доменные события: обработчики публикуют их и сразу отвечают пользователю
+
+Учет - лог активности, счетчики, кэши - подписан на события и выполняется
+в фоне пачками. Очередь каждого подписчика ограничена: если подписчик
+отстает, publish ждет места в очереди, а не копит события в памяти.
+"""
+
+import asyncio
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from database import log_user_activity_batch, remember_user_completed
+
+logger = logging.getLogger(__name__)
+
+EVENT_QUEUE_SIZE = 1000     # Событий в очереди подписчика до ожидания в publish
+EVENT_BATCH_SIZE = 200      # Максимум событий в одной пачке
+EVENT_CLOSE_TIMEOUT = 10    # Сколько ждать разбора очередей при остановке (сек)
+
+# ============================================================================
+# СОБЫТИЯ
+# ============================================================================
+
+class DomainEvent:
+    """Событие пользователя; type - имя события, оно же действие в логе активности"""
+
+    type = None
+    __slots__ = ('telegram_id', 'details', 'timestamp')
+
+    def __init__(self, telegram_id: int, **details):
+        self.telegram_id = telegram_id
+        self.details = details
+        self.timestamp = datetime.now()
+
+    @property
+    def action(self) -> str:
+        return self.type
+
+    @property
+    def step(self) -> str:
+        return self.type
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}(telegram_id={self.telegram_id})>"
+
+
+class UserRegistered(DomainEvent):
+    __slots__ = ()
+    type = "user_registered"
+
+
+class SurveyCompleted(DomainEvent):
+    __slots__ = ()
+    type = "survey_completed"
+
+
+class TestCompleted(DomainEvent):
+    """Пройден один из тестов: details содержат test и score"""
+
+    __slots__ = ()
+    type = "test_completed"
+
+    @property
+    def action(self) -> str:
+        return f"{self.details.get('test')}_completed"
+
+
+class DiagnosticCompleted(DomainEvent):
+    __slots__ = ()
+    type = "diagnostic_completed"
+
+
+class UserAction(DomainEvent):
+    """Прочие действия пользователя, нужные только для лога активности"""
+
+    type = "user_action"
+    __slots__ = ('name',)
+
+    def __init__(self, telegram_id: int, name: str, details: Optional[Dict[str, Any]] = None):
+        super().__init__(telegram_id, **(details or {}))
+        self.name = name
+
+    @property
+    def action(self) -> str:
+        return self.name
+
+    @property
+    def step(self) -> str:
+        return self.name
+
+# ============================================================================
+# ШИНА
+# ============================================================================
+
+class _Subscriber:
+    __slots__ = ('name', 'handler', 'types', 'queue', 'batch_size', 'flush_interval', 'task',
+                 'delivered', 'failed')
+
+    def __init__(self, name, handler, types, max_queue, batch_size, flush_interval):
+        self.name = name
+        self.handler = handler
+        self.types = types
+        self.queue = asyncio.Queue(max_queue)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.task = None
+        self.delivered = 0
+        self.failed = 0
+
+
+class EventBus:
+    """Рассылка событий подписчикам через ограниченные очереди
+
+    Подписчик получает список событий: все, что накопилось в очереди
+    (не больше batch_size), плюс то, что успело прийти за flush_interval.
+    """
+
+    def __init__(self):
+        self._subscribers: List[_Subscriber] = []
+        self._closing = False
+
+        # Метрики
+        self.published = 0
+        self.backpressure_waits = 0
+
+    def subscribe(self, name: str, handler, *types, max_queue: int = EVENT_QUEUE_SIZE,
+                  batch_size: int = EVENT_BATCH_SIZE, flush_interval: float = 0.0):
+        """Подписать handler(events) на события указанных классов (без классов - на все)"""
+        self._subscribers.append(_Subscriber(name, handler, types, max_queue, batch_size, flush_interval))
+
+    async def publish(self, event: DomainEvent):
+        """Передать событие подписчикам, не дожидаясь обработки"""
+        if self._closing:
+            logger.warning(f"Событие {event!r} опубликовано после остановки шины и будет потеряно")
+            return
+        self.published += 1
+        for subscriber in self._subscribers:
+            if subscriber.types and not isinstance(event, subscriber.types):
+                continue
+            if subscriber.task is None or subscriber.task.done():
+                subscriber.task = asyncio.create_task(self._consume(subscriber))
+            try:
+                subscriber.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Подписчик отстает: придерживаем издателя, а не память
+                self.backpressure_waits += 1
+                await subscriber.queue.put(event)
+
+    async def _consume(self, subscriber: _Subscriber):
+        queue = subscriber.queue
+        while True:
+            batch = [await queue.get()]
+            if subscriber.flush_interval and len(batch) < subscriber.batch_size:
+                await asyncio.sleep(subscriber.flush_interval)
+            while len(batch) < subscriber.batch_size and not queue.empty():
+                batch.append(queue.get_nowait())
+
+            try:
+                await subscriber.handler(batch)
+                subscriber.delivered += len(batch)
+            except Exception as e:
+                subscriber.failed += len(batch)
+                logger.error(f"Подписчик {subscriber.name}: ошибка обработки {len(batch)} событий: {e}")
+            finally:
+                for _ in batch:
+                    queue.task_done()
+
+    async def close(self, timeout: float = EVENT_CLOSE_TIMEOUT):
+        """Дождаться обработки уже опубликованных событий и остановить подписчиков"""
+        self._closing = True
+        pending = [subscriber for subscriber in self._subscribers if subscriber.task]
+        try:
+            await asyncio.wait_for(asyncio.gather(*(s.queue.join() for s in pending)), timeout)
+        except asyncio.TimeoutError:
+            lost = sum(s.queue.qsize() for s in pending)
+            logger.error(f"Шина событий остановлена, не обработано {lost} событий")
+        for subscriber in pending:
+            subscriber.task.cancel()
+        await asyncio.gather(*(s.task for s in pending), return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            'published': self.published,
+            'backpressure_waits': self.backpressure_waits,
+            'queued': sum(s.queue.qsize() for s in self._subscribers),
+            'failed': sum(s.failed for s in self._subscribers)
+        }
+
+# ============================================================================
+# ПОДПИСЧИКИ
+# ============================================================================
+
+async def write_activity_log(events: List[DomainEvent]):
+    """Пачка событий - одна транзакция в activity_logs"""
+    await log_user_activity_batch([
+        {
+            'telegram_id': event.telegram_id,
+            'action': event.action,
+            'details': event.details,
+            'step': event.step,
+            'timestamp': event.timestamp
+        }
+        for event in events
+    ])
+
+
+class EventCounters:
+    """Счетчики событий по типам с момента запуска"""
+
+    def __init__(self):
+        self.counts = {}
+
+    async def __call__(self, events: List[DomainEvent]):
+        counts = self.counts
+        for event in events:
+            counts[event.type] = counts.get(event.type, 0) + 1
+
+    def stats(self) -> dict:
+        return dict(self.counts)
+
+
+async def update_completed_cache(events: List[DomainEvent]):
+    """Сбросить кэш check_user_completed для пользователей из событий"""
+    for event in events:
+        remember_user_completed(event.telegram_id, True if isinstance(event, DiagnosticCompleted) else None)
+
+
+event_bus = EventBus()
+event_counters = EventCounters()
+
+event_bus.subscribe("activity_log", write_activity_log, flush_interval=0.2)
+event_bus.subscribe("counters", event_counters)
+event_bus.subscribe("user_completed_cache", update_completed_cache, UserRegistered, DiagnosticCompleted)
@@ -1,6 +1,7 @@
 import asyncio
+import functools
 import logging
-from aiogram import Router, F
+from aiogram import Router
 from aiogram.types import Message, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton,  BotCommand, BotCommandScopeDefault
 from aiogram.filters import CommandStart, StateFilter, Command
 from aiogram.fsm.context import FSMContext
@@ -9,12 +10,27 @@ from aiogram.fsm.state import State, StatesGroup
 from keyboards import *
 from database import *
 from surveys import *
+from middlewares import ExpiringMap, UserSerializer, AnswerGuardMiddleware, is_admin_action
+from routing import CallbackRoute, install_callback_trie
+from survey_engine import SurveyQuestion, load_survey, MIN_SELECTED_ALERT
+from media import materials_cache
+from outbound import edit_coalescer
+from events import event_bus, UserAction, UserRegistered, SurveyCompleted, TestCompleted, DiagnosticCompleted
 
 
 # Настройка логирования
 logger = logging.getLogger(__name__)
 
+
+async def run_db(fn, *args, **kwargs):
+    """Синхронная функция базы в пуле потоков: не блокирует цикл событий,
+    и время засчитывается обработчику в метриках (MeteredExecutor)"""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, functools.partial(fn, *args, **kwargs))
+
 router = Router()
+# callback_query выбираются по дереву префиксов callback_data, а не перебором фильтров
+install_callback_trie(router)
 
 # ============================================================================
 # MIDDLEWARE ДЛЯ ЗАЩИТЫ ОТ ЗАЦИКЛИВАНИЯ СОСТОЯНИЙ
@@ -23,10 +39,15 @@ router = Router()
 class StateProtectionMiddleware:
     """Middleware для предотвращения дублирования состояний и зацикливания"""
     
+    DEDUP_WINDOW = 2.0      # Окно дедупликации одинаковых действий (сек)
+    ACTION_CACHE_TTL = 600  # Время хранения последнего действия (сек)
+    MAX_PENDING_UPDATES = 5 # Максимальная длина очереди обновлений пользователя
+    
     def __init__(self):
-        self.processing_users = set()  # Множество пользователей в процессе обработки
-        self.user_last_action = {}     # Последние действия пользователей для дедупликации
-        self.action_timeouts = {}      # Тайм-ауты для пользователей
+        # Очереди пользователей: обновления одного пользователя обрабатываются по порядку
+        self.user_queues = UserSerializer(self.MAX_PENDING_UPDATES)
+        # Последние действия пользователей для дедупликации
+        self.user_last_action = ExpiringMap(self.ACTION_CACHE_TTL)
     
     async def __call__(self, handler, event, data):
         # Безопасная проверка наличия пользователя
@@ -50,9 +71,10 @@ class StateProtectionMiddleware:
                 return await handler(event, data)
             
             # Проверяем дедупликацию (одинаковые действия в течение 2 секунд)
-            if user_id in self.user_last_action:
-                last_action, last_time = self.user_last_action[user_id]
-                if last_action == action_id and (current_time - last_time) < 2.0:
+            last_action = self.user_last_action.get(user_id, current_time)
+            if last_action is not None:
+                last_action_id, last_time = last_action
+                if last_action_id == action_id and (current_time - last_time) < self.DEDUP_WINDOW:
                     # Дублированное действие - игнорируем
                     if hasattr(event, 'answer'):
                         try:
@@ -61,35 +83,22 @@ class StateProtectionMiddleware:
                             pass
                     return
             
-            # Проверяем, не обрабатывается ли уже запрос от этого пользователя
-            if user_id in self.processing_users:
+            # Ставим обновление в очередь пользователя
+            slot = self.user_queues.enter(user_id)
+            if slot is None:
                 if hasattr(event, 'answer'):
                     try:
-                        await event.answer("⏳ Пожалуйста, подождите, обрабатываю ваш предыдущий запрос...", show_alert=True)
+                        await event.answer("⏳ Пожалуйста, подождите, обрабатываю ваши предыдущие запросы...", show_alert=True)
                     except:
                         pass
                 return
             
-            # Проверяем тайм-аут для пользователя (защита от спама)
-            if user_id in self.action_timeouts:
-                if current_time < self.action_timeouts[user_id]:
-                    if hasattr(event, 'answer'):
-                        try:
-                            await event.answer("🔄 Слишком быстро! Подождите немного.", show_alert=True)
-                        except:
-                            pass
-                    return
-            
-            # Добавляем пользователя в обработку
-            self.processing_users.add(user_id)
-            self.user_last_action[user_id] = (action_id, current_time)
-            
-            # Устанавливаем минимальный тайм-аут между действиями (0.5 секунды)
-            self.action_timeouts[user_id] = current_time + 0.5
+            self.user_last_action.set(user_id, (action_id, current_time), current_time)
             
             try:
-                # Выполняем обработчик
-                return await handler(event, data)
+                # Ждем завершения предыдущих обновлений пользователя и выполняем обработчик
+                async with slot.lock:
+                    return await handler(event, data)
             except Exception as e:
                 logger.error(f"Ошибка в обработчике для пользователя {user_id}: {e}")
                 # Отправляем пользователю сообщение об ошибке
@@ -103,20 +112,12 @@ class StateProtectionMiddleware:
                 except Exception as answer_error:
                     logger.error(f"Не удалось отправить сообщение об ошибке пользователю {user_id}: {answer_error}")
             finally:
-                # Удаляем пользователя из обработки
-                self.processing_users.discard(user_id)
+                # Освобождаем место в очереди пользователя
+                self.user_queues.leave(user_id, slot)
                 
-                # Очищаем старые записи (старше 10 минут)
+                # Очищаем истекшие записи (снимаются только с начала очереди)
                 try:
-                    cutoff_time = current_time - 600
-                    self.user_last_action = {
-                        uid: (action, time) for uid, (action, time) in self.user_last_action.items()
-                        if time > cutoff_time
-                    }
-                    self.action_timeouts = {
-                        uid: timeout for uid, timeout in self.action_timeouts.items()
-                        if timeout > current_time
-                    }
+                    self.user_last_action.purge(current_time)
                 except Exception as cleanup_error:
                     logger.warning(f"Ошибка очистки кэша middleware: {cleanup_error}")
         
@@ -127,27 +128,20 @@ class StateProtectionMiddleware:
         
         return await handler(event, data)
     
+    def stats(self) -> dict:
+        """Состояние защиты для периодического логирования"""
+        stats = self.user_queues.stats()
+        stats['cache_size'] = len(self.user_last_action)
+        return stats
+    
+    def reset(self):
+        """Сбросить очереди и кэши"""
+        self.user_queues.clear()
+        self.user_last_action.clear()
+    
     def _is_admin_action(self, event):
         """Проверка, является ли действие административным"""
-        
-        # Список административных команд и callback'ов
-        admin_commands = ['/admin', '/stats', '/export', '/broadcast', '/adminhelp']
-        admin_callbacks = ['admin_', 'export_', 'stats_', 'broadcast_', 'clean_']
-        
-        # Проверяем текстовые команды
-        if hasattr(event, 'text') and event.text:
-            text = event.text.strip().lower()
-            for cmd in admin_commands:
-                if text.startswith(cmd):
-                    return True
-        
-        # Проверяем callback'и
-        if hasattr(event, 'data') and event.data:
-            for callback in admin_callbacks:
-                if event.data.startswith(callback):
-                    return True
-        
-        return False
+        return is_admin_action(event)
     
     def _get_action_id(self, event):
         """Получить уникальный идентификатор действия"""
@@ -176,18 +170,11 @@ class StateProtectionMiddleware:
         else:
             return "unknown"
 
-# Создаем экземпляр middleware
-class DebugStateProtectionMiddleware:
-    """Отладочная версия middleware"""
-    
-    async def __call__(self, handler, event, data):
-        if hasattr(event, 'from_user') and event.from_user:
-            user_id = event.from_user.id
-            logger.info(f"🔍 DEBUG: user_id={user_id}, event={type(event).__name__}")
-        return await handler(event, data)
+# Создаем экземпляр middleware (подключается в любом режиме, см. main.build_dispatcher)
+state_protection = StateProtectionMiddleware()
 
-# Создаем экземпляр отладочного middleware
-state_protection = DebugStateProtectionMiddleware()
+# Проверка ответов на вопросы тестов (курсоры выставляет show_current_question)
+answer_guard = AnswerGuardMiddleware()
 
 # ============================================================================
 # СОСТОЯНИЯ FSM
@@ -199,25 +186,7 @@ class UserStates(StatesGroup):
     waiting_email = State()
     waiting_phone = State()
     
-    # Опрос состояния
-    survey_age = State()
-    survey_gender = State()
-    survey_location = State()
-    survey_education = State()
-    survey_family = State()
-    survey_children = State()
-    survey_income = State()
-    survey_health = State()
-    survey_death_cause = State()
-    survey_heart_disease = State()
-    survey_cv_risk = State()
-    survey_cv_knowledge = State()
-    survey_heart_danger = State()
-    survey_health_importance = State()
-    survey_checkup_history = State()
-    survey_checkup_content = State()
-    survey_prevention_barriers = State()
-    survey_health_advice = State()
+    # Состояния вопросов опроса создаются из survey_cardio.json (survey_engine)
     
     # Тесты состояния
     test_selection = State()
@@ -244,24 +213,17 @@ async def setup_bot_commands(bot):
 # ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ДЛЯ ЗАЩИТЫ СОСТОЯНИЙ
 # ============================================================================
 
-async def safe_edit_message(message, text, parse_mode="HTML", reply_markup=None, max_retries=3):
-    """Безопасное редактирование сообщения с повторными попытками"""
-    for attempt in range(max_retries):
-        try:
-            await message.edit_text(text, parse_mode=parse_mode, reply_markup=reply_markup)
-            return True
-        except Exception as e:
-            if "message is not modified" in str(e):
-                return True  # Сообщение уже такое
-            if attempt == max_retries - 1:
-                # Последняя попытка - отправляем новое сообщение
-                try:
-                    await message.answer(text, parse_mode=parse_mode, reply_markup=reply_markup)
-                    return True
-                except:
-                    return False
-            await asyncio.sleep(0.5)
-    return False
+async def safe_edit_message(message, text, parse_mode="HTML", reply_markup=None, wait=True):
+    """Безопасное редактирование сообщения через склеивание правок
+
+    wait=False - не ждать отправки: следующий апдейт пользователя обработается
+    сразу, а правка, которую он успеет заменить, не уйдет в Telegram. True
+    тогда означает только, что правка поставлена в очередь, а не отправлена.
+    """
+    future = edit_coalescer.edit(message, text, parse_mode=parse_mode, reply_markup=reply_markup)
+    if not wait:
+        return True
+    return await asyncio.shield(future)
 
 async def safe_answer_callback(callback, text="", show_alert=False, max_retries=2):
     """Безопасный ответ на callback"""
@@ -278,16 +240,8 @@ async def safe_answer_callback(callback, text="", show_alert=False, max_retries=
     return False
 
 async def log_user_interaction(user_id: int, action: str, details: str = None):
-    """Логирование взаимодействий пользователя"""
-    try:
-        await log_user_activity(
-            telegram_id=user_id,
-            action=action,
-            details={"interaction": details} if details else {},
-            step=action
-        )
-    except Exception as e:
-        logger.warning(f"Не удалось залогировать активность пользователя {user_id}: {e}")
+    """Логирование взаимодействий пользователя: запись в базу выполнит шина событий"""
+    await event_bus.publish(UserAction(user_id, action, {"interaction": details} if details else None))
 
 # ============================================================================
 # КОМАНДЫ БОТА (С ЗАЩИТОЙ)
@@ -299,7 +253,7 @@ async def help_command(message: Message, state: FSMContext):
     await log_user_interaction(message.from_user.id, "help_requested")
     
     # Проверяем статус пользователя
-    user_completed = check_user_completed(message.from_user.id)
+    user_completed = await check_user_completed(message.from_user.id)
     current_state = await state.get_state()
     
     if user_completed:
@@ -372,7 +326,7 @@ async def status_command(message: Message, state: FSMContext):
     
     try:
         # Получаем данные пользователя
-        data = get_user_data(message.from_user.id)
+        data = await run_db(get_user_data, message.from_user.id)
         user = data.get('user')
         survey = data.get('survey') 
         tests = data.get('tests')
@@ -456,7 +410,7 @@ async def start_command_protected(message: Message, state: FSMContext):
     current_state = await state.get_state()
     
     # Проверяем, завершил ли пользователь диагностику
-    user_completed = check_user_completed(message.from_user.id)
+    user_completed = await check_user_completed(message.from_user.id)
     
     if user_completed:
         # Пользователь уже завершил диагностику
@@ -506,7 +460,7 @@ async def show_completed_user_info(message: Message, state: FSMContext):
     """Показать информацию для завершившего диагностику пользователя"""
     
     try:
-        data = get_user_data(message.from_user.id)
+        data = await run_db(get_user_data, message.from_user.id)
         user = data.get('user')
         tests = data.get('tests')
         
@@ -558,7 +512,7 @@ async def show_start_message(message: Message, state: FSMContext):
 # ОБРАБОТЧИКИ CALLBACK'ОВ ДЛЯ ЗАЩИТЫ СОСТОЯНИЙ
 # ============================================================================
 
-@router.callback_query(F.data == "continue_current")
+@router.callback_query(CallbackRoute("continue_current"))
 async def continue_current_process(callback: CallbackQuery, state: FSMContext):
     """Продолжить с текущего места"""
     await safe_answer_callback(callback)
@@ -612,7 +566,7 @@ async def continue_current_process(callback: CallbackQuery, state: FSMContext):
     else:
         await safe_edit_message(callback.message, "Продолжаем с того места, где остановились...")
 
-@router.callback_query(F.data == "restart_from_beginning")
+@router.callback_query(CallbackRoute("restart_from_beginning"))
 async def restart_from_beginning(callback: CallbackQuery, state: FSMContext):
     """Начать заново с самого начала"""
     await safe_answer_callback(callback)
@@ -633,14 +587,14 @@ async def restart_from_beginning(callback: CallbackQuery, state: FSMContext):
     await safe_edit_message(callback.message, text, reply_markup=keyboard)
     await state.set_state(UserStates.waiting_start)
 
-@router.callback_query(F.data == "show_status")
+@router.callback_query(CallbackRoute("show_status"))
 async def show_status_callback(callback: CallbackQuery, state: FSMContext):
     """Показать статус через callback"""
     await safe_answer_callback(callback)
     await log_user_interaction(callback.from_user.id, "show_status_callback")
     
     try:
-        data = get_user_data(callback.from_user.id)
+        data = await run_db(get_user_data, callback.from_user.id)
         user = data.get('user')
         
         if not user:
@@ -673,7 +627,7 @@ async def show_status_callback(callback: CallbackQuery, state: FSMContext):
         logger.error(f"Ошибка в show_status_callback для пользователя {callback.from_user.id}: {e}")
         await safe_edit_message(callback.message, "❌ Ошибка получения статуса")
 
-@router.callback_query(F.data == "show_full_results")
+@router.callback_query(CallbackRoute("show_full_results"))
 async def show_full_results(callback: CallbackQuery, state: FSMContext):
     """Показать полные результаты диагностики"""
     await safe_answer_callback(callback)
@@ -692,7 +646,7 @@ async def show_full_results(callback: CallbackQuery, state: FSMContext):
         logger.error(f"Ошибка в show_full_results для пользователя {callback.from_user.id}: {e}")
         await safe_edit_message(callback.message, "❌ Ошибка получения результатов")
 
-@router.callback_query(F.data == "show_materials")
+@router.callback_query(CallbackRoute("show_materials"))
 async def show_materials_callback(callback: CallbackQuery, state: FSMContext):
     """Показать материалы к вебинару"""
     await safe_answer_callback(callback)
@@ -721,7 +675,7 @@ async def show_materials_callback(callback: CallbackQuery, state: FSMContext):
     
     await safe_edit_message(callback.message, text, reply_markup=keyboard)
 
-@router.callback_query(F.data == "confirm_restart")
+@router.callback_query(CallbackRoute("confirm_restart"))
 async def confirm_restart(callback: CallbackQuery, state: FSMContext):
     """Подтверждение перезапуска"""
     await safe_answer_callback(callback)
@@ -744,7 +698,7 @@ async def confirm_restart(callback: CallbackQuery, state: FSMContext):
     await safe_edit_message(callback.message, text, reply_markup=keyboard)
     await state.set_state(UserStates.waiting_start)
 
-@router.callback_query(F.data == "cancel_restart")
+@router.callback_query(CallbackRoute("cancel_restart"))
 async def cancel_restart(callback: CallbackQuery, state: FSMContext):
     """Отмена перезапуска"""
     await safe_answer_callback(callback)
@@ -765,7 +719,7 @@ async def cancel_restart(callback: CallbackQuery, state: FSMContext):
 # ОСНОВНЫЕ ОБРАБОТЧИКИ (ОРИГИНАЛЬНЫЕ С ЗАЩИТОЙ)
 # ============================================================================
 
-@router.callback_query(F.data == "start_bot", StateFilter(UserStates.waiting_start))
+@router.callback_query(CallbackRoute("start_bot"), StateFilter(UserStates.waiting_start))
 async def handle_start_bot(callback: CallbackQuery, state: FSMContext):
     """Обработка нажатия кнопки Старт"""
     await safe_answer_callback(callback)
@@ -875,13 +829,8 @@ async def handle_phone(message: Message, state: FSMContext):
     # КРИТИЧЕСКИ ВАЖНО: ТОЛЬКО from_user.id - это настоящий telegram_id
     REAL_USER_ID = message.from_user.id
     
-    print("=" * 80)
-    print("🚨 ИСПРАВЛЕННАЯ ОБРАБОТКА ТЕЛЕФОНА")
-    print(f"✅ НАСТОЯЩИЙ user_id: {REAL_USER_ID}")
-    print(f"📱 from_user.id: {message.from_user.id}")
-    print(f"💬 chat.id: {message.chat.id}")
-    print(f"📝 message_id: {message.message_id}")
-    print("=" * 80)
+    logger.debug("Обработка телефона", extra={'telegram_id': REAL_USER_ID, 'chat_id': message.chat.id,
+                                               'message_id': message.message_id})
     
     # ДОПОЛНИТЕЛЬНАЯ ПРОВЕРКА
     if REAL_USER_ID != message.from_user.id:
@@ -917,11 +866,7 @@ async def handle_phone(message: Message, state: FSMContext):
     name = data.get('name', f'Пользователь_{REAL_USER_ID}')
     email = data.get('email', f'user_{REAL_USER_ID}@bot.com')
     
-    logger.info(f"🔍 ИСПРАВЛЕННЫЕ данные для сохранения:")
-    logger.info(f"   telegram_id: {REAL_USER_ID}")
-    logger.info(f"   name: {name}")
-    logger.info(f"   email: {email}")
-    logger.info(f"   phone: {phone}")
+    logger.debug("Данные регистрации для сохранения", extra={'telegram_id': REAL_USER_ID})
     
     try:
         # ИСПОЛЬЗУЕМ ИСПРАВЛЕННУЮ ФУНКЦИЮ
@@ -940,6 +885,8 @@ async def handle_phone(message: Message, state: FSMContext):
             success_message = "✅ Данные получены! Продолжаем..."
         
         await message.answer(success_message)
+        if save_result['success']:
+            await event_bus.publish(UserRegistered(REAL_USER_ID))
         
     except Exception as e:
         logger.error(f"❌ ОШИБКА исправленного сохранения: {e}")
@@ -949,9 +896,12 @@ async def handle_phone(message: Message, state: FSMContext):
     await start_survey(message, state)
 
 # ============================================================================
-# ОБРАБОТЧИКИ ОПРОСА (ПОЛНЫЕ ОРИГИНАЛЬНЫЕ)
+# ОБРАБОТЧИКИ ОПРОСА
 # ============================================================================
 
+# Вопросы, варианты и ограничения описаны в survey_cardio.json
+cardio_survey = load_survey("survey_cardio.json")
+
 async def start_survey(message: Message, state: FSMContext):
     """Начало опроса с удалением предыдущих сообщений"""
     await log_user_interaction(message.from_user.id, "survey_started")
@@ -965,200 +915,33 @@ async def start_survey(message: Message, state: FSMContext):
             except:
                 pass  # Игнорируем ошибки удаления
 
-    text = """<b>❓ Вопрос 1</b>
-Сколько вам лет?
-(введите число)"""
-    
-    await message.answer(text, parse_mode="HTML")
-    await state.set_state(UserStates.survey_age)
-
-@router.message(StateFilter(UserStates.survey_age))
-async def handle_age(message: Message, state: FSMContext):
-    """Обработка возраста с удалением сообщений"""
-    await log_user_interaction(message.from_user.id, "age_entered", message.text)
-    
-    try:
-        age = int(message.text.strip())
-        if age < 1 or age > 120:
-            await message.answer("Пожалуйста, введите корректный возраст.")
-            return
-        
-        await state.update_data(age=age)
-        
-        # Удаляем сообщение пользователя и вопрос
-        await message.delete()
-        # Пытаемся найти и удалить сообщение с вопросом (обычно предыдущее)
-        if message.message_id > 1:
-            try:
-                await message.bot.delete_message(chat_id=message.chat.id, message_id=message.message_id - 1)
-            except:
-                pass
-       
-        text = """<b>❓ Вопрос 2</b>
-
-Ваш пол"""
-        
-        keyboard = get_gender_keyboard()
-        await message.answer(text, parse_mode="HTML", reply_markup=keyboard)
-        await state.set_state(UserStates.survey_gender)
-        
-    except ValueError:
-        await message.answer("Пожалуйста, введите число.")
-
-@router.callback_query(F.data.in_(["gender_female", "gender_male"]), StateFilter(UserStates.survey_gender))
-async def handle_gender(callback: CallbackQuery, state: FSMContext):
-    """Обработка пола"""
-    await safe_answer_callback(callback)
-    await log_user_interaction(callback.from_user.id, "gender_selected", callback.data)
-    
-    gender = "Женский" if callback.data == "gender_female" else "Мужской"
-    await state.update_data(gender=gender)
-    
-    text = """<b>❓ Вопрос 3</b>
-Где вы живёте?
-(выберите 1 вариант ответа)
-
-Выберите тип населённого пункта:"""
-    
-    keyboard = get_location_keyboard()
-    await safe_edit_message(callback.message, text, reply_markup=keyboard)
-    await state.set_state(UserStates.survey_location)
-
-@router.callback_query(F.data.startswith("location_"), StateFilter(UserStates.survey_location))
-async def handle_location(callback: CallbackQuery, state: FSMContext):
-    """Обработка места жительства"""
-    await safe_answer_callback(callback)
-    await log_user_interaction(callback.from_user.id, "location_selected", callback.data)
-    
-    location_map = {
-        "location_big_city": "Город с населением >1 млн",
-        "location_medium_city": "Город 500–999 тыс",
-        "location_small_city": "Город с населением 100–500 тыс",
-        "location_town": "Город до 100 тыс",
-        "location_village": "Поселок / сельская местность"
-    }
-    
-    location = location_map[callback.data]
-    await state.update_data(location=location)
-    
-    text = """<b>❓ Вопрос 4</b>
-Ваше образование
-(выберите 1 вариант ответа)"""
-    
-    keyboard = get_education_keyboard()
-    await safe_edit_message(callback.message, text, reply_markup=keyboard)
-    await state.set_state(UserStates.survey_education)
-
-@router.callback_query(F.data.startswith("education_"), StateFilter(UserStates.survey_education))
-async def handle_education(callback: CallbackQuery, state: FSMContext):
-    """Обработка образования"""
-    await safe_answer_callback(callback)
-    await log_user_interaction(callback.from_user.id, "education_selected", callback.data)
-    
-    education_map = {
-        "education_secondary": "Среднее общее",
-        "education_vocational": "Средне-специальное",
-        "education_higher": "Высшее (немедицинское)",
-        "education_medical": "Высшее медицинское"
-    }
-    
-    education = education_map[callback.data]
-    await state.update_data(education=education)
-    
-    text = """<b>❓ Вопрос 5</b>
-Ваше семейное положение
-(выберите 1 вариант ответа)"""
-    
-    keyboard = get_family_keyboard()
-    await safe_edit_message(callback.message, text, reply_markup=keyboard)
-    await state.set_state(UserStates.survey_family)
+    await ask_survey_question(message, state, cardio_survey.first)
 
-@router.callback_query(F.data.startswith("family_"), StateFilter(UserStates.survey_family))
-async def handle_family(callback: CallbackQuery, state: FSMContext):
-    """Обработка семейного положения"""
-    await safe_answer_callback(callback)
-    await log_user_interaction(callback.from_user.id, "family_selected", callback.data)
-    
-    family_map = {
-        "family_single": "Холост / не замужем",
-        "family_married": "В браке",
-        "family_divorced": "Разведён(а) / вдов(ец/а)"
-    }
-    
-    family = family_map[callback.data]
-    await state.update_data(family_status=family)
-    
-    text = """<b>❓ Вопрос 6</b>
-Есть ли у вас дети?
-(выберите 1 вариант ответа)"""
-    
-    keyboard = get_children_keyboard()
-    await safe_edit_message(callback.message, text, reply_markup=keyboard)
-    await state.set_state(UserStates.survey_children)
-
-@router.callback_query(F.data.startswith("children_"), StateFilter(UserStates.survey_children))
-async def handle_children(callback: CallbackQuery, state: FSMContext):
-    """Обработка наличия детей"""
-    await safe_answer_callback(callback)
-    await log_user_interaction(callback.from_user.id, "children_selected", callback.data)
-    
-    children_map = {
-        "children_none": "Нет",
-        "children_one": "Да, один",
-        "children_multiple": "Да, двое и более"
-    }
-    
-    children = children_map[callback.data]
-    await state.update_data(children=children)
-    
-    text = """<b>❓ Вопрос 7</b>
-Среднемесячный доход на 1 работающего человека в семье 
-(выберите 1 вариант ответа)"""
+async def ask_survey_question(message: Message, state: FSMContext, question: SurveyQuestion, edit: bool = False):
+    """Показать вопрос опроса и перевести пользователя в его состояние"""
+    if edit:
+        await safe_edit_message(message, question.text, reply_markup=question.keyboard())
+    else:
+        await message.answer(question.text, parse_mode="HTML", reply_markup=question.keyboard())
     
-    keyboard = get_income_keyboard()
-    await safe_edit_message(callback.message, text, reply_markup=keyboard)
-    await state.set_state(UserStates.survey_income)
+    if question.kind == 'multi':
+        await state.update_data({question.selected_key: []})  # Инициализируем список выбранных вариантов
+    await state.set_state(question.state)
 
-@router.callback_query(F.data.startswith("income_"), StateFilter(UserStates.survey_income))
-async def handle_income(callback: CallbackQuery, state: FSMContext):
-    """Обработка дохода"""
-    await safe_answer_callback(callback)
-    await log_user_interaction(callback.from_user.id, "income_selected", callback.data)
-    
-    income_map = {
-        "income_low": "До 20 000 ₽",
-        "income_medium": "20–40 тыс ₽",
-        "income_high": "40–70 тыс ₽",
-        "income_very_high": "Более 70 тыс ₽",
-        "income_no_answer": "Предпочитаю не указывать"
-    }
-    
-    income = income_map[callback.data]
-    await state.update_data(income=income)
+@router.message(cardio_survey.question_filter('number'))
+async def handle_survey_text(message: Message, state: FSMContext, survey_question: SurveyQuestion):
+    """Текстовый ответ на вопрос опроса (возраст, оценка здоровья)"""
+    await log_user_interaction(message.from_user.id, f"{survey_question.key}_entered", message.text)
     
-    text = """<b>❓ Вопрос 8</b>
-Как вы оцениваете своё здоровье по шкале от 0 до 10?
-(0 — очень плохо, 10 — отлично)
-
-Введите число"""
+    value, error = survey_question.parse(message.text)
+    if error:
+        await message.answer(error)
+        return
     
-    await safe_edit_message(callback.message, text)
-    await state.set_state(UserStates.survey_health)
-
-@router.message(StateFilter(UserStates.survey_health))
-async def handle_health_rating(message: Message, state: FSMContext):
-    """Обработка оценки здоровья"""
-    await log_user_interaction(message.from_user.id, "health_rating_entered", message.text)
+    await state.update_data({survey_question.key: value})
     
+    # Удаляем сообщение пользователя и вопрос
     try:
-        health_rating = int(message.text.strip())
-        if health_rating < 0 or health_rating > 10:
-            await message.answer("Пожалуйста, введите число от 0 до 10.")
-            return
-        
-        await state.update_data(health_rating=health_rating)
-        
-        # Удаляем сообщение пользователя и вопрос
         await message.delete()
         # Пытаемся найти и удалить сообщение с вопросом (обычно предыдущее)
         if message.message_id > 1:
@@ -1166,389 +949,101 @@ async def handle_health_rating(message: Message, state: FSMContext):
                 await message.bot.delete_message(chat_id=message.chat.id, message_id=message.message_id - 1)
             except:
                 pass
-
-        text = """<b>❓ Вопрос 9</b>
-На ваш взгляд, какая из перечисленных причин чаще всего приводит к смерти людей в мире? 
-(выберите 1 вариант ответа)"""
-        
-        keyboard = get_death_cause_keyboard()
-        await message.answer(text, parse_mode="HTML", reply_markup=keyboard)
-        await state.set_state(UserStates.survey_death_cause)
-        
-    except ValueError:
-        await message.answer("Пожалуйста, введите число от 0 до 10.")
-
-
-@router.callback_query(F.data.startswith("death_cause_"), StateFilter(UserStates.survey_death_cause))
-async def handle_death_cause(callback: CallbackQuery, state: FSMContext):
-    """Обработка причины смерти"""
-    await safe_answer_callback(callback)
-    await log_user_interaction(callback.from_user.id, "death_cause_selected", callback.data)
-    
-    cause_map = {
-        "death_cause_cancer": "Онкологические заболевания",
-        "death_cause_cardio": "Сердечно-сосудистые заболевания",
-        "death_cause_infections": "Инфекции",
-        "death_cause_respiratory": "Болезни дыхательных путей",
-        "death_cause_digestive": "Болезни желудочно-кишечного тракта",
-        "death_cause_external": "Внешние причины"
-    }
-    
-    death_cause = cause_map[callback.data]
-    await state.update_data(death_cause=death_cause)
-    
-    text = """<b>❓ Вопрос 10</b>
-Есть ли у вас хронические заболевания сердца или сосудов?
-(выберите 1 вариант ответа)"""
-    
-    keyboard = get_heart_disease_keyboard()
-    await safe_edit_message(callback.message, text, reply_markup=keyboard)
-    await state.set_state(UserStates.survey_heart_disease)
-
-@router.callback_query(F.data.startswith("heart_disease_"), StateFilter(UserStates.survey_heart_disease))
-async def handle_heart_disease(callback: CallbackQuery, state: FSMContext):
-    """Обработка наличия заболеваний сердца"""
-    await safe_answer_callback(callback)
-    await log_user_interaction(callback.from_user.id, "heart_disease_selected", callback.data)
-    
-    disease_map = {
-        "heart_disease_yes": "Да",
-        "heart_disease_no": "Нет",
-        "heart_disease_unknown": "Не знаю / не обследовался(ась)"
-    }
-    
-    heart_disease = disease_map[callback.data]
-    await state.update_data(heart_disease=heart_disease)
-    
-    text = """<b>❓ Вопрос 11</b>
-Как вы оцениваете свой сердечно-сосудистый риск? 
-(выберите 1 вариант ответа)"""
-    
-    keyboard = get_cv_risk_keyboard()
-    await safe_edit_message(callback.message, text, reply_markup=keyboard)
-    await state.set_state(UserStates.survey_cv_risk)
-
-@router.callback_query(F.data.startswith("cv_risk_"), StateFilter(UserStates.survey_cv_risk))
-async def handle_cv_risk(callback: CallbackQuery, state: FSMContext):
-    """Обработка оценки сердечно-сосудистого риска"""
-    await safe_answer_callback(callback)
-    await log_user_interaction(callback.from_user.id, "cv_risk_selected", callback.data)
-    
-    risk_map = {
-        "cv_risk_low": "низкий/умеренный",
-        "cv_risk_high": "высокий",
-        "cv_risk_very_high": "очень высокий"
-    }
-    
-    cv_risk = risk_map[callback.data]
-    await state.update_data(cv_risk=cv_risk)
-    
-    text = """<b>❓ Вопрос 12</b>
-Слышали ли вы раньше о факторах риска сердечно-сосудистых заболеваний?
-(выберите 1 вариант ответа)"""
-    
-    keyboard = get_cv_knowledge_keyboard()
-    await safe_edit_message(callback.message, text, reply_markup=keyboard)
-    await state.set_state(UserStates.survey_cv_knowledge)
-
-@router.callback_query(F.data.startswith("cv_knowledge_"), StateFilter(UserStates.survey_cv_knowledge))
-async def handle_cv_knowledge(callback: CallbackQuery, state: FSMContext):
-    """Обработка знания о факторах риска"""
-    await safe_answer_callback(callback)
-    await log_user_interaction(callback.from_user.id, "cv_knowledge_selected", callback.data)
-    
-    knowledge_map = {
-        "cv_knowledge_good": "Да, хорошо разбираюсь",
-        "cv_knowledge_some": "Да, но не до конца понимаю",
-        "cv_knowledge_none": "Нет / почти ничего не знаю"
-    }
-    
-    cv_knowledge = knowledge_map[callback.data]
-    await state.update_data(cv_knowledge=cv_knowledge)
-    
-    text = """<b>❓ Вопрос 13</b>
-Что из перечисленного вы считаете наиболее опасным для сердца?
-(выберите до 3 вариантов)"""
+    except Exception as e:
+        logger.warning(f"Не удалось удалить сообщения: {e}")
     
-    await state.update_data(heart_danger_selected=[])  # Инициализируем список выбранных вариантов
-    keyboard = get_heart_danger_keyboard([])
-    await safe_edit_message(callback.message, text, reply_markup=keyboard)
-    await state.set_state(UserStates.survey_heart_danger)
+    await ask_survey_question(message, state, survey_question.next)
 
-@router.callback_query(F.data.startswith("heart_danger_"), StateFilter(UserStates.survey_heart_danger))
-async def handle_heart_danger(callback: CallbackQuery, state: FSMContext):
-    """Обработка опасных факторов для сердца (мультивыбор до 3)"""
-    await safe_answer_callback(callback)
-    
-    data = await state.get_data()
-    selected = data.get('heart_danger_selected', [])
+@router.callback_query(CallbackRoute(*cardio_survey.callback_data), cardio_survey.question_filter('single', 'multi'))
+async def handle_survey_choice(callback: CallbackQuery, state: FSMContext, survey_question: SurveyQuestion):
+    """Ответ кнопкой на вопрос опроса: один вариант или мультивыбор"""
     
-    if callback.data == "heart_danger_done":
-        if not selected:
-            await safe_answer_callback(callback, "Выберите хотя бы один вариант", show_alert=True)
-            return
-        
-        await state.update_data(heart_danger=selected)
-        await log_user_interaction(callback.from_user.id, "heart_danger_completed", f"Selected: {len(selected)} items")
+    if survey_question.kind == 'single':
+        option = survey_question.by_callback.get(callback.data)
+        await safe_answer_callback(callback)
+        if option is None:
+            return  # Кнопка другого вопроса
         
-        text = """<b>❓ Вопрос 14</b>
-Как вы оцениваете для себя важность регулярного наблюдения за здоровьем сердца?
-(выберите 1 вариант ответа)"""
-        
-        keyboard = get_health_importance_keyboard()
-        await safe_edit_message(callback.message, text, reply_markup=keyboard)
-        await state.set_state(UserStates.survey_health_importance)
+        await log_user_interaction(callback.from_user.id, f"{survey_question.key}_selected", callback.data)
+        await state.update_data({survey_question.key: option.value})
+        await advance_survey(callback, state, survey_question)
         return
     
-    danger_map = {
-        "heart_danger_age": "Возраст",
-        "heart_danger_male": "Мужской пол",
-        "heart_danger_family": "Семейный анамнез ранних сердечно-сосудистых заболеваний",
-        "heart_danger_pressure": "Повышенное артериальное давление",
-        "heart_danger_cholesterol": "Повышенный холестерин",
-        "heart_danger_glucose": "Повышение глюкозы в крови",
-        "heart_danger_weight": "Избыточный вес",
-        "heart_danger_smoking": "Курение",
-        "heart_danger_alcohol": "Алкоголь",
-        "heart_danger_nutrition": "Несбалансированное питание",
-        "heart_danger_sedentary": "Малоподвижный образ жизни",
-        "heart_danger_stress": "Стрессы",
-        "heart_danger_sleep": "Нарушение сна, храп"
-    }
-    
-    danger_option = danger_map.get(callback.data)
-    if danger_option:
-        if danger_option in selected:
-            selected.remove(danger_option)
-        else:
-            if len(selected) < 3:
-                selected.append(danger_option)
-            else:
-                await safe_answer_callback(callback, "Можно выбрать максимум 3 варианта", show_alert=True)
-                return
-        
-        await state.update_data(heart_danger_selected=selected)
-        keyboard = get_heart_danger_keyboard(selected)
-        await safe_edit_message(callback.message, callback.message.text, reply_markup=keyboard)
-
-@router.callback_query(F.data.startswith("health_importance_"), StateFilter(UserStates.survey_health_importance))
-async def handle_health_importance(callback: CallbackQuery, state: FSMContext):
-    """Обработка важности наблюдения за здоровьем сердца"""
-    await safe_answer_callback(callback)
-    await log_user_interaction(callback.from_user.id, "health_importance_selected", callback.data)
-    
-    importance_map = {
-        "health_importance_elderly": "Это для пожилых/хронически больных, \nно не про меня",
-        "health_importance_secondary": "Важно, но не на первом месте",
-        "health_importance_understand": "Понимаю, что нужно, но раньше об этом не думал(а)",
-        "health_importance_plan": "Осознаю значимость — планирую действовать"
-    }
-    
-    health_importance = importance_map[callback.data]
-    await state.update_data(health_importance=health_importance)
-    
-    text = """<b>❓ Вопрос 15</b>
-Проходили ли вы кардиочекап ранее?
-(выберите 1 вариант ответа)"""
-    
-    keyboard = get_checkup_history_keyboard()
-    await safe_edit_message(callback.message, text, reply_markup=keyboard)
-    await state.set_state(UserStates.survey_checkup_history)
-
-@router.callback_query(F.data.startswith("checkup_history_"), StateFilter(UserStates.survey_checkup_history))
-async def handle_checkup_history(callback: CallbackQuery, state: FSMContext):
-    """Обработка истории кардиочекапов"""
-    await safe_answer_callback(callback)
-    await log_user_interaction(callback.from_user.id, "checkup_history_selected", callback.data)
-    
-    history_map = {
-        "checkup_history_recent": "Да, в последние 12 месяцев",
-        "checkup_history_old": "Да, более года назад",
-        "checkup_history_never": "Нет, никогда",
-        "checkup_history_forgot": "Не помню"
-    }
-    
-    checkup_history = history_map[callback.data]
-    await state.update_data(checkup_history=checkup_history)
-    
-    text = """<b>❓ Вопрос 16</b>
-Если вы проходили кардиочекап, то какие обследования он включал? 
-(выберите все подходящие варианты)"""
-    
-    await state.update_data(checkup_content_selected=[])
-    keyboard = get_checkup_content_keyboard([])
-    await safe_edit_message(callback.message, text, reply_markup=keyboard)
-    await state.set_state(UserStates.survey_checkup_content)
-
-@router.callback_query(F.data.startswith("checkup_content_"), StateFilter(UserStates.survey_checkup_content))
-async def handle_checkup_content(callback: CallbackQuery, state: FSMContext):
-    """ПОЛНОСТЬЮ ИСПРАВЛЕННАЯ обработка содержимого кардиочекапа"""
-    await safe_answer_callback(callback)
-    
     data = await state.get_data()
-    selected = data.get('checkup_content_selected', [])
+    selected = data.get(survey_question.selected_key, [])
     
-    if callback.data == "checkup_content_done":
-        await state.update_data(checkup_content=selected)
-        await log_user_interaction(callback.from_user.id, "checkup_content_completed", f"Selected: {len(selected)} items")
-        
-        text = """<b>❓ Вопрос 17</b>
-Что мешает вам пройти профилактическое обследование сейчас?
-(выберите все подходящие варианты)"""
+    if callback.data == survey_question.done_callback:
+        if len(selected) < survey_question.min_selected:
+            await safe_answer_callback(callback, MIN_SELECTED_ALERT, show_alert=True)
+            return
         
-        await state.update_data(prevention_barriers_selected=[])
-        keyboard = get_prevention_barriers_keyboard([])
-        await safe_edit_message(callback.message, text, reply_markup=keyboard)
-        await state.set_state(UserStates.survey_prevention_barriers)
+        await safe_answer_callback(callback)
+        await state.update_data({survey_question.key: selected})
+        await log_user_interaction(callback.from_user.id, f"{survey_question.key}_completed", f"Selected: {len(selected)} items")
+        await advance_survey(callback, state, survey_question)
         return
     
-    # ТОЧНОЕ соответствие названий с клавиатурой
-    content_map = {
-        "checkup_content_consultation": "Консультация и осмотр врача-кардиолога / терапевта",
-        "checkup_content_risk_assessment": "Оценка факторов риска сердечно-сосудистых заболеваний",
-        "checkup_content_lipids": "Определение уровня липидов крови",
-        "checkup_content_glucose": "Определение уровня глюкозы крови",
-        "checkup_content_ecg": "ЭКГ",
-        "checkup_content_ultrasound": "УЗИ сосудов (дуплексное сканирование)",
-        "checkup_content_echo": "ЭхоКГ",
-        "checkup_content_monitoring": "Суточное мониторирование давления",
-        "checkup_content_ct": "МСКТ-коронарный кальций",
-        "checkup_content_calc": "Расчет индивидуального СС-риска"
-    }
-    
-    if callback.data == "checkup_content_skip":
-        # Обрабатываем "Не проходил(а)"
-        if "Не проходил(а)" in selected:
-            selected.remove("Не проходил(а)")
-        else:
-            # Очищаем все остальные выборы и добавляем "Не проходил(а)"
-            selected.clear()
-            selected.append("Не проходил(а)")
-        
-        await state.update_data(checkup_content_selected=selected)
-        keyboard = get_checkup_content_keyboard(selected)
-        await safe_edit_message(callback.message, callback.message.text, reply_markup=keyboard)
+    option = survey_question.by_callback.get(callback.data)
+    if option is None:
+        await safe_answer_callback(callback)  # Кнопка другого вопроса
         return
     
-    # Обрабатываем выбор конкретного пункта
-    content_option = content_map.get(callback.data)
-    if content_option:
-        # Если выбираем обычную опцию, убираем "Не проходил(а)"
-        if "Не проходил(а)" in selected:
-            selected.remove("Не проходил(а)")
-        
-        if content_option in selected:
-            selected.remove(content_option)
-        else:
-            selected.append(content_option)
-        
-        await state.update_data(checkup_content_selected=selected)
-        keyboard = get_checkup_content_keyboard(selected)
-        await safe_edit_message(callback.message, callback.message.text, reply_markup=keyboard)
+    selected, alert = survey_question.toggle(selected, option)
+    if alert:
+        await safe_answer_callback(callback, alert, show_alert=True)
         return
     
-    # Если дошли сюда - неизвестный callback
-    await safe_answer_callback(callback, "Неизвестная команда", show_alert=True)
-
-
-@router.callback_query(F.data.startswith("prevention_barriers_"), StateFilter(UserStates.survey_prevention_barriers))
-async def handle_prevention_barriers(callback: CallbackQuery, state: FSMContext):
-    """Обработка препятствий для профилактического обследования (мультивыбор)"""
     await safe_answer_callback(callback)
-    
-    data = await state.get_data()
-    selected = data.get('prevention_barriers_selected', [])
-    
-    if callback.data == "prevention_barriers_done":
-        await state.update_data(prevention_barriers=selected)
-        await log_user_interaction(callback.from_user.id, "prevention_barriers_completed", f"Selected: {len(selected)} items")
-        
-        text = """<b>❓ Вопрос 18</b>
-С кем вы обычно советуетесь, если появляются вопросы со здоровьем?
-(выберите до 2 вариантов)"""
-        
-        await state.update_data(health_advice_selected=[])
-        keyboard = get_health_advice_keyboard([])
-        await safe_edit_message(callback.message, text, reply_markup=keyboard)
-        await state.set_state(UserStates.survey_health_advice)
-        return
-    
-    if callback.data == "prevention_barriers_other":
-        await callback.message.answer("Введите ваш вариант:")
-        # Здесь можно добавить обработку ввода текста для "Другое"
-        return
-    
-    barriers_map = {
-        "prevention_barriers_no_symptoms": "Не вижу необходимости — нет симптомов",
-        "prevention_barriers_fear": "Страх услышать диагноз",
-        "prevention_barriers_money": "Финансовые ограничения",
-        "prevention_barriers_time": "Нет времени",
-        "prevention_barriers_knowledge": "Не знаю, с чего начать",
-        "prevention_barriers_doctor": "Уже наблюдаюсь у врача",
-        "prevention_barriers_nothing": "Ничего не мешает"
-    }
-    
-    barrier_option = barriers_map.get(callback.data)
-    if barrier_option:
-        if barrier_option in selected:
-            selected.remove(barrier_option)
-        else:
-            selected.append(barrier_option)
-        
-        await state.update_data(prevention_barriers_selected=selected)
-        keyboard = get_prevention_barriers_keyboard(selected)
-        await safe_edit_message(callback.message, callback.message.text, reply_markup=keyboard)
+    await state.update_data({survey_question.selected_key: selected})
+    # Отметки переключаются быстрее, чем Telegram применяет правки: отправится последняя
+    await safe_edit_message(callback.message, survey_question.text,
+                            reply_markup=survey_question.keyboard(selected), wait=False)
+
+async def advance_survey(callback: CallbackQuery, state: FSMContext, question: SurveyQuestion):
+    """Переход к следующему вопросу или завершение опроса"""
+    if question.next is not None:
+        await ask_survey_question(callback.message, state, question.next, edit=True)
+    else:
+        await complete_survey(callback, state)
 
-@router.callback_query(F.data.startswith("health_advice_"), StateFilter(UserStates.survey_health_advice))
-async def handle_health_advice(callback: CallbackQuery, state: FSMContext):
-    """НАДЕЖНАЯ обработка последнего вопроса опроса с гарантированным сохранением"""
-    await safe_answer_callback(callback)
+async def complete_survey(callback: CallbackQuery, state: FSMContext):
+    """НАДЕЖНОЕ завершение опроса с гарантированным сохранением"""
     
-    data = await state.get_data()
-    selected = data.get('health_advice_selected', [])
+    # НАДЕЖНОЕ сохранение данных опроса
+    survey_success = False
+    error_details = ""
+    survey_data = {}
     
-    if callback.data == "health_advice_done":
-        if not selected:
-            await safe_answer_callback(callback, "Выберите хотя бы один вариант", show_alert=True)
-            return
-        
-        await state.update_data(health_advice=selected)
-        await log_user_interaction(callback.from_user.id, "health_advice_completed", f"Selected: {len(selected)} items")
-        
-        # НАДЕЖНОЕ сохранение данных опроса
-        survey_success = False
-        error_details = ""
-        
+    try:
+        # ПОПЫТКА 1: Обычное сохранение опроса
+        logger.info(f"ПОПЫТКА 1: Сохранение опроса для {callback.from_user.id}")
+        survey_data = await state.get_data()
+        save_result = await save_survey_data(callback.from_user.id, survey_data)
+        logger.info(f"✅ ОПРОС СОХРАНЕН: {save_result}")
+        survey_success = True
+        
+    except Exception as e1:
+        logger.error(f"❌ ОШИБКА сохранения опроса: {e1}")
+        error_details += f"Survey save error: {str(e1)[:100]}; "
+        
+        # ПОПЫТКА 2: Убеждаемся что пользователь существует
         try:
-            # ПОПЫТКА 1: Обычное сохранение опроса
-            logger.info(f"ПОПЫТКА 1: Сохранение опроса для {callback.from_user.id}")
-            survey_data = await state.get_data()
-            save_result = await save_survey_data(callback.from_user.id, survey_data)
-            logger.info(f"✅ ОПРОС СОХРАНЕН: {save_result}")
-            survey_success = True
+            logger.info("ПОПЫТКА 2: Проверка/создание пользователя")
+            from database import emergency_create_user
             
-        except Exception as e1:
-            logger.error(f"❌ ОШИБКА сохранения опроса: {e1}")
-            error_details += f"Survey save error: {str(e1)[:100]}; "
+            user_created = emergency_create_user(callback.from_user.id)
+            if user_created:
+                # Повторяем сохранение опроса
+                save_result = await save_survey_data(callback.from_user.id, await state.get_data())
+                survey_success = True
+                logger.info("✅ ОПРОС СОХРАНЕН после создания пользователя")
             
-            # ПОПЫТКА 2: Убеждаемся что пользователь существует
-            try:
-                logger.info("ПОПЫТКА 2: Проверка/создание пользователя")
-                from database import emergency_create_user
-                
-                user_created = emergency_create_user(callback.from_user.id)
-                if user_created:
-                    # Повторяем сохранение опроса
-                    save_result = await save_survey_data(callback.from_user.id, await state.get_data())
-                    survey_success = True
-                    logger.info("✅ ОПРОС СОХРАНЕН после создания пользователя")
-                
-            except Exception as e2:
-                logger.error(f"❌ ПОПЫТКА 2 провалилась: {e2}")
-                error_details += f"User creation error: {str(e2)[:100]}; "
-        
-        # ВСЕГДА показываем успех пользователю
-        text = """✅ Спасибо за помощь! 
+        except Exception as e2:
+            logger.error(f"❌ ПОПЫТКА 2 провалилась: {e2}")
+            error_details += f"User creation error: {str(e2)[:100]}; "
+    
+    # ВСЕГДА показываем успех пользователю
+    text = """✅ Спасибо за помощь! 
 
 Мы подходим к следующему этапу — диагностике скрытых факторов риска, которые часто остаются вне фокуса, но напрямую влияют на здоровье сердца и сосудов.
 
@@ -1557,44 +1052,24 @@ async def handle_health_advice(callback: CallbackQuery, state: FSMContext):
 Пожалуйста, пройдите их до вебинара — так вы извлечете гораздо больше пользы и сможете применить полученные рекомендации к своему случаю. 
 
 👉 После этого я пришлю вам список базовых анализов и чек-лист подготовки к вебинару."""
-        
-        await safe_edit_message(callback.message, text)
-        
-        if survey_success:
-            logger.info(f"✅ ОПРОС {callback.from_user.id} СОХРАНЕН УСПЕШНО")
-        else:
-            logger.error(f"❌ ОПРОС {callback.from_user.id} НЕ СОХРАНЕН: {error_details}")
-            # НО НЕ показываем ошибку пользователю
-        
-        # ВСЕГДА переходим к тестам
-        await asyncio.sleep(5)
-        await start_tests(callback.message, state)
-        return
     
-    # Обработка выбора вариантов (без изменений)
-    advice_map = {
-        "health_advice_doctor": "С врачом",
-        "health_advice_relatives": "С родственниками",
-        "health_advice_colleagues": "С коллегами",
-        "health_advice_internet": "Через интернет (статьи, форумы)",
-        "health_advice_blogger": "С врачом-блогером в соцсетях",
-        "health_advice_nobody": "Ни с кем"
-    }
+    await safe_edit_message(callback.message, text)
     
-    advice_option = advice_map.get(callback.data)
-    if advice_option:
-        if advice_option in selected:
-            selected.remove(advice_option)
-        else:
-            if len(selected) < 2:
-                selected.append(advice_option)
-            else:
-                await safe_answer_callback(callback, "Можно выбрать максимум 2 варианта", show_alert=True)
-                return
-        
-        await state.update_data(health_advice_selected=selected)
-        keyboard = get_health_advice_keyboard(selected)
-        await safe_edit_message(callback.message, callback.message.text, reply_markup=keyboard)
+    if survey_success:
+        logger.info(f"✅ ОПРОС {callback.from_user.id} СОХРАНЕН УСПЕШНО")
+        await event_bus.publish(SurveyCompleted(
+            callback.from_user.id,
+            questions_count=len(cardio_survey.questions),
+            demographics={key: survey_data.get(key) for key in ('age', 'gender', 'location', 'education')},
+            health_data={key: survey_data.get(key) for key in ('health_rating', 'heart_disease', 'cv_risk', 'cv_knowledge')}
+        ))
+    else:
+        logger.error(f"❌ ОПРОС {callback.from_user.id} НЕ СОХРАНЕН: {error_details}")
+        # НО НЕ показываем ошибку пользователю
+    
+    # ВСЕГДА переходим к тестам
+    await asyncio.sleep(5)
+    await start_tests(callback.message, state)
 
 # ============================================================================
 # ОБРАБОТЧИКИ ТЕСТОВ (ПОЛНЫЕ ОРИГИНАЛЬНЫЕ)
@@ -1623,7 +1098,7 @@ async def start_tests(message: Message, state: FSMContext):
     
     await state.set_state(UserStates.test_selection)
     
-@router.callback_query(F.data.startswith("test_"), StateFilter(UserStates.test_selection))
+@router.callback_query(CallbackRoute(prefix="test_"), StateFilter(UserStates.test_selection))
 async def handle_test_selection(callback: CallbackQuery, state: FSMContext):
     """Обработка выбора теста"""
     await safe_answer_callback(callback)
@@ -1668,11 +1143,12 @@ async def start_hads_test(message: Message, state: FSMContext):
     from surveys import get_hads_questions
     
     questions = get_hads_questions()
-    await state.update_data(
+    data = await state.update_data(
         current_test="hads",
         test_questions=questions,
         current_question_index=0,
-        test_answers=[]
+        test_answers=[],
+        test_nonce=new_test_nonce()
     )
     
     text = """🟣 <b>Тест 1. Уровень тревоги и депрессии — HADS</b>
@@ -1684,7 +1160,7 @@ async def start_hads_test(message: Message, state: FSMContext):
     await safe_edit_message(message, text)
     await asyncio.sleep(2)
     
-    await show_current_question(message, state)
+    await show_current_question(message, state, data)
     await state.set_state(UserStates.hads_test)
 
 async def start_burns_test(message: Message, state: FSMContext):
@@ -1692,11 +1168,12 @@ async def start_burns_test(message: Message, state: FSMContext):
     from surveys import get_burns_questions
     
     questions = get_burns_questions()
-    await state.update_data(
+    data = await state.update_data(
         current_test="burns",
         test_questions=questions,
         current_question_index=0,
-        test_answers=[]
+        test_answers=[],
+        test_nonce=new_test_nonce()
     )
     
     text = """🔵 <b>Тест 2. Эмоциональное выгорание — Шкала депрессии Бернса</b>
@@ -1708,7 +1185,7 @@ async def start_burns_test(message: Message, state: FSMContext):
     await safe_edit_message(message, text)
     await asyncio.sleep(2)
     
-    await show_current_question(message, state)
+    await show_current_question(message, state, data)
     await state.set_state(UserStates.burns_test)
 
 async def start_isi_test(message: Message, state: FSMContext):
@@ -1716,11 +1193,12 @@ async def start_isi_test(message: Message, state: FSMContext):
     from surveys import get_isi_questions
     
     questions = get_isi_questions()
-    await state.update_data(
+    data = await state.update_data(
         current_test="isi",
         test_questions=questions,
         current_question_index=0,
-        test_answers=[]
+        test_answers=[],
+        test_nonce=new_test_nonce()
     )
     
     text = """🌙 <b>Тест 3. Качество сна — ISI</b>
@@ -1730,7 +1208,7 @@ async def start_isi_test(message: Message, state: FSMContext):
     await safe_edit_message(message, text)
     await asyncio.sleep(2)
     
-    await show_current_question(message, state)
+    await show_current_question(message, state, data)
     await state.set_state(UserStates.isi_test)
 
 async def start_stop_bang_test(message: Message, state: FSMContext):
@@ -1738,11 +1216,12 @@ async def start_stop_bang_test(message: Message, state: FSMContext):
     from surveys import get_stop_bang_questions
     
     questions = get_stop_bang_questions()
-    await state.update_data(
+    data = await state.update_data(
         current_test="stop_bang",
         test_questions=questions,
         current_question_index=0,
-        test_answers=[]
+        test_answers=[],
+        test_nonce=new_test_nonce()
     )
     
     text = """😴 <b>Тест 4. Риск апноэ сна — STOP-BANG</b>
@@ -1752,7 +1231,7 @@ async def start_stop_bang_test(message: Message, state: FSMContext):
     await safe_edit_message(message, text)
     await asyncio.sleep(2)
     
-    await show_current_question(message, state)
+    await show_current_question(message, state, data)
     await state.set_state(UserStates.stop_bang_test)
 
 async def start_ess_test(message: Message, state: FSMContext):
@@ -1760,11 +1239,12 @@ async def start_ess_test(message: Message, state: FSMContext):
     from surveys import get_ess_questions
     
     questions = get_ess_questions()
-    await state.update_data(
+    data = await state.update_data(
         current_test="ess",
         test_questions=questions,
         current_question_index=0,
-        test_answers=[]
+        test_answers=[],
+        test_nonce=new_test_nonce()
     )
     
     text = """😴 <b>Тест 5. Сонливость днём — ESS</b>
@@ -1774,7 +1254,7 @@ async def start_ess_test(message: Message, state: FSMContext):
     await safe_edit_message(message, text)
     await asyncio.sleep(2)
     
-    await show_current_question(message, state)
+    await show_current_question(message, state, data)
     await state.set_state(UserStates.ess_test)
 
 async def start_fagerstrom_test(message: Message, state: FSMContext):
@@ -1782,11 +1262,12 @@ async def start_fagerstrom_test(message: Message, state: FSMContext):
     from surveys import get_fagerstrom_questions
     
     questions = get_fagerstrom_questions()
-    await state.update_data(
+    data = await state.update_data(
         current_test="fagerstrom",
         test_questions=questions,
         current_question_index=0,
-        test_answers=[]
+        test_answers=[],
+        test_nonce=new_test_nonce()
     )
     
     text = """🚬 <b>Тест 6. Никотиновая зависимость — Фагерстрем</b>
@@ -1796,7 +1277,7 @@ async def start_fagerstrom_test(message: Message, state: FSMContext):
     await safe_edit_message(message, text)
     await asyncio.sleep(2)
     
-    await show_current_question(message, state)
+    await show_current_question(message, state, data)
     await state.set_state(UserStates.fagerstrom_test)
 
 async def start_audit_test(message: Message, state: FSMContext):
@@ -1804,11 +1285,12 @@ async def start_audit_test(message: Message, state: FSMContext):
     from surveys import get_audit_questions
     
     questions = get_audit_questions()
-    await state.update_data(
+    data = await state.update_data(
         current_test="audit",
         test_questions=questions,
         current_question_index=0,
-        test_answers=[]
+        test_answers=[],
+        test_nonce=new_test_nonce()
     )
     
     text = """🍷 <b>Тест 7. Употребление алкоголя — RUS-AUDIT</b>
@@ -1818,18 +1300,22 @@ async def start_audit_test(message: Message, state: FSMContext):
     await safe_edit_message(message, text)
     await asyncio.sleep(2)
     
-    await show_current_question(message, state)
+    await show_current_question(message, state, data)
     await state.set_state(UserStates.audit_test)
 
-async def show_current_question(message: Message, state: FSMContext):
-    """Показать текущий вопрос теста"""
-    data = await state.get_data()
+async def show_current_question(message: Message, state: FSMContext, data: dict = None):
+    """Показать текущий вопрос теста
+    
+    data - уже загруженные данные состояния: если переданы, хранилище не читается.
+    """
+    if data is None:
+        data = await state.get_data()
     questions = data['test_questions']
     current_index = data['current_question_index']
     current_test = data['current_test']
     
     if current_index >= len(questions):
-        await complete_current_test(message, state)
+        await complete_current_test(message, state, data)
         return
     
     question = questions[current_index]
@@ -1839,11 +1325,14 @@ async def show_current_question(message: Message, state: FSMContext):
     if question.get('info_text'):
         text += f"\n\nℹ️ {question['info_text']}"
     
-    keyboard = get_question_keyboard(question, current_test)
+    nonce = data.get('test_nonce')
+    keyboard = get_question_keyboard(question, current_test, current_index, nonce)
+    if nonce is not None:
+        answer_guard.expect(message.chat.id, TEST_CODES[current_test], current_index, nonce)
     await safe_edit_message(message, text, reply_markup=keyboard)
 
-@router.callback_query(F.data.startswith("answer_"))
-async def handle_test_answer(callback: CallbackQuery, state: FSMContext):
+@router.callback_query(TestAnswer.filter())
+async def handle_test_answer(callback: CallbackQuery, callback_data: TestAnswer, state: FSMContext):
     """Обработка ответа на вопрос теста с защитой от потери состояния"""
     await safe_answer_callback(callback)
     
@@ -1866,7 +1355,8 @@ async def handle_test_answer(callback: CallbackQuery, state: FSMContext):
                 await state.update_data(
                     test_questions=questions,
                     current_question_index=0,
-                    test_answers=[]
+                    test_answers=[],
+                    test_nonce=new_test_nonce()
                 )
             elif "burns_test" in current_fsm_state:
                 await state.update_data(current_test="burns")
@@ -1875,7 +1365,8 @@ async def handle_test_answer(callback: CallbackQuery, state: FSMContext):
                 await state.update_data(
                     test_questions=questions,
                     current_question_index=0,
-                    test_answers=[]
+                    test_answers=[],
+                    test_nonce=new_test_nonce()
                 )
             elif "isi_test" in current_fsm_state:
                 await state.update_data(current_test="isi")
@@ -1884,7 +1375,8 @@ async def handle_test_answer(callback: CallbackQuery, state: FSMContext):
                 await state.update_data(
                     test_questions=questions,
                     current_question_index=0,
-                    test_answers=[]
+                    test_answers=[],
+                    test_nonce=new_test_nonce()
                 )
             elif "stop_bang_test" in current_fsm_state:
                 await state.update_data(current_test="stop_bang")
@@ -1893,7 +1385,8 @@ async def handle_test_answer(callback: CallbackQuery, state: FSMContext):
                 await state.update_data(
                     test_questions=questions,
                     current_question_index=0,
-                    test_answers=[]
+                    test_answers=[],
+                    test_nonce=new_test_nonce()
                 )
             elif "ess_test" in current_fsm_state:
                 await state.update_data(current_test="ess")
@@ -1902,7 +1395,8 @@ async def handle_test_answer(callback: CallbackQuery, state: FSMContext):
                 await state.update_data(
                     test_questions=questions,
                     current_question_index=0,
-                    test_answers=[]
+                    test_answers=[],
+                    test_nonce=new_test_nonce()
                 )
             elif "fagerstrom_test" in current_fsm_state:
                 await state.update_data(current_test="fagerstrom")
@@ -1911,7 +1405,8 @@ async def handle_test_answer(callback: CallbackQuery, state: FSMContext):
                 await state.update_data(
                     test_questions=questions,
                     current_question_index=0,
-                    test_answers=[]
+                    test_answers=[],
+                    test_nonce=new_test_nonce()
                 )
             elif "audit_test" in current_fsm_state:
                 await state.update_data(current_test="audit")
@@ -1920,7 +1415,8 @@ async def handle_test_answer(callback: CallbackQuery, state: FSMContext):
                 await state.update_data(
                     test_questions=questions,
                     current_question_index=0,
-                    test_answers=[]
+                    test_answers=[],
+                    test_nonce=new_test_nonce()
                 )
             else:
                 # Не можем восстановить - возвращаем к выбору тестов
@@ -1958,28 +1454,65 @@ async def handle_test_answer(callback: CallbackQuery, state: FSMContext):
         await state.set_state(UserStates.test_selection)
         return
     
-    # Извлекаем оценку из callback_data
+    # Кнопка должна относиться к текущему прохождению и текущему вопросу
+    # (основную проверку без чтения состояния уже выполнил answer_guard)
+    if callback_data.n != data.get('test_nonce') or TEST_BY_CODE.get(callback_data.t) != current_test:
+        await show_current_question(callback.message, state, data)
+        return
+    if callback_data.q != current_index:
+        if callback_data.q > current_index:
+            await show_current_question(callback.message, state, data)
+        # Ответ на уже пройденный вопрос - повтор, игнорируем
+        return
+    
+    # Извлекаем оценку по индексу варианта
     try:
-        score = int(callback.data.split("_")[1])
-    except (IndexError, ValueError):
+        score = data['test_questions'][current_index]['options'][callback_data.o]['score']
+    except (IndexError, KeyError):
         await safe_answer_callback(callback, "❌ Некорректный ответ", show_alert=True)
         return
     
-    answers.append(score)
+    # Новый список: get_data возвращает поверхностную копию, исходный список не трогаем
+    data['test_answers'] = answers + [score]
+    data['current_question_index'] = current_index + 1
     
     await log_user_interaction(callback.from_user.id, f"{current_test}_answer", f"Q{current_index+1}: {score}")
     
-    await state.update_data(
-        test_answers=answers,
-        current_question_index=current_index + 1
-    )
+    # Одна запись вместо update_data (которое заново читает состояние)
+    await state.set_data(data)
     
-    # Продолжаем показывать следующий вопрос
-    await show_current_question(callback.message, state)
+    # Продолжаем показывать следующий вопрос по уже загруженным данным
+    await show_current_question(callback.message, state, data)
 
-async def complete_current_test(message: Message, state: FSMContext):
-    """Завершение текущего теста с отметкой о завершении и ОБЯЗАТЕЛЬНЫМ сохранением результата"""
+@router.callback_query(CallbackRoute(prefix="answer_"))
+async def handle_legacy_test_answer(callback: CallbackQuery, state: FSMContext):
+    """Кнопки старого формата answer_{score} из сообщений, отправленных до обновления
+    
+    По ним нельзя понять, к какому вопросу относится нажатие, поэтому ответ
+    не засчитывается: текущий вопрос показывается заново с новыми кнопками.
+    """
+    await safe_answer_callback(callback, "Кнопка устарела, ответьте еще раз")
+    
     data = await state.get_data()
+    if 'current_test' not in data or 'test_questions' not in data:
+        await safe_edit_message(
+            callback.message,
+            "❌ Сессия прервана. Выберите тест для прохождения заново:",
+            reply_markup=get_test_selection_keyboard()
+        )
+        await state.set_state(UserStates.test_selection)
+        return
+    
+    if not data.get('test_nonce'):
+        data['test_nonce'] = new_test_nonce()
+        await state.set_data(data)
+    
+    await show_current_question(callback.message, state, data)
+
+async def complete_current_test(message: Message, state: FSMContext, data: dict = None):
+    """Завершение текущего теста с отметкой о завершении и ОБЯЗАТЕЛЬНЫМ сохранением результата"""
+    if data is None:
+        data = await state.get_data()
     current_test = data['current_test']
     answers = data['test_answers']
     
@@ -2049,7 +1582,7 @@ async def complete_current_test(message: Message, state: FSMContext):
         result_text = get_audit_interpretation(total_score)
     
     # Логируем завершение теста
-    await log_user_interaction(message.from_user.id, f"{current_test}_completed", f"Score: {total_score}")
+    await event_bus.publish(TestCompleted(message.from_user.id, test=current_test, score=total_score))
     
     # КРИТИЧЕСКИ ВАЖНО: Сохраняем промежуточные результаты в базу данных СРАЗУ
     try:
@@ -2080,7 +1613,7 @@ async def complete_current_test(message: Message, state: FSMContext):
         logger.info(f"Сохраняю промежуточный результат теста {current_test} для пользователя {message.from_user.id}: {test_data_to_save}")
         
         # Загружаем текущие сохраненные данные и обновляем их
-        existing_data = get_user_data(message.from_user.id)
+        existing_data = await run_db(get_user_data, message.from_user.id)
         if existing_data and existing_data.get('tests'):
             # Если есть данные тестов, обновляем их
             logger.info(f"Обновляю существующие данные тестов для пользователя {message.from_user.id}")
@@ -2122,42 +1655,6 @@ async def complete_current_test(message: Message, state: FSMContext):
     
     await message.answer(continue_text, reply_markup=keyboard, parse_mode="HTML")
 
-@router.message(StateFilter(UserStates.survey_health))
-async def handle_health_rating(message: Message, state: FSMContext):
-    """Обработка оценки здоровья"""
-    await log_user_interaction(message.from_user.id, "health_rating_entered", message.text)
-    
-    try:
-        health_rating = int(message.text.strip())
-        if health_rating < 0 or health_rating > 10:
-            await message.answer("Пожалуйста, введите число от 0 до 10.")
-            return
-        
-        await state.update_data(health_rating=health_rating)
-        
-        # Удаляем сообщение пользователя и вопрос
-        try:
-            await message.delete()
-            # Пытаемся найти и удалить сообщение с вопросом (обычно предыдущее)
-            if message.message_id > 1:
-                try:
-                    await message.bot.delete_message(chat_id=message.chat.id, message_id=message.message_id - 1)
-                except:
-                    pass
-        except Exception as e:
-            logger.warning(f"Не удалось удалить сообщения: {e}")
-        
-        text = """<b>❓ Вопрос 9</b>
-На ваш взгляд, какая из перечисленных причин чаще всего приводит к смерти людей в мире? 
-(выберите 1 вариант ответа)"""
-        
-        keyboard = get_death_cause_keyboard()
-        await message.answer(text, parse_mode="HTML", reply_markup=keyboard)
-        await state.set_state(UserStates.survey_death_cause)
-        
-    except ValueError:
-        await message.answer("Пожалуйста, введите число от 0 до 10.")
-
 async def complete_all_tests(message: Message, state: FSMContext):
     """ИСПРАВЛЕННОЕ завершение тестов - гарантия сохранения под НАСТОЯЩИМ telegram_id"""
     
@@ -2179,9 +1676,11 @@ async def complete_all_tests(message: Message, state: FSMContext):
     if 'audit_score' not in test_results:
         test_results['audit_skipped'] = True
     
+    tests_saved, completion = {}, None
     try:
         # 1. НАЙТИ ИЛИ СОЗДАТЬ пользователя с НАСТОЯЩИМ telegram_id
-        existing_user = find_existing_user(
+        existing_user = await run_db(
+            find_existing_user,
             telegram_id=REAL_TELEGRAM_ID,
             email=data.get('email'),
             phone=data.get('phone')
@@ -2199,11 +1698,11 @@ async def complete_all_tests(message: Message, state: FSMContext):
             logger.info(f"✅ Пользователь найден: {existing_user.id}")
         
         # 2. СОХРАНИТЬ ТЕСТЫ ДЛЯ НАСТОЯЩЕГО telegram_id
-        await save_test_results(REAL_TELEGRAM_ID, test_results)
+        tests_saved = await save_test_results(REAL_TELEGRAM_ID, test_results)
         logger.info(f"✅ Тесты сохранены для {REAL_TELEGRAM_ID}")
         
         # 3. ОТМЕТИТЬ КАК ЗАВЕРШИВШЕГО
-        await mark_user_completed(REAL_TELEGRAM_ID)
+        completion = await mark_user_completed(REAL_TELEGRAM_ID)
         logger.info(f"✅ Пользователь {REAL_TELEGRAM_ID} отмечен как завершивший")
         
     except Exception as e:
@@ -2219,12 +1718,19 @@ async def complete_all_tests(message: Message, state: FSMContext):
 📎 Отправляю обещанные материалы..."""
     
     await message.answer(success_text, parse_mode="HTML")
+    if completion and completion.get('success'):
+        await event_bus.publish(DiagnosticCompleted(
+            REAL_TELEGRAM_ID,
+            cv_risk_level=tests_saved.get('cv_risk_level'),
+            tests_count=len([key for key in test_results if not key.endswith('_skipped')]),
+            completion_stats=completion['completion_stats']
+        ))
     await send_completion_materials(message)
     await state.clear()
     
     logger.info(f"✅ ПРОЦЕСС ЗАВЕРШЕН ДЛЯ {REAL_TELEGRAM_ID}")
 
-@router.callback_query(F.data == "retry_save_tests")
+@router.callback_query(CallbackRoute("retry_save_tests"))
 async def retry_save_tests(callback: CallbackQuery, state: FSMContext):
     """ИСПРАВЛЕННЫЙ повтор сохранения - сразу к материалам"""
     await safe_answer_callback(callback)
@@ -2234,7 +1740,7 @@ async def retry_save_tests(callback: CallbackQuery, state: FSMContext):
     await complete_all_tests(callback.message, state)
     
 # ОБНОВЛЯЕМ также обработчик кнопки "Завершить"
-@router.callback_query(F.data == "test_complete")
+@router.callback_query(CallbackRoute("test_complete"))
 async def handle_test_complete_button(callback: CallbackQuery, state: FSMContext):
     """ИСПРАВЛЕННЫЙ обработчик кнопки завершения тестов"""
     await safe_answer_callback(callback)
@@ -2244,7 +1750,7 @@ async def handle_test_complete_button(callback: CallbackQuery, state: FSMContext
     await complete_all_tests(callback.message, state)
 
 # ИСПРАВЛЯЕМ обработчик проверки готовности
-@router.callback_query(F.data == "test_check_completion")
+@router.callback_query(CallbackRoute("test_check_completion"))
 async def check_test_completion(callback: CallbackQuery, state: FSMContext):
     """УПРОЩЕННАЯ проверка - всегда разрешаем завершать"""
     await safe_answer_callback(callback)
@@ -2264,60 +1770,30 @@ async def check_test_completion(callback: CallbackQuery, state: FSMContext):
 
 
 async def send_completion_materials(message: Message):
-    """Отправка материалов после завершения диагностики"""
+    """Отправка материалов после завершения диагностики
+
+    Файлы уходят одной медиагруппой; загруженные ранее отправляются по file_id.
+    """
     import os
-    from aiogram.types import FSInputFile
-    
-    materials_dir = "materials"
     
     # Проверяем существование папки materials
-    if not os.path.exists(materials_dir):
+    if not os.path.isdir(materials_cache.directory):
         logger.warning("Папка materials не найдена")
         await message.answer("📁 Материалы готовятся к отправке...")
         return
     
-    # Ищем файлы в папке materials
-    files_to_send = []
-    
     try:
-        all_files = os.listdir(materials_dir)
-        
-        # Ищем нужные файлы по имени
-        for filename in all_files:
-            file_path = os.path.join(materials_dir, filename)
-            if os.path.isfile(file_path):
-                files_to_send.append(file_path)
-        
-        # Отправляем файлы
-        if files_to_send:
-            await message.answer("📎 Отправляю обещанные материалы:")
-            
-            for i, file_path in enumerate(files_to_send):
-                try:
-                    file_input = FSInputFile(file_path)
-                    filename = os.path.basename(file_path)
-                    
-                    if "analyses" in filename.lower() or "анализ" in filename.lower():
-                        caption = "📌 Бонус: чек-лист «Препараты и методики, которые не лечат сердце и сосуды»"
-                    elif "checklist" in filename.lower() or "чеклист" in filename.lower() or "препарат" in filename.lower():
-                        caption = "📋 Список базовых анализов для подготовки к вебинару"
-                    elif "webinar" in filename.lower() or "вебинар" in filename.lower():
-                        caption = "📋 Материалы к вебинару"
-                    else:
-                        caption = f"📄 Дополнительный материал: {filename}"
-                    
-                    await message.answer_document(file_input, caption=caption)
-                    await asyncio.sleep(1) 
-                    
-                except Exception as e:
-                    logger.error(f"Ошибка отправки файла {file_path}: {e}")
-                    await message.answer(f"❌ Не удалось отправить файл {os.path.basename(file_path)}")
-        else:
+        files = await materials_cache.refresh()
+        if not files:
             # Если файлов нет, отправляем текстовую информацию
             await send_text_materials(message)
-            
+            return
+        
+        await message.answer("📎 Отправляю обещанные материалы:")
+        await materials_cache.send(message)
+        
     except Exception as e:
-        logger.error(f"Ошибка при работе с папкой materials: {e}")
+        logger.error(f"Ошибка отправки материалов: {e}")
         await send_text_materials(message)
 
 async def send_text_materials(message: Message):
@@ -2406,7 +1882,7 @@ async def generate_final_results_summary(telegram_id: int) -> str:
         from database import get_user_data
         
         # Получаем данные пользователя с дополнительной проверкой
-        data = get_user_data(telegram_id)
+        data = await run_db(get_user_data, telegram_id)
         
         logger.info(f"Данные из базы: {data is not None}")
         if data:
@@ -2620,7 +2096,7 @@ def get_risk_explanation(risk_level: str) -> str:
     }
     return explanations.get(risk_level, "⚪ Уровень риска требует дополнительной оценки.")
 
-@router.callback_query(F.data == "continue_tests")
+@router.callback_query(CallbackRoute("continue_tests"))
 async def continue_to_test_menu(callback: CallbackQuery, state: FSMContext):
     """ИСПРАВЛЕННЫЙ обработчик продолжения к меню тестов"""
     await safe_answer_callback(callback)
@@ -2649,7 +2125,7 @@ async def continue_to_test_menu(callback: CallbackQuery, state: FSMContext):
 # ============================================================================
 # ОБРАБОТЧИК ДЛЯ НЕИЗВЕСТНЫХ СООБЩЕНИЙ (С ЗАЩИТОЙ)
 # ============================================================================
-@router.callback_query(F.data == "test_check_completion")
+@router.callback_query(CallbackRoute("test_check_completion"))
 async def check_test_completion(callback: CallbackQuery, state: FSMContext):
     """УПРОЩЕННАЯ проверка готовности к завершению - всегда разрешаем"""
     await safe_answer_callback(callback)
@@ -2708,7 +2184,7 @@ async def check_test_completion(callback: CallbackQuery, state: FSMContext):
     
     await safe_edit_message(callback.message, text, reply_markup=keyboard)
 
-@router.callback_query(F.data == "back_to_tests")
+@router.callback_query(CallbackRoute("back_to_tests"))
 async def back_to_test_selection(callback: CallbackQuery, state: FSMContext):
     """Возврат к выбору тестов"""
     await safe_answer_callback(callback)
@@ -2731,7 +2207,7 @@ async def handle_unknown_message(message: Message, state: FSMContext):
         return
     
     # Также пропускаем другие админские команды
-    admin_commands = ['/stats', '/export', '/broadcast']
+    admin_commands = ['/stats', '/export', '/broadcast', '/metrics']
     if message.text:
         text = message.text.strip().lower()
         for cmd in admin_commands:
@@ -2742,7 +2218,7 @@ async def handle_unknown_message(message: Message, state: FSMContext):
     
     # Проверяем, в каком состоянии пользователь
     current_state = await state.get_state()
-    user_completed = check_user_completed(message.from_user.id)
+    user_completed = await check_user_completed(message.from_user.id)
     
     if current_state and ("survey" in current_state or "test" in current_state):
         # Пользователь в процессе диагностики - подсказываем
@@ -2789,4 +2265,4 @@ async def handle_unknown_message(message: Message, state: FSMContext):
 # ============================================================================
 
 # Экспортируем middleware для использования в main.py
-__all__ = ['state_protection', 'router']
\ No newline at end of file
+__all__ = ['state_protection', 'answer_guard', 'router']
\ No newline at end of file
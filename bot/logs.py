@@ -0,0 +1,170 @@
+"""
+Логирование через очередь: запись в файл и консоль в отдельном потоке
+
+Вызов logger.* только кладет запись в очередь, поэтому медленный диск
+не задерживает цикл событий. Файл пишется в JSON (по записи на строку)
+с ротацией по размеру, консоль - в привычном текстовом формате.
+Частые отладочные записи можно прореживать по имени логгера (LOG_SAMPLE).
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")                          # json или text для файла
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))  # Размер файла до ротации
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+# Доля сохраняемых записей ниже WARNING по логгерам: "database=0.1,handlers=0.5"
+LOG_SAMPLE = os.getenv("LOG_SAMPLE", "")
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Атрибуты LogRecord, которые не считаются пользовательскими полями extra
+_RECORD_ATTRS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+# ============================================================================
+# ФОРМАТ И ПРОРЕЖИВАНИЕ
+# ============================================================================
+
+class JsonFormatter(logging.Formatter):
+    """Запись лога одной строкой JSON; поля из extra= попадают в объект"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': self.formatTime(record, '%Y-%m-%dT%H:%M:%S') + f".{int(record.msecs):03d}",
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def parse_sample_rates(spec: str) -> dict:
+    """'database=0.1,handlers=0.5' -> {'database': 0.1, 'handlers': 0.5}"""
+    rates = {}
+    for item in spec.split(','):
+        name, _, rate = item.partition('=')
+        if name.strip() and rate.strip():
+            rates[name.strip()] = min(max(float(rate), 0.0), 1.0)
+    return rates
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает каждую N-ю запись ниже WARNING у указанных логгеров
+
+    Счетчик вместо случайного числа: прореживание равномерное и не стоит
+    ничего, кроме инкремента. Предупреждения и ошибки проходят всегда.
+    """
+
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.every = {name: round(1 / rate) if rate else 0 for name, rate in rates.items()}
+        self.counters = dict.fromkeys(rates, 0)
+        self.dropped = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        every = self.every.get(record.name)
+        if every is None or every == 1:
+            return True
+        if every:
+            count = self.counters[record.name]
+            self.counters[record.name] = count + 1
+            if count % every == 0:
+                return True
+        self.dropped += 1
+        return False
+
+# ============================================================================
+# НАСТРОЙКА
+# ============================================================================
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Кладет в очередь запись с уже подставленными аргументами
+
+    Стандартный prepare форматирует запись целиком; здесь только message,
+    а формат (JSON или текст) применяет поток записи.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def _process_log_file(path: str) -> str:
+    # Ротация небезопасна при записи в один файл из нескольких процессов
+    name = multiprocessing.current_process().name
+    if name == 'MainProcess':
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{name}{ext}"
+
+
+def setup_logging(level: str = LOG_LEVEL, log_file: str = LOG_FILE) -> logging.handlers.QueueListener:
+    """Направить корневой логгер в очередь, запустить поток записи"""
+    global _listener
+    with _listener_lock:
+        if _listener is not None:
+            return _listener
+
+        file_handler = logging.handlers.RotatingFileHandler(
+            _process_log_file(log_file), maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT,
+            encoding='utf-8', errors='replace'
+        )
+        file_handler.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(TEXT_FORMAT))
+
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+        log_queue = queue.SimpleQueue()
+        queue_handler = _QueueHandler(log_queue)
+        rates = parse_sample_rates(LOG_SAMPLE)
+        if rates:
+            queue_handler.addFilter(SamplingFilter(rates))
+
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+        root.addHandler(queue_handler)
+        root.setLevel(level)
+
+        _listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler)
+        _listener.start()
+        atexit.register(stop_logging)
+        return _listener
+
+
+def stop_logging():
+    """Дописать очередь и остановить поток записи"""
+    global _listener
+    with _listener_lock:
+        if _listener is None:
+            return
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
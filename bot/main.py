@@ -2,6 +2,11 @@ import asyncio
 import logging
 import os
 import sys
+import time
+
+# Отметка до импорта aiogram и модулей бота: от нее считается время до первого апдейта
+PROCESS_STARTED = time.monotonic()
+
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
@@ -9,11 +14,24 @@ from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.client.session.aiohttp import AiohttpSession
 import aiohttp
 
-from handlers import router, state_protection
-from database import init_db, ensure_database_exists, fix_incomplete_records, validate_data_integrity
+from handlers import router, state_protection, answer_guard
+from middlewares import RateLimitMiddleware
+from media import materials_cache
+from outbound import install_outbound_limiter, edit_coalescer
+from events import event_bus, event_counters
+from metrics import handler_metrics, install_metrics, start_metrics_server, FirstUpdateTimer, METRICS_PORT
+from database import (
+    init_db, ensure_database_exists, fix_incomplete_records, validate_data_integrity, setup_daily_stats_job,
+    checkpoint_wal
+)
 from admin import admin_router
-from broadcast import BroadcastScheduler
+from broadcast import BroadcastScheduler, stop_active_broadcasts
+from webhook import run_webhook
+from storage import SQLiteStorage
+from sharding import run_sharded
+from shutdown import shutdown_coordinator
 from dotenv import load_dotenv
+from logs import setup_logging as configure_logging
 
 load_dotenv()
 
@@ -21,48 +39,25 @@ load_dotenv()
 def setup_logging():
     """Настройка логирования с учетом кодировки Windows"""
     
-    # Определяем формат без эмодзи
-    log_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    # Для Windows устанавливаем безопасную кодировку консоли
+    if sys.platform.startswith('win'):
+        import codecs
+        
+        try:
+            # Для Python 3.7+
+            if hasattr(sys.stdout, 'reconfigure'):
+                sys.stdout.reconfigure(encoding='utf-8', errors='replace')
+                sys.stderr.reconfigure(encoding='utf-8', errors='replace')
+            else:
+                # Для старых версий Python
+                sys.stdout = codecs.getwriter('utf-8')(sys.stdout.buffer, 'replace')
+                sys.stderr = codecs.getwriter('utf-8')(sys.stderr.buffer, 'replace')
+        except:
+            # Если ничего не помогает, используем безопасную кодировку
+            pass
     
-    try:
-        # Настройка для файла с UTF-8
-        file_handler = logging.FileHandler('bot.log', encoding='utf-8')
-        file_handler.setLevel(logging.INFO)
-        file_handler.setFormatter(logging.Formatter(log_format))
-        
-        # Настройка для консоли с безопасной кодировкой
-        console_handler = logging.StreamHandler(sys.stdout)
-        console_handler.setLevel(logging.INFO)
-        console_handler.setFormatter(logging.Formatter(log_format))
-        
-        # Для Windows устанавливаем безопасную кодировку
-        if sys.platform.startswith('win'):
-            import locale
-            import codecs
-            
-            # Попытка установить UTF-8 кодировку для Windows
-            try:
-                # Для Python 3.7+
-                if hasattr(sys.stdout, 'reconfigure'):
-                    sys.stdout.reconfigure(encoding='utf-8', errors='replace')
-                    sys.stderr.reconfigure(encoding='utf-8', errors='replace')
-                else:
-                    # Для старых версий Python
-                    sys.stdout = codecs.getwriter('utf-8')(sys.stdout.buffer, 'replace')
-                    sys.stderr = codecs.getwriter('utf-8')(sys.stderr.buffer, 'replace')
-            except:
-                # Если ничего не помогает, используем безопасную кодировку
-                pass
-    except Exception as e:
-        # Fallback для проблемных систем
-        logging.basicConfig(
-            level=logging.INFO,
-            format=log_format,
-            handlers=[
-                logging.FileHandler('bot.log', encoding='utf-8', errors='replace'),
-                logging.StreamHandler()
-            ]
-        )
+    # Запись в bot.log и консоль идет из отдельного потока (logs.py)
+    configure_logging()
 
 setup_logging()
 logger = logging.getLogger(__name__)
@@ -81,6 +76,26 @@ if ADMIN_IDS_STR:
     except ValueError:
         logger.warning("Некорректный формат ADMIN_IDS в .env файле")
 
+# Способ получения обновлений: polling или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+# Количество процессов-обработчиков (больше 1 - шардирование по пользователям)
+WORKERS = int(os.getenv("WORKERS", "1"))
+# Отбрасывать ли обновления, накопленные пока бот был остановлен (только polling)
+DROP_PENDING_UPDATES = os.getenv("DROP_PENDING_UPDATES", "false").lower() == "true"
+# Быстрый старт: исправление записей, проверка целостности и статистика дня
+# выполняются в фоне после начала приема обновлений, а не до него
+FAST_START = os.getenv("FAST_START", "true").lower() == "true"
+DEFERRED_CHECKS_DELAY = float(os.getenv("DEFERRED_CHECKS_DELAY", "5"))  # Пауза перед фоновыми проверками (сек)
+
+# Ограничение частоты запросов (токены в секунду и размер ведра)
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMIT_USER_RATE = float(os.getenv("RATE_LIMIT_USER_RATE", "3"))
+RATE_LIMIT_USER_BURST = float(os.getenv("RATE_LIMIT_USER_BURST", "8"))
+RATE_LIMIT_GLOBAL_RATE = float(os.getenv("RATE_LIMIT_GLOBAL_RATE", "200"))
+RATE_LIMIT_GLOBAL_BURST = float(os.getenv("RATE_LIMIT_GLOBAL_BURST", "400"))
+RATE_LIMIT_MESSAGE_COST = float(os.getenv("RATE_LIMIT_MESSAGE_COST", "1"))
+RATE_LIMIT_CALLBACK_COST = float(os.getenv("RATE_LIMIT_CALLBACK_COST", "0.5"))
+
 class AdminMiddleware:
     """Middleware для проверки прав администратора"""
     
@@ -226,23 +241,8 @@ async def startup_checks():
         init_db()
         logger.info("УСПЕХ: База данных инициализирована")
         
-        # Исправляем неполные записи
-        try:
-            fixed_data = fix_incomplete_records()
-            if fixed_data['fixed_records'] > 0:
-                logger.info(f"ИСПРАВЛЕНО: {fixed_data['fixed_records']} неполных записей")
-        except Exception as e:
-            logger.warning(f"Не удалось исправить записи: {e}")
-        
-        # Проверяем целостность данных
-        try:
-            integrity_check = validate_data_integrity()
-            if not integrity_check['healthy']:
-                logger.warning(f"ВНИМАНИЕ: Обнаружены проблемы с данными: {'; '.join(integrity_check['issues'])}")
-            else:
-                logger.info("УСПЕХ: Целостность данных проверена")
-        except Exception as e:
-            logger.warning(f"Не удалось проверить целостность: {e}")
+        if not FAST_START:
+            run_integrity_checks()
             
     except Exception as e:
         logger.error(f"ОШИБКА при работе с базой данных: {e}")
@@ -257,6 +257,142 @@ async def startup_checks():
     
     return True
 
+def run_integrity_checks():
+    """Исправление неполных записей, проверка целостности и статистика дня
+
+    Полный проход по таблицам: при FAST_START выполняется в пуле потоков
+    после запуска бота (deferred_integrity_checks).
+    """
+    started = time.perf_counter()
+    
+    # Исправляем неполные записи
+    try:
+        fixed_data = fix_incomplete_records()
+        if fixed_data['fixed_records'] > 0:
+            logger.info(f"ИСПРАВЛЕНО: {fixed_data['fixed_records']} неполных записей")
+    except Exception as e:
+        logger.warning(f"Не удалось исправить записи: {e}")
+    
+    # Проверяем целостность данных
+    try:
+        integrity_check = validate_data_integrity()
+        if not integrity_check['healthy']:
+            logger.warning(f"ВНИМАНИЕ: Обнаружены проблемы с данными: {'; '.join(integrity_check['issues'])}")
+        else:
+            logger.info("УСПЕХ: Целостность данных проверена")
+    except Exception as e:
+        logger.warning(f"Не удалось проверить целостность: {e}")
+    
+    setup_daily_stats_job()
+    logger.info(f"Проверки базы данных заняли {time.perf_counter() - started:.2f} сек")
+
+async def deferred_integrity_checks(delay: float = DEFERRED_CHECKS_DELAY):
+    """Фоновые проверки базы после начала приема обновлений"""
+    await asyncio.sleep(delay)
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, run_integrity_checks)
+    except Exception as e:
+        logger.warning(f"Фоновые проверки базы данных не выполнены: {e}")
+
+def build_dispatcher(storage, global_rate_share: float = 1.0) -> Dispatcher:
+    """Создание диспетчера с middleware и роутерами
+
+    global_rate_share - доля общего лимита частоты, приходящаяся на процесс
+    (при шардировании каждый воркер получает 1/N общего лимита).
+    """
+    
+    dp = Dispatcher(storage=storage)
+    dp.update.outer_middleware(FirstUpdateTimer(PROCESS_STARTED))
+    # Учет начатых обработчиков: при остановке их дожидается shutdown_coordinator
+    dp.update.outer_middleware(shutdown_coordinator)
+    
+    # Метрики регистрируются первыми: в замер входят все остальные middleware
+    dp.message.middleware(handler_metrics)
+    dp.callback_query.middleware(handler_metrics)
+    
+    # ============================================================================
+    # ИНТЕГРАЦИЯ MIDDLEWARE ДЛЯ ЗАЩИТЫ ОТ ЗАЦИКЛИВАНИЯ
+    # ============================================================================
+    
+    # Ограничитель частоты регистрируется до защиты состояний:
+    # лишние обновления отбрасываются до постановки в очередь пользователя
+    rate_limiter = None
+    if RATE_LIMIT_ENABLED:
+        rate_limiter = RateLimitMiddleware(
+            user_rate=RATE_LIMIT_USER_RATE,
+            user_burst=RATE_LIMIT_USER_BURST,
+            global_rate=RATE_LIMIT_GLOBAL_RATE * global_rate_share,
+            global_burst=RATE_LIMIT_GLOBAL_BURST * global_rate_share,
+            message_cost=RATE_LIMIT_MESSAGE_COST,
+            callback_cost=RATE_LIMIT_CALLBACK_COST,
+            admin_ids=ADMIN_IDS
+        )
+        dp.message.middleware(rate_limiter)
+        dp.callback_query.middleware(rate_limiter)
+        dp["rate_limiter"] = rate_limiter
+        logger.info(f"✅ Ограничение частоты: {RATE_LIMIT_USER_RATE}/с на пользователя "
+                   f"(запас {RATE_LIMIT_USER_BURST}), {RATE_LIMIT_GLOBAL_RATE}/с на бота")
+    
+    # КРИТИЧЕСКИ ВАЖНО: Регистрируем middleware защиты состояний в любом режиме
+    # Обновления одного пользователя выполняются по очереди, повторы отбрасываются
+    dp.message.middleware(state_protection)
+    dp.callback_query.middleware(state_protection)
+    logger.info("✅ Защищенный middleware зарегистрирован")
+    
+    if os.getenv("DEBUG_MODE", "true").lower() == "true":
+        logger.info("🔍 РЕЖИМ ДИАГНОСТИКИ: простой middleware")
+        
+        class SimpleDiagnosticMiddleware:
+            async def __call__(self, handler, event, data):
+                if hasattr(event, 'from_user') and event.from_user:
+                    user_id = event.from_user.id
+                    logger.info(f"🔍 ДИАГНОСТИКА: user_id={user_id}")
+                return await handler(event, data)
+        
+        diagnostic_middleware = SimpleDiagnosticMiddleware()
+        dp.message.middleware(diagnostic_middleware)
+        dp.callback_query.middleware(diagnostic_middleware)
+        logger.info("✅ Диагностический middleware зарегистрирован")
+    
+    # Регистрация административного middleware
+    admin_middleware = AdminMiddleware(ADMIN_IDS)
+    dp.message.middleware(admin_middleware)
+    dp.callback_query.middleware(admin_middleware)
+    logger.info("УСПЕХ: Административный middleware зарегистрирован")
+    
+    # Отсечение устаревших и повторных ответов в тестах (после очереди пользователя)
+    dp.callback_query.middleware(answer_guard)
+    
+    # Ошибки обработчиков считаются последним слоем: защита состояний их перехватывает
+    dp.message.middleware(handler_metrics.errors)
+    dp.callback_query.middleware(handler_metrics.errors)
+    
+    # Регистрация роутеров (ПОРЯДОК ВАЖЕН!)
+    if ADMIN_IDS:
+        dp.include_router(admin_router)  # ПЕРВЫМ - админский роутер
+        logger.info("УСПЕХ: Административный роутер подключен")
+    
+    dp.include_router(router)  # ВТОРЫМ - основной роутер
+    
+    logger.info("УСПЕХ: Диспетчер настроен с защитой состояний")
+    
+    return dp
+
+def register_shutdown_steps(outbound, storage):
+    """Шаги сброса при остановке, после того как начатые обработчики завершились
+
+    Порядок важен: рассылки останавливаются первыми, иначе их отправители
+    занимают очередь исходящих до конца отведенного времени; правки сообщений
+    отправляются через очередь исходящих, а контрольная точка WAL - после
+    всех записей в базу.
+    """
+    shutdown_coordinator.add_step("broadcasts", stop_active_broadcasts)
+    shutdown_coordinator.add_step("edits", edit_coalescer.flush)
+    shutdown_coordinator.add_step("outbound", outbound.drain)
+    shutdown_coordinator.add_step("event_bus", event_bus.close)
+    shutdown_coordinator.add_step("fsm_storage", storage.close)
+    shutdown_coordinator.add_step("wal_checkpoint", checkpoint_wal)
+
 async def main():
     """Основная функция запуска бота с интеграцией защиты состояний"""
     
@@ -271,6 +407,9 @@ async def main():
     bot = None
     try:
         bot = await create_bot_with_retry()
+        install_metrics(bot, asyncio.get_running_loop())
+        # При шардировании исходящий лимит Telegram делится на WORKERS + 1: этот процесс (рассылки) и воркеры
+        outbound = install_outbound_limiter(bot, rate_share=1 / (WORKERS + 1) if WORKERS > 1 else 1.0)
         logger.info("УСПЕХ: Бот создан")
         
         # Тестируем подключение
@@ -282,50 +421,11 @@ async def main():
         # Настройка команд
         await setup_commands(bot)
         
-        # Создаем диспетчер
-        storage = MemoryStorage()
-        dp = Dispatcher(storage=storage)
-        
-        # ============================================================================
-        # ИНТЕГРАЦИЯ MIDDLEWARE ДЛЯ ЗАЩИТЫ ОТ ЗАЦИКЛИВАНИЯ
-        # ============================================================================
-        
-        # КРИТИЧЕСКИ ВАЖНО: Регистрируем middleware защиты состояний ПЕРВЫМ
-        # Это обеспечивает обработку всех запросов через защиту от дублирования
-        if os.getenv("DEBUG_MODE", "true").lower() == "true":
-            logger.info("🔍 РЕЖИМ ДИАГНОСТИКИ: простой middleware")
-            
-            class SimpleDiagnosticMiddleware:
-                async def __call__(self, handler, event, data):
-                    if hasattr(event, 'from_user') and event.from_user:
-                        user_id = event.from_user.id
-                        logger.info(f"🔍 ДИАГНОСТИКА: user_id={user_id}")
-                    return await handler(event, data)
-            
-            diagnostic_middleware = SimpleDiagnosticMiddleware()
-            dp.message.middleware(diagnostic_middleware)
-            dp.callback_query.middleware(diagnostic_middleware)
-            logger.info("✅ Диагностический middleware зарегистрирован")
-        else:
-            logger.info("🛡️ ПРОДАКШН РЕЖИМ: защищенный middleware") 
-            dp.message.middleware(state_protection)
-            dp.callback_query.middleware(state_protection)
-            logger.info("✅ Защищенный middleware зарегистрирован")
-        
-        # Регистрация административного middleware
-        admin_middleware = AdminMiddleware(ADMIN_IDS)
-        dp.message.middleware(admin_middleware)
-        dp.callback_query.middleware(admin_middleware)
-        logger.info("УСПЕХ: Административный middleware зарегистрирован")
-        
-        # Регистрация роутеров (ПОРЯДОК ВАЖЕН!)
-        if ADMIN_IDS:
-            dp.include_router(admin_router)  # ПЕРВЫМ - админский роутер
-            logger.info("УСПЕХ: Административный роутер подключен")
-        
-        dp.include_router(router)  # ВТОРЫМ - основной роутер
-        
-        logger.info("УСПЕХ: Диспетчер настроен с защитой состояний")
+        # Создаем диспетчер: при шардировании FSM хранится в общей базе
+        storage = SQLiteStorage() if WORKERS > 1 else MemoryStorage()
+        dp = build_dispatcher(storage)
+        rate_limiter = dp.get("rate_limiter")
+        register_shutdown_steps(outbound, storage)
         
     except Exception as e:
         logger.error(f"ОШИБКА создания бота: {e}")
@@ -334,6 +434,8 @@ async def main():
     # Запуск планировщика рассылок
     scheduler = None
     scheduler_task = None
+    metrics_runner = None
+    checks_task = None
     
     try:
         if ADMIN_IDS:
@@ -348,11 +450,12 @@ async def main():
     logger.info(f"   Пароль админки: {'установлен' if ADMIN_PASSWORD else 'НЕ УСТАНОВЛЕН'}")
     logger.info(f"   Планировщик рассылок: {'включен' if scheduler else 'отключен'}")
     logger.info(f"   Прокси: {'используется' if PROXY_URL else 'не используется'}")
+    logger.info(f"   Режим получения обновлений: {BOT_MODE}")
     logger.info(f"   Защита состояний: ВКЛЮЧЕНА")
-    logger.info(f"   Middleware: StateProtection -> AdminMiddleware -> Handlers")
+    logger.info(f"   Middleware: RateLimit -> StateProtection -> AdminMiddleware -> Handlers")
     
     # Запуск бота
-    logger.info("Запуск polling с защитой от зацикливания...")
+    logger.info(f"Запуск ({BOT_MODE}) с защитой от зацикливания...")
     
     try:
         # Запускаем планировщик в фоне
@@ -362,13 +465,49 @@ async def main():
         
         # Статистика защиты состояний
         def log_protection_stats():
-            processing_count = len(state_protection.processing_users)
-            cache_size = len(state_protection.user_last_action)
-            timeout_size = len(state_protection.action_timeouts)
+            if rate_limiter:
+                limits = rate_limiter.stats()
+                if limits['throttled_user'] or limits['throttled_global']:
+                    logger.info(f"Ограничение частоты: пропущено {limits['passed_total']}, "
+                               f"отклонено по лимиту пользователя {limits['throttled_user']}, "
+                               f"по общему лимиту {limits['throttled_global']}, "
+                               f"ведер в памяти {limits['tracked_users']}")
+            
+            answers = answer_guard.stats()
+            if answers['duplicate_total'] or answers['stale_total']:
+                logger.info(f"Ответы в тестах: принято {answers['passed_total']}, "
+                           f"повторов {answers['duplicate_total']}, устаревших {answers['stale_total']}")
+            
+            sends = outbound.stats()
+            if sends['queued_low'] or sends['retry_after_total'] or sends['max_wait_high'] > 1:
+                logger.info(f"Исходящие: ответов {sends['sent_high']} (ожидание в среднем {sends['avg_wait_high']:.2f} сек, "
+                           f"макс. {sends['max_wait_high']:.2f}), рассылки {sends['sent_low']} "
+                           f"(в очереди {sends['queued_low']}), RetryAfter {sends['retry_after_total']}")
+            
+            edits = edit_coalescer.stats()
+            if edits['superseded'] or edits['unchanged'] or edits['fallbacks']:
+                logger.info(f"Правки сообщений: отправлено {edits['sent']}, отброшено устаревших {edits['superseded']}, "
+                           f"без изменений {edits['unchanged']}, заменено новым сообщением {edits['fallbacks']}")
             
-            if processing_count > 0 or cache_size > 50:
-                logger.info(f"Защита состояний: обрабатывается {processing_count} пользователей, "
-                           f"кэш {cache_size} записей, тайм-ауты {timeout_size}")
+            bus = event_bus.stats()
+            if bus['published']:
+                counts = ", ".join(f"{name} {count}" for name, count in sorted(event_counters.stats().items()))
+                logger.info(f"События: опубликовано {bus['published']} ({counts}), в очередях {bus['queued']}, "
+                           f"ожиданий из-за переполнения {bus['backpressure_waits']}, ошибок {bus['failed']}")
+            
+            media = materials_cache.stats()
+            if media['uploads'] or media['cached_sends']:
+                logger.info(f"Материалы: загружено в Telegram {media['uploads']} файлов, "
+                           f"отправлено по file_id {media['cached_sends']}")
+            
+            stats = state_protection.stats()
+            
+            if stats['active_users'] > 0 or stats['cache_size'] > 50:
+                logger.info(f"Защита состояний: обрабатывается {stats['active_users']} пользователей "
+                           f"({stats['pending_updates']} обновлений, в ожидании {stats['waiting_users']}), "
+                           f"макс. глубина очереди {stats['max_depth']}, "
+                           f"в очереди всего {stats['queued_total']}, отброшено {stats['rejected_total']}, "
+                           f"кэш {stats['cache_size']} записей")
         
         # Периодическое логирование статистики (каждые 5 минут)
         async def stats_logger():
@@ -378,19 +517,36 @@ async def main():
         
         stats_task = asyncio.create_task(stats_logger())
         
-        # Запускаем поллинг
-        await dp.start_polling(
-            bot,
-            handle_signals=True,
-            drop_pending_updates=True
-        )
+        # При шардировании обработчики работают в воркерах, у каждого свой порт метрик
+        if METRICS_PORT and WORKERS <= 1:
+            metrics_runner = await start_metrics_server()
+        
+        if FAST_START:
+            checks_task = asyncio.create_task(deferred_integrity_checks())
+        logger.info(f"Готов принимать обновления через {time.monotonic() - PROCESS_STARTED:.2f} сек после запуска")
+        
+        if WORKERS > 1:
+            # Этот процесс только принимает обновления и раздает их воркерам
+            await run_sharded(bot, dp, WORKERS, BOT_MODE)
+        elif BOT_MODE == "webhook":
+            # Запускаем webhook-сервер
+            await run_webhook(bot, dp)
+        else:
+            # Запускаем поллинг; сессию закрываем сами - после остановки поллинга
+            # начатые обработчики еще дорабатывают
+            await dp.start_polling(
+                bot,
+                handle_signals=True,
+                close_bot_session=False,
+                drop_pending_updates=DROP_PENDING_UPDATES
+            )
         
     except KeyboardInterrupt:
         logger.info("ОСТАНОВКА: Бот остановлен пользователем")
     except Exception as e:
         logger.error(f"ОШИБКА при работе бота: {e}")
         # Логируем состояние защиты при ошибке
-        logger.error(f"Состояние защиты: {len(state_protection.processing_users)} активных пользователей")
+        logger.error(f"Состояние защиты: {state_protection.stats()['active_users']} активных пользователей")
     finally:
         # Останавливаем планировщик
         if scheduler:
@@ -404,6 +560,13 @@ async def main():
             except asyncio.CancelledError:
                 pass
         
+        if checks_task:
+            checks_task.cancel()
+            try:
+                await checks_task
+            except asyncio.CancelledError:
+                pass
+        
         # Останавливаем логирование статистики
         if 'stats_task' in locals():
             stats_task.cancel()
@@ -412,16 +575,21 @@ async def main():
             except asyncio.CancelledError:
                 pass
         
+        # Прием обновлений уже остановлен: дожидаемся начатых обработчиков,
+        # сбрасываем правки, исходящие, лог активности, FSM и WAL базы
+        await shutdown_coordinator.shutdown()
+        
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        
         # Финальная статистика защиты
-        final_processing = len(state_protection.processing_users)
-        final_cache = len(state_protection.user_last_action)
-        logger.info(f"ФИНАЛЬНАЯ СТАТИСТИКА: {final_processing} активных пользователей, "
-                   f"{final_cache} записей в кэше")
+        final_stats = state_protection.stats()
+        logger.info(f"ФИНАЛЬНАЯ СТАТИСТИКА: {final_stats['active_users']} активных пользователей, "
+                   f"{final_stats['cache_size']} записей в кэше, "
+                   f"отброшено из-за переполнения очереди {final_stats['rejected_total']}")
         
         # Очищаем состояние защиты
-        state_protection.processing_users.clear()
-        state_protection.user_last_action.clear()
-        state_protection.action_timeouts.clear()
+        state_protection.reset()
         logger.info("ОЧИЩЕНО: Состояние защиты сброшено")
         
         # Закрываем сессию бота
@@ -0,0 +1,188 @@
+"""
+Отправка материалов с кэшем file_id Telegram
+
+Каждый файл загружается в Telegram один раз, дальше отправляется по file_id.
+Кэш хранится в таблице media_cache и сбрасывается, когда меняется
+содержимое файла (проверяется sha256 при изменении размера или mtime).
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+from typing import List
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile, InputMediaDocument, Message
+
+from database import get_media_cache, save_media_file_id
+
+logger = logging.getLogger(__name__)
+
+MATERIALS_DIR = os.getenv("MATERIALS_DIR", "materials")
+MEDIA_GROUP_LIMIT = 10  # Максимум файлов в одной медиагруппе Telegram
+
+
+def material_caption(filename: str) -> str:
+    """Подпись к файлу материалов по его имени"""
+    name = filename.lower()
+    if "analyses" in name or "анализ" in name:
+        return "📌 Бонус: чек-лист «Препараты и методики, которые не лечат сердце и сосуды»"
+    if "checklist" in name or "чеклист" in name or "препарат" in name:
+        return "📋 Список базовых анализов для подготовки к вебинару"
+    if "webinar" in name or "вебинар" in name:
+        return "📋 Материалы к вебинару"
+    return f"📄 Дополнительный материал: {filename}"
+
+
+def _file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class MaterialFile:
+    """Файл материалов и его file_id в Telegram (если уже загружен)"""
+
+    __slots__ = ('path', 'name', 'caption', 'size', 'mtime_ns', 'sha256', 'file_id')
+
+    def __init__(self, path: str):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.caption = material_caption(self.name)
+        self.size = None
+        self.mtime_ns = None
+        self.sha256 = None
+        self.file_id = None
+
+    def media(self):
+        return self.file_id or FSInputFile(self.path)
+
+
+class MaterialsCache:
+    """Файлы из папки материалов с кэшированными file_id"""
+
+    def __init__(self, directory: str = MATERIALS_DIR):
+        self.directory = directory
+        self._files = {}                 # путь -> MaterialFile
+        self._loaded = False
+        self._upload_lock = asyncio.Lock()
+
+        # Метрики
+        self.uploads = 0
+        self.cached_sends = 0
+
+    async def _load(self):
+        """Подтянуть file_id, сохраненные до перезапуска"""
+        try:
+            saved = await get_media_cache()
+        except Exception as e:
+            logger.warning(f"Не удалось загрузить кэш file_id: {e}")
+            saved = {}
+
+        for path, row in saved.items():
+            material = self._files.setdefault(path, MaterialFile(path))
+            material.file_id = row['file_id']
+            material.sha256 = row['sha256']
+            material.size = row['size']
+            material.mtime_ns = row['mtime_ns']
+        self._loaded = True
+
+    def _scan(self) -> List[MaterialFile]:
+        """Актуальный список файлов; file_id сбрасывается, если содержимое изменилось"""
+        files = []
+        for filename in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, filename)
+            if not os.path.isfile(path):
+                continue
+
+            stat = os.stat(path)
+            material = self._files.setdefault(path, MaterialFile(path))
+            if material.size != stat.st_size or material.mtime_ns != stat.st_mtime_ns:
+                sha256 = _file_sha256(path)
+                if sha256 != material.sha256:
+                    if material.file_id:
+                        logger.info(f"Файл {path} изменился, будет загружен заново")
+                    material.file_id = None
+                    material.sha256 = sha256
+                material.size = stat.st_size
+                material.mtime_ns = stat.st_mtime_ns
+            files.append(material)
+        return files
+
+    async def refresh(self) -> List[MaterialFile]:
+        """Список файлов материалов (пустой, если папки нет)"""
+        if not self._loaded:
+            await self._load()
+        if not os.path.isdir(self.directory):
+            return []
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self._scan)
+
+    async def send(self, message: Message) -> int:
+        """Отправить все материалы в чат сообщения, возвращает число файлов"""
+        files = await self.refresh()
+        if not files:
+            return 0
+
+        if not all(material.file_id for material in files):
+            # Первую загрузку выполняет один пользователь, остальные ждут file_id
+            async with self._upload_lock:
+                files = await self.refresh()
+                if not all(material.file_id for material in files):
+                    await self._send(message, files)
+                    return len(files)
+
+        await self._send(message, files)
+        return len(files)
+
+    async def _send(self, message: Message, files: List[MaterialFile]):
+        for start in range(0, len(files), MEDIA_GROUP_LIMIT):
+            chunk = files[start:start + MEDIA_GROUP_LIMIT]
+            try:
+                await self._send_chunk(message, chunk)
+            except TelegramBadRequest as e:
+                if not any(material.file_id for material in chunk):
+                    raise
+                # file_id мог стать недействительным: загружаем файлы заново
+                logger.warning(f"Отправка по file_id не удалась ({e}), загружаю файлы заново")
+                for material in chunk:
+                    material.file_id = None
+                await self._send_chunk(message, chunk)
+
+    async def _send_chunk(self, message: Message, chunk: List[MaterialFile]):
+        uploaded = [material for material in chunk if not material.file_id]
+
+        if len(chunk) == 1:
+            sent = [await message.answer_document(chunk[0].media(), caption=chunk[0].caption)]
+        else:
+            sent = await message.answer_media_group([
+                InputMediaDocument(media=material.media(), caption=material.caption)
+                for material in chunk
+            ])
+
+        self.uploads += len(uploaded)
+        self.cached_sends += len(chunk) - len(uploaded)
+
+        for material, sent_message in zip(chunk, sent):
+            if material.file_id or not sent_message.document:
+                continue
+            material.file_id = sent_message.document.file_id
+            try:
+                await save_media_file_id(material.path, material.file_id, material.sha256,
+                                         material.size, material.mtime_ns)
+            except Exception as e:
+                logger.warning(f"file_id для {material.path} не сохранен в базе: {e}")
+
+    def stats(self) -> dict:
+        return {
+            'files': len(self._files),
+            'cached': sum(1 for material in self._files.values() if material.file_id),
+            'uploads': self.uploads,
+            'cached_sends': self.cached_sends
+        }
+
+
+materials_cache = MaterialsCache()
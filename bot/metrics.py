@@ -0,0 +1,284 @@
+"""
+Метрики обработчиков: время обработки, время в базе и в Bot API, ошибки
+
+Время копится в гистограммах с фиксированными границами по имени
+обработчика. Выгрузка - командой /metrics в админке и в текстовом формате
+Prometheus по HTTP (METRICS_PORT, только локальный адрес по умолчанию).
+"""
+
+import contextvars
+import logging
+import os
+import time
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+logger = logging.getLogger(__name__)
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 - HTTP-выгрузка отключена
+
+# Границы корзин (сек), как у гистограмм Prometheus по умолчанию
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Счетчики текущего апдейта; None - вызов не из обработчика (рассылки, фон)
+_current = contextvars.ContextVar("handler_timing", default=None)
+
+# ============================================================================
+# ГИСТОГРАММЫ
+# ============================================================================
+
+class Histogram:
+    """Гистограмма с фиксированными границами корзин"""
+
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Последняя корзина - +Inf
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля сверху: граница корзины, в которую он попал"""
+        total = self.count
+        if not total:
+            return 0.0
+        rank = q * total
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class _Timing:
+    """Время текущего апдейта в базе и в Bot API"""
+
+    __slots__ = ('db', 'api')
+
+    def __init__(self):
+        self.db = 0.0
+        self.api = 0.0
+
+
+class HandlerStats:
+    __slots__ = ('name', 'wall', 'db', 'api', 'errors')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.wall = Histogram()
+        self.db = Histogram()
+        self.api = Histogram()
+        self.errors = 0
+
+# ============================================================================
+# СБОР
+# ============================================================================
+
+class HandlerMetrics:
+    """Middleware, замеряющий каждый вызов обработчика
+
+    Регистрируется первым из inner middleware, поэтому в замер входят и
+    остальные middleware (очередь пользователя, лимиты). Время в базе
+    считает MeteredExecutor (запросы обработчиков идут через
+    run_in_executor), время в Bot API - ApiTimingMiddleware сессии.
+    Ошибки считает errors - middleware, регистрируемый последним:
+    StateProtectionMiddleware перехватывает исключения обработчиков, и
+    до этого слоя они не доходят.
+    """
+
+    def __init__(self):
+        self._by_callback = {}   # функция обработчика -> HandlerStats
+        self._by_name = {}
+        self.errors = HandlerErrorCounter(self)
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get('handler')
+        if handler_object is None:
+            return await handler(event, data)
+
+        stats = self.stats_for(handler_object.callback)
+        timing = _Timing()
+        token = _current.set(timing)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            stats.wall.observe(time.perf_counter() - started)
+            stats.db.observe(timing.db)
+            stats.api.observe(timing.api)
+            _current.reset(token)
+
+    def stats_for(self, callback) -> HandlerStats:
+        stats = self._by_callback.get(callback)
+        if stats is None:
+            stats = self._register(callback)
+        return stats
+
+    def _register(self, callback) -> HandlerStats:
+        name = getattr(callback, '__name__', None) or type(callback).__name__
+        stats = self._by_name.get(name)
+        if stats is None:
+            stats = self._by_name[name] = HandlerStats(name)
+        self._by_callback[callback] = stats
+        return stats
+
+    def handlers(self):
+        return sorted(self._by_name.values(), key=lambda stats: stats.name)
+
+    def summary(self, limit: int = 20) -> str:
+        """Самые медленные по p95 обработчики для админки"""
+        rows = sorted(self._by_name.values(), key=lambda s: (s.wall.quantile(0.95), s.wall.count), reverse=True)
+        lines = []
+        for stats in rows[:limit]:
+            count = stats.wall.count
+            lines.append(
+                f"<b>{stats.name}</b>: {count} вызовов, "
+                f"p50 ≤ {stats.wall.quantile(0.5) * 1000:.0f} мс, p95 ≤ {stats.wall.quantile(0.95) * 1000:.0f} мс, "
+                f"база {stats.db.sum / max(count, 1) * 1000:.1f} мс, API {stats.api.sum / max(count, 1) * 1000:.1f} мс"
+                + (f", ошибок {stats.errors}" if stats.errors else "")
+            )
+        return "\n".join(lines)
+
+    def render_prometheus(self) -> str:
+        """Метрики в текстовом формате Prometheus"""
+        lines = []
+        for metric, help_text, attr in (
+            ("cardio_handler_seconds", "Время обработки апдейта", 'wall'),
+            ("cardio_handler_db_seconds", "Время в базе данных за апдейт", 'db'),
+            ("cardio_handler_api_seconds", "Время в Bot API за апдейт", 'api'),
+        ):
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} histogram")
+            for stats in self.handlers():
+                histogram = getattr(stats, attr)
+                label = f'handler="{stats.name}"'
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{{label},le="{bound}"}} {cumulative}')
+                cumulative += histogram.counts[-1]
+                lines.append(f'{metric}_bucket{{{label},le="+Inf"}} {cumulative}')
+                lines.append(f"{metric}_sum{{{label}}} {histogram.sum:.6f}")
+                lines.append(f"{metric}_count{{{label}}} {cumulative}")
+
+        lines.append("# HELP cardio_handler_errors_total Исключения в обработчиках")
+        lines.append("# TYPE cardio_handler_errors_total counter")
+        for stats in self.handlers():
+            lines.append(f'cardio_handler_errors_total{{handler="{stats.name}"}} {stats.errors}')
+        return "\n".join(lines) + "\n"
+
+
+class ApiTimingMiddleware(BaseRequestMiddleware):
+    """Время запросов к Bot API, сделанных из обработчика"""
+
+    async def __call__(self, make_request, bot, method):
+        timing = _current.get()
+        if timing is None:
+            return await make_request(bot, method)
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            timing.api += time.perf_counter() - started
+
+
+class HandlerErrorCounter:
+    """Middleware, засчитывающий исключение обработчика в его метрики
+
+    Регистрируется последним из inner middleware, ближе всех к обработчику,
+    и пропускает исключение дальше.
+    """
+
+    def __init__(self, metrics: HandlerMetrics):
+        self.metrics = metrics
+
+    async def __call__(self, handler, event, data):
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_object = data.get('handler')
+            if handler_object is not None:
+                self.metrics.stats_for(handler_object.callback).errors += 1
+            raise
+
+
+class MeteredExecutor(ThreadPoolExecutor):
+    """Пул потоков для run_in_executor, засчитывающий время обработчику
+
+    Все обращения к базе из обработчиков идут через run_in_executor,
+    поэтому время от постановки задачи до ее завершения - время в базе
+    (включая ожидание свободного потока).
+    """
+
+    def submit(self, fn, *args, **kwargs):
+        future = super().submit(fn, *args, **kwargs)
+        timing = _current.get()
+        if timing is not None:
+            started = time.perf_counter()
+
+            def _done(_):
+                timing.db += time.perf_counter() - started
+
+            future.add_done_callback(_done)
+        return future
+
+
+class FirstUpdateTimer:
+    """Outer middleware апдейтов: время от старта процесса до первого апдейта
+
+    started - отметка time.monotonic() в начале импорта main. После первого
+    апдейта остается одна проверка флага.
+    """
+
+    def __init__(self, started: float):
+        self.started = started
+        self.elapsed = None
+
+    async def __call__(self, handler, event, data):
+        if self.elapsed is None:
+            self.elapsed = time.monotonic() - self.started
+            logger.info(f"Первое обновление через {self.elapsed:.2f} сек после запуска процесса")
+        return await handler(event, data)
+
+
+handler_metrics = HandlerMetrics()
+
+
+def install_metrics(bot: Bot, loop) -> None:
+    """Подключить замер Bot API и базы; вызывать до install_outbound_limiter,
+    чтобы ожидание лимита отправки тоже входило во время API"""
+    bot.session.middleware(ApiTimingMiddleware())
+    loop.set_default_executor(MeteredExecutor())
+
+# ============================================================================
+# HTTP-ВЫГРУЗКА
+# ============================================================================
+
+async def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT) -> web.AppRunner:
+    """Поднять HTTP-сервер с GET /metrics"""
+
+    async def metrics_handler(request: web.Request) -> web.Response:
+        return web.Response(text=handler_metrics.render_prometheus(),
+                            content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host=host, port=port).start()
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
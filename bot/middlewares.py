@@ -0,0 +1,404 @@
+"""
+Вспомогательные структуры данных и middleware для защиты бота от нагрузки
+"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+from aiogram.types import CallbackQuery
+
+from keyboards import TestAnswer
+
+logger = logging.getLogger(__name__)
+
+# ============================================================================
+# АДМИНИСТРАТИВНЫЕ ДЕЙСТВИЯ
+# ============================================================================
+
+# Список административных команд и callback'ов
+ADMIN_COMMANDS = ('/admin', '/stats', '/export', '/broadcast', '/adminhelp', '/metrics', '/schedule', '/webinar',
+                  '/segment', '/send_segment')
+ADMIN_CALLBACKS = ('admin_', 'export_', 'stats_', 'broadcast_', 'clean_', 'bjob_', 'segment_send_')
+
+
+def is_admin_action(event) -> bool:
+    """Проверка, является ли действие административным"""
+    
+    # Проверяем текстовые команды
+    text = getattr(event, 'text', None)
+    if text and text.strip().lower().startswith(ADMIN_COMMANDS):
+        return True
+    
+    # Проверяем callback'и
+    callback_data = getattr(event, 'data', None)
+    if callback_data and isinstance(callback_data, str) and callback_data.startswith(ADMIN_CALLBACKS):
+        return True
+    
+    return False
+
+# ============================================================================
+# СЛОВАРЬ С ИСТЕЧЕНИЕМ ЗАПИСЕЙ
+# ============================================================================
+
+class ExpiringMap:
+    """Словарь с TTL: записи истекают в порядке вставки за амортизированное O(1)
+
+    Все записи живут одинаковое время (ttl), поэтому порядок в OrderedDict
+    совпадает с порядком истечения: при обновлении ключ переносится в конец,
+    а очистка снимает просроченные записи только с начала.
+    """
+
+    __slots__ = ('ttl', '_data')
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+
+    def set(self, key, value, now: float):
+        """Записать значение, продлевая срок жизни ключа"""
+        data = self._data
+        if key in data:
+            data.move_to_end(key)
+        data[key] = (now + self.ttl, value)
+
+    def get(self, key, now: float, default=None):
+        """Получить значение, если запись еще не истекла"""
+        item = self._data.get(key)
+        if item is None or item[0] <= now:
+            return default
+        return item[1]
+
+    def pop(self, key, default=None):
+        """Удалить ключ и вернуть его значение"""
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def purge(self, now: float) -> int:
+        """Удалить просроченные записи, возвращает количество удаленных"""
+        data = self._data
+        removed = 0
+        while data:
+            expires_at = next(iter(data.values()))[0]
+            if expires_at > now:
+                break
+            data.popitem(last=False)
+            removed += 1
+        return removed
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+# ============================================================================
+# ПОСЛЕДОВАТЕЛЬНАЯ ОБРАБОТКА ОБНОВЛЕНИЙ ПОЛЬЗОВАТЕЛЯ
+# ============================================================================
+
+class _UserSlot:
+    """Очередь одного пользователя: FIFO-блокировка и счетчик ожидающих"""
+
+    __slots__ = ('lock', 'pending')
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.pending = 0  # Обрабатываемое обновление + ожидающие в очереди
+
+
+class UserSerializer:
+    """Строго последовательная обработка обновлений одного пользователя
+
+    Обновления одного пользователя выполняются по очереди в порядке поступления
+    (asyncio.Lock будит ожидающих в порядке FIFO), разные пользователи
+    обрабатываются параллельно. Очередь ограничена max_pending, слот удаляется,
+    как только в нем не остается обновлений.
+    """
+
+    def __init__(self, max_pending: int = 5):
+        self.max_pending = max_pending
+        self._slots = {}  # user_id -> _UserSlot
+
+        # Метрики
+        self.queued_total = 0    # Обновлений, ожидавших своей очереди
+        self.rejected_total = 0  # Обновлений, отброшенных из-за переполнения
+        self.max_depth = 0       # Максимальная глубина очереди
+
+    def enter(self, user_id):
+        """Занять место в очереди пользователя, None если очередь переполнена"""
+        slot = self._slots.get(user_id)
+        if slot is None:
+            slot = self._slots[user_id] = _UserSlot()
+        elif slot.pending >= self.max_pending:
+            self.rejected_total += 1
+            return None
+
+        slot.pending += 1
+        if slot.pending > 1:
+            self.queued_total += 1
+            if slot.pending > self.max_depth:
+                self.max_depth = slot.pending
+        return slot
+
+    def leave(self, user_id, slot: _UserSlot):
+        """Освободить место в очереди, удаляя опустевший слот"""
+        slot.pending -= 1
+        if slot.pending <= 0 and self._slots.get(user_id) is slot:
+            del self._slots[user_id]
+
+    def depth(self, user_id) -> int:
+        """Текущая глубина очереди пользователя"""
+        slot = self._slots.get(user_id)
+        return slot.pending if slot else 0
+
+    def stats(self) -> dict:
+        """Сводка по очередям для логирования"""
+        depths = [slot.pending for slot in self._slots.values()]
+        return {
+            'active_users': len(depths),
+            'pending_updates': sum(depths),
+            'waiting_users': sum(1 for d in depths if d > 1),
+            'max_depth': self.max_depth,
+            'queued_total': self.queued_total,
+            'rejected_total': self.rejected_total,
+        }
+
+    def clear(self):
+        self._slots.clear()
+
+    def __contains__(self, user_id):
+        return user_id in self._slots
+
+    def __len__(self):
+        return len(self._slots)
+
+
+# ============================================================================
+# ОГРАНИЧЕНИЕ ЧАСТОТЫ ЗАПРОСОВ (TOKEN BUCKET)
+# ============================================================================
+
+class TokenBucket:
+    """Ведро токенов: два числа на пользователя, без словаря атрибутов"""
+
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.updated = now
+
+    def consume(self, cost: float, rate: float, burst: float, now: float) -> bool:
+        """Пополнить ведро за прошедшее время и списать cost токенов"""
+        tokens = self.tokens + (now - self.updated) * rate
+        if tokens > burst:
+            tokens = burst
+        self.updated = now
+
+        if tokens >= cost:
+            self.tokens = tokens - cost
+            return True
+
+        self.tokens = tokens
+        return False
+
+    def delay(self, cost: float, rate: float) -> float:
+        """Сколько ждать, пока после неудачного consume накопится cost токенов"""
+        return max(0.0, (cost - self.tokens) / rate)
+
+
+class RateLimitMiddleware:
+    """Ограничение частоты запросов: ведро на пользователя и общее ведро бота
+
+    Ведро пользователя хранится в ExpiringMap со сроком жизни, равным времени
+    полного пополнения: истекшее ведро неотличимо от нового, поэтому в памяти
+    остаются только недавно активные пользователи. Административные действия
+    и администраторы не ограничиваются.
+    """
+
+    def __init__(self, user_rate: float = 3.0, user_burst: float = 8.0,
+                 global_rate: float = 200.0, global_burst: float = 400.0,
+                 message_cost: float = 1.0, callback_cost: float = 0.5,
+                 admin_ids=()):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.message_cost = message_cost
+        self.callback_cost = callback_cost
+        self.admin_ids = frozenset(admin_ids)
+
+        self.user_buckets = ExpiringMap(user_burst / user_rate)
+        self.global_bucket = TokenBucket(global_burst, 0.0)
+        self._global_started = False
+
+        # Метрики
+        self.passed_total = 0
+        self.exempt_total = 0
+        self.throttled_user = 0
+        self.throttled_global = 0
+
+    def _get_cost(self, event) -> float:
+        """Стоимость события: callback'и дешевле сообщений"""
+        if isinstance(event, CallbackQuery):
+            return self.callback_cost
+        return self.message_cost
+
+    async def __call__(self, handler, event, data):
+        if not hasattr(event, 'from_user') or not event.from_user:
+            return await handler(event, data)
+
+        user_id = event.from_user.id
+        if user_id in self.admin_ids or is_admin_action(event):
+            self.exempt_total += 1
+            return await handler(event, data)
+
+        now = asyncio.get_event_loop().time()
+        cost = self._get_cost(event)
+
+        # Ведро пользователя
+        bucket = self.user_buckets.get(user_id, now)
+        if bucket is None:
+            bucket = TokenBucket(self.user_burst, now)
+        allowed = bucket.consume(cost, self.user_rate, self.user_burst, now)
+        self.user_buckets.set(user_id, bucket, now)
+        self.user_buckets.purge(now)
+
+        if not allowed:
+            self.throttled_user += 1
+            await self._notify(event, "🔄 Слишком быстро! Подождите немного.")
+            return
+
+        # Общее ведро бота
+        if not self._global_started:
+            self.global_bucket.updated = now
+            self._global_started = True
+        if not self.global_bucket.consume(cost, self.global_rate, self.global_burst, now):
+            # Возвращаем токены пользователю: он не превышал свой лимит
+            bucket.tokens += cost
+            self.throttled_global += 1
+            await self._notify(event, "⏳ Бот сейчас перегружен, повторите через несколько секунд.")
+            return
+
+        self.passed_total += 1
+        return await handler(event, data)
+
+    async def _notify(self, event, text: str):
+        """Ответить на отклоненный callback, чтобы у пользователя не висели часики
+
+        На сообщения не отвечаем: ответ стоил бы еще одного запроса к API
+        именно в момент перегрузки.
+        """
+        if isinstance(event, CallbackQuery):
+            try:
+                await event.answer(text, show_alert=False)
+            except Exception as e:
+                logger.debug(f"Не удалось ответить на ограниченный callback: {e}")
+
+    def stats(self) -> dict:
+        """Сводка ограничителя для логирования"""
+        return {
+            'tracked_users': len(self.user_buckets),
+            'passed_total': self.passed_total,
+            'exempt_total': self.exempt_total,
+            'throttled_user': self.throttled_user,
+            'throttled_global': self.throttled_global,
+        }
+
+    def reset(self):
+        self.user_buckets.clear()
+
+
+# ============================================================================
+# ПРОВЕРКА ОТВЕТОВ НА ВОПРОСЫ ТЕСТОВ
+# ============================================================================
+
+class AnswerGuardMiddleware:
+    """Отсечение устаревших и повторных ответов на вопросы тестов без чтения FSM
+
+    При показе вопроса запоминается курсор чата: тест, идентификатор
+    прохождения и ожидаемый вопрос. Нажатие на кнопку TestAnswer сверяется
+    с курсором: ответ на уже пройденный или обрабатываемый сейчас вопрос -
+    повтор (молча игнорируется), кнопка другого прохождения или вопроса -
+    устаревшая. Если курсора нет (например, после перезапуска), проверку
+    выполняет обработчик по FSM.
+
+    Курсор сдвигается только после успешной обработки ответа (обычно сам
+    обработчик, показывая следующий вопрос): если обработчик упал,
+    повторное нажатие на тот же вопрос пропускается.
+    """
+
+    def __init__(self, ttl: float = 3600):
+        self.cursors = ExpiringMap(ttl)  # chat_id -> (код теста, nonce, ожидаемый вопрос)
+        self.in_flight = set()           # chat_id, ответ которых сейчас обрабатывается
+
+        # Метрики
+        self.passed_total = 0
+        self.duplicate_total = 0
+        self.stale_total = 0
+
+    def expect(self, chat_id: int, test_code: str, question_index: int, nonce: str):
+        """Запомнить вопрос, ответ на который ожидается в чате (чат сообщения с вопросом)"""
+        now = time.monotonic()
+        self.cursors.set(chat_id, (test_code, nonce, question_index), now)
+        self.cursors.purge(now)
+
+    async def __call__(self, handler, event, data):
+        callback_data = getattr(event, 'data', None)
+        if not isinstance(event, CallbackQuery) or not callback_data or not callback_data.startswith("ta:"):
+            return await handler(event, data)
+
+        try:
+            answer = TestAnswer.unpack(callback_data)
+        except (TypeError, ValueError):
+            return await handler(event, data)
+
+        # Курсор ставится по чату сообщения с вопросом (у inline-сообщений его нет)
+        if event.message is None:
+            return await handler(event, data)
+        chat_id = event.message.chat.id
+        now = time.monotonic()
+        cursor = self.cursors.get(chat_id, now)
+        if cursor is None:
+            return await handler(event, data)
+
+        test_code, nonce, expected = cursor
+        if answer.t == test_code and answer.n == nonce and (
+                answer.q < expected or (answer.q == expected and chat_id in self.in_flight)):
+            # Повторное нажатие: ответ уже учтен или обрабатывается
+            self.duplicate_total += 1
+            await self._answer(event)
+            return
+        if answer.t != test_code or answer.n != nonce or answer.q != expected:
+            self.stale_total += 1
+            await self._answer(event, "Эта кнопка устарела, ответьте на текущий вопрос")
+            return
+
+        self.passed_total += 1
+        self.in_flight.add(chat_id)
+        try:
+            result = await handler(event, data)
+        finally:
+            self.in_flight.discard(chat_id)
+        # Обработчик не показал следующий вопрос (например, тест завершен) - вопрос пройден
+        now = time.monotonic()
+        if self.cursors.get(chat_id, now) == cursor:
+            self.cursors.set(chat_id, (test_code, nonce, expected + 1), now)
+        return result
+
+    async def _answer(self, event, text: str = ""):
+        try:
+            await event.answer(text)
+        except Exception as e:
+            logger.debug(f"Не удалось ответить на отклоненный callback: {e}")
+
+    def stats(self) -> dict:
+        return {
+            'tracked_users': len(self.cursors),
+            'passed_total': self.passed_total,
+            'duplicate_total': self.duplicate_total,
+            'stale_total': self.stale_total,
+        }
@@ -0,0 +1,413 @@
+"""
+Исходящие запросы к Telegram: общий и по-чатовый лимиты, приоритеты, RetryAfter
+
+Все отправки бота проходят через middleware сессии aiogram, поэтому
+ответы обработчиков и рассылки делят один общий лимит. Интерактивные
+ответы идут в приоритетной полосе и всегда обгоняют рассылку.
+Частые правки одного сообщения склеиваются в EditCoalescer.
+"""
+
+import asyncio
+import contextvars
+import logging
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+from middlewares import ExpiringMap, TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# ============================================================================
+# НАСТРОЙКИ
+# ============================================================================
+
+# Запас + темп за любую секунду не превышают 30 сообщений - лимита Telegram
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "25"))    # Сообщений в секунду на бота
+OUTBOUND_GLOBAL_BURST = float(os.getenv("OUTBOUND_GLOBAL_BURST", "5"))
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", "1"))         # Сообщений в секунду в один чат
+OUTBOUND_CHAT_BURST = float(os.getenv("OUTBOUND_CHAT_BURST", "5"))       # Короткий всплеск в диалоге
+OUTBOUND_HIGH_RESERVE = float(os.getenv("OUTBOUND_HIGH_RESERVE", "2"))   # Токенов, недоступных рассылке
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "3"))       # Повторов после RetryAfter
+
+PRIORITY_HIGH = 0   # Ответы пользователям
+PRIORITY_LOW = 1    # Рассылки
+
+# Методы, которые создают или меняют сообщения и попадают под лимиты Telegram
+LIMITED_METHODS = frozenset({
+    "sendMessage", "sendDocument", "sendPhoto", "sendVideo", "sendAudio", "sendVoice",
+    "sendAnimation", "sendSticker", "sendMediaGroup", "sendContact", "sendLocation",
+    "copyMessage", "forwardMessage",
+    "editMessageText", "editMessageCaption", "editMessageReplyMarkup", "editMessageMedia",
+})
+
+_priority = contextvars.ContextVar("outbound_priority", default=PRIORITY_HIGH)
+
+
+@contextmanager
+def low_priority():
+    """Отправки внутри блока идут в полосе рассылок"""
+    token = _priority.set(PRIORITY_LOW)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+# ============================================================================
+# ОГРАНИЧИТЕЛЬ
+# ============================================================================
+
+class OutboundLimiter(BaseRequestMiddleware):
+    """Очередь исходящих сообщений с ведрами токенов и двумя полосами
+
+    Сначала запрос ждет токен своего чата (это не задерживает другие чаты),
+    затем токен общего ведра. Ожидающие общего токена стоят в двух очередях:
+    приоритетная обслуживается всегда первой, полоса рассылок - только когда
+    приоритетная пуста. Кроме того, рассылка не может израсходовать последние
+    high_reserve токенов, поэтому ответ пользователю обычно не ждет вовсе.
+    После RetryAfter чат ждет указанное время, а полоса рассылок
+    приостанавливается целиком, так как ограничение могло быть общим. Если
+    у запроса нет чата (например, правка inline-сообщения), на retry_after
+    останавливаются обе полосы: общее ведро уходит в минус.
+    """
+
+    def __init__(self, global_rate: float = OUTBOUND_GLOBAL_RATE, global_burst: float = OUTBOUND_GLOBAL_BURST,
+                 chat_rate: float = OUTBOUND_CHAT_RATE, chat_burst: float = OUTBOUND_CHAT_BURST,
+                 high_reserve: float = OUTBOUND_HIGH_RESERVE, max_retries: int = OUTBOUND_MAX_RETRIES):
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.high_reserve = min(high_reserve, max(global_burst - 1, 0.0))
+        self.max_retries = max_retries
+
+        self._global = TokenBucket(global_burst, time.monotonic())
+        # Истекшее ведро чата неотличимо от нового; минута - запас на RetryAfter
+        self._chats = ExpiringMap(ttl=max(chat_burst / chat_rate, 60.0))
+        self._lanes = (deque(), deque())     # Ожидающие общего токена: futures по приоритетам
+        self._low_paused_until = 0.0
+        self._pump_task = None
+        self._wakeup = asyncio.Event()       # Будит раздачу, стоящую на паузе рассылок
+
+        # Метрики
+        self.sent = [0, 0]
+        self.wait_total = [0.0, 0.0]
+        self.wait_max = [0.0, 0.0]
+        self.retry_after_total = 0
+
+    async def __call__(self, make_request, bot, method):
+        if method.__api_method__ not in LIMITED_METHODS:
+            return await make_request(bot, method)
+
+        priority = _priority.get()
+        chat_id = getattr(method, 'chat_id', None)
+
+        for attempt in range(self.max_retries + 1):
+            started = time.monotonic()
+            await self._acquire_chat(chat_id)
+            await self._acquire_global(priority)
+
+            waited = time.monotonic() - started
+            self.wait_total[priority] += waited
+            if waited > self.wait_max[priority]:
+                self.wait_max[priority] = waited
+
+            try:
+                result = await make_request(bot, method)
+                self.sent[priority] += 1
+                return result
+            except TelegramRetryAfter as e:
+                self.retry_after_total += 1
+                if attempt >= self.max_retries:
+                    raise
+                logger.warning(f"Telegram просит подождать {e.retry_after} сек ({method.__api_method__}, "
+                               f"чат {chat_id}), попытка {attempt + 1}/{self.max_retries}")
+                self._retry_after(chat_id, e.retry_after)
+
+    # ------------------------------------------------------------------ чаты
+
+    def _chat_bucket(self, chat_id, now: float) -> TokenBucket:
+        bucket = self._chats.get(chat_id, now)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_burst, now)
+        self._chats.set(chat_id, bucket, now)
+        return bucket
+
+    async def _acquire_chat(self, chat_id):
+        if chat_id is None:
+            return
+        while True:
+            now = time.monotonic()
+            self._chats.purge(now)
+            bucket = self._chat_bucket(chat_id, now)
+            if bucket.consume(1, self.chat_rate, self.chat_burst, now):
+                return
+            await asyncio.sleep(bucket.delay(1, self.chat_rate))
+
+    def _retry_after(self, chat_id, retry_after: float):
+        now = time.monotonic()
+        if chat_id is not None:
+            # Отрицательный запас: следующий токен накопится ровно через retry_after
+            bucket = self._chat_bucket(chat_id, now)
+            bucket.tokens = 1.0 - retry_after * self.chat_rate
+            bucket.updated = now
+        else:
+            # Ждать нечего, кроме общего ведра: следующий токен - через retry_after
+            self._global.consume(0, self.global_rate, self.global_burst, now)
+            self._global.tokens = min(self._global.tokens, 1.0 - retry_after * self.global_rate)
+        self._low_paused_until = max(self._low_paused_until, now + retry_after)
+
+    # ------------------------------------------------------------ общий лимит
+
+    async def _acquire_global(self, priority: int):
+        now = time.monotonic()
+        high, low = self._lanes
+        if priority == PRIORITY_HIGH:
+            can_skip_queue = not high
+        else:
+            can_skip_queue = not high and not low and now >= self._low_paused_until
+        if can_skip_queue and self._take_global(priority, now):
+            return
+
+        waiter = asyncio.get_event_loop().create_future()
+        self._lanes[priority].append(waiter)
+        self._wakeup.set()
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+        await waiter
+
+    def _take_global(self, priority: int, now: float) -> bool:
+        if priority == PRIORITY_HIGH or not self.high_reserve:
+            return self._global.consume(1, self.global_rate, self.global_burst, now)
+        # Рассылке нужен токен сверх резерва; резерв остается в ведре
+        if self._global.consume(1 + self.high_reserve, self.global_rate, self.global_burst, now):
+            self._global.tokens += self.high_reserve
+            return True
+        return False
+
+    def _next_lane(self, now: float):
+        high, low = self._lanes
+        while high and high[0].done():
+            high.popleft()
+        while low and low[0].done():
+            low.popleft()
+        if high:
+            return high
+        if low and now >= self._low_paused_until:
+            return low
+        return None
+
+    async def _pump(self):
+        """Раздача общих токенов ожидающим в порядке приоритета"""
+        while self._lanes[0] or self._lanes[1]:
+            self._wakeup.clear()
+            now = time.monotonic()
+            lane = self._next_lane(now)
+            if lane is None:
+                if self._lanes[1]:
+                    # Рассылка на паузе после RetryAfter; новый ответ пользователю прервет ожидание
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), self._low_paused_until - now)
+                    except asyncio.TimeoutError:
+                        pass
+                continue
+
+            priority = PRIORITY_HIGH if lane is self._lanes[PRIORITY_HIGH] else PRIORITY_LOW
+            if self._take_global(priority, now):
+                lane.popleft().set_result(None)
+            else:
+                reserve = self.high_reserve if priority == PRIORITY_LOW else 0.0
+                await asyncio.sleep(self._global.delay(1 + reserve, self.global_rate))
+
+    async def drain(self):
+        """Дождаться, пока ожидающие общего токена получат его (при остановке)"""
+        while self._pump_task is not None and not self._pump_task.done():
+            await asyncio.shield(self._pump_task)
+
+    def stats(self) -> dict:
+        return {
+            'sent_high': self.sent[PRIORITY_HIGH],
+            'sent_low': self.sent[PRIORITY_LOW],
+            'queued_high': len(self._lanes[PRIORITY_HIGH]),
+            'queued_low': len(self._lanes[PRIORITY_LOW]),
+            'avg_wait_high': self.wait_total[PRIORITY_HIGH] / max(self.sent[PRIORITY_HIGH], 1),
+            'max_wait_high': self.wait_max[PRIORITY_HIGH],
+            'avg_wait_low': self.wait_total[PRIORITY_LOW] / max(self.sent[PRIORITY_LOW], 1),
+            'retry_after_total': self.retry_after_total,
+            'tracked_chats': len(self._chats)
+        }
+
+
+def install_outbound_limiter(bot: Bot, rate_share: float = 1.0, **kwargs) -> OutboundLimiter:
+    """Подключить ограничитель к сессии бота
+
+    rate_share - доля общего лимита, приходящаяся на процесс
+    """
+    kwargs.setdefault('global_rate', OUTBOUND_GLOBAL_RATE * rate_share)
+    kwargs.setdefault('global_burst', max(OUTBOUND_GLOBAL_BURST * rate_share, 1.0))
+    limiter = OutboundLimiter(**kwargs)
+    bot.session.middleware(limiter)
+    return limiter
+
+
+# ============================================================================
+# СКЛЕИВАНИЕ ПРАВОК СООБЩЕНИЙ
+# ============================================================================
+
+EDIT_MAX_RETRIES = 3
+EDIT_RETRY_DELAY = 0.25     # Пауза перед повтором, удваивается с каждой попыткой
+EDIT_RENDERED_TTL = 3600    # Сколько помнить последний отправленный вид сообщения (сек)
+
+
+def _render(text: str, parse_mode, reply_markup) -> tuple:
+    markup = reply_markup.model_dump_json(exclude_none=True) if reply_markup else None
+    return text, parse_mode, markup
+
+
+class _PendingEdit:
+    __slots__ = ('message', 'text', 'parse_mode', 'reply_markup', 'rendered', 'future')
+
+    def __init__(self, message, text, parse_mode, reply_markup, rendered, future):
+        self.message = message
+        self.text = text
+        self.parse_mode = parse_mode
+        self.reply_markup = reply_markup
+        self.rendered = rendered
+        self.future = future
+
+    def resolve(self, result: bool):
+        if not self.future.done():
+            self.future.set_result(result)
+
+
+class EditCoalescer:
+    """Правки сообщения по ключу (chat_id, message_id) отправляются по одной
+
+    Пока правка сообщения в полете, новые правки того же сообщения ждут,
+    причем ждет только последняя: более старые отбрасываются, их futures
+    сразу завершаются. Правка, не меняющая текст и клавиатуру, в Telegram
+    не отправляется вовсе.
+
+    Последний вид сообщения известен только по правкам, прошедшим через
+    склеивание, поэтому все правки таких сообщений должны идти через edit.
+    После неудачной правки и при отправке нового сообщения вместо правки
+    запомненный вид сбрасывается: дальше сравнение идет со снимком из апдейта.
+    """
+
+    def __init__(self, max_retries: int = EDIT_MAX_RETRIES, retry_delay: float = EDIT_RETRY_DELAY):
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self._pending = {}                   # key -> _PendingEdit, ожидающая отправки
+        self._workers = {}                   # key -> задача, отправляющая правки сообщения
+        self._rendered = ExpiringMap(EDIT_RENDERED_TTL)  # key -> что сейчас показано
+
+        # Метрики
+        self.sent = 0
+        self.superseded = 0
+        self.unchanged = 0
+        self.fallbacks = 0
+
+    def edit(self, message, text: str, parse_mode="HTML", reply_markup=None) -> asyncio.Future:
+        """Поставить правку в очередь; future завершается, когда правка отправлена или отброшена"""
+        key = (message.chat.id, message.message_id)
+        rendered = _render(text, parse_mode, reply_markup)
+        future = asyncio.get_event_loop().create_future()
+
+        previous = self._pending.pop(key, None)
+        if previous is not None:
+            self.superseded += 1
+            previous.resolve(True)
+        elif key not in self._workers and self._shown(key, message) == rendered:
+            self.unchanged += 1
+            future.set_result(True)
+            return future
+
+        self._pending[key] = _PendingEdit(message, text, parse_mode, reply_markup, rendered, future)
+        if key not in self._workers:
+            self._workers[key] = asyncio.create_task(self._run(key))
+        return future
+
+    def _shown(self, key, message):
+        """Текущий вид сообщения: последняя наша правка или снимок из апдейта"""
+        now = time.monotonic()
+        rendered = self._rendered.get(key, now)
+        if rendered is not None:
+            return rendered
+        if getattr(message, 'text', None) is None:
+            return None
+        return _render(message.html_text, "HTML", message.reply_markup)
+
+    def _remember(self, key, rendered: tuple):
+        now = time.monotonic()
+        self._rendered.purge(now)
+        self._rendered.set(key, rendered, now)
+
+    async def _run(self, key):
+        try:
+            while True:
+                pending = self._pending.pop(key, None)
+                if pending is None:
+                    return
+                pending.resolve(await self._send(key, pending))
+        finally:
+            self._workers.pop(key, None)
+
+    async def _send(self, key, pending: _PendingEdit) -> bool:
+        if self._shown(key, pending.message) == pending.rendered:
+            self.unchanged += 1
+            return True
+
+        message = pending.message
+        for attempt in range(self.max_retries):
+            try:
+                await message.edit_text(pending.text, parse_mode=pending.parse_mode,
+                                        reply_markup=pending.reply_markup)
+                self._remember(key, pending.rendered)
+                self.sent += 1
+                return True
+            except Exception as e:
+                if "message is not modified" in str(e):
+                    self._remember(key, pending.rendered)
+                    return True
+                if key in self._pending:
+                    # Уже есть более новая правка, повторять устаревшую незачем
+                    self.superseded += 1
+                    return True
+                if isinstance(e, TelegramBadRequest) or attempt == self.max_retries - 1:
+                    # Сообщение удалено или недоступно для правки - повтор не поможет
+                    logger.warning(f"Не удалось отредактировать сообщение {key}: {e}")
+                    break
+                await asyncio.sleep(self.retry_delay * 2 ** attempt)
+
+        # Вид сообщения после неудачных попыток неизвестен (ответ на правку мог
+        # потеряться) - не считаем его показанным
+        self._rendered.pop(key)
+        # Сообщение не отредактировать - отправляем новое
+        try:
+            await message.answer(pending.text, parse_mode=pending.parse_mode, reply_markup=pending.reply_markup)
+            self.fallbacks += 1
+            return True
+        except Exception:
+            return False
+
+    async def flush(self):
+        """Дождаться отправки всех ожидающих правок (при остановке)"""
+        while self._workers:
+            await asyncio.gather(*list(self._workers.values()), return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            'sent': self.sent,
+            'superseded': self.superseded,
+            'unchanged': self.unchanged,
+            'fallbacks': self.fallbacks,
+            'in_flight': len(self._workers)
+        }
+
+
+edit_coalescer = EditCoalescer()
@@ -0,0 +1,188 @@
+"""
+Маршрутизация callback-запросов по префиксному дереву callback_data
+"""
+
+import logging
+import operator
+
+from aiogram import Router
+from aiogram.dispatcher.event.bases import UNHANDLED, SkipHandler
+from aiogram.dispatcher.event.telegram import TelegramEventObserver
+from aiogram.filters import Filter
+from aiogram.filters.callback_data import CallbackQueryFilter
+from aiogram.types import CallbackQuery
+
+logger = logging.getLogger(__name__)
+
+
+class CallbackRoute(Filter):
+    """Фильтр callback_data с явными ключами маршрута
+
+    CallbackRoute("admin_stats", "admin_back") - точные значения,
+    CallbackRoute(prefix="clean_") - префикс. Вне индекса работает как
+    обычный фильтр aiogram, а CallbackTrieObserver берет ключи прямо из него.
+    """
+
+    def __init__(self, *values: str, prefix: str = None):
+        if bool(values) == (prefix is not None):
+            raise ValueError("Нужно указать либо точные значения, либо префикс")
+        self.values = frozenset(values)
+        self.prefix = prefix
+
+    async def __call__(self, callback: CallbackQuery) -> bool:
+        data = callback.data
+        if data is None:
+            return False
+        if self.prefix is not None:
+            return data.startswith(self.prefix)
+        return data in self.values
+
+    def keys(self) -> list:
+        """Ключи маршрута: ('exact'|'prefix', строка)"""
+        if self.prefix is not None:
+            return [('prefix', self.prefix)]
+        return [('exact', value) for value in sorted(self.values)]
+
+
+def _get_route_keys(filter_):
+    """Ключи маршрута, которые гарантирует фильтр, или None
+
+    Ключи есть у CallbackRoute и у фильтров CallbackData (префикс класса).
+    """
+    if isinstance(filter_, CallbackRoute):
+        return filter_.keys()
+    if isinstance(filter_, CallbackQueryFilter):
+        callback_data = filter_.callback_data
+        return [('prefix', f"{callback_data.__prefix__}{callback_data.__separator__}")]
+    return None
+
+
+async def _check_filters(filters, event, kwargs: dict):
+    """То же, что HandlerObject.check, но для заданного списка фильтров"""
+    if not filters:
+        return True, kwargs
+    kwargs = dict(kwargs)
+    for event_filter in filters:
+        check = await event_filter.call(event, **kwargs)
+        if not check:
+            return False, kwargs
+        if isinstance(check, dict):
+            kwargs.update(check)
+    return True, kwargs
+
+
+class _TrieNode:
+    __slots__ = ('children', 'routes')
+
+    def __init__(self):
+        self.children = {}
+        self.routes = []  # (порядковый номер, обработчик, фильтры для проверки)
+
+
+class CallbackTrieObserver(TelegramEventObserver):
+    """Наблюдатель callback_query с индексом обработчиков по callback_data
+
+    Вместо проверки фильтров всех обработчиков подряд кандидаты выбираются
+    поиском по дереву префиксов и словарю точных значений, после чего их
+    фильтры проверяются в порядке регистрации. Поэтому результат совпадает
+    с обычным роутером aiogram: срабатывает первый зарегистрированный
+    обработчик, все фильтры которого прошли.
+
+    Ключи берутся из фильтров CallbackRoute и CallbackData, указанных при
+    регистрации; обработчики без них проверяются для каждого нажатия.
+    CallbackRoute после поиска по дереву повторно не проверяется.
+    """
+
+    def __init__(self, router: Router, event_name: str = "callback_query"):
+        super().__init__(router, event_name)
+        self._root = _TrieNode()
+        self._exact = {}     # callback_data -> [(порядковый номер, обработчик, фильтры)]
+        self._unkeyed = []   # Обработчики без распознанного ключа проверяются всегда
+
+    def register(self, callback, *filters, flags=None, **kwargs):
+        result = super().register(callback, *filters, flags=flags, **kwargs)
+        handler = self.handlers[-1]
+        index = len(self.handlers) - 1
+
+        keys, key_filter = None, None
+        for filter_ in filters:
+            keys = _get_route_keys(filter_)
+            if keys:
+                key_filter = filter_
+                break
+
+        if not keys:
+            self._unkeyed.append((index, handler, handler.filters))
+            return result
+
+        # Фильтр CallbackData еще должен распаковать данные, его оставляем
+        if isinstance(key_filter, CallbackQueryFilter):
+            residual = handler.filters
+        else:
+            residual = [f for f in handler.filters or [] if f.callback is not key_filter]
+        route = (index, handler, residual)
+
+        for kind, value in keys:
+            if kind == 'exact':
+                self._exact.setdefault(value, []).append(route)
+            else:
+                node = self._root
+                for char in value:
+                    node = node.children.setdefault(char, _TrieNode())
+                node.routes.append(route)
+        return result
+
+    def lookup(self, data: str) -> list:
+        """Кандидаты (обработчик, фильтры) для callback_data в порядке регистрации"""
+        candidates = list(self._unkeyed)
+        exact = self._exact.get(data)
+        if exact:
+            candidates.extend(exact)
+
+        node = self._root
+        if node.routes:
+            candidates.extend(node.routes)
+        for char in data:
+            node = node.children.get(char)
+            if node is None:
+                break
+            if node.routes:
+                candidates.extend(node.routes)
+
+        if len(candidates) > 1:
+            candidates.sort(key=operator.itemgetter(0))
+        return [(handler, filters) for _, handler, filters in candidates]
+
+    async def trigger(self, event, **kwargs):
+        data = getattr(event, 'data', None)
+        if not isinstance(data, str):
+            return await super().trigger(event, **kwargs)
+
+        for handler, filters in self.lookup(data):
+            kwargs["handler"] = handler
+            result, handler_data = await _check_filters(filters, event, kwargs)
+            if result:
+                kwargs.update(handler_data)
+                try:
+                    wrapped_inner = self.outer_middleware.wrap_middlewares(
+                        self._resolve_middlewares(),
+                        handler.call,
+                    )
+                    return await wrapped_inner(event, kwargs)
+                except SkipHandler:
+                    continue
+        return UNHANDLED
+
+
+def install_callback_trie(router: Router) -> CallbackTrieObserver:
+    """Заменить наблюдатель callback_query роутера на индексированный
+
+    Вызывается сразу после создания роутера, до регистрации обработчиков.
+    """
+    if router.callback_query.handlers:
+        raise RuntimeError("Индекс callback_query нужно установить до регистрации обработчиков")
+
+    observer = CallbackTrieObserver(router, "callback_query")
+    router.callback_query = observer
+    router.observers["callback_query"] = observer
+    return observer
@@ -0,0 +1,262 @@
+"""
+Сегменты аудитории рассылок
+
+Небольшой язык условий для админки (/segment) и send_custom_broadcast:
+
+    survey and not tests and survey_age >= 48h
+    risk in (ВЫСОКИЙ, ОЧЕНЬ_ВЫСОКИЙ)
+    stop_bang >= 5
+    inactive >= 7d
+    did survey_started and not did survey_started within 48h
+
+Выражение компилируется в одно условие над users: опрос и тесты
+проверяются EXISTS-подзапросами к последней записи пользователя в surveys
+и test_results, действия - к activity_logs. Подзапросы опираются на
+составные индексы по telegram_id.
+
+Грамматика:
+    выражение := терм ('or' терм)*
+    терм      := множитель ('and' множитель)*
+    множитель := 'not' множитель | '(' выражение ')' | условие
+    условие   := флаг | поле оператор значение | 'did' действие ['within' длительность]
+    оператор  := = != > >= < <= in
+    значение  := число | длительность (30m, 48h, 7d) | слово | "строка" | '(' значение, ... ')'
+"""
+
+import re
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, func, not_, or_, select
+from sqlalchemy.orm import aliased
+
+from database import ActivityLog, Survey, TestResult, User
+
+
+class SegmentError(ValueError):
+    """Ошибка в выражении сегмента"""
+
+
+# Флаги статуса пользователя: условие без оператора
+FLAGS = {
+    'registered': User.registration_completed,
+    'completed': User.completed_diagnostic,
+    'survey': User.survey_completed,
+    'tests': User.tests_completed,
+}
+
+# Поля последнего опроса и последних результатов тестов
+SURVEY_FIELDS = {
+    'age': Survey.age,
+    'gender': Survey.gender,
+    'health_rating': Survey.health_rating,
+}
+TEST_FIELDS = {
+    'risk': TestResult.overall_cv_risk_level,
+    'risk_score': TestResult.overall_cv_risk_score,
+    'risk_factors': TestResult.risk_factors_count,
+    'hads_anxiety': TestResult.hads_anxiety_score,
+    'hads_depression': TestResult.hads_depression_score,
+    'burns': TestResult.burns_score,
+    'isi': TestResult.isi_score,
+    'stop_bang': TestResult.stop_bang_score,
+    'ess': TestResult.ess_score,
+    'fagerstrom': TestResult.fagerstrom_score,
+    'audit': TestResult.audit_score,
+}
+
+# Давность события: поле >= 48h - событие было 48 часов назад или раньше
+AGE_FIELDS = {
+    'inactive': (None, User.last_activity),
+    'registered_age': (None, User.created_at),
+    'survey_age': (Survey, Survey.completed_at),
+    'tests_age': (TestResult, TestResult.completed_at),
+}
+
+KEYWORDS = {'and', 'or', 'not', 'in', 'did', 'within'}
+DURATION_UNITS = {'m': 'minutes', 'h': 'hours', 'd': 'days'}
+# Давность больше d <=> метка времени раньше now - d
+AGE_OPERATORS = {'>': '<', '>=': '<=', '<': '>', '<=': '>='}
+
+TOKEN_RE = re.compile(r'\s*(?:(?P<op>>=|<=|!=|=|>|<)|(?P<punct>[(),])|"(?P<string>[^"]*)"|(?P<word>[^\s()",=<>!]+))')
+DURATION_RE = re.compile(r'^(\d+)([mhd])$')
+
+
+def _tokenize(expression: str) -> list:
+    tokens = []
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = TOKEN_RE.match(expression, position)
+        if not match or match.end() == position:
+            raise SegmentError(f"Непонятный символ в позиции {position + 1}: {expression[position:position + 10]!r}")
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'word' and value.lower() in KEYWORDS:
+            kind, value = 'keyword', value.lower()
+        tokens.append((kind, value))
+        position = match.end()
+    return tokens
+
+
+def _compare(column, op: str, value):
+    if op == '=':
+        return column == value
+    if op == '!=':
+        return column != value
+    if op == '>':
+        return column > value
+    if op == '>=':
+        return column >= value
+    if op == '<':
+        return column < value
+    if op == '<=':
+        return column <= value
+    return column.in_(value)
+
+
+def _latest(model, condition):
+    """Условие на последнюю запись пользователя в surveys / test_results"""
+    newer = aliased(model)
+    latest_id = select(func.max(newer.id)).where(newer.telegram_id == model.telegram_id).scalar_subquery()
+    return select(model.id).where(model.telegram_id == User.telegram_id, model.id == latest_id, condition).exists()
+
+
+class _Parser:
+    def __init__(self, expression: str, now: datetime):
+        self.tokens = _tokenize(expression)
+        self.position = 0
+        self.now = now
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def take(self, kind: str = None, value: str = None):
+        token = self.peek()
+        if token[0] is None or (kind and token[0] != kind) or (value and token[1] != value):
+            expected = value or {'word': "поле, значение или действие"}.get(kind, "продолжение выражения")
+            found = token[1] if token[0] else "конец выражения"
+            raise SegmentError(f"Ожидалось {expected!r}, найдено {found!r}")
+        self.position += 1
+        return token[1]
+
+    def parse(self):
+        if not self.tokens:
+            raise SegmentError("Пустое выражение сегмента")
+        condition = self.expression()
+        if self.position < len(self.tokens):
+            raise SegmentError(f"Лишнее в конце выражения: {self.peek()[1]!r}")
+        return condition
+
+    def expression(self):
+        terms = [self.term()]
+        while self.peek() == ('keyword', 'or'):
+            self.take()
+            terms.append(self.term())
+        return terms[0] if len(terms) == 1 else or_(*terms)
+
+    def term(self):
+        factors = [self.factor()]
+        while self.peek() == ('keyword', 'and'):
+            self.take()
+            factors.append(self.factor())
+        return factors[0] if len(factors) == 1 else and_(*factors)
+
+    def factor(self):
+        token = self.peek()
+        if token == ('keyword', 'not'):
+            self.take()
+            return not_(self.factor())
+        if token == ('punct', '('):
+            self.take()
+            condition = self.expression()
+            self.take('punct', ')')
+            return condition
+        if token == ('keyword', 'did'):
+            self.take()
+            return self.did()
+        return self.condition()
+
+    def did(self):
+        action = self.take('word')
+        conditions = [ActivityLog.telegram_id == User.telegram_id, ActivityLog.action == action]
+        if self.peek() == ('keyword', 'within'):
+            self.take()
+            conditions.append(ActivityLog.timestamp >= self.now - self.duration(self.take('word')))
+        return select(ActivityLog.id).where(*conditions).exists()
+
+    def condition(self):
+        name = self.take('word').lower()
+        if name in FLAGS:
+            return FLAGS[name] == True
+
+        op = self.peek()
+        if op[0] == 'op':
+            op = self.take()
+        elif op == ('keyword', 'in'):
+            op = self.take()
+        else:
+            raise SegmentError(f"После {name!r} нужен оператор сравнения")
+
+        if name in AGE_FIELDS:
+            if op not in AGE_OPERATORS:
+                raise SegmentError(f"Для {name!r} допустимы только > >= < <=")
+            model, column = AGE_FIELDS[name]
+            condition = _compare(column, AGE_OPERATORS[op], self.now - self.duration(self.take('word')))
+            return _latest(model, condition) if model else condition
+
+        if name in SURVEY_FIELDS:
+            model, column = Survey, SURVEY_FIELDS[name]
+        elif name in TEST_FIELDS:
+            model, column = TestResult, TEST_FIELDS[name]
+        else:
+            known = sorted([*FLAGS, *SURVEY_FIELDS, *TEST_FIELDS, *AGE_FIELDS])
+            raise SegmentError(f"Неизвестное поле {name!r}. Доступны: {', '.join(known)}")
+
+        values = self.values() if op == 'in' else [self.value()]
+        numeric = column.type.python_type is int
+        values = [self.convert(name, value, numeric) for value in values]
+        return _latest(model, _compare(column, op, values if op == 'in' else values[0]))
+
+    def values(self) -> list:
+        self.take('punct', '(')
+        values = [self.value()]
+        while self.peek() == ('punct', ','):
+            self.take()
+            values.append(self.value())
+        self.take('punct', ')')
+        return values
+
+    def value(self) -> str:
+        kind, value = self.peek()
+        if kind not in ('word', 'string'):
+            return self.take('word')
+        self.position += 1
+        return value
+
+    @staticmethod
+    def convert(name: str, value: str, numeric: bool):
+        if numeric:
+            try:
+                return int(value)
+            except ValueError:
+                raise SegmentError(f"Для {name!r} нужно число, а не {value!r}")
+        if name == 'risk':
+            # Уровни риска хранятся заглавными и с пробелом: "ОЧЕНЬ ВЫСОКИЙ"
+            return value.replace('_', ' ').upper()
+        return value
+
+    @staticmethod
+    def duration(value: str) -> timedelta:
+        match = DURATION_RE.match(value.lower())
+        if not match:
+            raise SegmentError(f"Длительность записывается как 30m, 48h или 7d, а не {value!r}")
+        return timedelta(**{DURATION_UNITS[match.group(2)]: int(match.group(1))})
+
+
+def compile_segment(expression: str, now: datetime = None):
+    """Скомпилировать выражение сегмента в условие SQLAlchemy над users
+
+    Время в длительностях отсчитывается от now (по умолчанию - текущее
+    локальное, как и метки в базе). Ошибки выражения - SegmentError.
+    """
+    return _Parser(expression, now or datetime.now()).parse()
@@ -0,0 +1,253 @@
+"""
+Горизонтальное масштабирование: шардирование обновлений по пользователям
+
+Основной процесс получает обновления (polling или webhook) и раздает их
+N процессам-воркерам по from_user.id % N. Все обновления одного пользователя
+попадают в один воркер, поэтому порядок и кэш FSM остаются корректными:
+внутри воркера обновления одного пользователя выполняются по очереди.
+Планировщик рассылок работает только в основном процессе.
+
+Лимиты делятся так: входящие обновления (RateLimitMiddleware) - поровну
+между N воркерами, основной процесс их не обрабатывает; исходящие
+сообщения (OutboundLimiter) - на N + 1, доля основного процесса - рассылки.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+
+from aiogram import Bot, Dispatcher
+
+from webhook import (
+    DrainingRequestHandler, WEBHOOK_BASE_URL, WEBHOOK_SECRET,
+    create_stop_event, start_webhook_server
+)
+
+logger = logging.getLogger(__name__)
+
+SHARD_QUEUE_SIZE = int(os.getenv("SHARD_QUEUE_SIZE", "1000"))       # Размер очереди воркера
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "100"))    # Параллельных обновлений в воркере
+WORKER_STOP_TIMEOUT = float(os.getenv("WORKER_STOP_TIMEOUT", "30")) # Ожидание остановки воркера (сек)
+POLLING_TIMEOUT = 10
+
+# ============================================================================
+# РАСПРЕДЕЛЕНИЕ ОБНОВЛЕНИЙ
+# ============================================================================
+
+def get_update_user_id(update: dict) -> int:
+    """Идентификатор пользователя из сырого обновления Telegram"""
+    for key, event in update.items():
+        if key == "update_id" or not isinstance(event, dict):
+            continue
+        user = event.get("from") or event.get("user")
+        if user:
+            return user["id"]
+        chat = event.get("chat")
+        if chat:
+            return chat["id"]
+    return 0
+
+
+class ShardRouter:
+    """Раздача сырых обновлений по очередям воркеров"""
+
+    def __init__(self, queues: list):
+        self.queues = queues
+        self.routed = [0] * len(queues)
+
+    async def route(self, update: dict):
+        shard = get_update_user_id(update) % len(self.queues)
+        shard_queue = self.queues[shard]
+        while True:
+            try:
+                shard_queue.put_nowait(update)
+                break
+            except queue.Full:
+                # Воркер не успевает: ждем, не блокируя цикл событий
+                await asyncio.sleep(0.05)
+        self.routed[shard] += 1
+
+
+class ShardingRequestHandler(DrainingRequestHandler):
+    """Обработчик webhook, который передает обновления воркерам вместо диспетчера"""
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, secret_token: str, shard_router: ShardRouter, **kwargs):
+        super().__init__(dispatcher, bot, secret_token=secret_token, **kwargs)
+        self.shard_router = shard_router
+
+    async def _background_feed_update(self, bot: Bot, update: dict) -> None:
+        await self.shard_router.route(update)
+
+# ============================================================================
+# ПРОЦЕСС-ВОРКЕР
+# ============================================================================
+
+async def _worker_main(index: int, updates_queue, workers: int):
+    # Импорт здесь: воркер собирает собственные бот и диспетчер
+    from main import build_dispatcher, create_bot_with_retry, register_shutdown_steps
+    from middlewares import UserSerializer
+    from outbound import install_outbound_limiter
+    from storage import SQLiteStorage
+    from metrics import install_metrics, start_metrics_server, METRICS_PORT
+    from shutdown import shutdown_coordinator
+
+    bot = await create_bot_with_retry()
+    install_metrics(bot, asyncio.get_running_loop())
+    outbound = install_outbound_limiter(bot, rate_share=1 / (workers + 1))
+    storage = SQLiteStorage()
+    dp = build_dispatcher(storage, global_rate_share=1 / workers)
+    register_shutdown_steps(outbound, storage)
+    # Основной процесс ждет воркер WORKER_STOP_TIMEOUT, затем завершает принудительно
+    shutdown_coordinator.timeout = min(shutdown_coordinator.timeout,
+                                       max(WORKER_STOP_TIMEOUT - shutdown_coordinator.flush_timeout - 1, 1.0))
+    await dp.emit_startup(bot=bot)
+    metrics_runner = await start_metrics_server(port=METRICS_PORT + 1 + index) if METRICS_PORT else None
+
+    loop = asyncio.get_event_loop()
+    semaphore = asyncio.Semaphore(WORKER_CONCURRENCY)
+    # Очередь пользователя не переполняется: всего обновлений в работе не больше WORKER_CONCURRENCY
+    user_queues = UserSerializer(WORKER_CONCURRENCY)
+    tasks = set()
+    processed = 0
+
+    async def feed(update: dict, user_id: int, slot):
+        try:
+            # Обновления пользователя - по одному, в порядке поступления
+            # (не зависит от того, подключен ли StateProtectionMiddleware)
+            async with slot.lock:
+                await dp.feed_raw_update(bot, update)
+        except Exception as e:
+            logger.error(f"Воркер {index}: ошибка обработки обновления {update.get('update_id')}: {e}")
+        finally:
+            user_queues.leave(user_id, slot)
+            semaphore.release()
+
+    logger.info(f"Воркер {index} запущен (pid {os.getpid()})")
+    try:
+        while True:
+            update = await loop.run_in_executor(None, updates_queue.get)
+            if update is None:
+                break
+            # Задачи создаются в порядке поступления и в том же порядке ждут очереди пользователя
+            await semaphore.acquire()
+            user_id = get_update_user_id(update)
+            task = asyncio.create_task(feed(update, user_id, user_queues.enter(user_id)))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            processed += 1
+    finally:
+        # Координатор видит только начатые обработчики: обновления, ждущие очереди
+        # пользователя или места в семафоре, дожидаемся здесь, до закрытия хранилищ
+        if tasks:
+            logger.info(f"Воркер {index}: ожидаю {len(tasks)} обновлений (до {shutdown_coordinator.timeout} сек)...")
+            _, pending = await asyncio.wait(set(tasks), timeout=shutdown_coordinator.timeout)
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+                logger.warning(f"Воркер {index}: прервано {len(pending)} необработанных обновлений")
+        await shutdown_coordinator.shutdown()
+        await dp.emit_shutdown(bot=bot)
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await bot.session.close()
+        logger.info(f"Воркер {index} остановлен, обработано {processed} обновлений")
+
+
+def run_worker(index: int, updates_queue, workers: int):
+    """Точка входа процесса-воркера"""
+    # Ctrl+C получает вся группа процессов: воркер останавливается по команде основного процесса
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        asyncio.run(_worker_main(index, updates_queue, workers))
+    except KeyboardInterrupt:
+        pass
+
+# ============================================================================
+# ОСНОВНОЙ ПРОЦЕСС
+# ============================================================================
+
+def start_workers(workers: int, target=run_worker, *args):
+    """Запустить процессы-воркеры, возвращает (процессы, очереди)"""
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue(SHARD_QUEUE_SIZE) for _ in range(workers)]
+    processes = []
+    for index in range(workers):
+        process = context.Process(target=target, args=(index, queues[index], workers, *args),
+                                  name=f"cardio-worker-{index}")
+        process.start()
+        processes.append(process)
+    return processes, queues
+
+
+def stop_workers(processes: list, queues: list):
+    """Отправить воркерам сигнал остановки и дождаться их завершения"""
+    for updates_queue in queues:
+        updates_queue.put(None)
+    for process in processes:
+        process.join(WORKER_STOP_TIMEOUT)
+        if process.is_alive():
+            logger.warning(f"Воркер {process.name} не остановился вовремя, завершаю принудительно")
+            process.terminate()
+            process.join()
+
+
+async def _poll_updates(bot: Bot, dp: Dispatcher, shard_router: ShardRouter, stop_event: asyncio.Event):
+    """Long polling в основном процессе с передачей сырых обновлений воркерам"""
+    allowed_updates = dp.resolve_used_update_types()
+    offset = None
+    try:
+        while not stop_event.is_set():
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=POLLING_TIMEOUT,
+                                                allowed_updates=allowed_updates)
+            except Exception as e:
+                logger.error(f"Ошибка получения обновлений: {e}")
+                await asyncio.sleep(1)
+                continue
+
+            for update in updates:
+                await shard_router.route(update.model_dump(mode="json", by_alias=True, exclude_none=True))
+                offset = update.update_id + 1
+    except asyncio.CancelledError:
+        # Подтверждаем переданные воркерам обновления, чтобы Telegram не прислал их повторно
+        if offset is not None:
+            try:
+                await bot.get_updates(offset=offset, timeout=0, allowed_updates=allowed_updates)
+            except Exception as e:
+                logger.warning(f"Не удалось подтвердить полученные обновления: {e}")
+        raise
+
+
+async def run_sharded(bot: Bot, dp: Dispatcher, workers: int, mode: str = "polling"):
+    """Прием обновлений и распределение по воркерам до сигнала остановки"""
+
+    loop = asyncio.get_event_loop()
+    processes, queues = start_workers(workers)
+    shard_router = ShardRouter(queues)
+    stop_event = create_stop_event()
+    logger.info(f"Запущено {workers} воркеров, режим получения обновлений: {mode}")
+
+    server = None
+    try:
+        if mode == "webhook":
+            if not WEBHOOK_BASE_URL:
+                raise RuntimeError("Для режима webhook необходимо указать WEBHOOK_BASE_URL")
+            server = await start_webhook_server(
+                bot, dp, WEBHOOK_BASE_URL, secret_token=WEBHOOK_SECRET or None,
+                handler_cls=ShardingRequestHandler, shard_router=shard_router
+            )
+            await stop_event.wait()
+        else:
+            poll_task = asyncio.create_task(_poll_updates(bot, dp, shard_router, stop_event))
+            await stop_event.wait()
+            poll_task.cancel()
+            await asyncio.gather(poll_task, return_exceptions=True)
+    finally:
+        if server:
+            await server.stop()
+        await loop.run_in_executor(None, stop_workers, processes, queues)
+        logger.info(f"Воркеры остановлены, распределено обновлений: {shard_router.routed}")
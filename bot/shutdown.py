@@ -0,0 +1,101 @@
+"""
+Корректная остановка процесса бота
+
+Когда прием обновлений уже остановлен (поллинг завершен, webhook отвечает
+503, воркер получил сигнал), ShutdownCoordinator ждет начатые обработчики
+не дольше SHUTDOWN_TIMEOUT, затем по очереди выполняет шаги сброса:
+правки сообщений, очередь исходящих, шина событий, FSM, контрольная
+точка WAL. Время остановки и каждого шага пишется в лог.
+"""
+
+import asyncio
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "25"))             # Ожидание начатых обработчиков (сек)
+SHUTDOWN_FLUSH_TIMEOUT = float(os.getenv("SHUTDOWN_FLUSH_TIMEOUT", "5"))  # На все шаги сброса вместе (сек)
+
+
+class ShutdownCoordinator:
+    """Outer middleware апдейтов, считающий начатые обработчики, и порядок остановки
+
+    Новые апдейты после начала остановки не отбрасываются: к этому моменту
+    источник уже закрыт, и все, что дошло до диспетчера, Telegram считает
+    доставленным.
+    """
+
+    def __init__(self, timeout: float = SHUTDOWN_TIMEOUT, flush_timeout: float = SHUTDOWN_FLUSH_TIMEOUT):
+        self.timeout = timeout
+        self.flush_timeout = flush_timeout
+        self._steps = []              # (название, асинхронная функция без аргументов)
+        self._in_flight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+        # Метрики последней остановки
+        self.duration = None
+        self.interrupted = 0
+        self.step_durations = {}
+
+    async def __call__(self, handler, event, data):
+        self._in_flight += 1
+        self._idle.clear()
+        try:
+            return await handler(event, data)
+        finally:
+            self._in_flight -= 1
+            if not self._in_flight:
+                self._idle.set()
+
+    def add_step(self, name: str, callback):
+        """Добавить шаг сброса; шаги выполняются в порядке добавления"""
+        self._steps.append((name, callback))
+
+    async def shutdown(self) -> float:
+        """Дождаться обработчиков, выполнить шаги сброса, вернуть время остановки"""
+        started = time.monotonic()
+        # Задачи апдейтов, созданные перед остановкой, доходят до middleware за один шаг цикла
+        await asyncio.sleep(0)
+
+        if self._in_flight:
+            logger.info(f"Ожидаю завершения {self._in_flight} обработчиков (до {self.timeout} сек)...")
+            try:
+                await asyncio.wait_for(self._idle.wait(), self.timeout)
+            except asyncio.TimeoutError:
+                self.interrupted = self._in_flight
+                logger.warning(f"Не дождались {self.interrupted} обработчиков, они будут прерваны")
+        self.step_durations['handlers'] = time.monotonic() - started
+
+        deadline = time.monotonic() + self.flush_timeout
+        for name, callback in self._steps:
+            step_started = time.monotonic()
+            try:
+                await asyncio.wait_for(callback(), max(deadline - step_started, 0.1))
+            except asyncio.TimeoutError:
+                logger.warning(f"Остановка: шаг '{name}' не завершился вовремя")
+            except Exception as e:
+                logger.warning(f"Остановка: ошибка на шаге '{name}': {e}")
+            self.step_durations[name] = time.monotonic() - step_started
+
+        self.duration = time.monotonic() - started
+        logger.info(
+            f"Остановка заняла {self.duration:.2f} сек (обработчики {self.step_durations['handlers']:.2f} сек, "
+            f"прервано {self.interrupted})",
+            extra={'shutdown_seconds': round(self.duration, 3), 'interrupted_handlers': self.interrupted,
+                   'shutdown_steps': {name: round(value, 3) for name, value in self.step_durations.items()}}
+        )
+        return self.duration
+
+    def stats(self) -> dict:
+        return {
+            'in_flight': self._in_flight,
+            'duration': self.duration,
+            'interrupted': self.interrupted,
+            'steps': dict(self.step_durations)
+        }
+
+
+shutdown_coordinator = ShutdownCoordinator()
@@ -0,0 +1,122 @@
+"""
+Хранилище состояний FSM в SQLite, общее для нескольких процессов
+"""
+
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+
+from middlewares import ExpiringMap
+
+logger = logging.getLogger(__name__)
+
+FSM_DATABASE_PATH = "fsm_storage.db"
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище в отдельном файле SQLite (WAL) с кэшем в памяти процесса
+
+    Запись идет сразу в базу, чтение - из кэша. Кэш корректен, пока состояние
+    пользователя меняет только один процесс: при шардировании все обновления
+    пользователя попадают в один и тот же воркер.
+    """
+
+    def __init__(self, path: str = FSM_DATABASE_PATH, cache_ttl: float = 600):
+        self.path = path
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._cache = ExpiringMap(cache_ttl)  # key -> [state, data]
+        self._lock = threading.Lock()
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS fsm_storage ("
+            "key TEXT PRIMARY KEY, state TEXT, data TEXT NOT NULL DEFAULT '{}')"
+        )
+
+    # ------------------------------------------------------------------
+    # Синхронные операции (выполняются в пуле потоков)
+    # ------------------------------------------------------------------
+
+    def _load(self, key: str):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT state, data FROM fsm_storage WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return [None, {}]
+        return [row[0], json.loads(row[1])]
+
+    def _save_state(self, key: str, state: Optional[str]):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO fsm_storage (key, state) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET state = excluded.state",
+                (key, state)
+            )
+
+    def _save_data(self, key: str, data: str):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO fsm_storage (key, data) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET data = excluded.data",
+                (key, data)
+            )
+
+    # ------------------------------------------------------------------
+    # Интерфейс BaseStorage
+    # ------------------------------------------------------------------
+
+    async def _get_record(self, key: str) -> list:
+        now = time.monotonic()
+        record = self._cache.get(key, now)
+        if record is None:
+            loop = asyncio.get_event_loop()
+            record = await loop.run_in_executor(None, self._load, key)
+        self._cache.set(key, record, now)
+        self._cache.purge(now)
+        return record
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state = state.state if isinstance(state, State) else state
+        str_key = self.key_builder.build(key)
+        record = await self._get_record(str_key)
+        record[0] = state
+
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._save_state, str_key, state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = await self._get_record(self.key_builder.build(key))
+        return record[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        str_key = self.key_builder.build(key)
+        record = await self._get_record(str_key)
+        record[1] = data.copy()
+
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._save_data, str_key, json.dumps(data, ensure_ascii=False))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        record = await self._get_record(self.key_builder.build(key))
+        return record[1].copy()
+
+    async def close(self) -> None:
+        with self._lock:
+            try:
+                # Переносим WAL в основной файл, чтобы следующий запуск не начинал с его разбора
+                self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            except sqlite3.Error as e:
+                logger.warning(f"Не удалось выполнить контрольную точку WAL хранилища FSM: {e}")
+            self._conn.close()
+        self._cache.clear()
@@ -0,0 +1,202 @@
+"""
+Декларативный опрос: описание вопросов из JSON компилируется при запуске
+в состояния FSM, готовые клавиатуры и таблицы поиска для общих обработчиков
+"""
+
+import json
+import logging
+import os
+from typing import Dict, List, Optional
+
+from aiogram.filters import Filter
+from aiogram.fsm.state import State
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+logger = logging.getLogger(__name__)
+
+SURVEYS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+QUESTION_TYPES = ('number', 'single', 'multi')
+CALLBACK_DATA_LIMIT = 64  # Лимит Telegram на callback_data в байтах
+
+MAX_SELECTED_ALERT = "Можно выбрать максимум {max} варианта"
+MIN_SELECTED_ALERT = "Выберите хотя бы один вариант"
+
+# ============================================================================
+# ВОПРОСЫ И ВАРИАНТЫ ОТВЕТОВ
+# ============================================================================
+
+class SurveyOption:
+    """Вариант ответа с заранее собранными кнопками"""
+
+    __slots__ = ('code', 'text', 'value', 'exclusive', 'callback_data', 'button', 'checked_button')
+
+    def __init__(self, prefix: str, spec: dict):
+        self.code = spec['code']
+        self.text = spec['text']
+        self.value = spec.get('value', self.text)        # Что сохраняется в данных опроса
+        self.exclusive = spec.get('exclusive', False)    # Снимает все остальные отметки
+        self.callback_data = f"{prefix}_{self.code}"
+        self.button = InlineKeyboardButton(text=self.text, callback_data=self.callback_data)
+        self.checked_button = self.button
+
+
+class SurveyQuestion:
+    """Скомпилированный вопрос опроса
+
+    number - ответ вводится текстом и проверяется по диапазону,
+    single - одна кнопка, multi - отметки с кнопкой "Готово".
+    """
+
+    def __init__(self, number: int, spec: dict, state: State):
+        self.number = number
+        self.key = spec['key']
+        self.kind = spec['type']
+        self.state = state
+        self.text = f"<b>❓ Вопрос {number}</b>\n{spec['text']}"
+        self.prefix = spec.get('prefix', self.key)
+        self.selected_key = f"{self.key}_selected"  # Промежуточные отметки в данных FSM
+        self.next = None
+
+        # Текстовый ответ
+        self.min_value = spec.get('min')
+        self.max_value = spec.get('max')
+        self.range_error = spec.get('range_error', "Пожалуйста, введите корректное значение.")
+        self.format_error = spec.get('format_error', "Пожалуйста, введите число.")
+
+        # Мультивыбор
+        self.min_selected = spec.get('min_selected', 0)
+        self.max_selected = spec.get('max_selected')
+        self.done_callback = f"{self.prefix}_done" if self.kind == 'multi' else None
+
+        self.options = [SurveyOption(self.prefix, option) for option in spec.get('options', [])]
+        self.by_callback = {option.callback_data: option for option in self.options}
+        self.exclusive_values = {option.value for option in self.options if option.exclusive}
+
+        self._keyboard = None
+        self._done_buttons = {}
+        if self.kind == 'single':
+            self._keyboard = InlineKeyboardMarkup(inline_keyboard=[[option.button] for option in self.options])
+        elif self.kind == 'multi':
+            for option in self.options:
+                option.button = InlineKeyboardButton(text="☐ " + option.text, callback_data=option.callback_data)
+                option.checked_button = InlineKeyboardButton(text="✅ " + option.text, callback_data=option.callback_data)
+            done_text = spec.get('done_text', "Готово")
+            for count in range(len(self.options) + 1):
+                text = done_text.format(count=count, max=self.max_selected)
+                self._done_buttons[count] = InlineKeyboardButton(text=text, callback_data=self.done_callback)
+
+    def keyboard(self, selected: List[str] = ()) -> Optional[InlineKeyboardMarkup]:
+        """Клавиатура вопроса; для мультивыбора - с отметками выбранных значений"""
+        if self.kind != 'multi':
+            return self._keyboard
+
+        rows = [[option.checked_button if option.value in selected else option.button]
+                for option in self.options]
+        rows.append([self._done_buttons[min(len(selected), len(self.options))]])
+        return InlineKeyboardMarkup(inline_keyboard=rows)
+
+    def parse(self, text: str):
+        """Разобрать текстовый ответ: (значение, None) или (None, текст ошибки)"""
+        try:
+            value = int((text or "").strip())
+        except ValueError:
+            return None, self.format_error
+
+        if (self.min_value is not None and value < self.min_value) or \
+           (self.max_value is not None and value > self.max_value):
+            return None, self.range_error
+        return value, None
+
+    def toggle(self, selected: List[str], option: SurveyOption):
+        """Отметить или снять вариант: (новый список, None) или (None, текст предупреждения)"""
+        if option.value in selected:
+            return [value for value in selected if value != option.value], None
+
+        if option.exclusive:
+            return [option.value], None
+
+        selected = [value for value in selected if value not in self.exclusive_values]
+        if self.max_selected and len(selected) >= self.max_selected:
+            return None, MAX_SELECTED_ALERT.format(max=self.max_selected)
+        return selected + [option.value], None
+
+# ============================================================================
+# ОПРОС
+# ============================================================================
+
+class Survey:
+    """Опрос, собранный из описания
+
+    Вопрос находится по строке состояния FSM за O(1), поэтому на все вопросы
+    достаточно двух обработчиков: для текстовых ответов и для кнопок.
+    """
+
+    def __init__(self, spec: dict):
+        self.name = spec['name']
+        state_group = spec.get('state_group', self.name)
+        state_prefix = spec.get('state_prefix', "")
+
+        self.questions: List[SurveyQuestion] = []
+        for number, question_spec in enumerate(spec['questions'], start=1):
+            state = State(state_prefix + question_spec.get('state', question_spec['key']), group_name=state_group)
+            self.questions.append(SurveyQuestion(number, question_spec, state))
+
+        for question, next_question in zip(self.questions, self.questions[1:]):
+            question.next = next_question
+
+        self.by_state: Dict[str, SurveyQuestion] = {question.state.state: question for question in self.questions}
+        self.callback_data = [data for question in self.questions
+                              for data in [*question.by_callback, question.done_callback] if data]
+        self._validate()
+
+    def _validate(self):
+        keys, states = set(), set()
+        for question in self.questions:
+            if question.kind not in QUESTION_TYPES:
+                raise ValueError(f"Опрос {self.name}: неизвестный тип вопроса {question.kind} ({question.key})")
+            if question.kind != 'number' and not question.options:
+                raise ValueError(f"Опрос {self.name}: у вопроса {question.key} нет вариантов ответа")
+            if question.key in keys or question.state.state in states:
+                raise ValueError(f"Опрос {self.name}: вопрос {question.key} описан дважды")
+            keys.add(question.key)
+            states.add(question.state.state)
+
+        if len(set(self.callback_data)) != len(self.callback_data):
+            raise ValueError(f"Опрос {self.name}: callback_data вариантов повторяются")
+        for data in self.callback_data:
+            if len(data.encode()) > CALLBACK_DATA_LIMIT:
+                raise ValueError(f"Опрос {self.name}: слишком длинная callback_data {data}")
+
+    @property
+    def first(self) -> SurveyQuestion:
+        return self.questions[0]
+
+    def question_filter(self, *kinds: str) -> "SurveyQuestionFilter":
+        """Фильтр по состоянию FSM, передающий обработчику текущий вопрос"""
+        return SurveyQuestionFilter({state: question for state, question in self.by_state.items()
+                                     if question.kind in kinds})
+
+
+class SurveyQuestionFilter(Filter):
+    """Пропускает апдейты в состояниях вопросов опроса, передает survey_question"""
+
+    def __init__(self, questions: Dict[str, SurveyQuestion]):
+        self.questions = questions
+
+    async def __call__(self, event, raw_state: Optional[str] = None):
+        question = self.questions.get(raw_state)
+        if question is None:
+            return False
+        return {'survey_question': question}
+
+
+def load_survey(filename: str) -> Survey:
+    """Загрузить и скомпилировать опрос из JSON-файла рядом с модулем"""
+    path = filename if os.path.isabs(filename) else os.path.join(SURVEYS_DIR, filename)
+    with open(path, encoding='utf-8') as f:
+        spec = json.load(f)
+
+    survey = Survey(spec)
+    logger.info(f"Опрос {survey.name} загружен: {len(survey.questions)} вопросов")
+    return survey
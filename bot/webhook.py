@@ -0,0 +1,189 @@
+"""
+Режим webhook: встроенный aiohttp-сервер вместо long polling
+"""
+
+import asyncio
+import logging
+import os
+import secrets
+import signal
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+logger = logging.getLogger(__name__)
+
+# ============================================================================
+# НАСТРОЙКИ
+# ============================================================================
+
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")      # Публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")          # Если не задан, генерируется при запуске
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))  # Параллельных соединений от Telegram
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", "100"))         # Одновременно обрабатываемых обновлений
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "25"))    # Ожидание обработки при остановке (сек)
+
+# ============================================================================
+# ОБРАБОТЧИК ЗАПРОСОВ TELEGRAM
+# ============================================================================
+
+class DrainingRequestHandler(SimpleRequestHandler):
+    """Обработчик webhook с ограничением параллелизма и корректной остановкой
+
+    Telegram получает ответ сразу, обновление обрабатывается в фоне, но не более
+    concurrency обновлений одновременно. Место занимается до создания фоновой
+    задачи: если все заняты, запрос получает 503 и Telegram повторит доставку
+    позже, так что при всплеске очередь задач не растет без предела. При
+    остановке новые запросы тоже получают 503, а начатые дорабатываются.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, secret_token: str,
+                 concurrency: int = WEBHOOK_CONCURRENCY, **data):
+        super().__init__(dispatcher=dispatcher, bot=bot, handle_in_background=True,
+                         secret_token=secret_token, **data)
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._accepting = True
+
+        # Метрики
+        self.received_total = 0
+        self.rejected_total = 0
+        self.saturated_total = 0
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not self._accepting:
+            self.rejected_total += 1
+            return web.Response(status=503, text="Shutting down")
+        self.received_total += 1
+        return await super().handle(request)
+
+    __call__ = handle
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        update = await request.json(loads=bot.session.json_loads)
+        if self._semaphore.locked():
+            self.saturated_total += 1
+            return web.Response(status=503, text="Too many updates in progress")
+
+        # Свободное место есть, поэтому acquire() возвращается без ожидания
+        await self._semaphore.acquire()
+        task = asyncio.create_task(self._background_feed_update(bot=bot, update=update))
+        self._background_feed_update_tasks.add(task)
+        task.add_done_callback(self._background_feed_update_tasks.discard)
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    async def _background_feed_update(self, bot: Bot, update: dict) -> None:
+        try:
+            await super()._background_feed_update(bot, update)
+        except Exception as e:
+            logger.error(f"Ошибка обработки обновления {update.get('update_id')}: {e}")
+        finally:
+            self._semaphore.release()
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._background_feed_update_tasks)
+
+    async def drain(self, timeout: float = WEBHOOK_DRAIN_TIMEOUT) -> int:
+        """Перестать принимать обновления и дождаться начатых, возвращает число прерванных"""
+        self._accepting = False
+
+        tasks = set(self._background_feed_update_tasks)
+        if not tasks:
+            return 0
+
+        logger.info(f"Ожидаю завершения {len(tasks)} обновлений (до {timeout} сек)...")
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+            logger.warning(f"Прервано {len(pending)} необработанных обновлений")
+        return len(pending)
+
+    async def close(self) -> None:
+        # Сессией бота владеет main(): здесь только дожидаемся фоновых задач
+        await self.drain()
+
+# ============================================================================
+# ЗАПУСК СЕРВЕРА
+# ============================================================================
+
+class WebhookServer:
+    """Запущенный aiohttp-сервер webhook"""
+
+    def __init__(self, runner: web.AppRunner, handler: DrainingRequestHandler):
+        self.runner = runner
+        self.handler = handler
+
+    async def stop(self, drain_timeout: float = WEBHOOK_DRAIN_TIMEOUT) -> int:
+        """Остановить прием обновлений, дождаться обработки и закрыть сервер"""
+        interrupted = await self.handler.drain(drain_timeout)
+        await self.runner.cleanup()
+        return interrupted
+
+
+async def start_webhook_server(bot: Bot, dp: Dispatcher, base_url: str,
+                               host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT,
+                               path: str = WEBHOOK_PATH, secret_token: str = None,
+                               concurrency: int = WEBHOOK_CONCURRENCY,
+                               max_connections: int = WEBHOOK_MAX_CONNECTIONS,
+                               handler_cls=DrainingRequestHandler, **handler_kwargs) -> WebhookServer:
+    """Поднять сервер и зарегистрировать webhook в Telegram"""
+
+    # Telegram допускает в секрете только A-Z, a-z, 0-9, _ и -
+    secret_token = secret_token or secrets.token_urlsafe(32)
+
+    app = web.Application()
+    handler = handler_cls(dp, bot, secret_token=secret_token, concurrency=concurrency, **handler_kwargs)
+    handler.register(app, path=path)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host=host, port=port).start()
+
+    # Обновления, накопленные пока бот был остановлен, не отбрасываются
+    await bot.set_webhook(
+        url=base_url.rstrip("/") + path,
+        secret_token=secret_token,
+        max_connections=max_connections,
+        allowed_updates=dp.resolve_used_update_types(),
+        drop_pending_updates=False
+    )
+    logger.info(f"Webhook запущен на {host}:{port}{path}, параллельных обработчиков: {concurrency}")
+    return WebhookServer(runner, handler)
+
+
+def create_stop_event() -> asyncio.Event:
+    """Событие, которое устанавливается по SIGINT/SIGTERM"""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows: остановка по KeyboardInterrupt
+            pass
+    return stop_event
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher):
+    """Работа в режиме webhook до сигнала остановки"""
+
+    if not WEBHOOK_BASE_URL:
+        raise RuntimeError("Для режима webhook необходимо указать WEBHOOK_BASE_URL")
+
+    stop_event = create_stop_event()
+    server = await start_webhook_server(bot, dp, WEBHOOK_BASE_URL, secret_token=WEBHOOK_SECRET or None)
+    try:
+        await stop_event.wait()
+        logger.info("Получен сигнал остановки, завершаю прием обновлений...")
+    finally:
+        interrupted = await server.stop()
+        logger.info(f"Webhook остановлен: принято {server.handler.received_total} обновлений, "
+                   f"отклонено при перегрузке {server.handler.saturated_total}, "
+                   f"отклонено при остановке {server.handler.rejected_total}, прервано {interrupted}")